@@ -0,0 +1,67 @@
+"""
+App: daq-recorder.py
+Description: app for recording the data stream of daqopen-zmq-server to a file
+
+Author: Michael Oberhofer
+Created on: 2026-10-18
+
+License: MIT
+
+Notes: Replay the recorded file with daq-replay.py
+
+Version: 0.1
+Github: https://github.com/DaqOpen/pqopen-device/apps
+"""
+
+import time
+import zmq
+import logging
+import argparse
+import os
+import sys
+
+from daqopen.helper import GracefulKiller
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from modules.daqrecord import DaqRecorder
+from modules.daqshm import create_daq_subscriber
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Configure Argparser
+parser = argparse.ArgumentParser(description="Record DAQ ZMQ stream to file")
+parser.add_argument("-o", "--output", type=str, required=True, help="Path of the record file")
+parser.add_argument("--host", type=str, default="127.0.0.1", help="Host of daqopen-zmq-server")
+parser.add_argument("--port", type=int, default=50001, help="Port of daqopen-zmq-server")
+parser.add_argument("--shm", type=str, default="", help="Ring buffer file of the shm transport (instead of tcp)")
+parser.add_argument("-d", "--duration", type=float, default=0, help="Recording duration in seconds (0: until stopped)")
+args = parser.parse_args()
+
+# Initialize App Killer
+app_terminator = GracefulKiller()
+
+daq_sub = create_daq_subscriber(args.host, args.port, args.shm, init_daqinfo=False)
+daq_sub.sock.setsockopt(zmq.RCVTIMEO, 5000)
+recorder = DaqRecorder(args.output)
+start_time = time.time()
+last_packet_number = None
+logger.info(f"Recording to {args.output:s}")
+
+while not app_terminator.kill_now:
+    try:
+        m_data = daq_sub.recv_data(update_daqinfo=True)
+    except zmq.Again:
+        logger.error("Timeout of ZMQ socket ocurred - stopping")
+        break
+    if last_packet_number is not None and last_packet_number + 1 != daq_sub.packet_num:
+        logger.warning(f"DAQ packet gap detected {last_packet_number:d}+1 != {daq_sub.packet_num:d}")
+    last_packet_number = daq_sub.packet_num
+    recorder.write_packet(m_data, daq_sub.packet_num, daq_sub.timestamp, daq_sub.daq_info.to_dict(), daq_sub.data_columns, daq_sub.sync_status)
+    if args.duration and time.time() > start_time + args.duration:
+        break
+
+recorder.close()
+daq_sub.terminate()
+logger.info(f"Recorded {recorder.packet_count:d} packets")
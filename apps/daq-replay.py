@@ -0,0 +1,53 @@
+"""
+App: daq-replay.py
+Description: app for replaying a file recorded with daq-recorder.py via zmq
+
+Author: Michael Oberhofer
+Created on: 2026-10-18
+
+License: MIT
+
+Notes: Uses the same protocol as daqopen-zmq-server, pqopen-app can connect without changes.
+       With --speed 0 the packets are sent as fast as the subscriber consumes them,
+       the reported speed is then the real-time headroom of the subscriber.
+
+Version: 0.1
+Github: https://github.com/DaqOpen/pqopen-device/apps
+"""
+
+import logging
+import argparse
+import os
+import sys
+
+from daqopen.helper import GracefulKiller
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from modules.daqrecord import DaqRecordReader, DaqReplayPublisher
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Configure Argparser
+parser = argparse.ArgumentParser(description="Replay recorded DAQ stream")
+parser.add_argument("-i", "--input", type=str, required=True, help="Path of the record file")
+parser.add_argument("--bind", type=str, default="127.0.0.1", help="Bind address")
+parser.add_argument("--port", type=int, default=50001, help="TCP port to serve data")
+parser.add_argument("-s", "--speed", type=float, default=1.0, help="Replay speed (1.0: real time; 0: as fast as possible)")
+args = parser.parse_args()
+
+# Initialize App Killer
+app_terminator = GracefulKiller()
+
+reader = DaqRecordReader(args.input)
+replay_pub = DaqReplayPublisher(host=args.bind, port=args.port)
+logger.info("Waiting for subscriber")
+while not app_terminator.kill_now:
+    if replay_pub.wait_for_subscriber(timeout=1.0):
+        break
+
+if not app_terminator.kill_now:
+    replay_pub.replay(reader, speed=args.speed, stop_callback=lambda: app_terminator.kill_now)
+
+replay_pub.terminate()
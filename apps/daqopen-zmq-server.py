@@ -20,7 +20,6 @@ import logging
 import argparse
 import os
 import sys
-import numpy as np
 
 os.environ["OPENBLAS_NUM_THREADS"] = "1"
 
@@ -32,7 +31,11 @@ from daqopen.daqzmq import DaqPublisher
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from modules.timesync import is_time_synchronized
+from modules.timesync import TimeQualityMonitor
+from modules.tsestimator import PacketTimestampEstimator, ClockOffsetSmoother
+from modules.daqshm import ShmDaqPublisher
+from modules.decimation import DecimatedStreamWorker
+from modules.daqblock import BlockCoalescer
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -52,12 +55,15 @@ with open(args.config, "rb") as f:
     daq_config = tomllib.load(f)
 daq_info = DaqInfo.from_dict(daq_config)
 
-# Check time sync
+# Monitor time sync (kernel clock discipline, read in background)
+max_est_error = daq_config["app"].get("time_max_est_error", 0.1)
+time_monitor = TimeQualityMonitor(max_est_error=max_est_error)
 check_time_sync = daq_config["app"].get("check_timesync", False)
 if check_time_sync:
-    if not is_time_synchronized():
-        logger.error("System time is not synchronized")
+    if not time_monitor.time_quality_ok:
+        logger.error(f"System time is not synchronized: {time_monitor.clock_status.to_dict() if time_monitor.clock_status else None}")
         sys.exit(-1)
+time_monitor.start()
 
 # Init terminator
 terminator = GracefulKiller()
@@ -70,22 +76,36 @@ myDaq = DueDaq(channels=daq_info.ai_pin_name.values(),
                serial_port_name=daq_config["app"]["zmq_server"]["daq_port"])
 daq_info.board.samplerate = myDaq.samplerate * daq_info.board.adc_clock_gain
 
-# Initialize the daqzmq publisher
-daq_pub = DaqPublisher(daq_info=daq_info,
-                       data_columns=myDaq.data_columns,
-                       host=daq_config["app"]["zmq_server"]["bind_addr"], 
-                       port=daq_config["app"]["zmq_server"]["tcp_port"])
-
-# Local Time Sync
+# Initialize the publishers (tcp: daqzmq, shm: shared memory ring for local subscribers)
+transports = daq_config["app"]["zmq_server"].get("transports", ["tcp"])
+daq_pubs = []
+if "tcp" in transports:
+    daq_pubs.append(DaqPublisher(daq_info=daq_info,
+                                 data_columns=myDaq.data_columns,
+                                 host=daq_config["app"]["zmq_server"]["bind_addr"], 
+                                 port=daq_config["app"]["zmq_server"]["tcp_port"]))
+if "shm" in transports:
+    daq_pubs.append(ShmDaqPublisher(daq_info=daq_info,
+                                    data_columns=myDaq.data_columns,
+                                    shm_path=daq_config["app"]["zmq_server"].get("shm_path", "/dev/shm/daqopen"),
+                                    num_slots=daq_config["app"]["zmq_server"].get("shm_num_slots", 64)))
+
+# Initialize the decimated streams for remote viewers (optional)
+decimation_worker = DecimatedStreamWorker.from_config(daq_config, daq_info, myDaq.data_columns)
+if decimation_worker:
+    decimation_worker.start()
+
+# Local Time Sync (estimation on the monotonic clock, offset to the system clock added with limited slew rate)
 last_log_timestamp = 0.0
-ts_agg_window = 51
-ts_array = np.zeros(ts_agg_window)
-diff_agg_window = 1000
-diff_array = np.zeros(diff_agg_window)
+ts_estimator = PacketTimestampEstimator(ts_window=51, 
+                                        diff_window=1000, 
+                                        method=daq_config["app"].get("ts_estimator", "window_mean"))
+clock_smoother = ClockOffsetSmoother(max_slew_rate=daq_config["app"].get("ts_max_slew_ppm", 0.0)*1e-6)
 daq_ts_seconds = 0.0
 
 # Prepare for acquisition
 sent_packet_num = 0
+block_coalescer = BlockCoalescer(int(daq_config["app"]["zmq_server"].get("block_sec", 0.0)*daq_info.board.samplerate))
 
 # Start acquisition
 myDaq.start_acquisition()
@@ -102,28 +122,33 @@ while not terminator.kill_now:
 
     # Generate Timestamp
     actual_timestamp = time.time()
-    ts_array = np.roll(ts_array, -1)
-    ts_array[-1] = actual_timestamp
-    diff_array = np.roll(diff_array, -1)
-    diff_array[-1] = ts_array[-1] - ts_array[-2]
+    mono_timestamp = time.monotonic()
 
     if myDaq._num_frames_read > 10:
-        packet_ts_diff_mean = diff_array[-sent_packet_num-1:].mean()
-        packet_ts_diff_med = np.median(diff_array[-sent_packet_num-1:])
-        packet_ts_diff_min = diff_array[-sent_packet_num-1:].min()
-        packet_ts_diff_max = diff_array[-sent_packet_num-1:].max()
-        ts_mean = ts_array[-sent_packet_num-1:].mean()
-        daq_ts_seconds = ts_mean + packet_ts_diff_mean*(0.5*min(sent_packet_num+1, ts_agg_window) - 0.5)
-        if (packet_ts_diff_min < packet_ts_diff_med/2) or (packet_ts_diff_max > packet_ts_diff_med*2):
-            logger.warning(f"High packet jitter: packet_ts_diff_min={packet_ts_diff_min:f}, packet_ts_diff_max={packet_ts_diff_max:f}, packet_ts_diff_med={packet_ts_diff_med:f}")
-        # Send data with ZMQ
-        daq_pub.send_data(data, sent_packet_num, daq_ts_seconds - daq_info.board.adc_delay_seconds, True)
-        sent_packet_num += 1
+        daq_ts_seconds = ts_estimator.update(mono_timestamp) + clock_smoother.update(actual_timestamp - mono_timestamp, mono_timestamp)
+        # Time quality flag of the packets (sync_status)
+        time_quality_ok = time_monitor.time_quality_ok and abs(clock_smoother.pending) <= max_est_error
+        if ts_estimator.jitter_exceeded:
+            logger.warning(f"High packet jitter: packet_ts_diff={ts_estimator.last_diff:f}, packet_ts_diff_med={ts_estimator.diff_median:f}")
+        # Send data with ZMQ (one block of coalesced frames, timestamp of the last frame)
+        block = block_coalescer.add(data)
+        if block is not None:
+            for daq_pub in daq_pubs:
+                daq_pub.send_data(block, sent_packet_num, daq_ts_seconds - daq_info.board.adc_delay_seconds, time_quality_ok)
+            if decimation_worker:
+                decimation_worker.put(block, daq_ts_seconds - daq_info.board.adc_delay_seconds, time_quality_ok)
+            sent_packet_num += 1
+    else:
+        ts_estimator.prime(mono_timestamp)
 
     # Log Status
     if actual_timestamp > last_log_timestamp + 60:
-        logger.info(f"Packet Number: {sent_packet_num:d}, samplerate: {data.shape[0]/diff_array[-sent_packet_num-1:].mean():f}")
+        logger.info(f"Packet Number: {sent_packet_num:d}, samplerate: {data.shape[0]/ts_estimator.diff_mean if ts_estimator.diff_mean else 0.0:f}")
         last_log_timestamp = actual_timestamp
 
 myDaq.stop_acquisition()
-daq_pub.terminate()
+for daq_pub in daq_pubs:
+    daq_pub.terminate()
+if decimation_worker:
+    decimation_worker.stop()
+time_monitor.stop()
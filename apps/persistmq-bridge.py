@@ -33,6 +33,10 @@ import importlib.metadata
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 from modules.statuscomm import StatusSender
+from modules.mqttbatch import MessageBatcher
+from modules.mqttpriority import PriorityGate
+from modules.tieredcache import TieredSender
+from modules.localhandoff import HandoffServer
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -66,10 +70,35 @@ def on_connect(client, userdata, flags, reason_code, properties):
     for topic in config["source"]["topics"]:
         client.subscribe(topic, qos=0)
     
+# Forward a local message to remote (batched if enabled); block: wait while the batcher is full
+forwarded_messages = 0
+def forward_message(topic: str, payload: bytes, block: bool = False):
+    global forwarded_messages
+    forwarded_messages += 1
+    priority = 1
+    if priority_gate:
+        lane = priority_gate.admit(topic)
+        if lane is None:
+            return # Downsampled or dropped due to backlog
+        priority = lane.priority
+    if message_batcher:
+        message_batcher.put(topic, payload, priority, block=block)
+    else:
+        sender_publish(topic, payload, priority)
+
 # Callback function for reading the local message and publishing to remote
 def handle_message(client, userdata, msg):
-    logger.debug("New Message")
-    write_client.publish(msg.topic, msg.payload)
+    forward_message(msg.topic, msg.payload)
+
+# Callback function for messages handed over directly by pqopen-app (backpressure by blocking)
+def handle_handoff_message(topic: str, payload: bytes):
+    forward_message(topic, payload, block=True)
+
+# Records held back by the bridge, the handoff waits above [handoff] max_backlog
+def sender_backlog() -> int:
+    if tiered_sender:
+        return tiered_sender.cache.num_records
+    return write_client.get_status()["cached_items"]
 
 app_terminator = GracefulKiller()
 
@@ -89,6 +118,32 @@ if config["destination"].get("use_tls", False):
 write_client.connect_async(mqtt_host=config["destination"]["mqtt_host"],
                             mqtt_port=config["destination"]["mqtt_port"])
 
+# Priority lanes with rate limits depending on the cache backlog (optional)
+priority_gate = PriorityGate.from_config(config)
+
+# RAM/disk tiered cache in front of the persistent sender (optional), cached records are sent by priority
+tiered_sender = TieredSender.from_config(config, write_client.publish, write_client.get_status)
+def sender_publish(topic: str, payload: bytes, priority: int):
+    if tiered_sender:
+        tiered_sender.publish(topic, payload, priority)
+    else:
+        write_client.publish(topic, payload)
+
+# Batching of the local messages (optional)
+message_batcher = MessageBatcher.from_config(config, sender_publish)
+if message_batcher:
+    message_batcher.start()
+
+# Direct handoff from pqopen-app via Unix socket (optional)
+handoff_config = config.get("handoff", {})
+handoff_server = None
+if handoff_config.get("enabled", False):
+    handoff_server = HandoffServer(handoff_config.get("socket_path", "/run/pqopen/handoff.sock"), handle_handoff_message,
+                                   max_queued=handoff_config.get("max_queued", 1000),
+                                   get_backlog=sender_backlog,
+                                   max_backlog=handoff_config.get("max_backlog", 10000))
+    handoff_server.start()
+
 # Configure Source/Reading MQTT Client
 read_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, 
                             client_id=generate_unique_client_id("persistmq-bridge", 4), 
@@ -100,16 +155,37 @@ read_client.connect_async(config["source"].get("mqtt_host", "localhost"),
 read_client.loop_start()
 
 # Loop
+forwarded_count = 0
 while not app_terminator.kill_now:
-    time.sleep(1)
+    loop_start = time.monotonic()
+    if tiered_sender:
+        tiered_sender.update(timeout=1.0)
+    time.sleep(max(loop_start + 1 - time.monotonic(), 0))
     persist_client_state = write_client.get_status()
-    if persist_client_state["connected"] is None or persist_client_state["cached_items"] > 10:
-        status_sender.update("IDLE")
+    cache_tier = tiered_sender.cache.tier if tiered_sender else None
+    cache_depth = persist_client_state["cached_items"] + (tiered_sender.cache.num_records if tiered_sender else 0)
+    if priority_gate:
+        priority_gate.update_backlog(cache_depth)
+    if cache_tier == "disk":
+        status = "CACHING" # Long outage, records are written to disk segments
+    elif persist_client_state["connected"] is None or persist_client_state["cached_items"] > 10 or cache_tier == "ram":
+        status = "IDLE"
     elif persist_client_state["connected"]:
-        status_sender.update("RUNNING")
+        status = "RUNNING"
+    else:
+        status = None # Disconnected
+    status_sender.update(status, packets=forwarded_messages - forwarded_count,
+                         loop_lag=time.monotonic() - loop_start - 1, cache_depth=cache_depth)
+    forwarded_count = forwarded_messages
 
 read_client.loop_stop()
 read_client.disconnect()
+if handoff_server:
+    handoff_server.stop()
+if message_batcher:
+    message_batcher.stop()
+if tiered_sender:
+    tiered_sender.close()
 
 write_client.stop()
 
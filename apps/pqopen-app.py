@@ -11,15 +11,20 @@ from pathlib import Path
 os.environ["OPENBLAS_NUM_THREADS"] = "1"
 
 from daqopen.channelbuffer import AcqBufferPool
-from daqopen.daqzmq import DaqSubscriber
 from daqopen.helper import GracefulKiller
-from pqopen.powersystem import PowerSystem
-from pqopen.storagecontroller import StorageController
-from pqopen.eventdetector import EventController, EventDetectorLevelLow, EventDetectorLevelHigh
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 from modules.statuscomm import StatusSender
+from modules.daqshm import create_daq_subscriber
+from modules.inputtransform import InputTransform
+from modules.pqprocessing import create_power_system, create_storage_controller, create_event_controller, create_metrics_reporter, create_overload_guard
+from modules.pqprocessing import gap_recovery_enabled, create_gap_handler, create_power_system_checkpoint, create_storage_checkpoint, create_waveform_capture
+from modules.pqpipeline import PqPipeline
+from modules.feederpipeline import FeederPipeline
+from modules.stagetimer import StageTimer
+from modules.overloadguard import PacketAgeBacklog
+from modules.gaprecovery import GapLog, PacketGapFiller
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -54,101 +59,176 @@ app_terminator = GracefulKiller()
 # Generate measurement id
 measurement_id = str(uuid.uuid4())
 
+# Multiple DAQ sources: each feeder is processed in its own worker process
+if "feeder" in config:
+    feeder_pipeline = FeederPipeline(config, measurement_id, device_id)
+    print("Daq Connected")
+    feeder_pipeline.start()
+    logger.info(f"Feeder pipeline started ({', '.join(config['feeder'].keys())})")
+    while not app_terminator.kill_now and feeder_pipeline.is_alive():
+        status_sender.update("RUNNING")
+        time.sleep(1.0)
+    feeder_pipeline.stop()
+    print("Application Stopped")
+    status_sender.update("STOPPED")
+    sys.exit(0)
+
 # Subscribe to DaqOpen Zmq Server
-daq_sub = DaqSubscriber(config["zmq_server"]["host"], config["zmq_server"]["port"])
+daq_sub = create_daq_subscriber(config["zmq_server"]["host"], config["zmq_server"]["port"], config["zmq_server"].get("shm_path", ""))
 daq_sub.sock.setsockopt(zmq.RCVTIMEO, 5000) # set Socket Timeout to 5000ms
 print("Daq Connected")
 
-# Create DAQ Buffer Object
+# Block size published by the server (block_sec in daqinfo.toml)
+block_size = daq_sub.recv_data().shape[0]
+
+# Pipeline configuration (optional multiprocess mode)
+pipeline_config = config.get("pipeline", {})
+multiprocess = pipeline_config.get("multiprocess", False)
+max_lead_samples = int(pipeline_config.get("max_lead_sec", 2.0)*daq_sub.daq_info.board.samplerate) if multiprocess else 0
+
+# Create DAQ Buffer Object (multiple of the block size)
+buffer_size = max(200_000, 10*block_size) + max_lead_samples
+buffer_size += -buffer_size % block_size
 daq_buffer = AcqBufferPool(daq_info=daq_sub.daq_info, 
                            data_columns=daq_sub.data_columns,
                            start_timestamp_us=int(daq_sub.timestamp*1e6),
-                           size=200_000)
-input_wiring = config["powersystem"].get("input_wiring", "3P4W")    
-
-
-# Create Powersystem Object
-power_system = PowerSystem(zcd_channel = daq_buffer.channel[config["powersystem"]["zcd_channel"]],
-                           input_samplerate = daq_sub.daq_info.board.samplerate,
-                           zcd_threshold = 1)
-
-# Add Phases
-for phase_name, phase in config["powersystem"]["phase"].items():
-    power_system.add_phase(u_channel=daq_buffer.channel[phase["u_channel"]],
-                           i_channel=daq_buffer.channel[phase["i_channel"]])
-power_system.enable_harmonic_calculation()
-power_system.enable_nper_abs_time_sync(daq_buffer.time, interval_sec=10)
-power_system.enable_fluctuation_calculation(nominal_voltage=config["powersystem"].get("nominal_voltage", 230.0))
-power_system.enable_mains_signaling_calculation(frequency=config["powersystem"].get("msv_frequency", 383.3))
-power_system.enable_under_over_deviation_calculation(u_din=config["powersystem"].get("nominal_voltage", 230.0))
-power_system.enable_energy_channels(Path(config["powersystem"].get("energy_file_path", "/tmp/energy.json")))
-if config["powersystem"].get("enable_one_period_fundamental", False):
-    power_system.enable_one_period_fundamental()
-if config["powersystem"].get("enable_rms_trapz_rule", False):
-    power_system.enable_rms_trapz_rule()
-if config["powersystem"].get("enable_mains_signaling_tracer", False):
-    power_system.enable_mains_signaling_tracer()
-#power_system.enable_pmu_calculation()
-power_system._update_calc_channels()
-
-# Initialize Storage Controller
-storage_controller = StorageController(time_channel=daq_buffer.time, sample_rate=daq_sub.daq_info.board.samplerate)
-storage_controller.setup_endpoints_and_storageplans(endpoints=config["endpoint"],
-                                                    storage_plans=config["storageplan"],
-                                                    available_channels=power_system.output_channels,
-                                                    measurement_id=measurement_id,
-                                                    device_id=device_id,
-                                                    start_timestamp_us=int(daq_sub.timestamp*1e6),
-                                                    m_config=config,
-                                                    daq_info=daq_sub.daq_info,
-                                                    channel_info=power_system.get_channel_info())
-
-# Initialize Event Controller
-event_controller = EventController(time_channel=daq_buffer.time, sample_rate=daq_sub.daq_info.board.samplerate)
-if "eventdetector" in config:
-    for ch_name in [f"U{idx+1:d}_1p_hp_rms" for idx in range(len(power_system._phases))]:
-        level_low_voltage = config["eventdetector"].get("level_low_voltage", 208.0)
-        level_high_voltage = config["eventdetector"].get("level_high_voltage", 253.0)
-        threshold_voltage = config["eventdetector"].get("hysteresis_voltage", 2.0)
-        event_controller.add_event_detector(EventDetectorLevelLow(level_low_voltage, threshold_voltage, power_system.output_channels[ch_name]))
-        event_controller.add_event_detector(EventDetectorLevelHigh(level_high_voltage, threshold_voltage, power_system.output_channels[ch_name]))
-    
+                           size=buffer_size)
+
+# Create Input Transform (e.g. 3P3W wiring, Aron connection, CT polarity)
+input_transform = InputTransform.from_config(config["powersystem"], daq_sub.daq_info, daq_sub.data_columns)
+
+# Gap recovery: fill short DAQ packet gaps in place instead of restarting
+max_gap_sec = config.get("gap_recovery", {}).get("max_gap_sec", 0.0)
+if max_gap_sec > 0.25*buffer_size/daq_sub.daq_info.board.samplerate:
+    max_gap_sec = 0.25*buffer_size/daq_sub.daq_info.board.samplerate
+    logger.warning(f"Gap recovery: max_gap_sec limited to {max_gap_sec:.1f} s by buffer size")
+gap_filler = PacketGapFiller(samplerate=daq_sub.daq_info.board.samplerate,
+                             nominal_frequency=config["powersystem"].get("nominal_frequency", 50.0),
+                             max_gap_sec=max_gap_sec)
+
+if multiprocess:
+    # PowerSystem, Storage and Event Controller run in separate processes
+    pipeline = PqPipeline(config=config,
+                          daq_buffer=daq_buffer,
+                          daq_info=daq_sub.daq_info,
+                          measurement_id=measurement_id,
+                          device_id=device_id,
+                          start_timestamp_us=int(daq_sub.timestamp*1e6),
+                          max_lead_samples=max_lead_samples)
+    pipeline.start()
+    stage_timer = pipeline.timers["acquisition"]
+    gap_log = pipeline.gap_log
+    logger.info("Multiprocess pipeline started")
+else:
+    # Create Powersystem Object
+    power_system = create_power_system(config, daq_buffer, daq_sub.daq_info.board.samplerate)
+
+    # Initialize Storage Controller
+    storage_controller = create_storage_controller(config, daq_buffer, power_system, daq_sub.daq_info,
+                                                   measurement_id, device_id, int(daq_sub.timestamp*1e6))
+
+    # Initialize Event Controller
+    event_controller = create_event_controller(config, daq_buffer, power_system, daq_sub.daq_info.board.samplerate)
+
+    # Initialize Waveform Capture (raw samples around events, written in background)
+    waveform_capture = create_waveform_capture(config, daq_buffer, buffer_size, daq_sub.daq_info.board.samplerate, storage_controller, measurement_id)
+
+    # Initialize Checkpoints (restores the state of a recent run)
+    ps_checkpoint = create_power_system_checkpoint(config, daq_buffer, power_system, daq_sub.daq_info.board.samplerate,
+                                                   int(daq_sub.timestamp*1e6))
+    storage_checkpoint = create_storage_checkpoint(config, daq_buffer, storage_controller, daq_sub.daq_info.board.samplerate,
+                                                   int(daq_sub.timestamp*1e6))
+
+    # Initialize Gap Handler (flags filled gaps in the output data)
+    gap_log = GapLog()
+    gap_handler = create_gap_handler(config, daq_buffer, power_system, gap_log)
+
+    # Initialize Stage Timing and Metrics
+    stage_timer = StageTimer(["recv", "transform", "put_data", "power_system", "events", "storage", "store_events"], idle_stages=["recv"])
+    metrics_reporter = create_metrics_reporter(config, {"app": stage_timer}, storage_controller)
+
+    # Initialize Overload Guard (sheds optional calculations while falling behind)
+    overload_guard = create_overload_guard(config, daq_buffer, power_system)
+    packet_age_backlog = PacketAgeBacklog()
+
+# Write data to the AcqBufferPool (shared with the processing stages in multiprocess mode)
+def put_data_with_timestamp(data, timestamp_us: int) -> bool:
+    if multiprocess:
+        return pipeline.put_data_with_timestamp(data, timestamp_us, lambda: app_terminator.kill_now)
+    daq_buffer.put_data_with_timestamp(data, timestamp_us)
+    return True
+
 # Initialize Acq variables
 print_values_timestamp = time.time()
-last_packet_number = None
 
 # Application Loop
+stage_timer.start()
 while not app_terminator.kill_now:
     try:
         m_data = daq_sub.recv_data()
     except zmq.Again:
         logger.error("Timeout of ZMQ socket ocurred - stopping")
         break
-    if last_packet_number is None:
-        last_packet_number = daq_sub.packet_num
-    elif last_packet_number + 1 != daq_sub.packet_num:
-        logger.error(f"DAQ packet gap detected {last_packet_number:d}+1 != {daq_sub.packet_num:d} - stopping")
+    stage_timer.mark("recv")
+    missing_packets = gap_filler.check_packet(daq_sub.packet_num)
+    if missing_packets:
+        gap_samples = missing_packets*m_data.shape[0]
+        if missing_packets < 0 or not gap_recovery_enabled(config) or not gap_filler.can_fill(gap_samples):
+            logger.error(f"DAQ packet gap detected ({missing_packets:d} packets missing before {daq_sub.packet_num:d}) - stopping")
+            break
+        logger.warning(f"DAQ packet gap detected ({missing_packets:d} packets missing before {daq_sub.packet_num:d}) - filling in place")
+        gap_stop_ts_us = int(daq_sub.timestamp*1e6 - m_data.shape[0]*1e6/daq_sub.daq_info.board.samplerate)
+        if not gap_filler.fill_gap(gap_log, daq_buffer.time.sample_count, gap_samples, m_data.shape[0], gap_stop_ts_us, put_data_with_timestamp):
+            logger.error("Pipeline process stopped - stopping")
+            break
+        stage_timer.skip()
+    transformed_data = input_transform.apply(m_data)
+    stage_timer.mark("transform")
+    if not put_data_with_timestamp(transformed_data, int(daq_sub.timestamp*1e6)):
+        logger.error("Pipeline process stopped - stopping")
         break
-    else:
-        last_packet_number = daq_sub.packet_num
-    if input_wiring == "3P3W":
-        m_data_conv = m_data.copy()
-        u1_column = daq_sub.data_columns[daq_sub.daq_info.channel["U1"].ai_pin]
-        u2_column = daq_sub.data_columns[daq_sub.daq_info.channel["U2"].ai_pin]
-        u3_column = daq_sub.data_columns[daq_sub.daq_info.channel["U3"].ai_pin]
-        m_data_conv[:,u1_column] = 1/3*(m_data[:,u2_column] - m_data[:,u3_column])
-        m_data_conv[:,u2_column] = 1/3*(-2*m_data[:,u2_column] - m_data[:,u3_column])
-        m_data_conv[:,u3_column] = 1/3*(2*m_data[:,u3_column] + m_data[:,u2_column])
-        daq_buffer.put_data_with_timestamp(m_data_conv, int(daq_sub.timestamp*1e6))
-    else:
-        daq_buffer.put_data_with_timestamp(m_data, int(daq_sub.timestamp*1e6))
-    power_system.process()
-    events = event_controller.process()
-    storage_controller.process()
-    storage_controller.process_events(events)
+    gap_filler.update(transformed_data, int(daq_sub.timestamp*1e6))
+    stage_timer.mark("put_data")
+    if not multiprocess:
+        if gap_handler:
+            gap_handler.process()
+        power_system.process()
+        if overload_guard:
+            overload_guard.post_process()
+        stage_timer.mark("power_system")
+        events = event_controller.process()
+        if overload_guard:
+            events += overload_guard.get_events()
+        if gap_handler:
+            events += gap_handler.get_events()
+        if waveform_capture:
+            waveform_capture.process(events)
+        stage_timer.mark("events")
+        storage_controller.process()
+        if ps_checkpoint:
+            ps_checkpoint.process()
+        if storage_checkpoint:
+            storage_checkpoint.process()
+        stage_timer.mark("storage")
+        storage_controller.process_events(events)
+        stage_timer.mark("store_events")
+        if metrics_reporter:
+            metrics_reporter.process()
+    data_seconds = m_data.shape[0]/daq_sub.daq_info.board.samplerate
+    packet_age = time.time() - daq_sub.timestamp
+    stage_timer.finish_cycle(data_seconds, packet_age)
+    if not multiprocess and overload_guard:
+        overload_guard.update(stage_timer.last_rtf, data_seconds, packet_age_backlog.update(packet_age, data_seconds))
 
     # Publish actual state
-    status_sender.update("RUNNING")
+    status_sender.update("RUNNING", packets=1, loop_lag=packet_age)
+    stage_timer.start()
 
+if multiprocess:
+    pipeline.stop()
+else:
+    storage_controller.close()
+    if waveform_capture:
+        waveform_capture.close()
 print("Application Stopped")
 status_sender.update("STOPPED")
\ No newline at end of file
@@ -1,6 +1,8 @@
-import time
+import tomllib
 import sys
 import os
+import argparse
+from pathlib import Path
 
 import logging
 import gpiod
@@ -9,25 +11,59 @@ from gpiod.line import Direction, Value
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
-from modules.statuscomm import StatusReceiver
+from modules.statuscomm import StatusReceiver, TimerWheel
 from daqopen.helper import GracefulKiller
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Configure Argparser
+parser = argparse.ArgumentParser(description="Configure App Paths")
+parser.add_argument(
+        "-c", "--config",
+        type=str,
+        default="/etc/pqopen/statusmonitor-conf.toml",
+        help="Path to statusmonitor-conf.toml Config File (optional)"
+    )
+args = parser.parse_args()
+
+# Read Config (optional)
+config = {}
+if Path(args.config).exists():
+    with open(args.config, "rb") as f:
+        config = tomllib.load(f)
+
+class StatusLed(object):
+    """LED which is set to a steady value or blinks, toggled by the timer wheel"""
+    def __init__(self, gpio_request, line: int, timer_wheel: TimerWheel, blink_interval: float = 0.4):
+        self._gpio_request = gpio_request
+        self._line = line
+        self._timer_wheel = timer_wheel
+        self._blink_interval = blink_interval
+        self._blink_timer = None
+        self._value = Value.ACTIVE
+
+    def set(self, value: Value):
+        self._timer_wheel.cancel(self._blink_timer)
+        self._blink_timer = None
+        self._value = value
+        self._gpio_request.set_value(self._line, value)
+
+    def blink(self):
+        if self._blink_timer is None:
+            self._toggle()
+
+    def _toggle(self):
+        self._value = Value.INACTIVE if self._value == Value.ACTIVE else Value.ACTIVE
+        self._gpio_request.set_value(self._line, self._value)
+        self._blink_timer = self._timer_wheel.schedule(self._blink_interval, self._toggle)
+
 # Initialize App Killer
 app_terminator = GracefulKiller()
 
-# Status Receiver
-status_receiver = StatusReceiver(services=["persistmq-bridge", "pqopen-app"])
-status_receiver._sock.settimeout(0.1)
-last_time = time.time()
-
 #Status LED 1 Init
 LED_GREEN = 27
-led_green_blink_duration = 0.1
 LED_YELLOW = 17
-led_yellow_blink_duration = 0.1
 
 gpio_request = gpiod.request_lines(
     path="/dev/gpiochip0",
@@ -41,44 +77,39 @@ gpio_request = gpiod.request_lines(
         )
     })
 
+def update_leds(service: str, status: str | None):
+    logger.info(f"{service}: {status}")
+    # PQopen Status LED
+    if service == "pqopen-app":
+        if status == "RUNNING":
+            led_green.set(Value.ACTIVE)
+        else:
+            led_green.blink()
+    # Persistmq-Status-LED
+    elif service == "persistmq-bridge":
+        if status == "RUNNING":
+            led_yellow.set(Value.INACTIVE)
+        elif status in ["IDLE", "CACHING"]:
+            led_yellow.blink()
+        else:
+            led_yellow.set(Value.ACTIVE) # OFF
+
+# Status Receiver (registry of all services readable via Unix socket)
+status_receiver = StatusReceiver(services=["persistmq-bridge", "pqopen-app"],
+                                 inactive_timeout=config.get("inactive_timeout", 5),
+                                 registry_path=config.get("registry_socket", "/run/pqopen/status.sock"),
+                                 on_change=update_leds)
+led_green = StatusLed(gpio_request, LED_GREEN, status_receiver.timer_wheel)
+led_yellow = StatusLed(gpio_request, LED_YELLOW, status_receiver.timer_wheel)
+for service, service_status in status_receiver.status_reg.items():
+    update_leds(service, service_status["status"])
+
 while not app_terminator.kill_now:
-    ret = status_receiver.recv_message()
+    status_receiver.poll(timeout=1.0)
     logger.debug(str(status_receiver.status_reg))
-    time_diff = time.time() - last_time
-    last_time = time.time()
-    
-    # PQopen Status LED
-    if status_receiver.status_reg["pqopen-app"]["status"] == "RUNNING":
-        gpio_request.set_value(LED_GREEN, Value.ACTIVE)
-    else:
-        if led_green_blink_duration > 0.5:
-            gpio_request.set_value(LED_GREEN, Value.INACTIVE)
-            led_green_blink_duration = -0.1
-        elif led_green_blink_duration < -0.5:
-            gpio_request.set_value(LED_GREEN, Value.ACTIVE)
-            led_green_blink_duration = 0.1
-        elif led_green_blink_duration > 0:
-            led_green_blink_duration += time_diff
-        elif led_green_blink_duration < 0:
-            led_green_blink_duration -= time_diff
 
-    # Persistmq-Status-LED
-    if status_receiver.status_reg["persistmq-bridge"]["status"] == "RUNNING":
-        gpio_request.set_value(LED_YELLOW, Value.INACTIVE)
-    elif status_receiver.status_reg["persistmq-bridge"]["status"] == "IDLE":
-        if led_yellow_blink_duration > 0.5:
-            gpio_request.set_value(LED_YELLOW, Value.INACTIVE)
-            led_yellow_blink_duration = -0.1
-        elif led_yellow_blink_duration < -0.5:
-            gpio_request.set_value(LED_YELLOW, Value.ACTIVE)
-            led_yellow_blink_duration = 0.1
-        elif led_yellow_blink_duration > 0:
-            led_yellow_blink_duration += time_diff
-        elif led_yellow_blink_duration < 0:
-            led_yellow_blink_duration -= time_diff
-    else:
-        gpio_request.set_value(LED_YELLOW, Value.ACTIVE) # OFF
+status_receiver.close()
 
 # Last will: Set LEDS to ON
-gpio_request.set_value(LED_GREEN, Value.ACTIVE)
-gpio_request.set_value(LED_YELLOW, Value.ACTIVE)
\ No newline at end of file
+led_green.set(Value.ACTIVE)
+led_yellow.set(Value.ACTIVE)
@@ -0,0 +1,119 @@
+"""
+Benchmark: bridge-benchmark.py
+Description: throughput and end-to-end latency of persistmq-bridge
+
+Drives apps/persistmq-bridge.py with a local and a remote MQTT broker stand-in.
+A producer publishes timestamped messages to the local broker, the bridge forwards
+them to the remote broker, where bulk messages are decoded and the latency of each
+message is measured. The result is printed as JSON.
+
+License: MIT
+
+Github: https://github.com/DaqOpen/pqopen-device/benchmark
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from pathlib import Path
+
+from paho.mqtt import client as mqtt
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from modules.mqttbatch import decode_bulk
+from mqttbroker import MqttBrokerStandIn
+
+BULK_TOPIC_REWRITE = "mixed/cbor"
+
+parser = argparse.ArgumentParser(description="Benchmark persistmq-bridge")
+parser.add_argument("-n", "--num-messages", type=int, default=5000, help="Number of messages to send")
+parser.add_argument("-r", "--rate", type=float, default=1000.0, help="Message rate of the producer in 1/s (0: as fast as possible)")
+parser.add_argument("-s", "--payload-size", type=int, default=200, help="Payload size in bytes")
+parser.add_argument("--no-batching", action="store_true", help="Disable the batching stage of the bridge")
+parser.add_argument("--timeout", type=float, default=120.0, help="Max. time to wait for the messages in seconds")
+args = parser.parse_args()
+
+class LatencyRecorder(object):
+    def __init__(self):
+        self.latencies = {}
+        self.last_receive_ts = None
+        self.all_received = threading.Event()
+
+    def on_publish(self, topic: str, payload: bytes):
+        now = time.time()
+        for _, msg_payload in decode_bulk(topic, payload, BULK_TOPIC_REWRITE):
+            message = json.loads(msg_payload)
+            self.latencies[message["seq"]] = now - message["ts"]
+        self.last_receive_ts = now
+        if len(self.latencies) >= args.num_messages:
+            self.all_received.set()
+
+recorder = LatencyRecorder()
+local_broker = MqttBrokerStandIn()
+remote_broker = MqttBrokerStandIn(on_publish=recorder.on_publish)
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    config_path = Path(tmp_dir, "persistmq-conf.toml")
+    config_path.write_text(f"""
+[source]
+mqtt_host = "127.0.0.1"
+mqtt_port = {local_broker.port:d}
+topics = ["dt/#"]
+
+[destination]
+mqtt_host = "127.0.0.1"
+mqtt_port = {remote_broker.port:d}
+client_id = "bridge-benchmark"
+
+[cache]
+path = "{Path(tmp_dir, 'cache').as_posix()}"
+
+[bulk_messages]
+bulk_msg_count = 100
+bulk_topic_rewrite = "{BULK_TOPIC_REWRITE}"
+
+[batching]
+enabled = {'false' if args.no_batching else 'true'}
+""")
+    bridge = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(SCRIPT_DIR), "apps", "persistmq-bridge.py"), "-c", str(config_path)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    producer = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="bridge-benchmark-producer")
+    producer.connect("127.0.0.1", local_broker.port)
+    producer.loop_start()
+    # Wait for the subscription of the bridge
+    time.sleep(3.0)
+
+    topics = [f"dt/pqopen/benchmark/{name}" for name in ["dataseries", "agg_10s", "agg_600s", "event"]]
+    padding = "x"*max(args.payload_size - 40, 0)
+    start_ts = time.time()
+    for seq in range(args.num_messages):
+        if args.rate:
+            time.sleep(max(start_ts + seq/args.rate - time.time(), 0))
+        payload = json.dumps({"seq": seq, "ts": time.time(), "pad": padding})
+        producer.publish(topics[seq % len(topics)], payload, qos=0)
+    send_duration = time.time() - start_ts
+    recorder.all_received.wait(timeout=args.timeout)
+
+    bridge.terminate()
+    bridge.wait()
+    producer.loop_stop()
+    producer.disconnect()
+local_broker.stop()
+remote_broker.stop()
+
+latencies_ms = np.array(list(recorder.latencies.values()))*1000
+result = {"batching": not args.no_batching,
+          "messages": args.num_messages,
+          "received": len(recorder.latencies),
+          "producer_rate": args.num_messages/send_duration,
+          "messages_per_sec": len(recorder.latencies)/(recorder.last_receive_ts - start_ts) if recorder.last_receive_ts else 0.0,
+          "latency_ms": {name: float(np.percentile(latencies_ms, percentile)) if latencies_ms.size else None
+                         for name, percentile in [("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)]}}
+print(json.dumps(result, indent=2))
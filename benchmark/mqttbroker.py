@@ -0,0 +1,161 @@
+"""
+Minimal MQTT 3.1.1 broker stand-in for benchmarks
+
+Supports CONNECT, PUBLISH (QoS 0-2 acknowledged, delivered with QoS 0), SUBSCRIBE,
+UNSUBSCRIBE, PINGREQ and DISCONNECT. No retained messages, sessions or auth.
+"""
+
+import os
+import sys
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from typing import Callable
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from modules.mqttbatch import topic_matches
+
+logger = logging.getLogger(__name__)
+
+def encode_packet(header: int, body: bytes) -> bytes:
+    length = len(body)
+    encoded_length = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded_length.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes([header]) + bytes(encoded_length) + body
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.subscriptions = []
+        self._buffer = b""
+
+    def _recv_exact(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            data = self.request.recv(65536)
+            if not data:
+                raise ConnectionError
+            self._buffer += data
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _recv_packet(self):
+        header = self._recv_exact(1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self._recv_exact(1)[0]
+            length += (byte & 0x7F)*multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, self._recv_exact(length)
+
+    def send(self, packet: bytes):
+        with self.send_lock:
+            self.request.sendall(packet)
+
+    def handle(self):
+        broker: MqttBrokerStandIn = self.server.broker
+        try:
+            while True:
+                header, body = self._recv_packet()
+                packet_type = header >> 4
+                if packet_type == 1:    # CONNECT
+                    self.send(encode_packet(0x20, b"\x00\x00"))
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    (topic_len,) = struct.unpack_from(">H", body, 0)
+                    topic = body[2:2+topic_len].decode()
+                    offset = 2 + topic_len
+                    if qos:
+                        packet_id = body[offset:offset+2]
+                        offset += 2
+                        self.send(encode_packet(0x40 if qos == 1 else 0x50, packet_id))
+                    broker.deliver(topic, body[offset:])
+                elif packet_type == 6:  # PUBREL
+                    self.send(encode_packet(0x70, body[:2]))
+                elif packet_type == 8:  # SUBSCRIBE
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        (filter_len,) = struct.unpack_from(">H", body, offset)
+                        self.subscriptions.append(body[offset+2:offset+2+filter_len].decode())
+                        offset += 3 + filter_len
+                        granted.append(0)
+                    broker.add_subscriber(self)
+                    self.send(encode_packet(0x90, body[:2] + bytes(granted)))
+                elif packet_type == 10: # UNSUBSCRIBE
+                    self.subscriptions = []
+                    self.send(encode_packet(0xB0, body[:2]))
+                elif packet_type == 12: # PINGREQ
+                    self.send(encode_packet(0xD0, b""))
+                elif packet_type == 14: # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            broker.remove_subscriber(self)
+
+
+class _ThreadingTcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MqttBrokerStandIn(object):
+    """MQTT broker stand-in running in a background thread
+
+    Parameters:
+        port: tcp port (0: choose a free port, see .port)
+        on_publish: optional callback(topic, payload) for every published message
+    """
+    def __init__(self, port: int = 0, on_publish: Callable[[str, bytes], None] = None):
+        self._on_publish = on_publish
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._server = _ThreadingTcpServer(("127.0.0.1", port), _ConnectionHandler)
+        self._server.broker = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def add_subscriber(self, handler: _ConnectionHandler):
+        with self._lock:
+            if handler not in self._subscribers:
+                self._subscribers.append(handler)
+
+    def remove_subscriber(self, handler: _ConnectionHandler):
+        with self._lock:
+            if handler in self._subscribers:
+                self._subscribers.remove(handler)
+
+    def deliver(self, topic: str, payload: bytes):
+        if self._on_publish:
+            self._on_publish(topic, payload)
+        with self._lock:
+            subscribers = [handler for handler in self._subscribers
+                           if any(topic_matches(topic_filter, topic) for topic_filter in handler.subscriptions)]
+        if not subscribers:
+            return
+        topic_bytes = topic.encode()
+        packet = encode_packet(0x30, struct.pack(">H", len(topic_bytes)) + topic_bytes + payload)
+        for handler in subscribers:
+            try:
+                handler.send(packet)
+            except OSError:
+                self.remove_subscriber(handler)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,224 @@
+"""
+Benchmark: pqopen-benchmark.py
+Description: real-time capability of pqopen-app with synthetic load
+
+Runs apps/pqopen-app.py with a synthetic 3-phase signal (harmonics, flicker, dips and
+mains signaling bursts, see synthetic.py) for a matrix of feature toggles, both wiring
+modes (3P4W, 3P3W) and both pipeline modes (single process, multiprocess). For each
+configuration, the real-time factor and the tail latencies are taken from the metrics
+file of the app, the peak RSS from /proc. The result is printed as JSON.
+
+Example: python benchmark/pqopen-benchmark.py --matrix full --duration 30 -o result.json
+
+License: MIT
+
+Github: https://github.com/DaqOpen/pqopen-device/benchmark
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import tempfile
+import subprocess
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from synthetic import SyntheticPowerSignal, SyntheticDaqPublisher
+
+FEATURES = ["one_period_fundamental", "pmu", "msv_tracer", "events", "storage"]
+WIRINGS = ["3P4W", "3P3W"]
+PIPELINES = ["single", "multiprocess"]
+STARTUP_TIMEOUT_SEC = 60.0
+
+parser = argparse.ArgumentParser(description="Benchmark pqopen-app with synthetic load")
+parser.add_argument("--matrix", choices=["quick", "full"], default="quick",
+                    help="quick: no and all features, full: additionally each feature on its own")
+parser.add_argument("--features", nargs="*", choices=FEATURES, default=None, help="Run only this feature set")
+parser.add_argument("--wiring", nargs="+", choices=WIRINGS, default=WIRINGS, help="Wiring modes")
+parser.add_argument("--pipeline", nargs="+", choices=PIPELINES, default=PIPELINES, help="Pipeline modes")
+parser.add_argument("-d", "--duration", type=float, default=20.0, help="Measured duration per configuration in seconds")
+parser.add_argument("-w", "--warmup", type=float, default=5.0, help="Time after the start not measured in seconds")
+parser.add_argument("-s", "--samplerate", type=float, default=50000.0, help="Samplerate of the synthetic signal")
+parser.add_argument("-p", "--packet-size", type=int, default=5000, help="Samples per DAQ packet")
+parser.add_argument("--speed", type=float, default=1.0, help="Pace of the publisher relative to real time (latencies only meaningful at 1)")
+parser.add_argument("-o", "--output", type=str, default="", help="Write the JSON result to this file (default: stdout)")
+args = parser.parse_args()
+
+def feature_sets() -> list:
+    if args.features is not None:
+        return [sorted(args.features)]
+    sets = [[], list(FEATURES)]
+    if args.matrix == "full":
+        sets[1:1] = [[feature] for feature in FEATURES]
+    return sets
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def create_config(tmp_dir: Path, port: int, features: list, wiring: str, pipeline: str) -> str:
+    enabled = lambda feature: "true" if feature in features else "false"
+    config = f"""
+[powersystem]
+nominal_frequency = 50.0
+nominal_voltage = 230.0
+msv_frequency = 383.3
+zcd_channel = "U1"
+energy_file_path = "{(tmp_dir/'energy.json').as_posix()}"
+input_wiring = "{wiring}"
+enable_one_period_fundamental = {enabled('one_period_fundamental')}
+enable_pmu_calculation = {enabled('pmu')}
+enable_mains_signaling_tracer = {enabled('msv_tracer')}
+
+[powersystem.phase.1]
+u_channel = "U1"
+i_channel = "I1"
+
+[powersystem.phase.2]
+u_channel = "U2"
+i_channel = "I2"
+
+[powersystem.phase.3]
+u_channel = "U3"
+i_channel = "I3"
+
+[metrics]
+interval_sec = 1
+file_path = "{(tmp_dir/'metrics.log').as_posix()}"
+
+[pipeline]
+multiprocess = {'true' if pipeline == 'multiprocess' else 'false'}
+
+[zmq_server]
+host = "127.0.0.1"
+port = {port:d}
+"""
+    if "events" in features:
+        config += f"""
+[eventdetector]
+capture_dir = "{(tmp_dir/'waveforms').as_posix()}"
+"""
+    if "storage" in features:
+        config += f"""
+[endpoint.archive]
+data_dir = "{(tmp_dir/'archive').as_posix()}"
+
+[storageplan.archive_10s]
+endpoint = "archive"
+channels = []
+interval_sec = 10
+
+[storageplan.archive_dataseries]
+endpoint = "archive"
+channels = ["Freq", "U1_1p_hp_rms", "U2_1p_hp_rms", "U3_1p_hp_rms"]
+interval_sec = 0
+"""
+    else:
+        config += "\n[endpoint]\n\n[storageplan]\n"
+    return config
+
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    for task_dir in Path(f"/proc/{pid:d}/task").glob("*"):
+        try:
+            children = (task_dir/"children").read_text().split()
+        except OSError:
+            continue
+        for child in children:
+            pids += process_tree(int(child))
+    return pids
+
+def peak_rss_bytes(pid: int) -> int:
+    """Sum of the peak RSS (VmHWM) of the process and its children"""
+    peak_rss = 0
+    for tree_pid in process_tree(pid):
+        try:
+            status = Path(f"/proc/{tree_pid:d}/status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmHWM:"):
+                peak_rss += int(line.split()[1])*1024
+    return peak_rss
+
+def evaluate_metrics(metrics_path: Path, start_ts: float, stop_ts: float) -> dict:
+    if not metrics_path.exists():
+        return {}
+    lines = [json.loads(line) for line in metrics_path.read_text().splitlines() if line]
+    lines = [line for line in lines if start_ts <= line["timestamp"] <= stop_ts]
+    if not lines:
+        return {}
+    timers = sorted({key[:-len("_rtf")] for line in lines for key in line if key.endswith("_rtf")})
+    timer_rtf = {timer: float(np.mean([line[f"{timer}_rtf"] for line in lines if f"{timer}_rtf" in line])) for timer in timers}
+    stages = sorted({key[:-len("_p99_ms")] for line in lines for key in line if key.endswith("_p99_ms")})
+    packet_ages_ms = np.array([line[key]*1e3 for line in lines for key in line if key.endswith("_packet_age_max_s")])
+    return {"rtf": max(timer_rtf.values(), default=None),
+            "rtf_max": max((line[key] for line in lines for key in line if key.endswith("_rtf_max")), default=None),
+            "timer_rtf": timer_rtf,
+            "latency_ms": {"packet_age_p50": float(np.percentile(packet_ages_ms, 50)) if packet_ages_ms.size else None,
+                           "packet_age_p99": float(np.percentile(packet_ages_ms, 99)) if packet_ages_ms.size else None,
+                           "packet_age_max": float(packet_ages_ms.max()) if packet_ages_ms.size else None,
+                           "stage_p99": {stage: max(line[f"{stage}_p99_ms"] for line in lines if f"{stage}_p99_ms" in line)
+                                         for stage in stages}},
+            "intervals": len(lines)}
+
+def run_config(features: list, wiring: str, pipeline: str) -> dict:
+    result = {"name": f"{pipeline}-{wiring}-{'+'.join(features) or 'base'}",
+              "features": features, "wiring": wiring, "pipeline": pipeline}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        port = free_port()
+        config_path = tmp_dir/"pqopen-config.toml"
+        config_path.write_text(create_config(tmp_dir, port, features, wiring, pipeline))
+        signal = SyntheticPowerSignal(samplerate=args.samplerate, wiring=wiring)
+        publisher = SyntheticDaqPublisher(signal, port, packet_size=args.packet_size,
+                                          duration_sec=(STARTUP_TIMEOUT_SEC + args.warmup + args.duration)*max(args.speed, 1.0),
+                                          speed=args.speed)
+        publisher.start()
+        with open(tmp_dir/"pqopen-app.log", "wb") as log_file:
+            app = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(SCRIPT_DIR), "apps", "pqopen-app.py"), "-c", str(config_path)],
+                                   stdout=subprocess.PIPE, stderr=log_file, env={**os.environ, "PYTHONUNBUFFERED": "1"})
+            # Wait for the connection of the app
+            ready_ts = None
+            for line in app.stdout:
+                if b"Daq Connected" in line:
+                    ready_ts = time.time()
+                    break
+            peak_rss = 0
+            stop_ts = (ready_ts or time.time()) + args.warmup + args.duration
+            while ready_ts and time.time() < stop_ts and app.poll() is None:
+                peak_rss = max(peak_rss, peak_rss_bytes(app.pid))
+                time.sleep(0.2)
+            result["completed"] = ready_ts is not None and app.poll() is None
+            publisher.stop()
+            try:
+                app.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                app.terminate()
+                app.wait()
+        if not result["completed"]:
+            result["error"] = (tmp_dir/"pqopen-app.log").read_text(errors="replace").splitlines()[-5:]
+        result["peak_rss_mb"] = peak_rss/1024/1024
+        result["publisher_max_delay_ms"] = publisher.max_delay_sec*1e3
+        result.update(evaluate_metrics(tmp_dir/"metrics.log", ready_ts + args.warmup if ready_ts else 0, stop_ts))
+    result["realtime"] = bool(result.get("completed") and result.get("rtf") is not None and result["rtf"] < 1.0)
+    return result
+
+results = []
+for features, wiring, pipeline in itertools.product(feature_sets(), args.wiring, args.pipeline):
+    results.append(run_config(features, wiring, pipeline))
+    print(f"{results[-1]['name']}: rtf={results[-1].get('rtf')}", file=sys.stderr)
+
+output = json.dumps({"samplerate": args.samplerate, "packet_size": args.packet_size, "speed": args.speed,
+                     "duration_sec": args.duration, "results": results}, indent=2)
+if args.output:
+    Path(args.output).write_text(output)
+else:
+    print(output)
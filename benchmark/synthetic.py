@@ -0,0 +1,171 @@
+"""
+Synthetic 3-phase power system signals for benchmarks
+
+SyntheticPowerSignal generates voltages and currents with harmonics, flicker modulation,
+periodic dips and mains signaling bursts. SyntheticDaqPublisher publishes them like the
+daqopen-zmq-server (DaqPublisher), paced in real time or faster.
+"""
+
+import time
+import logging
+import threading
+import numpy as np
+from typing import Dict, List
+
+from daqopen.daqinfo import DaqInfo
+from daqopen.daqzmq import DaqPublisher
+
+logger = logging.getLogger(__name__)
+
+CHANNELS = ["U1", "U2", "U3", "I1", "I2", "I3"]
+PHASE_ANGLES = np.array([0.0, -2*np.pi/3, 2*np.pi/3])
+
+def create_daq_info(samplerate: float) -> tuple:
+    """Return DaqInfo and data columns of the synthetic channels (raw values in physical units)"""
+    daq_info = DaqInfo.from_dict({"board": {"type": "duedaq", "samplerate": samplerate},
+                                  "channel": {name: {"ai_pin": f"A{idx:d}", "gain": 1.0, "offset": 0.0,
+                                                     "unit": "V" if name.startswith("U") else "A"}
+                                              for idx, name in enumerate(CHANNELS)}})
+    return daq_info, {f"A{idx:d}": idx for idx in range(len(CHANNELS))}
+
+
+class SyntheticPowerSignal(object):
+    """Generates continuous 3-phase voltages and currents
+
+    Columns are U1, U2, U3, I1, I2, I3. With wiring "3P3W", the voltage inputs carry the
+    line-to-line voltages expected by the input transform preset (U1 unused, U2 = U12, U3 = U31).
+
+    Parameters:
+        samplerate: samplerate in Hz
+        frequency: fundamental frequency in Hz
+        voltage: phase voltage (rms)
+        current: phase current (rms)
+        current_angle: phase shift of the currents in degrees
+        voltage_harmonics: voltage harmonics {order: fraction of the fundamental}
+        current_harmonics: current harmonics {order: fraction of the fundamental}
+        flicker_frequency: frequency of the amplitude modulation in Hz
+        flicker_depth: relative amplitude change of the modulation (delta U/U, 0: none)
+        dip_interval_sec: interval of dips (0: none)
+        dip_duration_sec: duration of a dip
+        dip_residual: residual voltage of a dip (fraction of the voltage)
+        dip_phases: indices of the phases affected by dips
+        msv_interval_sec: interval of mains signaling bursts (0: none)
+        msv_duration_sec: duration of a burst
+        msv_frequency: frequency of the mains signaling voltage in Hz
+        msv_level: amplitude of the burst (fraction of the voltage)
+        noise_level: rms of the added noise (fraction of the voltage/current)
+        wiring: "3P4W" or "3P3W"
+        seed: seed of the noise generator
+    """
+    def __init__(self, samplerate: float = 50000.0, frequency: float = 50.0, voltage: float = 230.0, current: float = 10.0,
+                 current_angle: float = 20.0, voltage_harmonics: Dict[int, float] = {3: 0.01, 5: 0.03, 7: 0.02, 11: 0.01},
+                 current_harmonics: Dict[int, float] = {3: 0.3, 5: 0.15, 7: 0.08, 9: 0.04},
+                 flicker_frequency: float = 8.8, flicker_depth: float = 0.003,
+                 dip_interval_sec: float = 5.0, dip_duration_sec: float = 0.1, dip_residual: float = 0.7, dip_phases: List[int] = [0],
+                 msv_interval_sec: float = 10.0, msv_duration_sec: float = 2.0, msv_frequency: float = 383.3, msv_level: float = 0.02,
+                 noise_level: float = 0.001, wiring: str = "3P4W", seed: int = 0):
+        if wiring not in ("3P4W", "3P3W"):
+            raise ValueError(f"Unknown wiring {wiring}")
+        self.samplerate = samplerate
+        self._frequency = frequency
+        self._voltage_amplitude = voltage*np.sqrt(2)
+        self._current_amplitude = current*np.sqrt(2)
+        self._current_angle = np.deg2rad(current_angle)
+        self._voltage_harmonics = voltage_harmonics
+        self._current_harmonics = current_harmonics
+        self._flicker_frequency = flicker_frequency
+        self._flicker_depth = flicker_depth
+        self._dip_interval_sec = dip_interval_sec
+        self._dip_duration_sec = dip_duration_sec
+        self._dip_residual = dip_residual
+        self._dip_phases = dip_phases
+        self._msv_interval_sec = msv_interval_sec
+        self._msv_duration_sec = msv_duration_sec
+        self._msv_frequency = msv_frequency
+        self._msv_level = msv_level
+        self._noise_level = noise_level
+        self._wiring = wiring
+        self._rng = np.random.default_rng(seed)
+        self.sample_count = 0
+
+    def _burst_active(self, t: np.ndarray, interval_sec: float, duration_sec: float) -> np.ndarray:
+        # First burst after one interval, so the processing can settle
+        return (t >= interval_sec) & (np.mod(t, interval_sec) < duration_sec)
+
+    def generate(self, num_samples: int) -> np.ndarray:
+        """Return the next num_samples samples (shape: num_samples x 6)"""
+        t = (self.sample_count + np.arange(num_samples))/self.samplerate
+        self.sample_count += num_samples
+        angle = 2*np.pi*self._frequency*t[:, None] + PHASE_ANGLES[None, :]
+        voltages = np.sin(angle)
+        for order, fraction in self._voltage_harmonics.items():
+            voltages += fraction*np.sin(order*angle)
+        currents = np.sin(angle - self._current_angle)
+        for order, fraction in self._current_harmonics.items():
+            currents += fraction*np.sin(order*(angle - self._current_angle))
+        envelope = np.ones((num_samples, 3))
+        if self._flicker_depth:
+            envelope *= (1 + self._flicker_depth/2*np.sin(2*np.pi*self._flicker_frequency*t))[:, None]
+        if self._dip_interval_sec:
+            dip_active = self._burst_active(t, self._dip_interval_sec, self._dip_duration_sec)
+            envelope[np.ix_(dip_active, self._dip_phases)] *= self._dip_residual
+        voltages *= envelope*self._voltage_amplitude
+        if self._msv_interval_sec:
+            msv_active = self._burst_active(t, self._msv_interval_sec, self._msv_duration_sec)
+            voltages += (msv_active*self._msv_level*self._voltage_amplitude*np.sin(2*np.pi*self._msv_frequency*t))[:, None]
+        currents *= self._current_amplitude
+        if self._noise_level:
+            voltages += self._rng.normal(0, self._noise_level*self._voltage_amplitude, voltages.shape)
+            currents += self._rng.normal(0, self._noise_level*self._current_amplitude, currents.shape)
+        if self._wiring == "3P3W":
+            voltages = np.column_stack([np.zeros(num_samples), voltages[:, 0] - voltages[:, 1], voltages[:, 2] - voltages[:, 0]])
+        return np.hstack([voltages, currents]).astype(np.float32)
+
+
+class SyntheticDaqPublisher(threading.Thread):
+    """Publishes a SyntheticPowerSignal like the daqopen-zmq-server
+
+    The packets are paced with speed times real time (0: as fast as possible). The packet
+    timestamp is the time of its last sample, starting at the current time, so at speed 1
+    the packet age in the receiver is the processing latency.
+
+    Parameters:
+        signal: the SyntheticPowerSignal
+        port: tcp port of the publisher
+        packet_size: samples per packet
+        duration_sec: duration of the published data
+        speed: pace relative to real time
+    """
+    def __init__(self, signal: SyntheticPowerSignal, port: int, packet_size: int = 5000, duration_sec: float = 30.0, speed: float = 1.0):
+        super().__init__(name="SyntheticDaqPublisher", daemon=True)
+        daq_info, data_columns = create_daq_info(signal.samplerate)
+        self._publisher = DaqPublisher(daq_info, data_columns, host="127.0.0.1", port=port)
+        self._signal = signal
+        self._packet_size = packet_size
+        self._num_packets = int(duration_sec*signal.samplerate/packet_size)
+        self._speed = speed
+        self._stopped = False
+        self.sent_packets = 0
+        self.max_delay_sec = 0.0
+
+    def run(self):
+        start_ts = time.time()
+        packet_duration = self._packet_size/self._signal.samplerate
+        for packet_num in range(self._num_packets):
+            if self._stopped:
+                break
+            data = self._signal.generate(self._packet_size)
+            data_ts = start_ts + (packet_num + 1)*packet_duration
+            if self._speed:
+                send_ts = start_ts + (packet_num + 1)*packet_duration/self._speed
+                delay = time.time() - send_ts
+                if delay < 0:
+                    time.sleep(-delay)
+                self.max_delay_sec = max(self.max_delay_sec, delay)
+            self._publisher.send_data(data, packet_num, data_ts, sync_status=True)
+            self.sent_packets += 1
+        self._publisher.terminate()
+
+    def stop(self):
+        self._stopped = True
+        self.join()
@@ -147,6 +147,8 @@ StandardOutput=journal
 StandardError=journal
 User=$USER
 Group=$USER
+RuntimeDirectory=pqopen
+RuntimeDirectoryPreserve=yes
 
 [Install]
 WantedBy=multi-user.target
@@ -168,6 +170,8 @@ StandardOutput=journal
 StandardError=journal
 User=$USER
 Group=$USER
+RuntimeDirectory=pqopen
+RuntimeDirectoryPreserve=yes
 
 [Install]
 WantedBy=multi-user.target
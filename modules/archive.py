@@ -0,0 +1,321 @@
+"""
+Columnar rolling archive
+
+Layout: <data_dir>/<table>/<segment start in µs>/
+  - meta.json: measurement id, start timestamp and columns (dtype, width, first row)
+  - time.i8: timestamps in µs (int64, sorted)
+  - <column>.bin: values (float32/float64, little endian, width values per row)
+
+The files are append-only. The aggregated data of an interval is one table
+(agg_<interval>s), every data series channel has its own table (dataseries/<channel>).
+With multiple feeders, the tables of a feeder are prefixed with its name (<feeder>/agg_600s).
+Segments are closed after segment_max_bytes or segment_duration_sec; the oldest
+segments are deleted if the archive exceeds max_size_bytes.
+
+The start timestamps in the segment names select the segments of a time range, the
+sorted time column of a segment is searched via memory map (see ArchiveReader).
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from pqopen.eventdetector import Event
+from pqopen.storagecontroller import StorageEndpoint
+
+logger = logging.getLogger(__name__)
+
+TIME_FILE = "time.i8"
+META_FILE = "meta.json"
+
+def _segment_name(start_us: int) -> str:
+    return f"{start_us:020d}"
+
+def _write_meta(segment_path: Path, meta: dict) -> int:
+    tmp_path = segment_path/(META_FILE + ".tmp")
+    size = tmp_path.write_text(json.dumps(meta))
+    os.replace(tmp_path, segment_path/META_FILE)
+    return size
+
+
+class ArchiveTableWriter(object):
+    """Appends rows to the segments of one archive table
+
+    Parameters:
+        path: directory of the table
+        measurement_id: measurement id stored in the segments
+        segment_max_bytes: segment size after which a new segment is started
+        segment_duration_sec: time span after which a new segment is started
+    """
+    def __init__(self, path: Path, measurement_id: str, segment_max_bytes: int, segment_duration_sec: float):
+        self._path = path
+        self._measurement_id = measurement_id
+        self._segment_max_bytes = segment_max_bytes
+        self._segment_duration_us = int(segment_duration_sec*1e6)
+        self.segment_path = None
+        self._meta = {}
+        self._rows = 0
+        self._segment_bytes = 0
+        self._pending_time = []
+        self._pending_columns: Dict[str, list] = {}
+        self._pending_rows = 0
+        self._meta_bytes = 0
+        self._unaccounted_bytes = 0
+
+    def _store_meta(self):
+        meta_bytes = _write_meta(self.segment_path, self._meta)
+        self._unaccounted_bytes += meta_bytes - self._meta_bytes
+        self._meta_bytes = meta_bytes
+
+    def _start_segment(self, start_us: int):
+        # Never append to a segment of a previous run
+        while (self._path/_segment_name(start_us)).exists():
+            start_us += 1
+        self.segment_path = self._path/_segment_name(start_us)
+        self.segment_path.mkdir(parents=True)
+        self._meta = {"measurement_id": self._measurement_id, "start_us": start_us, "columns": {}}
+        self._rows = 0
+        self._segment_bytes = 0
+        self._meta_bytes = 0
+        self._store_meta()
+
+    def append(self, timestamps: np.ndarray, columns: Dict[str, np.ndarray]):
+        """Append rows (timestamps: int64 µs, columns: arrays with one row per timestamp)"""
+        if not timestamps.size:
+            return
+        if (self.segment_path is None or self._segment_bytes >= self._segment_max_bytes or
+                timestamps[0] >= self._meta["start_us"] + self._segment_duration_us):
+            self.flush()
+            self._start_segment(int(timestamps[0]))
+        for name, values in columns.items():
+            column_meta = self._meta["columns"].get(name)
+            width = int(np.prod(values.shape[1:]))
+            if width == 0:
+                continue # Empty list values
+            if column_meta is None:
+                column_meta = {"dtype": values.dtype.newbyteorder("<").str, "width": width, "first_row": self._rows + self._pending_rows}
+                self._meta["columns"][name] = column_meta
+                self._pending_columns[name] = []
+                self._store_meta()
+            elif column_meta["width"] != width:
+                logger.warning(f"Archive {self._path.name:s}: width of {name:s} changed ({column_meta['width']:d} -> {width:d}) - not stored")
+                continue
+            self._pad_column(name, self._pending_rows)
+            self._pending_columns[name].append(values.astype(column_meta["dtype"], copy=False).reshape(-1, width))
+        self._pending_time.append(timestamps.astype("<i8", copy=False))
+        self._pending_rows += timestamps.size
+        for name in self._meta["columns"]:
+            self._pad_column(name, self._pending_rows)
+
+    def _pad_column(self, name: str, num_rows: int):
+        # Fill missing values of a column up to num_rows pending rows with NaN
+        column_meta = self._meta["columns"][name]
+        pending_rows = sum(values.shape[0] for values in self._pending_columns[name])
+        first_pending_row = max(column_meta["first_row"] - self._rows, 0)
+        missing_rows = num_rows - first_pending_row - pending_rows
+        if missing_rows > 0:
+            self._pending_columns[name].append(np.full((missing_rows, column_meta["width"]), np.nan, dtype=column_meta["dtype"]))
+
+    @property
+    def pending_rows(self) -> int:
+        return self._pending_rows
+
+    def flush(self) -> int:
+        """Write the pending rows; returns the number of bytes written (including the meta data)"""
+        written_bytes = self._unaccounted_bytes
+        self._unaccounted_bytes = 0
+        if not self._pending_rows:
+            return written_bytes
+        # Columns first, the time column defines the complete rows
+        for name, pending_values in self._pending_columns.items():
+            if pending_values:
+                data = np.concatenate(pending_values).tobytes()
+                with open(self.segment_path/f"{name:s}.bin", "ab") as f:
+                    f.write(data)
+                written_bytes += len(data)
+            self._pending_columns[name] = []
+        data = np.concatenate(self._pending_time).tobytes()
+        with open(self.segment_path/TIME_FILE, "ab") as f:
+            f.write(data)
+        written_bytes += len(data)
+        self._rows += self._pending_rows
+        self._segment_bytes += written_bytes
+        self._pending_time = []
+        self._pending_rows = 0
+        return written_bytes
+
+
+class ArchiveStorageEndpoint(StorageEndpoint):
+    """Stores aggregated data and data series in the columnar rolling archive
+
+    Rows are buffered and written every flush_interval_sec (few, larger writes on the
+    SD card). Non numeric values are not stored, None is stored as NaN. Values are
+    float32, except for the float64_channels of the storage plan. Events are not stored.
+
+    Parameters:
+        name: name of the endpoint
+        measurement_id: id of the measurement
+        data_dir: directory of the archive
+        max_size_bytes: max. size of the archive, the oldest segments are deleted
+        segment_max_bytes: max. size of a segment
+        segment_duration_sec: max. time span of a segment
+        flush_interval_sec: max. time rows are buffered
+    """
+    def __init__(self, name: str, measurement_id: str, data_dir: str | Path, max_size_bytes: int = 1024*1024*1024,
+                 segment_max_bytes: int = 16*1024*1024, segment_duration_sec: float = 86400.0, flush_interval_sec: float = 10.0):
+        super().__init__(name, measurement_id)
+        self._data_dir = Path(data_dir)
+        self._data_dir.mkdir(parents=True, exist_ok=True)
+        self._max_size_bytes = max_size_bytes
+        self._segment_max_bytes = segment_max_bytes
+        self._segment_duration_sec = segment_duration_sec
+        self._flush_interval_sec = flush_interval_sec
+        self._tables: Dict[str, ArchiveTableWriter] = {}
+        self._last_flush_ts = time.monotonic()
+        self._size_bytes = sum(file.stat().st_size for file in self._data_dir.rglob("*") if file.is_file())
+
+    def _get_table(self, table_name: str) -> ArchiveTableWriter:
+        if table_name not in self._tables:
+            self._tables[table_name] = ArchiveTableWriter(self._data_dir/table_name, self.measurement_id,
+                                                          self._segment_max_bytes, self._segment_duration_sec)
+        return self._tables[table_name]
+
+    @staticmethod
+    def _table_name(table: str, **kwargs) -> str:
+        # Tables of a feeder (see DeviceStorageController) are in its own directory
+        return f"{kwargs['feeder']:s}/{table:s}" if kwargs.get("feeder") else table
+
+    def write_aggregated_data(self, data: dict, timestamp_us: int, interval_seconds: int, **kwargs):
+        float64_channels = kwargs.get("float64_channels", [])
+        columns = {}
+        for channel, value in data.items():
+            if isinstance(value, (list, tuple)):
+                value = [np.nan if item is None else item for item in value]
+            elif value is None:
+                value = np.nan
+            try:
+                columns[channel] = np.array([value], dtype=np.float64 if channel in float64_channels else np.float32)
+            except (TypeError, ValueError):
+                continue # Not numeric
+        self._get_table(self._table_name(f"agg_{interval_seconds:d}s", **kwargs)).append(np.array([timestamp_us], dtype=np.int64), columns)
+        self.process()
+
+    def write_data_series(self, data: dict, **kwargs):
+        float64_channels = kwargs.get("float64_channels", [])
+        for channel, series in data.items():
+            values = np.array(series["data"], dtype=np.float64 if channel in float64_channels else np.float32)
+            self._get_table(self._table_name(f"dataseries/{channel:s}", **kwargs)).append(np.array(series["timestamps"], dtype=np.int64), {channel: values})
+        self.process()
+
+    def write_event(self, event: Event, **kwargs):
+        pass
+
+    def write_metrics(self, metrics: dict, timestamp: float, **kwargs):
+        """Append processing metrics (see modules/stagetimer.py) to the own table metrics"""
+        columns = {name: np.array([value], dtype=np.float64) for name, value in metrics.items()}
+        self._get_table(self._table_name("metrics", **kwargs)).append(np.array([int(timestamp*1e6)], dtype=np.int64), columns)
+        self.process()
+
+    def process(self):
+        """Flush the buffered rows if flush_interval_sec elapsed"""
+        if time.monotonic() >= self._last_flush_ts + self._flush_interval_sec:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows and apply the retention"""
+        self._last_flush_ts = time.monotonic()
+        self._size_bytes += sum(table.flush() for table in self._tables.values())
+        if self._size_bytes > self._max_size_bytes:
+            self._apply_retention()
+
+    def _apply_retention(self):
+        open_segments = [table.segment_path for table in self._tables.values()]
+        segments = sorted((segment_path.parent.name, segment_path.parent) for segment_path in self._data_dir.rglob(META_FILE))
+        for _, segment_path in segments:
+            if self._size_bytes <= self._max_size_bytes:
+                break
+            if segment_path in open_segments:
+                continue
+            segment_bytes = sum(file.stat().st_size for file in segment_path.iterdir())
+            shutil.rmtree(segment_path)
+            self._size_bytes -= segment_bytes
+            logger.info(f"Archive: segment {segment_path.relative_to(self._data_dir)} deleted (retention)")
+
+    def close(self):
+        self.flush()
+
+
+class ArchiveReader(object):
+    """Reads time ranges from the columnar rolling archive
+
+    Only the segments of the requested range are opened, the rows are found by binary
+    search in the memory mapped time column.
+
+    Parameters:
+        data_dir: directory of the archive
+    """
+    def __init__(self, data_dir: str | Path):
+        self._data_dir = Path(data_dir)
+
+    def tables(self) -> List[str]:
+        """Names of the tables, e.g. agg_600s or dataseries/Freq"""
+        return sorted({meta_path.parent.parent.relative_to(self._data_dir).as_posix() for meta_path in self._data_dir.rglob(META_FILE)})
+
+    def _segments(self, table: str) -> List[Path]:
+        table_path = self._data_dir/table
+        return sorted(segment_path for segment_path in table_path.iterdir() if (segment_path/META_FILE).exists()) if table_path.is_dir() else []
+
+    def channels(self, table: str) -> List[str]:
+        channels = set()
+        for segment_path in self._segments(table):
+            channels.update(json.loads((segment_path/META_FILE).read_text())["columns"])
+        return sorted(channels)
+
+    @staticmethod
+    def _map(file_path: Path, dtype: str) -> np.ndarray:
+        if not file_path.exists() or file_path.stat().st_size < np.dtype(dtype).itemsize:
+            return np.zeros(0, dtype=dtype)
+        num_items = file_path.stat().st_size//np.dtype(dtype).itemsize
+        return np.memmap(file_path, dtype=dtype, mode="r", shape=(num_items,))
+
+    def read(self, table: str, channel: str, start_us: int = None, stop_us: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Read the values of a channel with start_us <= timestamp < stop_us
+
+        Returns:
+            timestamps (int64, µs) and values (one row per timestamp, NaN if missing)
+        """
+        start_us = -2**63 if start_us is None else start_us
+        stop_us = 2**63 - 1 if stop_us is None else stop_us
+        segments = self._segments(table)
+        segment_starts = [int(segment_path.name) for segment_path in segments]
+        first_segment = max(int(np.searchsorted(segment_starts, start_us, side="right")) - 1, 0)
+        timestamps = []
+        values = []
+        width = 1
+        for segment_path, segment_start in zip(segments[first_segment:], segment_starts[first_segment:]):
+            if segment_start >= stop_us:
+                break
+            meta = json.loads((segment_path/META_FILE).read_text())
+            column_meta = meta["columns"].get(channel)
+            if column_meta is None:
+                continue
+            width = column_meta["width"]
+            time_data = self._map(segment_path/TIME_FILE, "<i8")
+            column_data = self._map(segment_path/f"{channel:s}.bin", column_meta["dtype"])
+            # Rows of the column (files may be incomplete after a power loss)
+            num_rows = min(time_data.size - column_meta["first_row"], column_data.size//width)
+            if num_rows <= 0:
+                continue
+            time_data = time_data[column_meta["first_row"]:column_meta["first_row"] + num_rows]
+            start_idx, stop_idx = np.searchsorted(time_data, [start_us, stop_us])
+            timestamps.append(np.array(time_data[start_idx:stop_idx]))
+            values.append(np.array(column_data[:num_rows*width].reshape(num_rows, width)[start_idx:stop_idx]))
+        if not timestamps:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        values = np.concatenate(values)
+        return np.concatenate(timestamps), values[:, 0] if width == 1 else values
@@ -0,0 +1,165 @@
+"""
+Compact binary payloads of the MQTT endpoint
+
+The messages have the same structure as the JSON messages, encoded with CBOR:
+
+- numeric arrays are CBOR typed arrays (RFC 8746, little endian)
+- values are rounded to float32, except for the float64 channels (e.g. energy counters)
+- the timestamps of data series are stored as first timestamp and delta of deltas
+  (smallest integer type), channels with equal timestamps refer to the first one
+- the values of data series are XOR encoded with the previous value (Gorilla-style),
+  the leading zero bits compress well
+- optionally compressed with zlib and a preset dictionary (see train_dictionary)
+
+Only numpy and cbor2 are needed, so this module can be used on the receiving side.
+"""
+
+import zlib
+import cbor2
+import numpy as np
+from typing import Dict, List
+
+TYPED_ARRAY_TAGS = {np.dtype("u1"): 64, np.dtype("<u2"): 69, np.dtype("<u4"): 70, np.dtype("<u8"): 71,
+                    np.dtype("i1"): 72, np.dtype("<i2"): 77, np.dtype("<i4"): 78, np.dtype("<i8"): 79,
+                    np.dtype("<f4"): 85, np.dtype("<f8"): 86}
+TYPED_ARRAY_DTYPES = {tag: dtype for dtype, tag in TYPED_ARRAY_TAGS.items()}
+XOR_DTYPES = {np.dtype("<f4"): np.dtype("<u4"), np.dtype("<f8"): np.dtype("<u8")}
+MAX_DICTIONARY_SIZE = 32*1024
+
+def encode_typed_array(values: np.ndarray) -> cbor2.CBORTag:
+    dtype = values.dtype.newbyteorder("<") if values.dtype.itemsize > 1 else values.dtype
+    return cbor2.CBORTag(TYPED_ARRAY_TAGS[dtype], values.astype(dtype, copy=False).tobytes())
+
+def _smallest_int(values: np.ndarray) -> np.ndarray:
+    for dtype in ["i1", "<i2", "<i4"]:
+        info = np.iinfo(dtype)
+        if not values.size or (values.min() >= info.min and values.max() <= info.max):
+            return values.astype(dtype)
+    return values.astype("<i8")
+
+def encode_timestamps(timestamps: np.ndarray) -> dict:
+    """Encode integer timestamps as first timestamp and delta of deltas"""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if not timestamps.size:
+        return {"t0": 0, "dod": encode_typed_array(np.zeros(0, dtype="i1")), "n": 0}
+    delta_of_deltas = np.diff(np.diff(timestamps), prepend=0)
+    return {"t0": int(timestamps[0]), "dod": encode_typed_array(_smallest_int(delta_of_deltas)), "n": int(timestamps.size)}
+
+def decode_timestamps(encoded: dict) -> np.ndarray:
+    timestamps = np.full(encoded["n"], encoded["t0"], dtype=np.int64)
+    timestamps[1:] += np.cumsum(np.cumsum(np.asarray(encoded["dod"], dtype=np.int64)))
+    return timestamps
+
+def encode_xor(values: np.ndarray) -> cbor2.CBORTag:
+    """XOR encode float values with the previous value"""
+    bits = values.view(XOR_DTYPES[values.dtype])
+    return encode_typed_array(bits ^ np.concatenate([bits[:1]*0, bits[:-1]]))
+
+def decode_xor(encoded: np.ndarray) -> np.ndarray:
+    bits = np.bitwise_xor.accumulate(encoded)
+    return bits.view("<f4" if bits.dtype.itemsize == 4 else "<f8")
+
+def encode_data_series(data: dict, measurement_uuid: str, float64_channels: List[str] = []) -> dict:
+    """Encode a data series message (data: channel -> {"data": values, "timestamps": timestamps})"""
+    encoded_data = {}
+    encoded_timestamps = []
+    for channel, series in data.items():
+        timestamps = np.asarray(series["timestamps"], dtype=np.int64)
+        values = np.array(series["data"], dtype=np.float64 if channel in float64_channels else np.float32)
+        ts_ref = next((ref_channel for ref_channel, ref_timestamps in encoded_timestamps if np.array_equal(ref_timestamps, timestamps)), None)
+        if ts_ref is None:
+            encoded_timestamps.append((channel, timestamps))
+            encoded_data[channel] = {"ts": encode_timestamps(timestamps), "xor": encode_xor(values)}
+        else:
+            encoded_data[channel] = {"ts_ref": ts_ref, "xor": encode_xor(values)}
+    return {"type": "timeseries_data", "measurement_uuid": measurement_uuid, "data": encoded_data}
+
+def _encode_agg_value(value, dtype: np.dtype):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return encode_typed_array(np.array([np.nan if item is None else item for item in value], dtype=dtype))
+    if isinstance(value, (float, np.floating)):
+        return float(dtype.type(value))
+    return value
+
+def encode_aggregated_data(data: dict, timestamp_us: int, interval_seconds: int, measurement_uuid: str,
+                           float64_channels: List[str] = []) -> dict:
+    """Encode an aggregated data message (data: channel -> value or list of values)"""
+    encoded_data = {channel: _encode_agg_value(value, np.dtype(np.float64 if channel in float64_channels else np.float32))
+                    for channel, value in data.items()}
+    return {"type": "aggregated_data", "measurement_uuid": measurement_uuid, "interval_sec": interval_seconds,
+            "timestamp": timestamp_us/1e6, "data": encoded_data}
+
+def train_dictionary(samples: List[bytes], size: int = MAX_DICTIONARY_SIZE) -> bytes:
+    """Create a preset dictionary for zlib from sample payloads (uncompressed CBOR)
+
+    zlib uses the dictionary as preceding window, so the most recent samples are kept
+    at the end (strings near the end are matched with shorter distances).
+    """
+    return b"".join(samples)[-min(size, MAX_DICTIONARY_SIZE):]
+
+
+class PayloadCompressor(object):
+    """Compresses payloads with zlib and an optional preset dictionary
+
+    Parameters:
+        dictionary: preset dictionary (see train_dictionary); the id is part of the zlib header
+        level: zlib compression level
+    """
+    def __init__(self, dictionary: bytes | None = None, level: int = 6):
+        self._dictionary = dictionary
+        self._level = level
+
+    def compress(self, payload: bytes) -> bytes:
+        if self._dictionary:
+            compressor = zlib.compressobj(self._level, zdict=self._dictionary)
+        else:
+            compressor = zlib.compressobj(self._level)
+        return compressor.compress(payload) + compressor.flush()
+
+def encode_payload(message: dict, compressor: PayloadCompressor | None = None) -> bytes:
+    payload = cbor2.dumps(message, canonical=True)
+    return compressor.compress(payload) if compressor else payload
+
+def _decode_typed_array(*args):
+    # tag_hook arguments: (decoder, tag) up to cbor2 5, (tag, immutable) since cbor2 6
+    tag = next(arg for arg in args if isinstance(arg, cbor2.CBORTag))
+    if tag.tag in TYPED_ARRAY_DTYPES:
+        return np.frombuffer(tag.value, dtype=TYPED_ARRAY_DTYPES[tag.tag])
+    return tag
+
+def _to_list(values: np.ndarray) -> list:
+    return [None if np.isnan(value) else value for value in values.tolist()] if values.dtype.kind == "f" else values.tolist()
+
+def decode_payload(payload: bytes, dictionaries: List[bytes] = []) -> dict:
+    """Decode a binary payload into the structure of the corresponding JSON message
+
+    The samples of waveform messages are returned as numpy arrays.
+
+    Parameters:
+        payload: CBOR payload, optionally zlib compressed (detected by the zlib header)
+        dictionaries: preset dictionaries used by the senders (selected by their id)
+    """
+    if payload[:1] == b"\x78":
+        decompressor = zlib.decompressobj()
+        if payload[1] & 0x20:
+            dictionary_id = int.from_bytes(payload[2:6], "big")
+            dictionary = next((dictionary for dictionary in dictionaries if zlib.adler32(dictionary) == dictionary_id), None)
+            if dictionary is None:
+                raise ValueError(f"Dictionary {dictionary_id:08x} not available")
+            decompressor = zlib.decompressobj(zdict=dictionary)
+        payload = decompressor.decompress(payload) + decompressor.flush()
+    message = cbor2.loads(payload, tag_hook=_decode_typed_array)
+    if message.get("type") == "timeseries_data":
+        decoded_timestamps: Dict[str, list] = {}
+        for channel, series in message["data"].items():
+            if "ts" in series:
+                decoded_timestamps[channel] = decode_timestamps(series["ts"]).tolist()
+            message["data"][channel] = {"data": decode_xor(series["xor"]).tolist(),
+                                        "timestamps": decoded_timestamps[series.get("ts_ref", channel)]}
+    elif message.get("type") == "waveform":
+        # Waveforms are kept as numpy arrays
+        message["timestamps"] = decode_timestamps(message.pop("ts"))
+    elif message.get("type") == "aggregated_data":
+        message["data"] = {channel: _to_list(value) if isinstance(value, np.ndarray) else value
+                           for channel, value in message["data"].items()}
+    return message
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import numpy as np
+from pathlib import Path
+
+from daqopen.channelbuffer import AcqBuffer, DataChannelBuffer
+from pqopen.powersystem import PowerSystem
+from pqopen.helper import floor_timestamp
+
+from modules.storageendpoints import DeviceStorageController
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+FLUCTUATION_STATE_KEYS = ["stage0_tp_filter_zi", "stage1_tp_filter_zi", "stage3_hp_filter_zi", "stage3_tp_filter_zi",
+                          "stage3_weight_filter_zi", "stage4_tp_filter_zi"]
+
+def config_hash(config: dict, samplerate: float) -> str:
+    """Hash of the config and samplerate a checkpoint is valid for"""
+    config = {key: value for key, value in config.items() if key not in ["checkpoint", "metrics"]}
+    return hashlib.sha256(json.dumps([config, samplerate], sort_keys=True, default=str).encode()).hexdigest()
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Type {type(value)} not serializable")
+
+
+class StateCheckpoint(object):
+    """Periodically writes calculation state to disk and restores it on startup
+
+    The state is written atomically (temporary file and rename) as json, together with the
+    timestamp of the data and the hash of the config. It is only restored if the config
+    is unchanged and the gap between checkpoint and new data is below max_age_sec.
+
+    Parameters:
+        file_path: path of the checkpoint file
+        config_hash: hash of the actual config (see config_hash)
+        interval_sec: interval of the checkpoints in seconds
+        max_age_sec: max. age of a checkpoint to be restored
+    """
+    def __init__(self, file_path: str | Path, config_hash: str, interval_sec: float = 60.0, max_age_sec: float = 600.0):
+        self._file_path = Path(file_path)
+        self._config_hash = config_hash
+        self._interval_sec = interval_sec
+        self._max_age_sec = max_age_sec
+        self._next_checkpoint_ts = time.time() + interval_sec
+
+    def load(self, timestamp_us: int) -> dict | None:
+        """Load the state if valid for data starting at timestamp_us"""
+        if not self._file_path.exists():
+            return None
+        try:
+            checkpoint = json.loads(self._file_path.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Checkpoint {self._file_path} not readable: {e}")
+            return None
+        if checkpoint.get("version") != CHECKPOINT_VERSION or checkpoint.get("config_hash") != self._config_hash:
+            logger.info(f"Checkpoint {self._file_path} does not match the actual config - ignoring")
+            return None
+        age_sec = (timestamp_us - checkpoint["timestamp_us"])/1e6
+        if not 0 <= age_sec <= self._max_age_sec:
+            logger.info(f"Checkpoint {self._file_path} is {age_sec:.1f} s old - ignoring")
+            return None
+        logger.info(f"Restoring checkpoint {self._file_path} ({age_sec:.1f} s old)")
+        return checkpoint["state"]
+
+    def save(self, state: dict, timestamp_us: int):
+        """Write the state atomically"""
+        checkpoint = {"version": CHECKPOINT_VERSION, "config_hash": self._config_hash,
+                      "timestamp_us": int(timestamp_us), "state": state}
+        tmp_path = self._file_path.with_name(self._file_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f, default=_to_json)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._file_path)
+
+    def is_due(self) -> bool:
+        """Check if the next checkpoint is due"""
+        now = time.time()
+        if now < self._next_checkpoint_ts:
+            return False
+        self._next_checkpoint_ts = now + self._interval_sec
+        return True
+
+
+def get_power_system_state(power_system: PowerSystem) -> dict:
+    """Return the state of the PowerSystem which needs long to settle"""
+    state = {"last_known_freq": power_system._last_known_freq, "phases": []}
+    for phase in power_system._phases:
+        phase_state = {}
+        processor = phase._voltage_fluctuation_processor
+        if processor is not None:
+            phase_state["fluctuation"] = {key: getattr(processor, key) for key in FLUCTUATION_STATE_KEYS}
+            phase_state["fluctuation"].update(steady_state=processor.steady_state,
+                                              processed_samples=processor.processed_samples,
+                                              next_reduction_start_idx=processor._next_reduction_start_idx)
+        if hasattr(phase._mains_signaling_tracer, "trigger_active"):
+            phase_state["msv_tracer_trigger_active"] = phase._mains_signaling_tracer.trigger_active
+        state["phases"].append(phase_state)
+    return state
+
+def set_power_system_state(power_system: PowerSystem, state: dict):
+    """Restore the state returned by get_power_system_state (PowerSystem must be set up identically)"""
+    power_system._last_known_freq = state["last_known_freq"]
+    for phase, phase_state in zip(power_system._phases, state["phases"]):
+        processor = phase._voltage_fluctuation_processor
+        if processor is not None and "fluctuation" in phase_state:
+            for key in FLUCTUATION_STATE_KEYS:
+                setattr(processor, key, np.array(phase_state["fluctuation"][key]))
+            processor.steady_state = phase_state["fluctuation"]["steady_state"]
+            processor.processed_samples = phase_state["fluctuation"]["processed_samples"]
+            processor._next_reduction_start_idx = phase_state["fluctuation"]["next_reduction_start_idx"]
+        if "msv_tracer_trigger_active" in phase_state and hasattr(phase._mains_signaling_tracer, "trigger_active"):
+            phase._mains_signaling_tracer.trigger_active = phase_state["msv_tracer_trigger_active"]
+
+
+def _partial_aggregate(channel: DataChannelBuffer, data: np.ndarray):
+    """Aggregate of the data which can be merged with further data (mean square for rms)"""
+    if channel.agg_type == "rms":
+        return np.mean(np.power(data, 2), axis=0)
+    if channel.agg_type == "max":
+        return data.max(axis=0)
+    if channel.agg_type == "phi":
+        return np.mean((data + 180) % 360 - 180, axis=0)
+    return data.mean(axis=0)
+
+def _merge_aggregate(agg_type: str, value: np.ndarray, count: int, partial: np.ndarray, partial_count: int) -> np.ndarray:
+    """Merge the final aggregate value (of count samples) with a partial aggregate"""
+    if count == 0:
+        return np.sqrt(partial) if agg_type == "rms" else partial
+    if agg_type == "rms":
+        return np.sqrt((count*np.power(value, 2) + partial_count*partial)/(count + partial_count))
+    if agg_type == "max":
+        return np.maximum(value, partial)
+    if agg_type == "phi":
+        partial = value + (partial - value + 180) % 360 - 180
+        merged = (count*value + partial_count*partial)/(count + partial_count)
+        return (merged + 180) % 360 - 180
+    return (count*value + partial_count*partial)/(count + partial_count)
+
+
+class _ResumedChannel(object):
+    """Channel of a storage plan, merges the partial aggregate of the last run into its first aggregation"""
+    def __init__(self, channel: DataChannelBuffer, plan_channel: dict, partial: list, partial_count: int):
+        self._channel = channel
+        self._plan_channel = plan_channel
+        self._partial = np.array(partial, dtype=np.float64)
+        self._partial_count = partial_count
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    def read_agg_data_by_acq_sidx(self, start_idx: int, stop_idx: int, include_next: bool = False):
+        # Only the first aggregation is merged
+        self._plan_channel["channel"] = self._channel
+        value, last_sidx = self._channel.read_agg_data_by_acq_sidx(start_idx, stop_idx, include_next=include_next)
+        data, _ = self._channel.read_data_by_acq_sidx(start_idx, stop_idx, include_next=include_next)
+        merged = _merge_aggregate(self._channel.agg_type, np.array(value, dtype=np.float64), len(data),
+                                  self._partial, self._partial_count)
+        if merged.ndim:
+            return merged.tolist(), last_sidx
+        return float(merged), last_sidx
+
+
+def get_storage_state(storage_controller: DeviceStorageController, stop_sidx: int) -> dict:
+    """Return the partial aggregates of the actual interval of all aggregating storage plans
+
+    stop_sidx has to be the processed sample index of the controller (processed_sidx), data
+    beyond it may already belong to the next interval.
+    """
+    state = {}
+    for storage_plan in storage_controller.storage_plans:
+        if storage_plan.interval_seconds <= 0 or storage_plan._storage_counter == 0:
+            continue
+        channels = {}
+        for plan_channel in storage_plan.channels:
+            channel = plan_channel["channel"]
+            if isinstance(channel, _ResumedChannel) or channel.agg_function:
+                continue
+            data, _ = channel.read_data_by_acq_sidx(plan_channel["last_store_sidx"], stop_sidx)
+            if len(data) == 0:
+                continue
+            channels[channel.name] = {"count": len(data), "value": _partial_aggregate(channel, data)}
+        state[storage_plan.storage_name] = {"next_storage_timestamp": storage_plan.next_storage_timestamp,
+                                            "channels": channels}
+    return state
+
+def set_storage_state(storage_controller: DeviceStorageController, state: dict, start_timestamp_us: int):
+    """Restore the partial aggregates returned by get_storage_state
+
+    The partial aggregates are merged into the first aggregation, if it belongs to the
+    same interval as the checkpoint.
+    """
+    for storage_plan in storage_controller.storage_plans:
+        plan_state = state.get(storage_plan.storage_name)
+        if storage_plan.interval_seconds <= 0 or plan_state is None:
+            continue
+        first_storage_timestamp = int(floor_timestamp(timestamp=start_timestamp_us + int(storage_plan.interval_seconds*1e6),
+                                                      interval_seconds=storage_plan.interval_seconds,
+                                                      ts_resolution="us"))
+        if plan_state["next_storage_timestamp"] != first_storage_timestamp:
+            continue
+        num_resumed = 0
+        for plan_channel in storage_plan.channels:
+            channel_state = plan_state["channels"].get(plan_channel["channel"].name)
+            if channel_state is None:
+                continue
+            plan_channel["channel"] = _ResumedChannel(plan_channel["channel"], plan_channel,
+                                                      channel_state["value"], channel_state["count"])
+            num_resumed += 1
+        logger.info(f"Storage Plan {storage_plan.storage_name}: resumed {num_resumed:d} channels")
+
+
+class PowerSystemCheckpoint(object):
+    """Checkpoint of the PowerSystem state
+
+    Parameters:
+        checkpoint: the StateCheckpoint to use
+        power_system: the PowerSystem
+        time_channel: time channel of the AcqBufferPool
+    """
+    def __init__(self, checkpoint: StateCheckpoint, power_system: PowerSystem, time_channel: AcqBuffer):
+        self._checkpoint = checkpoint
+        self._power_system = power_system
+        self._time_channel = time_channel
+
+    def restore(self, start_timestamp_us: int) -> bool:
+        state = self._checkpoint.load(start_timestamp_us)
+        if state is None:
+            return False
+        set_power_system_state(self._power_system, state)
+        return True
+
+    def process(self):
+        """Write a checkpoint if due; call after PowerSystem.process()"""
+        if self._time_channel.sample_count == 0 or not self._checkpoint.is_due():
+            return
+        timestamp_us = self._time_channel.read_data_by_index(self._time_channel.sample_count-1, self._time_channel.sample_count)[0]
+        self._checkpoint.save(get_power_system_state(self._power_system), timestamp_us)
+
+
+class StorageCheckpoint(object):
+    """Checkpoint of the partial aggregates of the storage plans
+
+    Parameters:
+        checkpoint: the StateCheckpoint to use
+        storage_controller: the StorageController
+        time_channel: time channel of the AcqBufferPool
+    """
+    def __init__(self, checkpoint: StateCheckpoint, storage_controller: DeviceStorageController, time_channel: AcqBuffer):
+        self._checkpoint = checkpoint
+        self._storage_controller = storage_controller
+        self._time_channel = time_channel
+
+    def restore(self, start_timestamp_us: int) -> bool:
+        state = self._checkpoint.load(start_timestamp_us)
+        if state is None:
+            return False
+        set_storage_state(self._storage_controller, state, start_timestamp_us)
+        return True
+
+    def process(self):
+        """Write a checkpoint if due; call after StorageController.process()"""
+        stop_sidx = self._storage_controller.processed_sidx
+        if stop_sidx == 0 or not self._checkpoint.is_due():
+            return
+        timestamp_us = self._time_channel.read_data_by_index(stop_sidx-1, stop_sidx)[0]
+        self._checkpoint.save(get_storage_state(self._storage_controller, stop_sidx), timestamp_us)
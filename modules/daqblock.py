@@ -0,0 +1,47 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class BlockCoalescer(object):
+    """Coalesces DAQ frames into larger blocks for publishing
+
+    The frames are copied into one preallocated contiguous block. The block size is
+    rounded to whole frames (at least one frame), it is fixed with the first frame.
+
+    Parameters:
+        block_samples: target number of samples per block (0: one block per frame)
+    """
+    def __init__(self, block_samples: int = 0):
+        self._block_samples = block_samples
+        self._frame_shape = None
+        self._block = None
+        self._num_frames = 0
+        self.frames_per_block = 1
+
+    def _init_block(self, frame: np.ndarray):
+        if self._num_frames:
+            logger.warning(f"BlockCoalescer: frame shape changed to {frame.shape} - dropping partial block")
+        self._frame_shape = frame.shape
+        self.frames_per_block = max(1, int(round(self._block_samples/frame.shape[0])))
+        self._block = np.empty((self.frames_per_block*frame.shape[0], *frame.shape[1:]), dtype=frame.dtype)
+        self._num_frames = 0
+        logger.info(f"BlockCoalescer: {self.frames_per_block:d} frames per block ({self._block.shape[0]:d} samples)")
+
+    def add(self, frame: np.ndarray) -> np.ndarray | None:
+        """Add one frame
+
+        Returns:
+            the complete block (reused buffer, valid until the next call) or None
+        """
+        if frame.shape != self._frame_shape or frame.dtype != self._block.dtype:
+            self._init_block(frame)
+        if self.frames_per_block == 1:
+            return frame
+        start = self._num_frames*frame.shape[0]
+        self._block[start:start + frame.shape[0]] = frame
+        self._num_frames += 1
+        if self._num_frames < self.frames_per_block:
+            return None
+        self._num_frames = 0
+        return self._block
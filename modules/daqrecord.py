@@ -0,0 +1,241 @@
+import mmap
+import json
+import struct
+import time
+import logging
+import numpy as np
+import zmq
+from pathlib import Path
+from typing import Iterator, Tuple
+
+from daqopen.daqinfo import DaqInfo
+
+logger = logging.getLogger(__name__)
+
+# File layout:
+#   The file consists of chunks with fixed size. The first chunk starts with the file header.
+#   Records never cross chunk boundaries; a record type of 0 (zero padding) marks the end of
+#   the used space in a chunk. The last chunk is truncated when the recorder is closed.
+#   META record: payload is json with dtype, shape, daq_info and data_columns. It is written
+#                before the first packet and each time the metadata changes.
+#   DATA record: payload is the raw packet data, interpreted with the last META record.
+FILE_MAGIC = b"DAQREC01"
+FILE_HEADER = struct.Struct("<8sQ")       # magic, chunk_size
+RECORD_HEADER = struct.Struct("<BBHIqd")  # type, sync_status, reserved, payload_len, packet_num, timestamp
+RECORD_META = 1
+RECORD_DATA = 2
+RECORD_ALIGN = 8
+
+class DaqRecorder(object):
+    """Writes DAQ packets to a memory mapped, chunked binary file
+
+    Parameters:
+        file_path: path of the record file (will be overwritten)
+        chunk_size: size of one chunk in bytes, multiple of mmap.ALLOCATIONGRANULARITY
+    """
+    def __init__(self, file_path: str | Path, chunk_size: int = 16*1024*1024):
+        if chunk_size % mmap.ALLOCATIONGRANULARITY:
+            raise ValueError(f"chunk_size must be a multiple of {mmap.ALLOCATIONGRANULARITY:d}")
+        self.file_path = Path(file_path)
+        self._chunk_size = chunk_size
+        self._file = open(self.file_path, "w+b")
+        self._chunk_start = 0
+        self._chunk = None
+        self._pos = 0
+        self._last_meta = None
+        self.packet_count = 0
+        self._map_chunk(0)
+        FILE_HEADER.pack_into(self._chunk, 0, FILE_MAGIC, chunk_size)
+        self._pos = FILE_HEADER.size
+
+    def _map_chunk(self, chunk_start: int):
+        if self._chunk is not None:
+            self._chunk.flush()
+            self._chunk.close()
+        self._file.truncate(chunk_start + self._chunk_size)
+        self._chunk = mmap.mmap(self._file.fileno(), self._chunk_size, offset=chunk_start)
+        self._chunk_start = chunk_start
+        self._pos = 0
+
+    def _write_record(self, rec_type: int, payload, sync_status: bool = False, packet_num: int = 0, timestamp: float = 0.0):
+        payload = memoryview(payload).cast("B")
+        rec_size = RECORD_HEADER.size + payload.nbytes
+        rec_size += -rec_size % RECORD_ALIGN
+        if rec_size > self._chunk_size:
+            raise ValueError(f"Record with {rec_size:d} bytes exceeds chunk size")
+        if self._pos + rec_size > self._chunk_size:
+            self._map_chunk(self._chunk_start + self._chunk_size)
+        RECORD_HEADER.pack_into(self._chunk, self._pos, rec_type, int(sync_status), 0, payload.nbytes, packet_num, timestamp)
+        data_start = self._pos + RECORD_HEADER.size
+        self._chunk[data_start:data_start + payload.nbytes] = payload
+        self._pos += rec_size
+
+    def write_packet(self, data: np.ndarray, packet_num: int, timestamp: float, daq_info: dict, data_columns: dict, sync_status: bool = False):
+        """Write one packet; metadata is only stored again when it has changed
+
+        Parameters:
+            data: raw packet data as received
+            packet_num: packet number of the DAQ stream
+            timestamp: timestamp of the packet in seconds
+            daq_info: DaqInfo as dict
+            data_columns: mapping of ai pins to data columns
+            sync_status: sync status of the packet
+        """
+        meta = dict(dtype=str(data.dtype), shape=data.shape, daq_info=daq_info, data_columns=data_columns)
+        if meta != self._last_meta:
+            self._write_record(RECORD_META, json.dumps(meta).encode())
+            self._last_meta = meta
+        self._write_record(RECORD_DATA, np.ascontiguousarray(data), sync_status, packet_num, timestamp)
+        self.packet_count += 1
+
+    def close(self):
+        """Flush and truncate the file to the used size"""
+        if self._chunk is None:
+            return
+        self._chunk.flush()
+        self._chunk.close()
+        self._chunk = None
+        self._file.truncate(self._chunk_start + self._pos)
+        self._file.close()
+
+
+class DaqRecordReader(object):
+    """Reads packets from a file written by DaqRecorder
+
+    The data arrays returned by read_packets are read-only views into the mapped file.
+    """
+    def __init__(self, file_path: str | Path):
+        self.file_path = Path(file_path)
+        self._file = open(self.file_path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._chunk_size = FILE_HEADER.unpack_from(self._map, 0)
+        if magic != FILE_MAGIC:
+            raise ValueError(f"{self.file_path} is not a DAQ record file")
+
+    def read_packets(self) -> Iterator[Tuple[dict, np.ndarray]]:
+        """Iterate over all packets
+
+        Returns:
+            Tuples of metadata (same keys as sent by DaqPublisher) and data array
+        """
+        file_size = len(self._map)
+        chunk_start = 0
+        pos = FILE_HEADER.size
+        meta = None
+        while True:
+            if pos + RECORD_HEADER.size > self._chunk_size or chunk_start + pos + RECORD_HEADER.size > file_size:
+                chunk_start += self._chunk_size
+                pos = 0
+                if chunk_start + RECORD_HEADER.size > file_size:
+                    return
+            rec_type, sync_status, _, payload_len, packet_num, timestamp = RECORD_HEADER.unpack_from(self._map, chunk_start + pos)
+            if rec_type == 0:
+                # Unused rest of chunk
+                pos = self._chunk_size
+                continue
+            data_start = chunk_start + pos + RECORD_HEADER.size
+            if data_start + payload_len > file_size:
+                logger.warning("Record file ends with incomplete record")
+                return
+            rec_size = RECORD_HEADER.size + payload_len
+            pos += rec_size + (-rec_size % RECORD_ALIGN)
+            if rec_type == RECORD_META:
+                meta = json.loads(self._map[data_start:data_start + payload_len])
+            elif rec_type == RECORD_DATA:
+                data = np.frombuffer(self._map, dtype=meta["dtype"], count=payload_len//np.dtype(meta["dtype"]).itemsize, offset=data_start)
+                packet_meta = dict(timestamp=timestamp,
+                                   dtype=meta["dtype"],
+                                   shape=meta["shape"],
+                                   daq_info=meta["daq_info"],
+                                   data_columns=meta["data_columns"],
+                                   packet_num=packet_num,
+                                   sync_status=bool(sync_status))
+                yield packet_meta, data.reshape(meta["shape"])
+            else:
+                raise ValueError(f"Unknown record type {rec_type:d} at offset {chunk_start + pos:d}")
+
+    def get_daq_info(self) -> Tuple[DaqInfo, dict]:
+        """Return DaqInfo and data columns of the first packet"""
+        for meta, _ in self.read_packets():
+            return DaqInfo.from_dict(meta["daq_info"]), meta["data_columns"]
+        raise ValueError(f"{self.file_path} does not contain any packet")
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class DaqReplayPublisher(object):
+    """Publishes recorded packets with the same protocol as DaqPublisher
+
+    An XPUB socket with XPUB_NODROP is used, so sending blocks instead of dropping packets
+    when the subscriber can not keep up. This allows replaying as fast as the subscriber
+    is able to process the data.
+
+    Parameters:
+        host: bind address
+        port: tcp port
+        sndhwm: send high water mark in packets
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 50001, sndhwm: int = 100):
+        self.zmq_context = zmq.Context()
+        self.sock = self.zmq_context.socket(zmq.XPUB)
+        self.sock.setsockopt(zmq.XPUB_NODROP, 1)
+        self.sock.setsockopt(zmq.SNDHWM, sndhwm)
+        self.sock.bind(f"tcp://{host:s}:{port:d}")
+        self.packet_count = 0
+        self.data_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    def wait_for_subscriber(self, timeout: float | None = None) -> bool:
+        """Wait until a subscriber has connected
+
+        Parameters:
+            timeout: maximum time to wait in seconds (None: infinite)
+
+        Returns:
+            True if a subscriber has connected
+        """
+        if not self.sock.poll(None if timeout is None else int(timeout*1000), zmq.POLLIN):
+            return False
+        self.sock.recv()
+        return True
+
+    def replay(self, reader: DaqRecordReader, speed: float = 1.0, stop_callback = None):
+        """Send all packets of the record file
+
+        Parameters:
+            reader: record file reader
+            speed: replay speed relative to the recorded timestamps (1.0: real time; 0: as fast as possible)
+            stop_callback: optional callable, replay stops when it returns True
+        """
+        first_packet_ts = None
+        start_time = time.monotonic()
+        last_packet_ts = 0.0
+        last_packet_duration = 0.0
+        for meta, data in reader.read_packets():
+            if stop_callback is not None and stop_callback():
+                break
+            if first_packet_ts is None:
+                first_packet_ts = meta["timestamp"]
+            if speed > 0:
+                wait_time = start_time + (meta["timestamp"] - first_packet_ts)/speed - time.monotonic()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+            self.sock.send_json(meta, zmq.SNDMORE)
+            self.sock.send(data, 0, copy=True)
+            if self.packet_count > 0:
+                last_packet_duration = meta["timestamp"] - last_packet_ts
+            last_packet_ts = meta["timestamp"]
+            self.packet_count += 1
+        self.wall_seconds = time.monotonic() - start_time
+        if first_packet_ts is not None:
+            # Duration of data including the last packet
+            self.data_seconds = last_packet_ts - first_packet_ts + last_packet_duration
+        if self.wall_seconds > 0:
+            logger.info(f"Replayed {self.packet_count:d} packets ({self.data_seconds:.1f} s of data) in {self.wall_seconds:.1f} s, "
+                        f"speed: {self.data_seconds/self.wall_seconds:.2f}x real time")
+
+    def terminate(self):
+        self.sock.close()
+        self.zmq_context.destroy()
@@ -0,0 +1,243 @@
+import os
+import mmap
+import json
+import struct
+import logging
+import time
+import zmq
+import numpy as np
+from pathlib import Path
+
+from daqopen.daqinfo import DaqInfo
+from daqopen.daqzmq import DaqSubscriber
+
+logger = logging.getLogger(__name__)
+
+RING_MAGIC = b"DAQSHM01"
+RING_HEADER = struct.Struct("<8sqIIII")     # magic, session id, number of slots, slot size, header size, metadata size
+SLOT_HEADER = struct.Struct("<qqdqq")       # sequence number, packet number, timestamp, number of rows, sync status
+SLOT_DATA_OFFSET = 64
+NOTIFY_MSG = struct.Struct("<qq")           # session id, sequence number
+
+def notify_address(shm_path: str | Path) -> str:
+    """ZMQ endpoint of the notifications belonging to a shared memory ring"""
+    return f"ipc://{shm_path}.ipc"
+
+def _align(size: int, alignment: int) -> int:
+    return size + (-size % alignment)
+
+
+class ShmDaqPublisher(object):
+    """Publishes ADC data to local subscribers via a shared memory ring buffer
+
+    Each packet is written once into a slot of a ring buffer in a memory mapped file
+    (use tmpfs, e.g. /dev/shm) and announced with a small message via a ZMQ PUB socket
+    (ipc). All subscribers read the packet directly from the shared memory, the data
+    is neither serialized nor copied per subscriber. The ring is created with the
+    first packet (slot size from the packet size) and recreated with a new session id
+    if the packet layout changes.
+
+    Parameters:
+        daq_info: The DAQ configuration to be published
+        data_columns: A dictionary mapping data columns to DAQ channels
+        shm_path: path of the ring buffer file
+        num_slots: number of packets kept in the ring
+    """
+    def __init__(self, daq_info: DaqInfo, data_columns: dict, shm_path: str | Path = "/dev/shm/daqopen", num_slots: int = 64):
+        self._daq_info = daq_info.to_dict()
+        self._data_columns = data_columns
+        self._shm_path = Path(shm_path)
+        self._num_slots = num_slots
+        self._session_id = 0
+        self._mmap = None
+        self._slot_data = None
+        self._seq = 0
+        self.zmq_context = zmq.Context()
+        self.sock = self.zmq_context.socket(zmq.PUB)
+        self.sock.bind(notify_address(self._shm_path))
+
+    def _create_ring(self, m_data: np.ndarray):
+        self._slot_data = None
+        if self._mmap is not None:
+            self._mmap.close()
+        self._session_id = int.from_bytes(os.urandom(7), "little")
+        metadata = json.dumps(dict(dtype=str(m_data.dtype),
+                                   max_rows=m_data.shape[0],
+                                   num_columns=m_data.shape[1],
+                                   daq_info=self._daq_info,
+                                   data_columns=self._data_columns)).encode()
+        header_size = _align(RING_HEADER.size + len(metadata), 4096)
+        slot_size = _align(SLOT_DATA_OFFSET + m_data.nbytes, 64)
+        # Create with a temporary name, subscribers never see a partially initialized ring
+        tmp_path = self._shm_path.with_name(self._shm_path.name + ".tmp")
+        with open(tmp_path, "wb+") as f:
+            f.truncate(header_size + self._num_slots*slot_size)
+            self._mmap = mmap.mmap(f.fileno(), header_size + self._num_slots*slot_size)
+        RING_HEADER.pack_into(self._mmap, 0, RING_MAGIC, self._session_id, self._num_slots, slot_size, header_size, len(metadata))
+        self._mmap[RING_HEADER.size:RING_HEADER.size + len(metadata)] = metadata
+        for slot in range(self._num_slots):
+            SLOT_HEADER.pack_into(self._mmap, header_size + slot*slot_size, -1, 0, 0.0, 0, 0)
+        os.replace(tmp_path, self._shm_path)
+        self._header_size = header_size
+        self._slot_size = slot_size
+        self._slot_data = np.ndarray((self._num_slots, m_data.shape[0], m_data.shape[1]), dtype=m_data.dtype,
+                                     buffer=self._mmap, offset=header_size + SLOT_DATA_OFFSET,
+                                     strides=(slot_size, m_data.shape[1]*m_data.itemsize, m_data.itemsize))
+        self._seq = 0
+        logger.info(f"ShmDaqPublisher: created ring {self._shm_path} with {self._num_slots:d} slots of {slot_size:d} bytes")
+
+    def send_data(self, m_data: np.ndarray, packet_num: int, timestamp: float, sync_status: bool = False) -> int:
+        """Write one packet to the ring and notify the subscribers
+
+        Parameters:
+            m_data: The measurement data to be sent (samples x columns)
+            packet_num: The packet number for the data
+            timestamp: The timestamp associated with the data
+            sync_status: Indicates if the data is synchronized
+
+        Returns:
+            Number of bytes written
+        """
+        if (self._slot_data is None or m_data.dtype != self._slot_data.dtype or
+            m_data.shape[0] > self._slot_data.shape[1] or m_data.shape[1] != self._slot_data.shape[2]):
+            self._create_ring(m_data)
+        slot = self._seq % self._num_slots
+        slot_offset = self._header_size + slot*self._slot_size
+        # Invalidate the slot while writing
+        SLOT_HEADER.pack_into(self._mmap, slot_offset, -1, 0, 0.0, 0, 0)
+        self._slot_data[slot, :m_data.shape[0]] = m_data
+        SLOT_HEADER.pack_into(self._mmap, slot_offset, self._seq, packet_num, timestamp, m_data.shape[0], int(sync_status))
+        self.sock.send(NOTIFY_MSG.pack(self._session_id, self._seq))
+        self._seq += 1
+        return m_data.nbytes
+
+    def terminate(self):
+        """Close the socket and remove the ring (mapped views of subscribers stay valid)"""
+        self.sock.close()
+        self.zmq_context.destroy()
+        self._slot_data = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._shm_path.unlink(missing_ok=True)
+
+
+class ShmDaqSubscriber(object):
+    """Receives ADC data from a ShmDaqPublisher
+
+    Interface equivalent to daqopen.daqzmq.DaqSubscriber. The packet is copied once from
+    the shared memory ring into a buffer of the subscriber, then the sequence number of
+    the slot is checked again: if the publisher reused the slot during the copy (torn read),
+    the packet is discarded. The returned data stays valid until the next call of recv_data.
+    Packets overwritten before or while they were read are skipped with a warning, this
+    shows up as gap in packet_num.
+
+    Parameters:
+        shm_path: path of the ring buffer file of the publisher
+        init_daqinfo: Whether to receive one packet to initialize the DAQ metadata
+        connect_timeout: The timeout duration (in seconds) for the initial receive
+    """
+    NUM_CONNECT_RETRIES: int = 5
+
+    def __init__(self, shm_path: str | Path = "/dev/shm/daqopen", init_daqinfo: bool = True, connect_timeout: float = 1.0):
+        self._shm_path = Path(shm_path)
+        self.zmq_context = zmq.Context()
+        self.sock = self.zmq_context.socket(zmq.SUB)
+        self.sock.setsockopt_string(zmq.SUBSCRIBE, "")
+        self.sock.connect(notify_address(self._shm_path))
+        self.timestamp: float = -1
+        self.daq_info: DaqInfo = DaqInfo.get_default()
+        self.data_columns: dict = {}
+        self.packet_num: int = -1
+        self.sync_status: bool = False
+        self._session_id = None
+        self._metadata = {}
+        if init_daqinfo:
+            for read_try in range(self.NUM_CONNECT_RETRIES):
+                try:
+                    self.recv_data(update_daqinfo=True, flags=zmq.NOBLOCK)
+                    break
+                except zmq.ZMQError:
+                    logger.warning("Initial receive of data failed")
+                time.sleep(connect_timeout/self.NUM_CONNECT_RETRIES)
+            else:
+                raise ConnectionError
+
+    def _attach(self, session_id: int) -> bool:
+        """Map the ring of the given session; False if the file belongs to another session"""
+        self._session_id = None
+        self._slot_data = None
+        self._read_buffer = None
+        try:
+            with open(self._shm_path, "rb") as f:
+                ring_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            logger.warning(f"ShmDaqSubscriber: ring {self._shm_path} not available: {e}")
+            return False
+        magic, ring_session_id, num_slots, slot_size, header_size, metadata_size = RING_HEADER.unpack_from(ring_mmap, 0)
+        if magic != RING_MAGIC or ring_session_id != session_id:
+            return False
+        self._metadata = json.loads(ring_mmap[RING_HEADER.size:RING_HEADER.size + metadata_size])
+        dtype = np.dtype(self._metadata["dtype"])
+        self._mmap = ring_mmap
+        self._num_slots = num_slots
+        self._slot_size = slot_size
+        self._header_size = header_size
+        self._slot_data = np.ndarray((num_slots, self._metadata["max_rows"], self._metadata["num_columns"]), dtype=dtype,
+                                     buffer=ring_mmap, offset=header_size + SLOT_DATA_OFFSET,
+                                     strides=(slot_size, self._metadata["num_columns"]*dtype.itemsize, dtype.itemsize))
+        self._read_buffer = np.empty((self._metadata["max_rows"], self._metadata["num_columns"]), dtype=dtype)
+        self._session_id = session_id
+        logger.info(f"ShmDaqSubscriber: attached to ring {self._shm_path}")
+        return True
+
+    def recv_data(self, update_daqinfo: bool = False, flags = 0) -> np.ndarray:
+        """Receive the next packet
+
+        Parameters:
+            update_daqinfo: Whether to update DAQ metadata upon receiving the packet
+            flags: Optional ZeroMQ flags for receiving the notification
+
+        Returns:
+            Packet data (valid until the next call)
+        """
+        while True:
+            session_id, seq = NOTIFY_MSG.unpack(self.sock.recv(flags=flags))
+            if session_id != self._session_id and not self._attach(session_id):
+                continue
+            slot = seq % self._num_slots
+            slot_offset = self._header_size + slot*self._slot_size
+            slot_seq, packet_num, timestamp, num_rows, sync_status = SLOT_HEADER.unpack_from(self._mmap, slot_offset)
+            if slot_seq != seq:
+                logger.warning(f"ShmDaqSubscriber: packet {seq:d} overwritten before read - subscriber too slow")
+                continue
+            self._copy_slot(slot, num_rows)
+            # The publisher invalidates the slot before writing, an unchanged sequence number means a consistent copy
+            if SLOT_HEADER.unpack_from(self._mmap, slot_offset)[0] != seq:
+                logger.warning(f"ShmDaqSubscriber: packet {seq:d} overwritten while read - subscriber too slow")
+                continue
+            break
+        self.timestamp = timestamp
+        self.packet_num = packet_num
+        self.sync_status = bool(sync_status)
+        if update_daqinfo:
+            self.daq_info = DaqInfo.from_dict(self._metadata["daq_info"])
+            self.data_columns = self._metadata["data_columns"]
+        return self._read_buffer[:num_rows]
+
+    def _copy_slot(self, slot: int, num_rows: int):
+        self._read_buffer[:num_rows] = self._slot_data[slot, :num_rows]
+
+    def terminate(self):
+        """Close the socket and release the ring"""
+        self.sock.close()
+        self.zmq_context.destroy()
+        self._slot_data = None
+        self._read_buffer = None
+        self._mmap = None
+
+
+def create_daq_subscriber(host: str = "127.0.0.1", port: int = 50001, shm_path: str = "", **kwargs):
+    """Create a ShmDaqSubscriber if shm_path is given, a DaqSubscriber (tcp) otherwise"""
+    if shm_path:
+        return ShmDaqSubscriber(shm_path, **kwargs)
+    return DaqSubscriber(host, port, **kwargs)
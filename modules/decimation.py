@@ -0,0 +1,159 @@
+import queue
+import logging
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import firwin
+
+from daqopen.daqinfo import DaqInfo
+from daqopen.daqzmq import DaqPublisher
+
+logger = logging.getLogger(__name__)
+
+class PolyphaseDecimator(object):
+    """Anti-alias FIR filter and decimation by an integer factor, continued across packets
+
+    Only the output samples are calculated (polyphase form): each output takes
+    factor*taps_per_phase multiply-adds. The last samples of each packet are kept
+    as filter history for the next packet.
+
+    Parameters:
+        factor: decimation factor
+        num_columns: number of data columns
+        taps_per_phase: number of filter taps per polyphase branch
+        cutoff: cutoff frequency relative to the output nyquist frequency
+    """
+    def __init__(self, factor: int, num_columns: int, taps_per_phase: int = 16, cutoff: float = 0.8):
+        self.factor = factor
+        num_taps = factor*taps_per_phase
+        self._taps_rev = firwin(num_taps, cutoff/factor).astype(np.float32)[::-1].copy()
+        self._history = np.zeros((num_taps - 1, num_columns), dtype=np.float32)
+        self._phase = 0
+        # Delay between input and output in input samples
+        self.group_delay = (num_taps - 1)/2
+
+    def reset(self):
+        """Clear the filter history (e.g. after a gap in the input data)"""
+        self._history[:] = 0.0
+        self._phase = 0
+
+    def process(self, data: np.ndarray) -> tuple[np.ndarray, int]:
+        """Filter and decimate one packet
+
+        Parameters:
+            data: input data (samples x columns)
+
+        Returns:
+            decimated data (samples x columns), input index of the last output sample (-1 if no output)
+        """
+        extended = np.concatenate([self._history, data.astype(np.float32, copy=False)])
+        windows = sliding_window_view(extended, len(self._taps_rev), axis=0)[self._phase::self.factor]
+        output = windows @ self._taps_rev
+        last_idx = self._phase + (output.shape[0] - 1)*self.factor
+        self._phase = self._phase + output.shape[0]*self.factor - data.shape[0]
+        self._history = extended[data.shape[0]:]
+        return output, last_idx
+
+
+class DecimatedStream(object):
+    """Decimated copy of the DAQ data stream published on its own port
+
+    Parameters:
+        daq_info: DAQ configuration of the full rate stream
+        data_columns: A dictionary mapping data columns to DAQ channels
+        factor: decimation factor
+        host: bind address
+        port: tcp port
+        taps_per_phase: number of filter taps per polyphase branch
+    """
+    def __init__(self, daq_info: DaqInfo, data_columns: dict, factor: int, host: str, port: int, taps_per_phase: int = 16):
+        self._samplerate = daq_info.board.samplerate
+        self._decimator = PolyphaseDecimator(factor, len(data_columns), taps_per_phase)
+        stream_info = DaqInfo.from_dict(daq_info.to_dict())
+        stream_info.board.samplerate = daq_info.board.samplerate/factor
+        self._publisher = DaqPublisher(stream_info, data_columns, host=host, port=port)
+        self._packet_num = 0
+        logger.info(f"DecimatedStream: {stream_info.board.samplerate:.1f} S/s on {host:s}:{port:d}")
+
+    def process(self, data: np.ndarray, timestamp: float, sync_status: bool, skipped_packets: int = 0):
+        """Decimate one packet and publish the result
+
+        Parameters:
+            data: full rate data
+            timestamp: timestamp of the last sample of data
+            sync_status: Indicates if the data is synchronized
+            skipped_packets: number of packets dropped before this one
+        """
+        if skipped_packets:
+            # Subscribers detect the gap in the packet numbers, the filter restarts after the gap
+            self._packet_num += skipped_packets
+            self._decimator.reset()
+        output, last_idx = self._decimator.process(data)
+        if output.shape[0] == 0:
+            return
+        # Timestamp of the last output sample, corrected by the filter delay
+        timestamp -= (data.shape[0] - 1 - last_idx + self._decimator.group_delay)/self._samplerate
+        self._publisher.send_data(output, self._packet_num, timestamp, sync_status)
+        self._packet_num += 1
+
+    def terminate(self):
+        self._publisher.terminate()
+
+
+class DecimatedStreamWorker(threading.Thread):
+    """Worker thread feeding the decimated streams, decoupled from the acquisition loop
+
+    The acquisition loop only copies each packet into a bounded queue. If the worker
+    falls behind, packets are dropped (with a warning) instead of blocking the acquisition.
+    The packet numbers of the streams are advanced by the dropped packets, so the
+    subscribers see the gap.
+
+    Parameters:
+        streams: list of DecimatedStream
+        max_queued_packets: max. number of packets waiting for the worker
+    """
+    def __init__(self, streams: list, max_queued_packets: int = 100):
+        super().__init__(name="DecimatedStreamWorker", daemon=True)
+        self._streams = streams
+        self._queue = queue.Queue(maxsize=max_queued_packets)
+        self.dropped_packets = 0
+        self._skipped_packets = 0
+
+    def put(self, data: np.ndarray, timestamp: float, sync_status: bool):
+        """Queue one packet (copied, the acquisition may reuse its buffer)"""
+        try:
+            self._queue.put_nowait((data.copy(), timestamp, sync_status, self._skipped_packets))
+            self._skipped_packets = 0
+        except queue.Full:
+            self._skipped_packets += 1
+            self.dropped_packets += 1
+            logger.warning(f"DecimatedStreamWorker: queue full - dropped packet ({self.dropped_packets:d} in total)")
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            for stream in self._streams:
+                stream.process(*item)
+
+    def stop(self):
+        """Process the queued packets and stop the worker"""
+        self._queue.put(None)
+        self.join()
+        for stream in self._streams:
+            stream.terminate()
+
+    @classmethod
+    def from_config(cls, daq_config: dict, daq_info: DaqInfo, data_columns: dict):
+        """Create the worker from the [app.decimated_stream.<name>] sections; None if not configured"""
+        streams = []
+        for name, stream_config in daq_config["app"].get("decimated_stream", {}).items():
+            streams.append(DecimatedStream(daq_info, data_columns,
+                                           factor=stream_config["factor"],
+                                           host=stream_config.get("bind_addr", daq_config["app"]["zmq_server"]["bind_addr"]),
+                                           port=stream_config["tcp_port"],
+                                           taps_per_phase=stream_config.get("taps_per_phase", 16)))
+        if not streams:
+            return None
+        return cls(streams)
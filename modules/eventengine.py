@@ -0,0 +1,239 @@
+import uuid
+import logging
+import numpy as np
+from typing import List
+
+from daqopen.channelbuffer import AcqBuffer, DataChannelBuffer
+from pqopen.eventdetector import Event, EventController
+
+logger = logging.getLogger(__name__)
+
+AGGREGATIONS = ("phase", "any", "all")
+# Rapid voltage changes are not reported if one of these events occurs meanwhile
+RVC_EXCLUDED_TYPES = ("DIP", "SWELL", "INTERRUPTION")
+
+def hysteresis_state(mark: np.ndarray, prev_state: np.ndarray) -> np.ndarray:
+    """Evaluate hysteresis states along the last axis
+
+    Parameters:
+        mark: 1 where the state is set, -1 where it is cleared, 0 where it is kept
+        prev_state: state before the first sample (shape of mark without the last axis)
+    """
+    last_idx = np.maximum.accumulate(np.where(mark != 0, np.arange(mark.shape[-1]), -1), axis=-1)
+    state = np.take_along_axis(mark, np.maximum(last_idx, 0), axis=-1) > 0
+    return np.where(last_idx >= 0, state, prev_state[..., None])
+
+def state_edges(active: np.ndarray, prev_active: np.ndarray) -> tuple:
+    """Return (row, sample index) of the rising and of the falling edges of the rows of active"""
+    changes = np.diff(np.concatenate([prev_active[:, None], active], axis=1).astype(np.int8), axis=1)
+    return np.nonzero(changes > 0), np.nonzero(changes < 0)
+
+
+class ThresholdRule(object):
+    """Threshold with hysteresis evaluated on all phases
+
+    Parameters:
+        event_type: type of the reported events (e.g. "DIP")
+        limit: threshold in Volt
+        hysteresis: hysteresis in Volt
+        below: event while below the limit (else above)
+        aggregation: "phase" (one event per phase), "any" (from the first phase crossing
+            the limit until the last phase returned) or "all" (while all phases crossed the limit)
+    """
+    def __init__(self, event_type: str, limit: float, hysteresis: float, below: bool, aggregation: str = "phase"):
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {aggregation}")
+        self.event_type = event_type
+        self.limit = limit
+        self.hysteresis = hysteresis
+        self.below = below
+        self.aggregation = aggregation
+
+
+class PolyphaseEventController(EventController):
+    """EventController evaluating all phases and thresholds at once
+
+    The half-period RMS values of all phases are read into one matrix and compared with all
+    ThresholdRules in one pass; the hysteresis states of every rule and phase are kept in
+    arrays. The cost per call depends on the number of new values, not on the number of
+    detectors. With polyphase aggregation (EN 50160, IEC 61000-4-30), one event covers all
+    phases: its extreme value is the residual voltage (dip, interruption) or the maximum
+    voltage (swell) of the worst phase, which is reported as channel.
+
+    Rapid voltage changes (IEC 61000-4-30): an RVC starts when a value deviates more than
+    rvc_threshold from the mean of the preceding rvc_window values and ends at the start of
+    the next steady state (rvc_window values within rvc_threshold - rvc_hysteresis of their
+    mean) of all phases. RVCs are reported once finished with the max. deviation from the
+    former mean as extreme value, and are discarded if a dip, swell or interruption occurred.
+
+    Further event detectors can be added as usual (see EventController).
+
+    Parameters:
+        time_channel: the channel providing the timestamps
+        sample_rate: samplerate of the acquisition
+        voltage_channels: the half-period RMS voltage channels of the phases
+        rules: the ThresholdRules
+        rvc_threshold: RVC threshold in Volt (0: no RVC detection)
+        rvc_hysteresis: RVC hysteresis in Volt
+        rvc_window: number of half-period values of the steady state (100 at 50 Hz, 120 at 60 Hz)
+    """
+    def __init__(self, time_channel: AcqBuffer, sample_rate: float, voltage_channels: List[DataChannelBuffer],
+                 rules: List[ThresholdRule], rvc_threshold: float = 0.0, rvc_hysteresis: float = 0.0, rvc_window: int = 100):
+        super().__init__(time_channel=time_channel, sample_rate=sample_rate)
+        self._voltage_channels = voltage_channels
+        num_phases = len(voltage_channels)
+        self._rules = rules
+        # Values are multiplied by the sign, so every rule is an upper limit
+        self._sign = np.array([-1.0 if rule.below else 1.0 for rule in rules])[:, None, None]
+        self._limit = np.array([rule.limit for rule in rules])[:, None, None]*self._sign
+        self._release = self._limit - np.array([rule.hysteresis for rule in rules])[:, None, None]
+        self._rule_state = np.zeros((len(rules), num_phases), dtype=bool)
+        # Event streams: (rule index, phase index or None for polyphase)
+        self._phase_rules = [idx for idx, rule in enumerate(rules) if rule.aggregation == "phase"]
+        self._any_rules = [idx for idx, rule in enumerate(rules) if rule.aggregation == "any"]
+        self._all_rules = [idx for idx, rule in enumerate(rules) if rule.aggregation == "all"]
+        self._streams = ([(idx, phase_idx) for idx in self._phase_rules for phase_idx in range(num_phases)] +
+                         [(idx, None) for idx in self._any_rules + self._all_rules])
+        self._stream_active = np.zeros(len(self._streams), dtype=bool)
+        self._rvc_excluded = np.array([rules[idx].event_type in RVC_EXCLUDED_TYPES for idx, _ in self._streams], dtype=bool)
+        self._ongoing = {}
+        self._rvc_threshold = rvc_threshold
+        self._rvc_band = rvc_threshold - rvc_hysteresis
+        self._rvc_window = rvc_window
+        self._rvc_values = np.full((num_phases, rvc_window), np.nan)
+        self._rvc_sidx = np.zeros(rvc_window, dtype=np.int64)
+        self._rvc_state = np.zeros(num_phases, dtype=bool)
+        self._rvc_event = None
+
+    def _timestamp(self, sidx: int) -> float:
+        return float(self._time_channel.read_data_by_index(sidx, sidx+1)[0]/1e6)
+
+    def _read_values(self, start_acq_sidx: int, stop_acq_sidx: int) -> tuple:
+        channel_data = [channel.read_data_by_acq_sidx(start_acq_sidx, stop_acq_sidx) for channel in self._voltage_channels]
+        # The half-period values of all phases share the zero crossings of the zcd channel
+        num_values = min(data.size for data, _ in channel_data)
+        values = np.array([data[:num_values] for data, _ in channel_data], dtype=np.float64)
+        return values, channel_data[0][1][:num_values].astype(np.int64)
+
+    def _stream_extreme(self, stream_idx: int, signed_values: np.ndarray, start: int, stop: int) -> tuple:
+        """Return the extreme value (signed) and its phase index of a stream within [start, stop)"""
+        rule_idx, phase_idx = self._streams[stream_idx]
+        if phase_idx is not None:
+            segment = signed_values[rule_idx, phase_idx:phase_idx+1, start:stop]
+        else:
+            segment = signed_values[rule_idx, :, start:stop]
+        segment = np.where(np.isnan(segment), -np.inf, segment)
+        flat_idx = int(np.argmax(segment))
+        worst_phase = flat_idx // segment.shape[1]
+        return float(segment.flat[flat_idx]), phase_idx if phase_idx is not None else worst_phase
+
+    def _update_extreme(self, event: dict, stream_idx: int, signed_values: np.ndarray, start: int, stop: int):
+        if stop <= start:
+            return
+        extreme, phase_idx = self._stream_extreme(stream_idx, signed_values, start, stop)
+        if extreme > event["extreme"]:
+            event["extreme"] = extreme
+            event["phase_idx"] = phase_idx
+
+    def _create_event(self, stream_idx: int, event: dict, stop_sidx: int | None) -> Event:
+        rule = self._rules[self._streams[stream_idx][0]]
+        return Event(start_ts=event["start_ts"],
+                     stop_ts=self._timestamp(stop_sidx) if stop_sidx is not None else None,
+                     start_sidx=event["start_sidx"],
+                     stop_sidx=stop_sidx,
+                     extrem_value=event["extreme"]*(-1.0 if rule.below else 1.0),
+                     channel=self._voltage_channels[event["phase_idx"]].name,
+                     type=rule.event_type,
+                     id=event["id"])
+
+    def _process_rules(self, values: np.ndarray, sidx: np.ndarray) -> tuple:
+        signed_values = values[None, :, :]*self._sign
+        mark = np.where(signed_values > self._limit, 1, np.where(signed_values <= self._release, -1, 0)).astype(np.int8)
+        state = hysteresis_state(mark, self._rule_state)
+        self._rule_state = state[:, :, -1]
+        active = np.concatenate([state[self._phase_rules].reshape(-1, sidx.size),
+                                 state[self._any_rules].any(axis=1),
+                                 state[self._all_rules].all(axis=1)])
+        rising, falling = state_edges(active, self._stream_active)
+        self._stream_active = active[:, -1]
+        edges = sorted([(idx, stream_idx, True) for stream_idx, idx in zip(*rising)] +
+                       [(idx, stream_idx, False) for stream_idx, idx in zip(*falling)])
+        events = []
+        segment_start = {stream_idx: 0 for stream_idx in self._ongoing}
+        for idx, stream_idx, started in edges:
+            if started:
+                self._ongoing[stream_idx] = {"id": uuid.uuid4(), "start_sidx": int(sidx[idx]), "start_ts": self._timestamp(int(sidx[idx])),
+                                             "extreme": -np.inf, "phase_idx": 0, "reported": False}
+                segment_start[stream_idx] = idx
+            else:
+                event = self._ongoing.pop(stream_idx)
+                self._update_extreme(event, stream_idx, signed_values, segment_start.pop(stream_idx), idx)
+                events.append(self._create_event(stream_idx, event, int(sidx[idx])))
+        for stream_idx, event in self._ongoing.items():
+            self._update_extreme(event, stream_idx, signed_values, segment_start.get(stream_idx, 0), sidx.size)
+            if not event["reported"]:
+                event["reported"] = True
+                events.append(self._create_event(stream_idx, event, None))
+        return events, active[self._rvc_excluded].any(axis=0)
+
+    def _process_rvc(self, values: np.ndarray, sidx: np.ndarray, excluded_active: np.ndarray) -> List[Event]:
+        num_values = sidx.size
+        all_values = np.concatenate([self._rvc_values, values], axis=1)
+        all_sidx = np.concatenate([self._rvc_sidx, sidx])
+        # Window k covers the rvc_window values before the new value k
+        windows = np.lib.stride_tricks.sliding_window_view(all_values, self._rvc_window, axis=1)
+        window_mean = windows.mean(axis=-1)
+        steady = ((windows.max(axis=-1) - window_mean <= self._rvc_band) &
+                  (window_mean - windows.min(axis=-1) <= self._rvc_band))[:, 1:]
+        deviation = np.abs(values - window_mean[:, :num_values]) > self._rvc_threshold
+        mark = np.where(steady, -1, np.where(deviation, 1, 0)).astype(np.int8)
+        state = hysteresis_state(mark, self._rvc_state)
+        self._rvc_state = state[:, -1]
+        rising, falling = state_edges(state.any(axis=0)[None, :], np.array([self._rvc_event is not None]))
+        events = []
+        edges = sorted([(idx, True) for idx in rising[1]] + [(idx, False) for idx in falling[1]])
+        segment_start = 0
+        for idx, started in edges + [(num_values, None)]:
+            if self._rvc_event is not None and idx > segment_start:
+                deviation = np.abs(values[:, segment_start:idx] - self._rvc_event["mean"][:, None])
+                deviation = np.where(np.isnan(deviation), -np.inf, deviation)
+                flat_idx = int(np.argmax(deviation))
+                if deviation.flat[flat_idx] > self._rvc_event["extreme"]:
+                    self._rvc_event["extreme"] = float(deviation.flat[flat_idx])
+                    self._rvc_event["phase_idx"] = flat_idx // deviation.shape[1]
+                self._rvc_event["excluded"] |= bool(excluded_active[segment_start:idx].any())
+            if started:
+                self._rvc_event = {"id": uuid.uuid4(), "start_sidx": int(sidx[idx]), "mean": window_mean[:, idx],
+                                   "extreme": -np.inf, "phase_idx": 0, "excluded": False}
+            elif started is not None:
+                # The RVC ends with the start of the new steady state
+                stop_sidx = max(int(all_sidx[idx+1]), self._rvc_event["start_sidx"])
+                if not self._rvc_event["excluded"]:
+                    events.append(Event(start_ts=self._timestamp(self._rvc_event["start_sidx"]),
+                                        stop_ts=self._timestamp(stop_sidx),
+                                        start_sidx=self._rvc_event["start_sidx"],
+                                        stop_sidx=stop_sidx,
+                                        extrem_value=self._rvc_event["extreme"],
+                                        channel=self._voltage_channels[self._rvc_event["phase_idx"]].name,
+                                        type="RVC",
+                                        id=self._rvc_event["id"]))
+                self._rvc_event = None
+            segment_start = idx
+        self._rvc_values = all_values[:, -self._rvc_window:]
+        self._rvc_sidx = all_sidx[-self._rvc_window:]
+        return events
+
+    def process(self) -> List[Event]:
+        start_acq_sidx = self._last_processed_sidx
+        events = super().process()
+        stop_acq_sidx = self._last_processed_sidx
+        if stop_acq_sidx <= start_acq_sidx:
+            return events
+        values, sidx = self._read_values(start_acq_sidx, stop_acq_sidx)
+        if not sidx.size:
+            return events
+        rule_events, excluded_active = self._process_rules(values, sidx)
+        events += rule_events
+        if self._rvc_threshold > 0:
+            events += self._process_rvc(values, sidx, excluded_active)
+        return events
@@ -0,0 +1,306 @@
+import mmap
+import copy
+import time
+import logging
+import multiprocessing
+import numpy as np
+import zmq
+from pathlib import Path
+from typing import List
+
+from daqopen.channelbuffer import AcqBufferPool
+from daqopen.daqinfo import DaqInfo
+from daqopen.helper import GracefulKiller
+
+from modules.daqshm import create_daq_subscriber
+from modules.inputtransform import InputTransform
+from modules.pqprocessing import create_power_system, create_storage_controller, create_event_controller, create_metrics_reporter
+from modules.pqprocessing import create_overload_guard, create_waveform_capture, create_gap_handler, gap_recovery_enabled
+from modules.pqprocessing import create_power_system_checkpoint, create_storage_checkpoint
+from modules.pqpipeline import ShmMessageRing, ChannelForwarder, ChannelReceiver, share_acq_buffer_pool, set_acq_sample_count
+from modules.pqpipeline import ACQ_COUNT, PS_COUNT, OUTPUT_COUNT, STOP_FLAG, NUM_COUNTERS, POLL_INTERVAL, _set_cpu_affinity
+from modules.stagetimer import StageTimer
+from modules.overloadguard import PacketAgeBacklog
+from modules.gaprecovery import GapLog, PacketGapFiller
+
+logger = logging.getLogger(__name__)
+
+START_TIMESTAMP = 4  # Timestamp (µs) of the first packet of the feeder, set by the worker
+
+FEEDER_STAGES = ["recv", "transform", "put_data", "power_system", "events", "forward"]
+
+def feeder_config(config: dict, name: str) -> dict:
+    """Return the config of a feeder: the sections of [feeder.<name>] update the global sections
+
+    The phase mapping of a feeder replaces the global one. Without an own energy_file_path,
+    the name of the feeder is appended to the global one.
+    """
+    merged = copy.deepcopy({key: value for key, value in config.items() if key != "feeder"})
+    for key, value in config["feeder"][name].items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(copy.deepcopy(value))
+        else:
+            merged[key] = copy.deepcopy(value)
+    ps_config = merged["powersystem"]
+    if "energy_file_path" not in config["feeder"][name].get("powersystem", {}):
+        energy_file_path = Path(ps_config.get("energy_file_path", "/tmp/energy.json"))
+        ps_config["energy_file_path"] = str(energy_file_path.with_name(f"{energy_file_path.stem}-{name}{energy_file_path.suffix}"))
+    return merged
+
+
+class FeederSource(object):
+    """A DAQ source (daqopen-zmq-server) with its shared buffer and message ring
+
+    The DaqInfo and the packet size are read from the source on creation.
+
+    Parameters:
+        name: name of the feeder (used as tag of the stored data)
+        config: config of the feeder (see feeder_config)
+        counters: shared counters of the feeder
+        max_lead_sec: max. duration of data the feeder may be ahead of the output stage
+    """
+    def __init__(self, name: str, config: dict, counters: np.ndarray, max_lead_sec: float = 2.0):
+        self.name = name
+        self.config = config
+        self.counters = counters
+        zmq_config = config["zmq_server"]
+        probe = create_daq_subscriber(zmq_config.get("host", "localhost"), zmq_config.get("port", 50001), zmq_config.get("shm_path", ""))
+        self.daq_info: DaqInfo = probe.daq_info
+        self.data_columns: dict = probe.data_columns
+        block_size = probe.recv_data().shape[0]
+        probe.terminate()
+        self.samplerate = self.daq_info.board.samplerate
+        self.max_lead_samples = int(max_lead_sec*self.samplerate)
+        self.buffer_size = max(200_000, 10*block_size) + self.max_lead_samples
+        self.buffer_size += -self.buffer_size % block_size
+        self.daq_buffer = AcqBufferPool(daq_info=self.daq_info, data_columns=self.data_columns, size=self.buffer_size)
+        self.ring = ShmMessageRing(config.get("pipeline", {}).get("ring_size", 4*1024*1024))
+        self.timer = StageTimer([f"{name}_{stage}" for stage in FEEDER_STAGES], idle_stages=[f"{name}_recv"], shared=True)
+
+    def share(self):
+        self._shm = share_acq_buffer_pool(self.daq_buffer)
+
+    @property
+    def lead_samples(self) -> int:
+        return int(self.counters[ACQ_COUNT] - self.counters[OUTPUT_COUNT])
+
+
+def _feeder_worker(feeder: FeederSource, control: np.ndarray):
+    """Acquisition, PowerSystem and event detection of one feeder"""
+    killer = GracefulKiller()
+    _set_cpu_affinity(feeder.config.get("pipeline", {}).get("cpu_affinity", {}), feeder.name)
+    stop_callback = lambda: killer.kill_now or control[STOP_FLAG]
+    config = feeder.config
+    daq_buffer = feeder.daq_buffer
+    counters = feeder.counters
+    timer = feeder.timer
+    mark = lambda stage: timer.mark(f"{feeder.name}_{stage}")
+    zmq_config = config["zmq_server"]
+    daq_sub = create_daq_subscriber(zmq_config.get("host", "localhost"), zmq_config.get("port", 50001), zmq_config.get("shm_path", ""))
+    daq_sub.sock.setsockopt(zmq.RCVTIMEO, 5000)
+    # The first packet marks the start of the measurement
+    daq_sub.recv_data()
+    start_timestamp_us = int(daq_sub.timestamp*1e6)
+    daq_buffer._last_timestamp_us = start_timestamp_us
+    input_transform = InputTransform.from_config(config["powersystem"], daq_sub.daq_info, daq_sub.data_columns)
+    max_gap_sec = min(config.get("gap_recovery", {}).get("max_gap_sec", 0.0), 0.25*feeder.buffer_size/feeder.samplerate)
+    gap_filler = PacketGapFiller(samplerate=feeder.samplerate,
+                                 nominal_frequency=config["powersystem"].get("nominal_frequency", 50.0),
+                                 max_gap_sec=max_gap_sec)
+    gap_filler.check_packet(daq_sub.packet_num)
+    gap_log = GapLog()
+    power_system = create_power_system(config, daq_buffer, feeder.samplerate)
+    gap_handler = create_gap_handler(config, daq_buffer, power_system, gap_log)
+    event_controller = create_event_controller(config, daq_buffer, power_system, feeder.samplerate)
+    overload_guard = create_overload_guard(config, daq_buffer, power_system)
+    ps_checkpoint = create_power_system_checkpoint(config, daq_buffer, power_system, feeder.samplerate, start_timestamp_us, feeder=feeder.name)
+    packet_age_backlog = PacketAgeBacklog()
+    forwarder = ChannelForwarder(power_system.output_channels, feeder.ring)
+    counters[START_TIMESTAMP] = start_timestamp_us
+    if not forwarder.send_channel_names(stop_callback):
+        return
+
+    def put_data_with_timestamp(data: np.ndarray, timestamp_us: int) -> bool:
+        # Wait while the output stage is too far behind
+        while feeder.lead_samples + data.shape[0] > feeder.max_lead_samples:
+            if stop_callback():
+                return False
+            time.sleep(POLL_INTERVAL)
+        daq_buffer.put_data_with_timestamp(data, timestamp_us)
+        counters[ACQ_COUNT] = daq_buffer.time.sample_count
+        return True
+
+    last_acq_count = int(counters[ACQ_COUNT])
+    timer.start()
+    while not stop_callback():
+        try:
+            m_data = daq_sub.recv_data()
+        except zmq.Again:
+            logger.error(f"Feeder {feeder.name:s}: timeout of ZMQ socket ocurred - stopping")
+            break
+        mark("recv")
+        missing_packets = gap_filler.check_packet(daq_sub.packet_num)
+        if missing_packets:
+            gap_samples = missing_packets*m_data.shape[0]
+            if missing_packets < 0 or not gap_recovery_enabled(config) or not gap_filler.can_fill(gap_samples):
+                logger.error(f"Feeder {feeder.name:s}: DAQ packet gap detected ({missing_packets:d} packets missing) - stopping")
+                break
+            logger.warning(f"Feeder {feeder.name:s}: DAQ packet gap detected ({missing_packets:d} packets missing) - filling in place")
+            gap_stop_ts_us = int(daq_sub.timestamp*1e6 - m_data.shape[0]*1e6/feeder.samplerate)
+            if not gap_filler.fill_gap(gap_log, daq_buffer.time.sample_count, gap_samples, m_data.shape[0], gap_stop_ts_us, put_data_with_timestamp):
+                break
+            timer.skip()
+        transformed_data = input_transform.apply(m_data)
+        mark("transform")
+        if not put_data_with_timestamp(transformed_data, int(daq_sub.timestamp*1e6)):
+            break
+        gap_filler.update(transformed_data, int(daq_sub.timestamp*1e6))
+        mark("put_data")
+        if gap_handler:
+            gap_handler.process()
+        power_system.process()
+        if overload_guard:
+            overload_guard.post_process()
+        if ps_checkpoint:
+            ps_checkpoint.process()
+        mark("power_system")
+        events = event_controller.process()
+        if overload_guard:
+            events += overload_guard.get_events()
+        if gap_handler:
+            events += gap_handler.get_events()
+        mark("events")
+        acq_count = int(counters[ACQ_COUNT])
+        if not forwarder.send(acq_count, stop_callback, events):
+            break
+        mark("forward")
+        counters[PS_COUNT] = acq_count
+        data_seconds = (acq_count - last_acq_count)/feeder.samplerate
+        packet_age = time.time() - daq_sub.timestamp
+        timer.finish_cycle(data_seconds, packet_age)
+        if overload_guard:
+            overload_guard.update(timer.last_rtf, data_seconds, packet_age_backlog.update(packet_age, data_seconds))
+        last_acq_count = acq_count
+        timer.start()
+    daq_sub.terminate()
+    # Energy counters are persisted when power_system is deleted
+
+def _output_stage(feeders: List[FeederSource], config: dict, control: np.ndarray, measurement_id: str, device_id: str,
+                  timers: dict):
+    """Storage and output of all feeders, sharing the device endpoints"""
+    killer = GracefulKiller()
+    _set_cpu_affinity(config.get("pipeline", {}).get("cpu_affinity", {}), "output")
+    stop_callback = lambda: killer.kill_now or control[STOP_FLAG]
+    shared_endpoints = {}
+    outputs = []
+    for feeder in feeders:
+        # Mirror of the PowerSystem of the feeder, only its output channels are used and filled by the receiver
+        # Energy counters are persisted by the feeder worker only
+        power_system = create_power_system(feeder.config, feeder.daq_buffer, feeder.samplerate, persist_energy=False)
+        receiver = ChannelReceiver(power_system.output_channels, feeder.ring)
+        if not receiver.recv_channel_names(stop_callback):
+            return
+        storage_controller = create_storage_controller(feeder.config, feeder.daq_buffer, power_system, feeder.daq_info, measurement_id,
+                                                       device_id, int(feeder.counters[START_TIMESTAMP]),
+                                                       feeder=feeder.name, shared_endpoints=shared_endpoints)
+        waveform_capture = create_waveform_capture(feeder.config, feeder.daq_buffer, feeder.buffer_size, feeder.samplerate, storage_controller,
+                                                   measurement_id)
+        storage_checkpoint = create_storage_checkpoint(feeder.config, feeder.daq_buffer, storage_controller, feeder.samplerate,
+                                                       int(feeder.counters[START_TIMESTAMP]), feeder=feeder.name)
+        outputs.append((feeder, receiver, storage_controller, waveform_capture, storage_checkpoint, int(feeder.counters[OUTPUT_COUNT])))
+    metrics_reporter = create_metrics_reporter(config, timers, outputs[0][2])
+    timer: StageTimer = timers["output"]
+    last_acq_counts = [last_acq_count for *_, last_acq_count in outputs]
+    while not stop_callback():
+        timer.start()
+        data_seconds = 0.0
+        for idx, (feeder, receiver, storage_controller, waveform_capture, storage_checkpoint, _) in enumerate(outputs):
+            acq_count = None
+            while (batch_acq_count := receiver.recv()) is not None:
+                acq_count = batch_acq_count
+            timer.mark("receive")
+            if acq_count is None:
+                continue
+            set_acq_sample_count(feeder.daq_buffer, acq_count)
+            events = receiver.get_events()
+            if waveform_capture:
+                waveform_capture.process(events)
+            storage_controller.process()
+            if storage_checkpoint:
+                storage_checkpoint.process()
+            timer.mark("storage")
+            storage_controller.process_events(events)
+            timer.mark("store_events")
+            feeder.counters[OUTPUT_COUNT] = acq_count
+            # The feeders are processed in parallel, the slowest one defines the real-time factor
+            data_seconds = max(data_seconds, (acq_count - last_acq_counts[idx])/feeder.samplerate)
+            last_acq_counts[idx] = acq_count
+        if data_seconds <= 0:
+            time.sleep(POLL_INTERVAL)
+            continue
+        timer.finish_cycle(data_seconds)
+        if metrics_reporter:
+            metrics_reporter.process()
+    for _, _, storage_controller, waveform_capture, _, _ in outputs:
+        storage_controller.close()
+        if waveform_capture:
+            waveform_capture.close()
+
+
+class FeederPipeline(object):
+    """Processes multiple DAQ sources (feeders) in parallel worker processes
+
+    Every feeder of [feeder.<name>] has its own daqopen-zmq-server and powersystem config
+    (see feeder_config). A worker process per feeder runs acquisition, PowerSystem and event
+    detection and writes into its own shared AcqBufferPool. The new samples of the output
+    channels and the events are forwarded through a shared memory ring to one output process,
+    which runs the storage of all feeders with shared MQTT and archive endpoints (feeder-tagged
+    topics and tables). A feeder waits if it is more than max_lead_sec ahead of the output.
+
+    Parameters:
+        config: pqopen config with [feeder.<name>] sections
+        measurement_id: measurement id for the storage controllers
+        device_id: device id for the storage controllers
+    """
+    def __init__(self, config: dict, measurement_id: str, device_id: str):
+        self._config = config
+        self._measurement_id = measurement_id
+        self._device_id = device_id
+        self._processes: List[multiprocessing.Process] = []
+        names = list(config["feeder"].keys())
+        self._counters_shm = mmap.mmap(-1, (len(names) + 1)*NUM_COUNTERS*8)
+        counters = np.ndarray((len(names) + 1, NUM_COUNTERS), dtype=np.int64, buffer=self._counters_shm)
+        self._control = counters[-1]
+        max_lead_sec = config.get("pipeline", {}).get("max_lead_sec", 2.0)
+        self.feeders = [FeederSource(name, feeder_config(config, name), counters[idx], max_lead_sec)
+                        for idx, name in enumerate(names)]
+        # Statistics are kept in shared memory and reported by the output stage
+        self.timers = {feeder.name: feeder.timer for feeder in self.feeders}
+        self.timers["output"] = StageTimer(["receive", "storage", "store_events"], shared=True)
+
+    def start(self):
+        """Share the buffers and fork the worker and output processes"""
+        for feeder in self.feeders:
+            feeder.share()
+        mp_context = multiprocessing.get_context("fork")
+        self._processes = [mp_context.Process(target=_feeder_worker, name=f"pqopen-feeder-{feeder.name:s}", daemon=True,
+                                              args=(feeder, self._control))
+                           for feeder in self.feeders]
+        self._processes.append(mp_context.Process(target=_output_stage, name="pqopen-output", daemon=True,
+                                                  args=(self.feeders, self._config, self._control, self._measurement_id,
+                                                        self._device_id, self.timers)))
+        for process in self._processes:
+            process.start()
+
+    def is_alive(self) -> bool:
+        return all(process.is_alive() for process in self._processes)
+
+    def stop(self, timeout: float = 10.0):
+        """Stop all processes after the output stage has processed the data written so far"""
+        stop_time = time.time() + timeout
+        self._control[STOP_FLAG] = 1
+        for process in self._processes:
+            process.join(max(stop_time - time.time(), 0.1))
+            if process.is_alive():
+                logger.warning(f"Process {process.name:s} did not stop - terminating")
+                process.terminate()
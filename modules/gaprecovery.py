@@ -0,0 +1,199 @@
+import mmap
+import uuid
+import logging
+import numpy as np
+from typing import List, Tuple
+
+from daqopen.channelbuffer import AcqBuffer, DataChannelBuffer
+from pqopen.powersystem import PowerSystem
+from pqopen.eventdetector import Event
+
+from modules.overloadguard import restart_fluctuation_calc
+
+logger = logging.getLogger(__name__)
+
+GAP_CHANNEL = "DataGap"
+EVENT_TYPE = "DATA_GAP"
+
+class GapLog(object):
+    """Log of the sample ranges which were filled in place of missing packets
+
+    The log is written by the acquisition and read by the processing, each reader keeps
+    its own position. With shared=True the log is kept in anonymous shared memory, so a
+    process forked afterwards can read the gaps added by the parent.
+
+    Parameters:
+        capacity: number of gaps kept (older gaps are overwritten)
+        shared: keep the log in shared memory
+    """
+    def __init__(self, capacity: int = 64, shared: bool = False):
+        self._capacity = capacity
+        if shared:
+            self._shm = mmap.mmap(-1, (1 + 2*capacity)*8)
+            values = np.ndarray(1 + 2*capacity, dtype=np.int64, buffer=self._shm)
+        else:
+            values = np.zeros(1 + 2*capacity, dtype=np.int64)
+        self._count = values[:1]
+        self._gaps = values[1:].reshape(capacity, 2)
+        self._read_count = 0
+
+    def add(self, start_sidx: int, stop_sidx: int):
+        """Add a filled range (acq sample indices, stop excluded)"""
+        count = int(self._count[0])
+        self._gaps[count % self._capacity] = start_sidx, stop_sidx
+        self._count[0] = count + 1
+
+    def read_new(self) -> List[Tuple[int, int]]:
+        """Return the gaps added since the last call"""
+        count = int(self._count[0])
+        first = max(self._read_count, count - self._capacity)
+        self._read_count = count
+        return [tuple(int(sidx) for sidx in self._gaps[idx % self._capacity]) for idx in range(first, count)]
+
+
+class PacketGapFiller(object):
+    """Detects missing DAQ packets and creates data to fill them in place
+
+    The missing samples are filled by repeating the last period (at nominal frequency) of
+    the received signal, so the zero-cross detection and the filters of the processing
+    continue without disruption. Gaps longer than max_gap_sec are not filled.
+
+    Parameters:
+        samplerate: samplerate of the data
+        nominal_frequency: nominal frequency of the power system
+        max_gap_sec: max. duration of a gap to be filled
+    """
+    def __init__(self, samplerate: float, nominal_frequency: float = 50.0, max_gap_sec: float = 2.0):
+        self._samplerate = samplerate
+        self._period_samples = int(round(samplerate/nominal_frequency))
+        self._max_gap_sec = max_gap_sec
+        self._last_packet_num = None
+        self._last_timestamp_us = None
+        self._last_period = None
+
+    def check_packet(self, packet_num: int) -> int:
+        """Check the packet number and return the number of missing packets before it"""
+        last_packet_num = self._last_packet_num
+        self._last_packet_num = packet_num
+        if last_packet_num is None:
+            return 0
+        return packet_num - last_packet_num - 1
+
+    def can_fill(self, num_samples: int) -> bool:
+        """Check if a gap of num_samples can be filled"""
+        return (self._last_period is not None and num_samples > 0 and
+                num_samples <= self._max_gap_sec*self._samplerate)
+
+    def update(self, data: np.ndarray, timestamp_us: int):
+        """Remember the end of the data written to the buffer"""
+        if data.shape[0] >= self._period_samples or self._last_period is None:
+            self._last_period = data[-self._period_samples:].copy()
+        else:
+            self._last_period = np.concatenate([self._last_period, data])[-self._period_samples:]
+        self._last_timestamp_us = timestamp_us
+
+    def create_fill(self, num_samples: int, chunk_size: int, stop_timestamp_us: int):
+        """Create the data of the gap in chunks
+
+        Parameters:
+            num_samples: number of missing samples
+            chunk_size: max. number of samples per chunk (e.g. packet size)
+            stop_timestamp_us: timestamp of the last missing sample
+
+        Yields:
+            (data, timestamp_us) of each chunk
+        """
+        start_timestamp_us = self._last_timestamp_us
+        stop_timestamp_us = max(stop_timestamp_us, start_timestamp_us + 1)
+        last_period = self._last_period
+        period_idx = np.arange(num_samples) % len(last_period)
+        for start in range(0, num_samples, chunk_size):
+            stop = min(start + chunk_size, num_samples)
+            timestamp_us = int(start_timestamp_us + (stop_timestamp_us - start_timestamp_us)*stop/num_samples)
+            data = last_period[period_idx[start:stop]]
+            self.update(data, timestamp_us)
+            yield data, timestamp_us
+
+    def fill_gap(self, gap_log: GapLog, start_sidx: int, num_samples: int, chunk_size: int, stop_timestamp_us: int, put_data) -> bool:
+        """Log the gap and write the fill data
+
+        The gap is logged before the fill data is written, so a processing stage running in
+        parallel never sees fill data which is not flagged.
+
+        Parameters:
+            gap_log: log of the filled gaps
+            start_sidx: acq sample index of the first missing sample
+            num_samples, chunk_size, stop_timestamp_us: see create_fill
+            put_data: function writing (data, timestamp_us) to the buffer, returning False on failure
+
+        Returns:
+            False if writing the fill data failed
+        """
+        gap_log.add(start_sidx, start_sidx + num_samples)
+        return all(put_data(data, timestamp_us)
+                   for data, timestamp_us in self.create_fill(num_samples, chunk_size, stop_timestamp_us))
+
+
+class GapHandler(object):
+    """Marks filled gaps in the output data and resets the affected calculation state
+
+    Each gap of the GapLog is flagged in the output channel DataGap (value 1.0) from the gap
+    start until settle_sec after its end, valid data is flagged with 0.0 on each call. So
+    every aggregation interval which contains filled data has DataGap = 1, otherwise 0.
+    The flicker calculation is restarted and a DATA_GAP event is created for each gap.
+
+    Parameters:
+        power_system: the PowerSystem, must have the DataGap output channel (see add_gap_channel)
+        time_channel: time channel of the AcqBufferPool
+        gap_log: log of the filled gaps
+        settle_sec: time after a gap still affected by the filled data
+        flag_interval_sec: interval of the flag samples within a gap
+    """
+    def __init__(self, power_system: PowerSystem, time_channel: AcqBuffer, gap_log: GapLog,
+                 settle_sec: float = 0.2, flag_interval_sec: float = 0.1):
+        self._power_system = power_system
+        self._time_channel = time_channel
+        self._gap_log = gap_log
+        self._gap_channel: DataChannelBuffer = power_system.output_channels[GAP_CHANNEL]
+        self._settle_samples = int(settle_sec*power_system._samplerate)
+        self._flag_interval_samples = max(int(flag_interval_sec*power_system._samplerate), 1)
+        self._last_flag_sidx = -1
+        self._pending_gaps: List[Tuple[int, int]] = []
+        self._events: List[Event] = []
+
+    def process(self):
+        """Process new gaps; call before PowerSystem.process()"""
+        for start_sidx, stop_sidx in self._gap_log.read_new():
+            logger.warning(f"GapHandler: filled gap of {stop_sidx - start_sidx:d} samples at sidx {start_sidx:d}")
+            restart_fluctuation_calc(self._power_system)
+            flag_sidx = np.arange(start_sidx, stop_sidx + self._settle_samples, self._flag_interval_samples)
+            flag_sidx = np.append(flag_sidx, stop_sidx + self._settle_samples)
+            flag_sidx = flag_sidx[flag_sidx > self._last_flag_sidx]
+            if flag_sidx.size:
+                self._gap_channel.put_data_multi(flag_sidx, np.ones(flag_sidx.size))
+                self._last_flag_sidx = int(flag_sidx[-1])
+            self._pending_gaps.append((start_sidx, stop_sidx))
+        # Regular flag for valid data
+        last_sidx = self._time_channel.sample_count - 1
+        if last_sidx > self._last_flag_sidx:
+            self._gap_channel.put_data_single(last_sidx, 0.0)
+            self._last_flag_sidx = last_sidx
+        # Events are created once the timestamps of the gap are available
+        while self._pending_gaps and self._pending_gaps[0][1] <= self._time_channel.sample_count:
+            start_sidx, stop_sidx = self._pending_gaps.pop(0)
+            start_ts = self._time_channel.read_data_by_index(start_sidx, start_sidx+1)[0]/1e6
+            stop_ts = self._time_channel.read_data_by_index(stop_sidx-1, stop_sidx)[0]/1e6
+            self._events.append(Event(start_ts=float(start_ts), stop_ts=float(stop_ts), start_sidx=start_sidx, stop_sidx=stop_sidx,
+                                      extrem_value=(stop_sidx - start_sidx)/self._power_system._samplerate,
+                                      channel="DAQ", type=EVENT_TYPE, id=uuid.uuid4()))
+
+    def get_events(self) -> List[Event]:
+        """Return the gap events since the last call"""
+        events = self._events
+        self._events = []
+        return events
+
+
+def add_gap_channel(power_system: PowerSystem):
+    """Add the DataGap output channel to the PowerSystem"""
+    power_system.output_channels[GAP_CHANNEL] = DataChannelBuffer(GAP_CHANNEL, agg_type="max", unit="")
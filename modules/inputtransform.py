@@ -0,0 +1,94 @@
+import numpy as np
+import logging
+
+from daqopen.daqinfo import DaqInfo
+
+logger = logging.getLogger(__name__)
+
+# Presets as rows of the mixing matrix: output channel -> {input channel: coefficient}
+PRESETS = {
+    "3P4W": {},
+    "3P3W": {"U1": {"U2": 1/3, "U3": -1/3},
+             "U2": {"U2": -2/3, "U3": -1/3},
+             "U3": {"U2": 1/3, "U3": 2/3}},
+    "ARON": {"I2": {"I1": -1.0, "I3": -1.0}},
+}
+
+class InputTransform(object):
+    """Linear mixing of the input channels before they are written to the acquisition buffer
+
+    The mixing matrix is given in physical units (e.g. I3 = -I1 - I2) and converted once
+    into the raw domain of the DAQ packet, taking into account gain and offset of each
+    channel. Channels without a matrix row are passed through unchanged.
+
+    Parameters:
+        daq_info: DaqInfo of the data stream
+        data_columns: mapping of ai pins to data columns
+        matrix: rows of the mixing matrix {output channel: {input channel: coefficient}}
+        preset: name of a preset matrix (see PRESETS); rows of matrix replace those of the preset
+    """
+    def __init__(self, daq_info: DaqInfo, data_columns: dict, matrix: dict = {}, preset: str = "3P4W"):
+        if preset.upper() not in PRESETS:
+            raise ValueError(f"Unknown input transform preset: {preset:s}")
+        rows = dict(PRESETS[preset.upper()])
+        rows.update(matrix)
+        channel_info = daq_info.get_channel_info_with_sensor()
+        num_columns = max(data_columns.values()) + 1
+        self._matrix_t = np.eye(num_columns, dtype=np.float32)
+        self._bias = np.zeros(num_columns, dtype=np.float32)
+        for out_name, in_coeffs in rows.items():
+            out_col = self._get_column(out_name, daq_info, data_columns)
+            out_info = channel_info[out_name]
+            self._matrix_t[:, out_col] = 0.0
+            bias = out_info.offset
+            for in_name, coeff in in_coeffs.items():
+                in_col = self._get_column(in_name, daq_info, data_columns)
+                in_info = channel_info[in_name]
+                # out_phys = sum(coeff*(raw*gain - offset)), out_raw = (out_phys + out_offset)/out_gain
+                self._matrix_t[in_col, out_col] += coeff*in_info.gain/out_info.gain
+                bias -= coeff*in_info.offset
+            self._bias[out_col] = bias/out_info.gain
+        self.is_identity = not rows
+        self._has_bias = bool(np.any(self._bias))
+        self._in_buffer = np.zeros((0, num_columns), dtype=np.float32)
+        self._out_buffer = np.zeros((0, num_columns), dtype=np.float32)
+
+    @staticmethod
+    def _get_column(channel_name: str, daq_info: DaqInfo, data_columns: dict) -> int:
+        if channel_name not in daq_info.channel:
+            raise ValueError(f"Input transform: channel {channel_name:s} not configured")
+        ai_pin = daq_info.channel[channel_name].ai_pin
+        if ai_pin not in data_columns:
+            raise ValueError(f"Input transform: channel {channel_name:s} ({ai_pin:s}) not in data stream")
+        return data_columns[ai_pin]
+
+    @classmethod
+    def from_config(cls, config: dict, daq_info: DaqInfo, data_columns: dict) -> "InputTransform":
+        """Create from the [powersystem] section of pqopen-config.toml
+
+        The preset defaults to input_wiring, rows of [powersystem.input_transform.matrix]
+        replace the rows of the preset.
+        """
+        transform_config = config.get("input_transform", {})
+        preset = transform_config.get("preset", config.get("input_wiring", "3P4W"))
+        return cls(daq_info, data_columns, matrix=transform_config.get("matrix", {}), preset=preset)
+
+    def apply(self, data: np.ndarray) -> np.ndarray:
+        """Apply the transform to one packet
+
+        Parameters:
+            data: raw packet data (samples x columns)
+
+        Returns:
+            Transformed data; a view of an internal buffer, valid until the next call
+        """
+        if self.is_identity:
+            return data
+        if self._out_buffer.shape != data.shape:
+            self._in_buffer = np.zeros(data.shape, dtype=np.float32)
+            self._out_buffer = np.zeros(data.shape, dtype=np.float32)
+        np.copyto(self._in_buffer, data, casting="unsafe")
+        np.matmul(self._in_buffer, self._matrix_t, out=self._out_buffer)
+        if self._has_bias:
+            self._out_buffer += self._bias
+        return self._out_buffer
@@ -0,0 +1,227 @@
+import os
+import time
+import queue
+import socket
+import struct
+import logging
+import threading
+import collections
+from pathlib import Path
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Frame: topic length, payload length, topic (utf-8), payload
+FRAME_HEADER = struct.Struct("<HI")
+MAX_PAYLOAD_BYTES = 64*1024*1024
+POLL_INTERVAL = 0.01
+
+def encode_frame(topic: str, payload: bytes) -> bytes:
+    topic_bytes = topic.encode()
+    return FRAME_HEADER.pack(len(topic_bytes), len(payload)) + topic_bytes + payload
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+class HandoffClient(object):
+    """Hands pre-encoded messages to the persistmq-bridge via a Unix domain socket
+
+    Can replace the paho client of an MQTT storage endpoint (same publish signature),
+    the messages skip the local broker. The socket provides the backpressure: if the
+    bridge does not read for send_timeout_sec, the message is kept in a bounded pending
+    queue and sent with the next publish after the connection was established again.
+
+    Parameters:
+        socket_path: path of the Unix socket of the bridge
+        send_timeout_sec: max. time a publish blocks while the bridge is busy
+        max_pending: max. number of pending messages (the oldest are dropped)
+        reconnect_interval_sec: min. interval of connection attempts
+    """
+    def __init__(self, socket_path: str | Path, send_timeout_sec: float = 1.0, max_pending: int = 1000,
+                 reconnect_interval_sec: float = 1.0):
+        self._socket_path = str(socket_path)
+        self._send_timeout_sec = send_timeout_sec
+        self._reconnect_interval_sec = reconnect_interval_sec
+        self._lock = threading.Lock()
+        self._sock = None
+        self._last_connect_ts = -float("inf")
+        self._pending = collections.deque(maxlen=max_pending)
+        self.sent_messages = 0
+        self.dropped_messages = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    @property
+    def num_pending(self) -> int:
+        return len(self._pending)
+
+    def _connect(self) -> bool:
+        now = time.monotonic()
+        if now < self._last_connect_ts + self._reconnect_interval_sec:
+            return False
+        self._last_connect_ts = now
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._send_timeout_sec)
+        try:
+            sock.connect(self._socket_path)
+        except OSError as e:
+            sock.close()
+            logger.debug(f"HandoffClient: connection to {self._socket_path} failed: {e}")
+            return False
+        logger.info(f"HandoffClient: connected to {self._socket_path}")
+        self._sock = sock
+        return True
+
+    def _disconnect(self):
+        # A partially sent frame is discarded by the bridge at connection close
+        self._sock.close()
+        self._sock = None
+
+    def publish(self, topic: str, payload: bytes | str, qos: int = 0, retain: bool = False):
+        """Send one message (qos and retain are accepted for compatibility and ignored)"""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped_messages += 1
+                if self.dropped_messages % 1000 == 1:
+                    logger.warning(f"HandoffClient: pending queue full - {self.dropped_messages:d} messages dropped")
+            self._pending.append((topic, payload))
+            if self._sock is None and not self._connect():
+                return
+            while self._pending:
+                try:
+                    self._sock.sendall(encode_frame(*self._pending[0]))
+                except OSError as e:
+                    logger.warning(f"HandoffClient: sending failed, {len(self._pending):d} messages pending: {e}")
+                    self._disconnect()
+                    break
+                self._pending.popleft()
+                self.sent_messages += 1
+
+    def loop_stop(self):
+        """Close the connection (name compatible with the paho client)"""
+        with self._lock:
+            if self._sock is not None:
+                self._disconnect()
+
+
+class HandoffServer(threading.Thread):
+    """Receives the messages of HandoffClients on a Unix domain socket
+
+    Every connection is read by its own thread, which puts the messages into a queue of
+    max_queued messages. One forwarding thread passes them to handler; with get_backlog,
+    it waits while the backlog of the sender exceeds max_backlog. Once the queue is full,
+    the connections are not read anymore, so the backpressure reaches the producers.
+
+    Parameters:
+        socket_path: path of the Unix socket
+        handler: function called with (topic, payload) of each message
+        max_queued: max. number of received messages not yet passed to handler
+        get_backlog: returns the backlog of the sender (e.g. number of cached records)
+        max_backlog: max. backlog of the sender to pass further messages to handler
+    """
+    def __init__(self, socket_path: str | Path, handler: Callable[[str, bytes], None], max_queued: int = 1000,
+                 get_backlog: Callable[[], int] | None = None, max_backlog: int = 10000):
+        super().__init__(name="HandoffServer", daemon=True)
+        self._socket_path = Path(socket_path)
+        self._handler = handler
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._get_backlog = get_backlog
+        self._max_backlog = max_backlog
+        self._forwarder = threading.Thread(target=self._forward_messages, name="HandoffForwarder", daemon=True)
+        self._socket_path.parent.mkdir(parents=True, exist_ok=True)
+        self._socket_path.unlink(missing_ok=True)
+        self._server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server_sock.bind(str(self._socket_path))
+        self._server_sock.listen()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._stopped = False
+        self.received_messages = 0
+
+    def run(self):
+        self._forwarder.start()
+        while not self._stopped:
+            try:
+                conn, _ = self._server_sock.accept()
+            except OSError:
+                break
+            with self._lock:
+                self._connections.append(conn)
+            threading.Thread(target=self._read_connection, args=(conn,), name="HandoffReader", daemon=True).start()
+
+    def _read_connection(self, conn: socket.socket):
+        try:
+            while True:
+                topic_len, payload_len = FRAME_HEADER.unpack(_recv_exact(conn, FRAME_HEADER.size))
+                if payload_len > MAX_PAYLOAD_BYTES:
+                    logger.error(f"HandoffServer: payload of {payload_len:d} bytes too large - closing connection")
+                    break
+                topic = _recv_exact(conn, topic_len).decode()
+                payload = _recv_exact(conn, payload_len)
+                self.received_messages += 1
+                while not self._stopped:
+                    try:
+                        self._queue.put((topic, payload), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+
+    def _forward_messages(self):
+        while not (self._stopped and self._queue.empty()):
+            try:
+                topic, payload = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            while self._get_backlog is not None and self._get_backlog() > self._max_backlog and not self._stopped:
+                time.sleep(POLL_INTERVAL)
+            self._handler(topic, payload)
+
+    def stop(self, timeout: float = 5.0):
+        """Stop accepting, close all connections and pass the queued messages to handler"""
+        self._stopped = True
+        self._server_sock.shutdown(socket.SHUT_RDWR)
+        self._server_sock.close()
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.join()
+        self._forwarder.join(timeout)
+        if self._forwarder.is_alive():
+            logger.warning(f"HandoffServer: {self._queue.qsize():d} messages not forwarded at stop")
+        self._socket_path.unlink(missing_ok=True)
+
+def attach_handoff_client(endpoint, endpoint_config: dict) -> HandoffClient | None:
+    """Replace the MQTT client of a storage endpoint by a HandoffClient if handoff_socket is configured"""
+    socket_path = endpoint_config.get("handoff_socket", "")
+    if not socket_path:
+        return None
+    handoff_client = HandoffClient(socket_path,
+                                   send_timeout_sec=endpoint_config.get("handoff_send_timeout_sec", 1.0),
+                                   max_pending=endpoint_config.get("handoff_max_pending", 1000))
+    # Close the broker connection of the replaced client (sends DISCONNECT, then stops its network thread)
+    endpoint._client.disconnect()
+    endpoint._client.loop_stop()
+    endpoint._client = handoff_client
+    logger.info(f"Endpoint {endpoint.name:s}: messages handed over to the bridge via {socket_path}")
+    return handoff_client
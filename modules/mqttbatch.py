@@ -0,0 +1,166 @@
+import time
+import queue
+import logging
+import threading
+import cbor2
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Check if a topic matches an MQTT topic filter (wildcards + and #)"""
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for idx, filter_part in enumerate(filter_parts):
+        if filter_part == "#":
+            return True
+        if idx >= len(topic_parts) or (filter_part != "+" and filter_part != topic_parts[idx]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+def split_bulk_topic(topic: str, bulk_topic_rewrite: str) -> Tuple[str, str]:
+    """Split a topic into prefix and subtopic (same number of levels as bulk_topic_rewrite)
+
+    Topics with no more levels than bulk_topic_rewrite have an empty prefix.
+    """
+    topic_parts = topic.split("/")
+    num_subtopic_parts = len(bulk_topic_rewrite.split("/"))
+    if len(topic_parts) <= num_subtopic_parts:
+        return "", topic
+    return "/".join(topic_parts[:-num_subtopic_parts]), "/".join(topic_parts[-num_subtopic_parts:])
+
+def join_topic(prefix: str, subtopic: str) -> str:
+    """Join prefix and subtopic (without leading "/" for an empty prefix)"""
+    return prefix + "/" + subtopic if prefix else subtopic
+
+def encode_bulk(prefix: str, messages: List[Tuple[str, bytes]], bulk_topic_rewrite: str) -> Tuple[str, bytes]:
+    """Encode messages (subtopic, payload) with the bulk format of persistmq
+
+    Returns:
+        topic and payload of the bulk message
+    """
+    payload = [{"subtopic": subtopic, "payload": msg_payload} for subtopic, msg_payload in messages]
+    return join_topic(prefix, bulk_topic_rewrite), cbor2.dumps(payload)
+
+def decode_bulk(topic: str, payload: bytes, bulk_topic_rewrite: str) -> List[Tuple[str, bytes]]:
+    """Decode a message into the list of contained messages (topic, payload)
+
+    Non-bulk messages are returned unchanged; bulk messages may be nested (a bulk
+    message cached by persistmq is bulked again).
+    """
+    prefix, subtopic = split_bulk_topic(topic, bulk_topic_rewrite)
+    if subtopic != bulk_topic_rewrite:
+        return [(topic, payload)]
+    messages = []
+    for entry in cbor2.loads(payload):
+        messages += decode_bulk(join_topic(prefix, entry["subtopic"]), entry["payload"], bulk_topic_rewrite)
+    return messages
+
+
+class MessageBatcher(threading.Thread):
+    """Batches the local messages for the persistent sender
+
+    The reader callback only puts the messages into a bounded queue. The batcher thread
+    collects them per priority and topic prefix and sends a bulk message (persistmq bulk
+    format) as soon as max_count messages or max_bytes of payload are collected or the
+    oldest message waits for max_delay_sec. Batches due at the same time are sent in
+    order of priority (0 first). A batch of a single message is sent unchanged, as well
+    as messages with no more topic levels than bulk_topic_rewrite (no prefix to batch by).
+
+    Parameters:
+        publish: publish function of the sender (topic, payload, priority)
+        bulk_topic_rewrite: topic postfix of bulk messages
+        max_count: max. number of messages per batch
+        max_bytes: max. payload bytes per batch
+        max_delay_sec: max. time a message waits for its batch
+        max_queued: max. number of messages in the queue (further messages are dropped)
+    """
+    def __init__(self, publish: Callable[[str, bytes, int], None], bulk_topic_rewrite: str = "mixed/cbor", max_count: int = 100,
+                 max_bytes: int = 256*1024, max_delay_sec: float = 1.0, max_queued: int = 10000):
+        super().__init__(name="MessageBatcher", daemon=True)
+        self._publish = publish
+        self._bulk_topic_rewrite = bulk_topic_rewrite
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._max_delay_sec = max_delay_sec
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._pending = {}
+        self.received_messages = 0
+        self.sent_batches = 0
+        self.dropped_messages = 0
+
+    def put(self, topic: str, payload: bytes, priority: int = 1, block: bool = False) -> bool:
+        """Queue one message; False if the queue is full and the message was dropped
+
+        With block, the call waits for space in the queue instead (backpressure).
+        """
+        try:
+            self._queue.put((topic, payload, priority), block=block)
+        except queue.Full:
+            self.dropped_messages += 1
+            if self.dropped_messages % 1000 == 1:
+                logger.warning(f"MessageBatcher: queue full - {self.dropped_messages:d} messages dropped")
+            return False
+        return True
+
+    def _add(self, topic: str, payload: bytes, priority: int):
+        self.received_messages += 1
+        prefix, subtopic = split_bulk_topic(topic, self._bulk_topic_rewrite)
+        if not prefix:
+            self._publish(topic, payload, priority)
+            return
+        key = (priority, prefix)
+        if key not in self._pending:
+            self._pending[key] = {"messages": [], "bytes": 0, "deadline": time.monotonic() + self._max_delay_sec}
+        batch = self._pending[key]
+        batch["messages"].append((subtopic, payload))
+        batch["bytes"] += len(payload)
+        if len(batch["messages"]) >= self._max_count or batch["bytes"] >= self._max_bytes:
+            self._flush(key)
+
+    def _flush(self, key: tuple):
+        priority, prefix = key
+        messages = self._pending.pop(key)["messages"]
+        if len(messages) == 1:
+            self._publish(join_topic(prefix, messages[0][0]), messages[0][1], priority)
+        else:
+            self._publish(*encode_bulk(prefix, messages, self._bulk_topic_rewrite), priority)
+        self.sent_batches += 1
+
+    def run(self):
+        while True:
+            if self._pending:
+                timeout = max(min(batch["deadline"] for batch in self._pending.values()) - time.monotonic(), 0.0)
+            else:
+                timeout = None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                self._add(*item)
+            now = time.monotonic()
+            for key in sorted(key for key, batch in self._pending.items() if batch["deadline"] <= now):
+                self._flush(key)
+        for key in sorted(self._pending):
+            self._flush(key)
+
+    def stop(self):
+        """Send the queued messages and stop the thread"""
+        self._queue.put(None)
+        self.join()
+
+    @classmethod
+    def from_config(cls, config: dict, publish: Callable[[str, bytes, int], None]):
+        """Create the batcher from the [batching] section; None if not enabled"""
+        batching_config = config.get("batching", {})
+        if not batching_config.get("enabled", False):
+            return None
+        return cls(publish,
+                   bulk_topic_rewrite=config.get("bulk_messages", {}).get("bulk_topic_rewrite", "mixed/cbor"),
+                   max_count=batching_config.get("max_count", 100),
+                   max_bytes=batching_config.get("max_bytes", 256*1024),
+                   max_delay_sec=batching_config.get("max_delay_sec", 1.0),
+                   max_queued=batching_config.get("max_queued", 10000))
@@ -0,0 +1,101 @@
+import time
+import logging
+from typing import List
+
+from modules.mqttbatch import topic_matches
+
+logger = logging.getLogger(__name__)
+
+class PriorityLane(object):
+    """Topic lane of the bridge with priority and rate limits
+
+    Parameters:
+        name: name of the lane
+        topics: topic filters (MQTT wildcards) of the lane
+        priority: 0 is the highest priority; lanes with priority 0 are never limited
+        min_interval_sec: min. interval of messages per topic (0: unlimited)
+        backlog_min_interval_sec: min. interval of messages per topic while the cache is above the low watermark
+        drop_watermark: cached items above which all messages of the lane are dropped (0: never)
+    """
+    def __init__(self, name: str, topics: List[str], priority: int = 1, min_interval_sec: float = 0.0,
+                 backlog_min_interval_sec: float = 0.0, drop_watermark: int = 0):
+        self.name = name
+        self.topics = topics
+        self.priority = priority
+        self.min_interval_sec = min_interval_sec
+        self.backlog_min_interval_sec = backlog_min_interval_sec
+        self.drop_watermark = drop_watermark
+        self.passed_messages = 0
+        self.dropped_messages = 0
+
+
+class PriorityGate(object):
+    """Admits the local messages of the bridge depending on their lane and the cache backlog
+
+    The persistent sender sends and caches in arrival order (the tiered cache in front of
+    it hands over cached records by priority). To keep the backlog bounded
+    and let events and aggregates recover quickly after an outage, messages of low
+    priority lanes are downsampled (per topic) once the number of cached items passes
+    low_watermark and dropped above the drop_watermark of their lane.
+    Topics not matching any lane belong to a default lane with priority 1 without limits.
+
+    Parameters:
+        lanes: the configured lanes (first matching lane is used)
+        low_watermark: cached items above which the backlog limits apply
+    """
+    def __init__(self, lanes: List[PriorityLane], low_watermark: int = 1000):
+        self.lanes = lanes
+        self._default_lane = PriorityLane("default", ["#"])
+        self._low_watermark = low_watermark
+        self._cached_items = 0
+        self._topic_lanes = {}
+        self._last_pass_ts = {}
+
+    def update_backlog(self, cached_items: int):
+        """Update the number of cached items of the persistent sender"""
+        if (cached_items > self._low_watermark) != (self._cached_items > self._low_watermark):
+            logger.info(f"PriorityGate: {cached_items:d} cached items - backlog limits {'active' if cached_items > self._low_watermark else 'released'}")
+        self._cached_items = cached_items
+
+    def get_lane(self, topic: str) -> PriorityLane:
+        """Return the lane of a topic"""
+        lane = self._topic_lanes.get(topic)
+        if lane is None:
+            lane = next((lane for lane in self.lanes if any(topic_matches(topic_filter, topic) for topic_filter in lane.topics)),
+                        self._default_lane)
+            self._topic_lanes[topic] = lane
+        return lane
+
+    def admit(self, topic: str, now: float = None) -> PriorityLane | None:
+        """Check a message; returns its lane or None if the message is dropped"""
+        lane = self.get_lane(topic)
+        if lane.priority > 0:
+            if lane.drop_watermark and self._cached_items > lane.drop_watermark:
+                lane.dropped_messages += 1
+                return None
+            min_interval_sec = lane.min_interval_sec
+            if self._cached_items > self._low_watermark:
+                min_interval_sec = max(min_interval_sec, lane.backlog_min_interval_sec)
+            if min_interval_sec:
+                now = time.monotonic() if now is None else now
+                if now < self._last_pass_ts.get(topic, -float("inf")) + min_interval_sec:
+                    lane.dropped_messages += 1
+                    return None
+                self._last_pass_ts[topic] = now
+        lane.passed_messages += 1
+        return lane
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """Create the gate from the [priority] section; None if not configured"""
+        priority_config = config.get("priority", {})
+        lanes = [PriorityLane(name,
+                              topics=lane_config["topics"],
+                              priority=lane_config.get("priority", 1),
+                              min_interval_sec=lane_config.get("min_interval_sec", 0.0),
+                              backlog_min_interval_sec=lane_config.get("backlog_min_interval_sec", 0.0),
+                              drop_watermark=lane_config.get("drop_watermark", 0))
+                 for name, lane_config in priority_config.get("lane", {}).items()]
+        if not lanes:
+            return None
+        return cls(lanes, low_watermark=priority_config.get("low_watermark", 1000))
@@ -0,0 +1,299 @@
+import uuid
+import importlib.metadata
+import time
+import logging
+import numpy as np
+from typing import List
+
+from daqopen.channelbuffer import AcqBuffer
+from pqopen.powersystem import PowerSystem
+from pqopen.eventdetector import Event
+import pqopen.powerquality as pq
+
+logger = logging.getLogger(__name__)
+
+SHEDDABLE_FEATURES = ["mains_signaling_tracer", "fluctuation", "harmonics"]
+EVENT_TYPE = "OVERLOAD_SHED"
+
+class PowerSystemHooks(object):
+    """Access to the internals of the pqopen-lib PowerSystem required for shedding features
+
+    pqopen-lib has no public API to change the calculations of a running PowerSystem, so all
+    accesses to its private attributes are collected here. They are checked on creation and a
+    RuntimeError naming the installed pqopen-lib version is raised if one of them is missing.
+
+    Parameters:
+        power_system: the (configured) PowerSystem
+    """
+    POWER_SYSTEM_ATTRS = ["_phases", "_features", "_samplerate", "_nominal_voltage", "_harm_fft_resample_size", "_pst_last_calc_sidx"]
+    PHASE_ATTRS = ["_calc_channels", "_mains_signaling_tracer"]
+    CHANNEL_ATTRS = ["_data", "last_write_idx", "sample_count"]
+
+    def __init__(self, power_system: PowerSystem):
+        self._power_system = power_system
+        self._check(power_system, self.POWER_SYSTEM_ATTRS)
+        for phase in power_system._phases:
+            self._check(phase, self.PHASE_ATTRS)
+            if "multi_period" not in phase._calc_channels or "voltage" not in phase._calc_channels["multi_period"]:
+                self._mismatch("phase._calc_channels['multi_period']['voltage']")
+            for channel in phase._calc_channels["multi_period"]["voltage"].values():
+                self._check(channel, self.CHANNEL_ATTRS)
+
+    def _check(self, obj, attrs: List[str]):
+        for attr in attrs:
+            if not hasattr(obj, attr):
+                self._mismatch(f"{type(obj).__name__:s}.{attr:s}")
+
+    @staticmethod
+    def _mismatch(name: str):
+        try:
+            version = importlib.metadata.version("pqopen-lib")
+        except importlib.metadata.PackageNotFoundError:
+            version = "unknown"
+        raise RuntimeError(f"OverloadGuard: pqopen-lib {version:s} not supported, {name:s} not found")
+
+    @property
+    def features(self) -> dict:
+        return self._power_system._features
+
+    @property
+    def harm_fft_resample_size(self) -> int:
+        return self._power_system._harm_fft_resample_size
+
+    @harm_fft_resample_size.setter
+    def harm_fft_resample_size(self, resample_size: int):
+        self._power_system._harm_fft_resample_size = resample_size
+
+    @property
+    def tracers(self) -> list:
+        """Mains signaling tracers of the phases"""
+        return [phase._mains_signaling_tracer for phase in self._power_system._phases]
+
+    @tracers.setter
+    def tracers(self, tracers: list):
+        for phase, tracer in zip(self._power_system._phases, tracers):
+            phase._mains_signaling_tracer = tracer
+
+    def voltage_channels(self, phys_type: str) -> list:
+        """Multi-period voltage channels of the given type of all phases"""
+        return [phase._calc_channels["multi_period"]["voltage"][phys_type] for phase in self._power_system._phases
+                if phys_type in phase._calc_channels["multi_period"]["voltage"]]
+
+    @staticmethod
+    def invalidate_last_samples(channel, num_samples: int, start_col: int = 0):
+        """Set the last num_samples samples of the channel to NaN (from column start_col on if multi-dimensional)"""
+        num_samples = min(num_samples, len(channel._data))
+        if num_samples <= 0:
+            return
+        row_idx = (channel.last_write_idx - np.arange(1, num_samples+1)) % len(channel._data)
+        if channel._data.ndim > 1:
+            channel._data[row_idx, start_col:] = np.nan
+        else:
+            channel._data[row_idx] = np.nan
+        channel.last_sample_value = channel._data[(channel.last_write_idx-1) % len(channel._data)]
+
+    def restart_fluctuation_calc(self):
+        """Restart the flicker calculation with new processors, the actual (unfinished) Pst interval is skipped"""
+        ps = self._power_system
+        if ps._nominal_voltage is None:
+            return
+        for phase in ps._phases:
+            phase._voltage_fluctuation_processor = pq.VoltageFluctuation(samplerate=ps._samplerate,
+                                                                         nominal_volt=ps._nominal_voltage,
+                                                                         nominal_freq=ps.nominal_frequency)
+        ps._pst_last_calc_sidx = 0
+
+def restart_fluctuation_calc(power_system: PowerSystem):
+    """Restart the flicker calculation with new processors, the actual (unfinished) Pst interval is skipped"""
+    PowerSystemHooks(power_system).restart_fluctuation_calc()
+
+class _ShedTracer(object):
+    """Replaces the mains signaling tracer of a phase while it is shed"""
+    def process(self, data: np.ndarray):
+        return None, np.nan
+
+
+class PacketAgeBacklog(object):
+    """Estimates the receive backlog from the age of the packets
+
+    The age of a packet (processing time - packet timestamp) consists of a constant part
+    (packet duration, transport, clock offset) and the time the packet waited in the
+    receive queue. The constant part is tracked as minimum age, which is allowed to rise
+    slowly to follow clock adjustments.
+
+    Parameters:
+        baseline_rise_rate: rise of the baseline in seconds per second of data
+    """
+    def __init__(self, baseline_rise_rate: float = 0.001):
+        self._baseline_rise_rate = baseline_rise_rate
+        self._baseline = None
+
+    def update(self, packet_age: float, data_seconds: float) -> float:
+        """Update with the age of the actual packet and return the backlog in seconds"""
+        if self._baseline is None:
+            self._baseline = packet_age
+        self._baseline = min(self._baseline + data_seconds*self._baseline_rise_rate, packet_age)
+        return packet_age - self._baseline
+
+
+class OverloadGuard(object):
+    """Sheds optional calculations of the PowerSystem while processing falls behind
+
+    The processing is overloaded if the smoothed real-time factor (processing time / data
+    duration) exceeds shed_rtf or the backlog exceeds max_backlog_sec. Then the next
+    feature of the shed order is disabled, at most one per rtf_time_constant_sec. Features
+    are re-enabled in reverse order when the smoothed real-time factor is below restore_rtf
+    without backlog, at the earliest hold_sec after the last change. Each shedding is reported as event of type OVERLOAD_SHED with the name of
+    the feature as channel, which is finished when the feature is re-enabled.
+
+    Shedding harmonics reduces the voltage FFT to the size required for harmonics up to
+    harmonics_max_order, higher orders and the THD (which would only cover the kept orders)
+    are set to NaN. The internals of the PowerSystem are accessed via PowerSystemHooks.
+
+    Parameters:
+        power_system: the (configured) PowerSystem
+        time_channel: time channel of the AcqBufferPool (for event timestamps)
+        shed_order: features in the order they are shed
+        harmonics_max_order: highest harmonic order kept while harmonics are shed
+        shed_rtf: real-time factor above which a feature is shed
+        restore_rtf: real-time factor below which a feature is re-enabled
+        max_backlog_sec: backlog in seconds above which a feature is shed
+        hold_sec: min. time in seconds (of data) after a change before a feature is re-enabled
+        rtf_time_constant_sec: time constant of the real-time factor smoothing
+    """
+    def __init__(self, power_system: PowerSystem, time_channel: AcqBuffer,
+                 shed_order: List[str] = SHEDDABLE_FEATURES, harmonics_max_order: int = 25,
+                 shed_rtf: float = 0.9, restore_rtf: float = 0.6, max_backlog_sec: float = 1.0,
+                 hold_sec: float = 30.0, rtf_time_constant_sec: float = 10.0):
+        self._power_system = power_system
+        self._hooks = PowerSystemHooks(power_system)
+        self._time_channel = time_channel
+        self._harmonics_max_order = harmonics_max_order
+        self._shed_rtf = shed_rtf
+        self._restore_rtf = restore_rtf
+        self._max_backlog_sec = max_backlog_sec
+        self._hold_sec = hold_sec
+        self._rtf_time_constant_sec = rtf_time_constant_sec
+        unknown = set(shed_order) - set(SHEDDABLE_FEATURES)
+        if unknown:
+            raise ValueError(f"Features can not be shed: {unknown}")
+        self._shed_order = [feature for feature in shed_order if self._is_sheddable(feature)]
+        self._shed_events: List[Event] = []
+        self._pending_events: List[Event] = []
+        self._rtf = 0.0
+        self._seconds_since_change = hold_sec
+        self._orig_harm_fft_resample_size = self._hooks.harm_fft_resample_size
+        self._orig_tracers = self._hooks.tracers
+        # Channels invalidated while harmonics are shed, with the first invalid column
+        self._harm_channels = [(channel, self._harmonics_max_order+1) for phys_type in ["harm_rms", "iharm_rms"]
+                               for channel in self._hooks.voltage_channels(phys_type)]
+        self._harm_channels += [(channel, 0) for channel in self._hooks.voltage_channels("thd")]
+        self._harm_masked_count = [channel.sample_count for channel, _ in self._harm_channels]
+
+    def _is_sheddable(self, feature: str) -> bool:
+        features = self._hooks.features
+        if not features.get(feature):
+            return False
+        if feature == "harmonics":
+            # The hf 1khz band uses a window of the (full) resample size
+            if features.get("hf_1khz_band_calculation") or features["harmonics"] <= self._harmonics_max_order:
+                return False
+        return True
+
+    @property
+    def shed_features(self) -> List[str]:
+        """Features which are actually shed"""
+        return [event.channel for event in self._shed_events]
+
+    @property
+    def rtf(self) -> float:
+        """Smoothed real-time factor"""
+        return self._rtf
+
+    def update(self, rtf: float, data_seconds: float, backlog_sec: float = 0.0):
+        """Update with the statistics of the last processing cycle
+
+        Parameters:
+            rtf: real-time factor of the cycle
+            data_seconds: duration of the data processed in the cycle
+            backlog_sec: duration of the data waiting for processing
+        """
+        if data_seconds <= 0:
+            return
+        alpha = min(data_seconds/self._rtf_time_constant_sec, 1.0)
+        self._rtf += alpha*(rtf - self._rtf)
+        self._seconds_since_change += data_seconds
+        overloaded = self._rtf > self._shed_rtf or backlog_sec > self._max_backlog_sec
+        if overloaded:
+            # Give the smoothed real-time factor time to settle before shedding the next feature
+            if len(self._shed_events) < len(self._shed_order) and self._seconds_since_change >= self._rtf_time_constant_sec:
+                self._shed(self._shed_order[len(self._shed_events)])
+        elif self._shed_events and self._rtf < self._restore_rtf and self._seconds_since_change >= self._hold_sec:
+            self._restore()
+
+    def _last_timestamp(self) -> tuple:
+        if self._time_channel.sample_count == 0:
+            return time.time(), 0
+        sidx = self._time_channel.sample_count - 1
+        return self._time_channel.read_data_by_index(sidx, sidx+1)[0]/1e6, sidx
+
+    def _shed(self, feature: str):
+        if feature == "mains_signaling_tracer":
+            self._hooks.tracers = [_ShedTracer() for _ in self._orig_tracers]
+        elif feature == "fluctuation":
+            self._hooks.features["fluctuation"] = False
+        elif feature == "harmonics":
+            resample_size = 2**int(np.ceil(np.log2(2*(self._harmonics_max_order+1)*self._power_system.nper)))
+            self._hooks.harm_fft_resample_size = min(max(resample_size, 1024), self._orig_harm_fft_resample_size)
+        timestamp, sidx = self._last_timestamp()
+        event = Event(start_ts=float(timestamp), stop_ts=None, start_sidx=sidx, stop_sidx=None,
+                      extrem_value=float(self._rtf), channel=feature, type=EVENT_TYPE, id=uuid.uuid4())
+        self._shed_events.append(event)
+        self._pending_events.append(event)
+        self._seconds_since_change = 0.0
+        logger.warning(f"OverloadGuard: shed {feature:s} (rtf {self._rtf:.2f})")
+
+    def _restore(self):
+        shed_event = self._shed_events.pop()
+        feature = shed_event.channel
+        if feature == "mains_signaling_tracer":
+            self._hooks.tracers = self._orig_tracers
+        elif feature == "fluctuation":
+            self._hooks.restart_fluctuation_calc()
+            self._hooks.features["fluctuation"] = True
+        elif feature == "harmonics":
+            self._hooks.harm_fft_resample_size = self._orig_harm_fft_resample_size
+        timestamp, sidx = self._last_timestamp()
+        self._pending_events.append(Event(start_ts=shed_event.start_ts, stop_ts=float(timestamp),
+                                          start_sidx=shed_event.start_sidx, stop_sidx=sidx,
+                                          extrem_value=shed_event.extrem_value, channel=feature,
+                                          type=EVENT_TYPE, id=shed_event.id))
+        self._seconds_since_change = 0.0
+        logger.info(f"OverloadGuard: restored {feature:s} (rtf {self._rtf:.2f})")
+
+    def post_process(self):
+        """Invalidate the harmonics above the max. order and the THD calculated while shed; call after PowerSystem.process()"""
+        harmonics_shed = "harmonics" in self.shed_features
+        for idx, (channel, start_col) in enumerate(self._harm_channels):
+            num_new = channel.sample_count - self._harm_masked_count[idx]
+            self._harm_masked_count[idx] = channel.sample_count
+            if harmonics_shed:
+                self._hooks.invalidate_last_samples(channel, num_new, start_col)
+
+    def get_events(self) -> List[Event]:
+        """Return the shed/restore events since the last call"""
+        events = self._pending_events
+        self._pending_events = []
+        return events
+
+    @classmethod
+    def from_config(cls, guard_config: dict, power_system: PowerSystem, time_channel: AcqBuffer) -> "OverloadGuard":
+        """Create the guard from the [overload_guard] section of the config"""
+        return cls(power_system, time_channel,
+                   shed_order=guard_config.get("shed_order", SHEDDABLE_FEATURES),
+                   harmonics_max_order=guard_config.get("harmonics_max_order", 25),
+                   shed_rtf=guard_config.get("shed_rtf", 0.9),
+                   restore_rtf=guard_config.get("restore_rtf", 0.6),
+                   max_backlog_sec=guard_config.get("max_backlog_sec", 1.0),
+                   hold_sec=guard_config.get("hold_sec", 30.0),
+                   rtf_time_constant_sec=guard_config.get("rtf_time_constant_sec", 10.0))
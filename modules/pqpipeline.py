@@ -0,0 +1,428 @@
+import mmap
+import os
+import json
+import time
+import struct
+import uuid
+import dataclasses
+import logging
+import multiprocessing
+import numpy as np
+from typing import List
+
+from daqopen.channelbuffer import AcqBufferPool, AcqBuffer, DataChannelBuffer
+from daqopen.daqinfo import DaqInfo
+from daqopen.helper import GracefulKiller
+from pqopen.eventdetector import Event
+
+from modules.pqprocessing import create_power_system, create_storage_controller, create_event_controller, create_metrics_reporter, create_overload_guard
+from modules.pqprocessing import create_waveform_capture
+from modules.pqprocessing import create_gap_handler, create_power_system_checkpoint, create_storage_checkpoint
+from modules.stagetimer import StageTimer
+from modules.gaprecovery import GapLog
+
+logger = logging.getLogger(__name__)
+
+# Indices of the shared counters
+ACQ_COUNT = 0        # Samples written to the shared AcqBufferPool
+PS_COUNT = 1         # Samples processed by the PowerSystem stage
+OUTPUT_COUNT = 2     # Samples processed by the output stage
+STOP_FLAG = 3
+NUM_COUNTERS = 8
+
+POLL_INTERVAL = 0.001
+
+BATCH_HEADER = struct.Struct("<qII")    # acq sample count, number of channels, size of events json
+CHANNEL_HEADER = struct.Struct("<II")   # channel index, number of samples
+
+def share_acq_buffer_pool(daq_buffer: AcqBufferPool) -> mmap.mmap:
+    """Move the data of all AcqBuffers of the pool into one anonymous shared memory block
+
+    Processes forked afterwards see the data written by the parent without copying.
+    """
+    buffers: List[AcqBuffer] = list(daq_buffer.channel.values()) + [daq_buffer.time]
+    offsets = []
+    total_size = 0
+    for acq_buffer in buffers:
+        offsets.append(total_size)
+        total_size += acq_buffer._data.nbytes
+        total_size += -total_size % 64
+    shm = mmap.mmap(-1, max(total_size, 1))
+    for acq_buffer, offset in zip(buffers, offsets):
+        shared_data = np.ndarray(acq_buffer._data.shape, dtype=acq_buffer._data.dtype, buffer=shm, offset=offset)
+        shared_data[:] = acq_buffer._data
+        acq_buffer._data = shared_data
+    return shm
+
+def set_acq_sample_count(daq_buffer: AcqBufferPool, sample_count: int):
+    """Update the local view of a shared AcqBufferPool to the given sample count"""
+    for acq_buffer in list(daq_buffer.channel.values()) + [daq_buffer.time]:
+        acq_buffer.sample_count = sample_count
+        acq_buffer.last_write_idx = sample_count % len(acq_buffer._data)
+
+
+class ShmMessageRing(object):
+    """Single producer, single consumer message ring in anonymous shared memory
+
+    Must be created before forking producer and consumer process. Messages are
+    prefixed with their length and aligned to 8 bytes; a length of -1 marks the
+    unused end of the ring before wrapping around.
+    """
+    HEADER_SIZE = 64
+    MSG_HEADER = struct.Struct("<q")
+    WRAP_MARKER = -1
+
+    def __init__(self, capacity: int = 4*1024*1024):
+        self._capacity = capacity - capacity % 8
+        self._mmap = mmap.mmap(-1, self.HEADER_SIZE + self._capacity)
+        self._pos = np.ndarray(2, dtype=np.int64, buffer=self._mmap) # write pos, read pos
+        self._data = np.ndarray(self._capacity, dtype=np.uint8, buffer=self._mmap, offset=self.HEADER_SIZE)
+        self._pending_size = 0
+
+    def write(self, parts: list, stop_callback = None) -> bool:
+        """Write one message consisting of the concatenated parts; blocks while the ring is full
+
+        Parameters:
+            parts: list of bytes-like objects (contiguous)
+            stop_callback: optional callable, waiting is cancelled when it returns True
+
+        Returns:
+            False if waiting was cancelled
+        """
+        parts = [np.frombuffer(part, dtype=np.uint8) for part in parts]
+        payload_size = sum(part.size for part in parts)
+        msg_size = self.MSG_HEADER.size + payload_size
+        msg_size += -msg_size % 8
+        if msg_size > self._capacity:
+            raise ValueError(f"Message with {msg_size:d} bytes exceeds ring capacity")
+        write_pos = int(self._pos[0])
+        offset = write_pos % self._capacity
+        padding = self._capacity - offset if offset + msg_size > self._capacity else 0
+        while self._capacity - (write_pos - int(self._pos[1])) < msg_size + padding:
+            if stop_callback is not None and stop_callback():
+                return False
+            time.sleep(POLL_INTERVAL)
+        if padding:
+            self.MSG_HEADER.pack_into(self._mmap, self.HEADER_SIZE + offset, self.WRAP_MARKER)
+            write_pos += padding
+            offset = 0
+        self.MSG_HEADER.pack_into(self._mmap, self.HEADER_SIZE + offset, payload_size)
+        offset += self.MSG_HEADER.size
+        for part in parts:
+            self._data[offset:offset + part.size] = part
+            offset += part.size
+        self._pos[0] = write_pos + msg_size
+        return True
+
+    def read(self) -> memoryview | None:
+        """Return the next message (view into the ring) or None; call release() when done"""
+        while True:
+            read_pos = int(self._pos[1])
+            if read_pos == int(self._pos[0]):
+                return None
+            offset = read_pos % self._capacity
+            (payload_size,) = self.MSG_HEADER.unpack_from(self._mmap, self.HEADER_SIZE + offset)
+            if payload_size == self.WRAP_MARKER:
+                self._pos[1] = read_pos + self._capacity - offset
+                continue
+            msg_size = self.MSG_HEADER.size + payload_size
+            self._pending_size = msg_size + (-msg_size % 8)
+            start = self.HEADER_SIZE + offset + self.MSG_HEADER.size
+            return memoryview(self._mmap)[start:start + payload_size]
+
+    def release(self):
+        """Release the message returned by the last read()"""
+        self._pos[1] += self._pending_size
+        self._pending_size = 0
+
+
+def _events_to_json(events: List[Event]) -> bytes:
+    return json.dumps([{**dataclasses.asdict(event), "id": str(event.id)} for event in events]).encode()
+
+def _events_from_json(data: bytes) -> List[Event]:
+    return [Event(**{**event, "id": uuid.UUID(event["id"])}) for event in json.loads(data)]
+
+
+class ChannelForwarder(object):
+    """Sends new samples of output channels (DataChannelBuffer) and events through a ShmMessageRing"""
+    def __init__(self, output_channels: dict, ring: ShmMessageRing):
+        self._names = list(output_channels.keys())
+        self._channels: List[DataChannelBuffer] = list(output_channels.values())
+        self._sent_count = np.zeros(len(self._channels), dtype=np.int64)
+        self._ring = ring
+
+    def send_channel_names(self, stop_callback = None) -> bool:
+        return self._ring.write([json.dumps(self._names).encode()], stop_callback)
+
+    def send(self, acq_sample_count: int, stop_callback = None, events: List[Event] = []) -> bool:
+        """Send all samples added since the last call, tagged with the processed acq sample count"""
+        events_json = _events_to_json(events) if events else b""
+        parts = [b"", events_json, bytes(-len(events_json) % 8)]
+        num_channels = 0
+        for idx, channel in enumerate(self._channels):
+            num_new = channel.sample_count - self._sent_count[idx]
+            if num_new <= 0:
+                continue
+            num_new = min(num_new, len(channel._acq_sidx))
+            start_idx = channel.last_write_idx - num_new
+            if start_idx >= 0:
+                segments = [slice(start_idx, channel.last_write_idx)]
+            else:
+                segments = [slice(start_idx + len(channel._acq_sidx), len(channel._acq_sidx)), slice(0, channel.last_write_idx)]
+            parts.append(CHANNEL_HEADER.pack(idx, num_new))
+            parts.extend(channel._acq_sidx[segment] for segment in segments)
+            parts.extend(np.ascontiguousarray(channel._data[segment]) for segment in segments)
+            padding = -(num_new*channel._data[0].nbytes) % 8
+            if padding:
+                parts.append(bytes(padding))
+            self._sent_count[idx] = channel.sample_count
+            num_channels += 1
+        parts[0] = BATCH_HEADER.pack(acq_sample_count, num_channels, len(events_json))
+        return self._ring.write(parts, stop_callback)
+
+
+class ChannelReceiver(object):
+    """Receives samples sent by ChannelForwarder into local output channels"""
+    def __init__(self, output_channels: dict, ring: ShmMessageRing):
+        self._output_channels = output_channels
+        self._channels: List[DataChannelBuffer] = []
+        self._ring = ring
+        self._events: List[Event] = []
+
+    def recv_channel_names(self, stop_callback = None) -> bool:
+        while (msg := self._ring.read()) is None:
+            if stop_callback is not None and stop_callback():
+                return False
+            time.sleep(POLL_INTERVAL)
+        names = json.loads(bytes(msg))
+        msg.release()
+        self._ring.release()
+        missing = set(names) - set(self._output_channels)
+        if missing:
+            raise ValueError(f"Output channels differ between stages: {missing}")
+        self._channels = [self._output_channels[name] for name in names]
+        return True
+
+    def recv(self) -> int | None:
+        """Receive one batch
+
+        Returns:
+            The acq sample count the batch belongs to or None if no batch is available
+        """
+        msg = self._ring.read()
+        if msg is None:
+            return None
+        acq_sample_count, num_channels, events_size = BATCH_HEADER.unpack_from(msg, 0)
+        pos = BATCH_HEADER.size
+        if events_size:
+            self._events.extend(_events_from_json(bytes(msg[pos:pos + events_size])))
+        pos += events_size + (-events_size % 8)
+        for _ in range(num_channels):
+            idx, num_samples = CHANNEL_HEADER.unpack_from(msg, pos)
+            pos += CHANNEL_HEADER.size
+            channel = self._channels[idx]
+            acq_sidx = np.frombuffer(msg, dtype=np.int64, count=num_samples, offset=pos)
+            pos += acq_sidx.nbytes
+            sample_shape = channel._data.shape[1:]
+            values = np.frombuffer(msg, dtype=channel._data.dtype, count=num_samples*int(np.prod(sample_shape)), offset=pos)
+            pos += values.nbytes + (-values.nbytes % 8)
+            channel.put_data_multi(acq_sidx, values.reshape((num_samples,) + sample_shape))
+            # Do not keep a reference into the ring
+            channel.last_sample_value = channel._data[channel.last_write_idx-1]
+        self._ring.release()
+        return acq_sample_count
+
+    def get_events(self) -> List[Event]:
+        """Return the events received since the last call"""
+        events = self._events
+        self._events = []
+        return events
+
+
+def _set_cpu_affinity(cpu_affinity: dict, stage_name: str):
+    if stage_name in cpu_affinity:
+        os.sched_setaffinity(0, cpu_affinity[stage_name])
+
+def _power_system_stage(config: dict, daq_buffer: AcqBufferPool, samplerate: float, counters: np.ndarray, ring: ShmMessageRing,
+                        start_timestamp_us: int, timer: StageTimer, gap_log: GapLog):
+    killer = GracefulKiller()
+    _set_cpu_affinity(config.get("pipeline", {}).get("cpu_affinity", {}), "powersystem")
+    stop_callback = lambda: killer.kill_now or counters[STOP_FLAG]
+    power_system = create_power_system(config, daq_buffer, samplerate)
+    overload_guard = create_overload_guard(config, daq_buffer, power_system)
+    gap_handler = create_gap_handler(config, daq_buffer, power_system, gap_log)
+    ps_checkpoint = create_power_system_checkpoint(config, daq_buffer, power_system, samplerate, start_timestamp_us)
+    forwarder = ChannelForwarder(power_system.output_channels, ring)
+    if not forwarder.send_channel_names(stop_callback):
+        return
+    last_acq_count = 0
+    while not stop_callback():
+        acq_count = int(counters[ACQ_COUNT])
+        if acq_count == last_acq_count:
+            time.sleep(POLL_INTERVAL)
+            continue
+        timer.start()
+        set_acq_sample_count(daq_buffer, acq_count)
+        if gap_handler:
+            gap_handler.process()
+        power_system.process()
+        events = []
+        if overload_guard:
+            overload_guard.post_process()
+            events += overload_guard.get_events()
+        if gap_handler:
+            events += gap_handler.get_events()
+        if ps_checkpoint:
+            ps_checkpoint.process()
+        timer.mark("power_system")
+        if not forwarder.send(acq_count, stop_callback, events):
+            break
+        timer.mark("forward")
+        timer.finish_cycle((acq_count - last_acq_count)/samplerate)
+        if overload_guard:
+            overload_guard.update(timer.last_rtf, (acq_count - last_acq_count)/samplerate,
+                                  (int(counters[ACQ_COUNT]) - acq_count)/samplerate)
+        counters[PS_COUNT] = acq_count
+        last_acq_count = acq_count
+    # Energy counters are persisted when power_system is deleted
+
+def _output_stage(config: dict, daq_buffer: AcqBufferPool, daq_info: DaqInfo, counters: np.ndarray, ring: ShmMessageRing,
+                  measurement_id: str, device_id: str, start_timestamp_us: int, timers: dict):
+    killer = GracefulKiller()
+    _set_cpu_affinity(config.get("pipeline", {}).get("cpu_affinity", {}), "output")
+    stop_callback = lambda: killer.kill_now or counters[STOP_FLAG]
+    # Mirror of the PowerSystem, only its output channels are used and filled by the receiver
+    # Energy counters are persisted by the PowerSystem stage only
+    power_system = create_power_system(config, daq_buffer, daq_info.board.samplerate, persist_energy=False)
+    receiver = ChannelReceiver(power_system.output_channels, ring)
+    storage_controller = create_storage_controller(config, daq_buffer, power_system, daq_info, measurement_id, device_id, start_timestamp_us)
+    event_controller = create_event_controller(config, daq_buffer, power_system, daq_info.board.samplerate)
+    waveform_capture = create_waveform_capture(config, daq_buffer, len(daq_buffer.time._data), daq_info.board.samplerate,
+                                               storage_controller, measurement_id)
+    metrics_reporter = create_metrics_reporter(config, timers, storage_controller)
+    storage_checkpoint = create_storage_checkpoint(config, daq_buffer, storage_controller, daq_info.board.samplerate, start_timestamp_us)
+    timer: StageTimer = timers["output"]
+    if not receiver.recv_channel_names(stop_callback):
+        return
+    last_acq_count = int(counters[OUTPUT_COUNT])
+    while not stop_callback():
+        timer.start()
+        acq_count = None
+        while (batch_acq_count := receiver.recv()) is not None:
+            acq_count = batch_acq_count
+        if acq_count is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        timer.mark("receive")
+        set_acq_sample_count(daq_buffer, acq_count)
+        events = event_controller.process() + receiver.get_events()
+        if waveform_capture:
+            waveform_capture.process(events)
+        timer.mark("events")
+        storage_controller.process()
+        if storage_checkpoint:
+            storage_checkpoint.process()
+        timer.mark("storage")
+        storage_controller.process_events(events)
+        timer.mark("store_events")
+        timer.finish_cycle((acq_count - last_acq_count)/daq_info.board.samplerate)
+        counters[OUTPUT_COUNT] = acq_count
+        last_acq_count = acq_count
+        if metrics_reporter:
+            metrics_reporter.process()
+    storage_controller.close()
+    if waveform_capture:
+        waveform_capture.close()
+
+
+class PqPipeline(object):
+    """Runs PowerSystem and storage/event output in separate processes
+
+    The acquisition (calling process) writes into the AcqBufferPool which is shared with
+    both stages. The PowerSystem stage forwards new samples of its output channels to the
+    output stage through a shared memory ring. The acquisition waits if it is more than
+    max_lead_samples ahead of the slowest stage, so the pool has to be created with
+    max_lead_samples of additional size.
+
+    Parameters:
+        config: pqopen config
+        daq_buffer: AcqBufferPool, data is moved to shared memory on start()
+        daq_info: DaqInfo of the data stream
+        measurement_id: measurement id for the storage controller
+        device_id: device id for the storage controller
+        start_timestamp_us: start timestamp for the storage controller
+        max_lead_samples: max. number of samples the acquisition may be ahead
+    """
+    def __init__(self, config: dict, daq_buffer: AcqBufferPool, daq_info: DaqInfo, measurement_id: str, device_id: str,
+                 start_timestamp_us: int, max_lead_samples: int):
+        self._config = config
+        self._daq_buffer = daq_buffer
+        self._daq_info = daq_info
+        self._measurement_id = measurement_id
+        self._device_id = device_id
+        self._start_timestamp_us = start_timestamp_us
+        self._max_lead_samples = max_lead_samples
+        self._processes: List[multiprocessing.Process] = []
+        # Statistics are kept in shared memory and reported by the output stage
+        self.timers = {"acquisition": StageTimer(["recv", "transform", "put_data"], idle_stages=["recv"], shared=True),
+                       "powersystem": StageTimer(["power_system", "forward"], shared=True),
+                       "output": StageTimer(["receive", "events", "storage", "store_events"], shared=True)}
+        # Gaps filled by the acquisition, handled by the PowerSystem stage
+        self.gap_log = GapLog(shared=True)
+
+    def start(self):
+        """Share the buffers and fork the stage processes"""
+        _set_cpu_affinity(self._config.get("pipeline", {}).get("cpu_affinity", {}), "acquisition")
+        self._shm = share_acq_buffer_pool(self._daq_buffer)
+        self._counters_shm = mmap.mmap(-1, NUM_COUNTERS*8)
+        self._counters = np.ndarray(NUM_COUNTERS, dtype=np.int64, buffer=self._counters_shm)
+        self._counters[ACQ_COUNT] = self._daq_buffer.time.sample_count
+        self._counters[PS_COUNT] = self._counters[ACQ_COUNT]
+        self._counters[OUTPUT_COUNT] = self._counters[ACQ_COUNT]
+        self._ring = ShmMessageRing(self._config.get("pipeline", {}).get("ring_size", 4*1024*1024))
+        mp_context = multiprocessing.get_context("fork")
+        self._processes = [
+            mp_context.Process(target=_power_system_stage, name="pqopen-powersystem", daemon=True,
+                               args=(self._config, self._daq_buffer, self._daq_info.board.samplerate, self._counters, self._ring,
+                                     self._start_timestamp_us, self.timers["powersystem"], self.gap_log)),
+            mp_context.Process(target=_output_stage, name="pqopen-output", daemon=True,
+                               args=(self._config, self._daq_buffer, self._daq_info, self._counters, self._ring,
+                                     self._measurement_id, self._device_id, self._start_timestamp_us, self.timers))]
+        for process in self._processes:
+            process.start()
+
+    def is_alive(self) -> bool:
+        return all(process.is_alive() for process in self._processes)
+
+    @property
+    def lead_samples(self) -> int:
+        """Number of samples the acquisition is ahead of the slowest stage"""
+        return int(self._counters[ACQ_COUNT] - min(self._counters[PS_COUNT], self._counters[OUTPUT_COUNT]))
+
+    def put_data_with_timestamp(self, data: np.ndarray, timestamp_us: int, stop_callback = None) -> bool:
+        """Write data to the shared AcqBufferPool; waits while the stages are too far behind
+
+        Returns:
+            False if a stage has stopped or waiting was cancelled
+        """
+        while self.lead_samples + data.shape[0] > self._max_lead_samples:
+            if not self.is_alive() or (stop_callback is not None and stop_callback()):
+                return False
+            time.sleep(POLL_INTERVAL)
+        if not self.is_alive():
+            return False
+        self._daq_buffer.put_data_with_timestamp(data, timestamp_us)
+        self._counters[ACQ_COUNT] = self._daq_buffer.time.sample_count
+        return True
+
+    def stop(self, timeout: float = 10.0):
+        """Stop the stages after they have processed all data written so far"""
+        stop_time = time.time() + timeout
+        while self.is_alive() and self.lead_samples > 0 and time.time() < stop_time:
+            time.sleep(POLL_INTERVAL)
+        self._counters[STOP_FLAG] = 1
+        for process in self._processes:
+            process.join(max(stop_time - time.time(), 0.1))
+            if process.is_alive():
+                logger.warning(f"Process {process.name:s} did not stop - terminating")
+                process.terminate()
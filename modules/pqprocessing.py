@@ -0,0 +1,223 @@
+import os
+import logging
+import functools
+from pathlib import Path
+
+from daqopen.channelbuffer import AcqBufferPool
+from daqopen.daqinfo import DaqInfo
+from pqopen.powersystem import PowerSystem
+from pqopen.storagecontroller import StorageController
+from pqopen.eventdetector import EventController
+
+from modules.stagetimer import MetricsReporter
+from modules.overloadguard import OverloadGuard
+from modules.gaprecovery import GapLog, GapHandler, add_gap_channel
+from modules.checkpoint import StateCheckpoint, PowerSystemCheckpoint, StorageCheckpoint, config_hash
+from modules.localhandoff import attach_handoff_client
+from modules.storageendpoints import DeviceStorageController
+from modules.waveformcapture import WaveformCapture, WaveformWriter
+from modules.eventengine import PolyphaseEventController, ThresholdRule
+
+logger = logging.getLogger(__name__)
+
+def create_power_system(config: dict, daq_buffer: AcqBufferPool, samplerate: float, persist_energy: bool = True) -> PowerSystem:
+    """Create the PowerSystem with phases and features as configured in [powersystem]
+
+    Parameters:
+        persist_energy: Load and persist the energy counters of energy_file_path. Disable it for
+            a mirror of the PowerSystem, which needs the energy channels but must not own the file
+    """
+    ps_config = config["powersystem"]
+    power_system = PowerSystem(zcd_channel = daq_buffer.channel[ps_config["zcd_channel"]],
+                               input_samplerate = samplerate,
+                               zcd_threshold = 1)
+
+    # Add Phases
+    for phase_name, phase in ps_config["phase"].items():
+        power_system.add_phase(u_channel=daq_buffer.channel[phase["u_channel"]],
+                               i_channel=daq_buffer.channel[phase["i_channel"]])
+    power_system.enable_harmonic_calculation()
+    power_system.enable_nper_abs_time_sync(daq_buffer.time, interval_sec=10)
+    power_system.enable_fluctuation_calculation(nominal_voltage=ps_config.get("nominal_voltage", 230.0))
+    power_system.enable_mains_signaling_calculation(frequency=ps_config.get("msv_frequency", 383.3))
+    power_system.enable_under_over_deviation_calculation(u_din=ps_config.get("nominal_voltage", 230.0))
+    if persist_energy:
+        power_system.enable_energy_channels(Path(ps_config.get("energy_file_path", "/tmp/energy.json")))
+    else:
+        power_system.enable_energy_channels(Path(os.devnull), ignore_value=True)
+    if ps_config.get("enable_one_period_fundamental", False):
+        power_system.enable_one_period_fundamental()
+    if ps_config.get("enable_rms_trapz_rule", False):
+        power_system.enable_rms_trapz_rule()
+    if ps_config.get("enable_mains_signaling_tracer", False):
+        power_system.enable_mains_signaling_tracer(frequency=ps_config.get("msv_frequency", 383.3),
+                                                   trigger_level=ps_config.get("msv_tracer_trigger_level", 1.0))
+    if ps_config.get("enable_pmu_calculation", False):
+        power_system.enable_pmu_calculation()
+    power_system._update_calc_channels()
+    if gap_recovery_enabled(config):
+        add_gap_channel(power_system)
+    return power_system
+
+def create_storage_controller(config: dict, daq_buffer: AcqBufferPool, power_system: PowerSystem, daq_info: DaqInfo,
+                              measurement_id: str, device_id: str, start_timestamp_us: int,
+                              feeder: str = "", shared_endpoints: dict | None = None) -> DeviceStorageController:
+    """Create the StorageController with endpoints and storage plans of the config
+
+    With feeder and shared_endpoints, the device endpoints are shared with the controllers
+    of the other feeders (see DeviceStorageController).
+    """
+    new_mqtt_endpoint = shared_endpoints is None or "mqtt" not in shared_endpoints
+    storage_controller = DeviceStorageController(time_channel=daq_buffer.time, sample_rate=daq_info.board.samplerate,
+                                                 feeder=feeder, shared_endpoints=shared_endpoints)
+    storage_controller.setup_endpoints_and_storageplans(endpoints=config["endpoint"],
+                                                        storage_plans=config["storageplan"],
+                                                        available_channels=power_system.output_channels,
+                                                        measurement_id=measurement_id,
+                                                        device_id=device_id,
+                                                        start_timestamp_us=start_timestamp_us,
+                                                        m_config=config,
+                                                        daq_info=daq_info,
+                                                        channel_info=power_system.get_channel_info())
+    # Hand the messages of the MQTT endpoint directly to the bridge (optional)
+    if "mqtt" in config["endpoint"] and new_mqtt_endpoint:
+        attach_handoff_client(storage_controller.device_endpoints["mqtt"], config["endpoint"]["mqtt"])
+    return storage_controller
+
+def create_event_controller(config: dict, daq_buffer: AcqBufferPool, power_system: PowerSystem, samplerate: float) -> EventController:
+    """Create the EventController with the detectors configured in [eventdetector]
+
+    All phases are evaluated by one PolyphaseEventController: level low/high per phase,
+    dips, swells and interruptions with polyphase aggregation and rapid voltage changes.
+    """
+    if "eventdetector" not in config:
+        return EventController(time_channel=daq_buffer.time, sample_rate=samplerate)
+    ed_config = config["eventdetector"]
+    nominal_voltage = config["powersystem"].get("nominal_voltage", 230.0)
+    hysteresis_voltage = ed_config.get("hysteresis_voltage", 2.0)
+    pq_hysteresis = ed_config.get("hysteresis_pct", 2.0)*nominal_voltage/100
+    rules = [ThresholdRule("LEVEL_LOW", ed_config.get("level_low_voltage", 208.0), hysteresis_voltage, below=True),
+             ThresholdRule("LEVEL_HIGH", ed_config.get("level_high_voltage", 253.0), hysteresis_voltage, below=False),
+             ThresholdRule("DIP", ed_config.get("dip_threshold_pct", 90.0)*nominal_voltage/100, pq_hysteresis, below=True, aggregation="any"),
+             ThresholdRule("SWELL", ed_config.get("swell_threshold_pct", 110.0)*nominal_voltage/100, pq_hysteresis, below=False, aggregation="any"),
+             ThresholdRule("INTERRUPTION", ed_config.get("interruption_threshold_pct", 5.0)*nominal_voltage/100, pq_hysteresis, below=True, aggregation="all")]
+    voltage_channels = [power_system.output_channels[f"U{idx+1:d}_1p_hp_rms"] for idx in range(len(power_system._phases))]
+    return PolyphaseEventController(time_channel=daq_buffer.time,
+                                    sample_rate=samplerate,
+                                    voltage_channels=voltage_channels,
+                                    rules=rules,
+                                    rvc_threshold=ed_config.get("rvc_threshold_pct", 5.0)*nominal_voltage/100,
+                                    rvc_hysteresis=ed_config.get("rvc_hysteresis_pct", 2.5)*nominal_voltage/100,
+                                    rvc_window=int(round(2*power_system.nominal_frequency)))
+
+def create_waveform_capture(config: dict, daq_buffer: AcqBufferPool, buffer_size: int, samplerate: float,
+                            storage_controller: DeviceStorageController, measurement_id: str) -> WaveformCapture | None:
+    """Create the WaveformCapture as configured in [eventdetector], None if neither capture_dir nor capture_mqtt is set
+
+    Parameters:
+        buffer_size: size of the AcqBufferPool in samples
+    """
+    ed_config = config.get("eventdetector", {})
+    capture_dir = ed_config.get("capture_dir", "")
+    mqtt_endpoint = storage_controller.device_endpoints.get("mqtt") if ed_config.get("capture_mqtt", False) else None
+    if not capture_dir and mqtt_endpoint is None:
+        return None
+    # Pre-trigger samples are taken from the AcqBufferPool
+    buffer_sec = buffer_size/samplerate
+    pre_sec = ed_config.get("capture_pre_sec", 0.2)
+    post_sec = ed_config.get("capture_post_sec", 0.8)
+    if pre_sec + post_sec > 0.5*buffer_sec:
+        post_sec = max(0.5*buffer_sec - pre_sec, 0.0)
+        logger.warning(f"Waveform capture: capture_post_sec limited to {post_sec:.2f} s by buffer size")
+    publish = None
+    if mqtt_endpoint:
+        publish = functools.partial(mqtt_endpoint.write_waveform, **storage_controller.endpoint_kwargs("mqtt"))
+    writer = WaveformWriter(capture_dir=capture_dir or None, publish=publish)
+    writer.start()
+    return WaveformCapture(daq_buffer,
+                           buffer_size=buffer_size,
+                           channels=ed_config.get("capture_channels", list(daq_buffer.channel.keys())),
+                           samplerate=samplerate,
+                           writer=writer,
+                           measurement_id=measurement_id,
+                           pre_sec=pre_sec,
+                           post_sec=post_sec,
+                           max_captures_per_day=ed_config.get("capture_max_per_day", 50))
+
+def create_metrics_reporter(config: dict, timers: dict, storage_controller: DeviceStorageController) -> MetricsReporter | None:
+    """Create the MetricsReporter as configured in [metrics], None if not configured"""
+    if "metrics" not in config:
+        return None
+    metrics_config = config["metrics"]
+    endpoint = None
+    if "endpoint" in metrics_config:
+        endpoint = storage_controller.device_endpoints.get(metrics_config["endpoint"])
+        if endpoint is None:
+            logger.warning(f"Metrics: endpoint {metrics_config['endpoint']:s} not configured")
+        elif not hasattr(endpoint, "write_metrics"):
+            logger.warning(f"Metrics: endpoint {metrics_config['endpoint']:s} does not support metrics")
+            endpoint = None
+    endpoint_kwargs = {}
+    if "mqtt_topic_prefix" in metrics_config:
+        endpoint_kwargs["mqtt_topic_prefix"] = metrics_config["mqtt_topic_prefix"]
+    return MetricsReporter(timers,
+                           interval_sec=metrics_config.get("interval_sec", 60),
+                           file_path=metrics_config.get("file_path"),
+                           endpoint=endpoint,
+                           endpoint_kwargs=endpoint_kwargs)
+
+def create_overload_guard(config: dict, daq_buffer: AcqBufferPool, power_system: PowerSystem) -> OverloadGuard | None:
+    """Create the OverloadGuard as configured in [overload_guard], None if not enabled"""
+    guard_config = config.get("overload_guard", {})
+    if not guard_config.get("enabled", False):
+        return None
+    return OverloadGuard.from_config(guard_config, power_system, daq_buffer.time)
+
+def gap_recovery_enabled(config: dict) -> bool:
+    """Check if short DAQ packet gaps are filled in place as configured in [gap_recovery]"""
+    return config.get("gap_recovery", {}).get("max_gap_sec", 0.0) > 0
+
+def create_gap_handler(config: dict, daq_buffer: AcqBufferPool, power_system: PowerSystem, gap_log: GapLog) -> GapHandler | None:
+    """Create the GapHandler as configured in [gap_recovery], None if not enabled"""
+    if not gap_recovery_enabled(config):
+        return None
+    return GapHandler(power_system, daq_buffer.time, gap_log,
+                      settle_sec=config["gap_recovery"].get("settle_sec", power_system.nper/power_system.nominal_frequency))
+
+def _create_state_checkpoint(config: dict, samplerate: float, name: str, feeder: str = "") -> StateCheckpoint | None:
+    if "checkpoint" not in config:
+        return None
+    if feeder:
+        name = f"{name:s}-{feeder:s}"
+    checkpoint_config = config["checkpoint"]
+    checkpoint_dir = Path(checkpoint_config.get("path", "/var/lib/pqopen/checkpoint"))
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    return StateCheckpoint(checkpoint_dir/f"{name:s}.json", config_hash(config, samplerate),
+                           interval_sec=checkpoint_config.get("interval_sec", 60),
+                           max_age_sec=checkpoint_config.get("max_age_sec", 600))
+
+def create_power_system_checkpoint(config: dict, daq_buffer: AcqBufferPool, power_system: PowerSystem, samplerate: float,
+                                   start_timestamp_us: int, feeder: str = "") -> PowerSystemCheckpoint | None:
+    """Create the PowerSystem checkpoint as configured in [checkpoint] and restore a valid checkpoint
+
+    With feeder, the name of the feeder is appended to the file name (powersystem-<feeder>.json).
+    """
+    state_checkpoint = _create_state_checkpoint(config, samplerate, "powersystem", feeder)
+    if state_checkpoint is None:
+        return None
+    ps_checkpoint = PowerSystemCheckpoint(state_checkpoint, power_system, daq_buffer.time)
+    ps_checkpoint.restore(start_timestamp_us)
+    return ps_checkpoint
+
+def create_storage_checkpoint(config: dict, daq_buffer: AcqBufferPool, storage_controller: StorageController, samplerate: float,
+                              start_timestamp_us: int, feeder: str = "") -> StorageCheckpoint | None:
+    """Create the storage checkpoint as configured in [checkpoint] and restore a valid checkpoint
+
+    With feeder, the name of the feeder is appended to the file name (storage-<feeder>.json).
+    """
+    state_checkpoint = _create_state_checkpoint(config, samplerate, "storage", feeder)
+    if state_checkpoint is None:
+        return None
+    storage_checkpoint = StorageCheckpoint(state_checkpoint, storage_controller, daq_buffer.time)
+    storage_checkpoint.restore(start_timestamp_us)
+    return storage_checkpoint
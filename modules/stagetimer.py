@@ -0,0 +1,185 @@
+import mmap
+import json
+import time
+import logging
+import numpy as np
+from bisect import bisect_right
+from pathlib import Path
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Upper edges of the histogram buckets in seconds, last bucket is open
+BUCKET_EDGES = [10e-6, 20e-6, 50e-6, 100e-6, 200e-6, 500e-6,
+                1e-3, 2e-3, 5e-3, 10e-3, 20e-3, 50e-3,
+                100e-3, 200e-3, 500e-3, 1.0, 2.0, 5.0]
+NUM_BUCKETS = len(BUCKET_EDGES) + 1
+SUM_IDX = NUM_BUCKETS
+MAX_IDX = NUM_BUCKETS + 1
+
+# Cycle statistics
+CYCLE_COUNT = 0
+CYCLE_DATA_SECONDS = 1
+CYCLE_BUSY_SECONDS = 2
+CYCLE_MAX_RTF = 3
+CYCLE_MAX_AGE = 4
+
+class StageTimer(object):
+    """Measures the duration of the stages of a processing cycle with fixed-bucket histograms
+
+    Call start() at the beginning of a cycle, mark(stage) at the end of each stage and
+    finish_cycle(data_seconds) at the end of the cycle. The real-time factor (RTF) of a
+    cycle is the time spent in non-idle stages divided by the duration of the processed data.
+
+    Parameters:
+        stages: names of the stages
+        idle_stages: stages which are waiting for data (e.g. recv) and not counted as busy
+        shared: keep statistics in anonymous shared memory, so a process forked afterwards
+            can record and the parent (or another child) can report them
+    """
+    def __init__(self, stages: List[str], idle_stages: List[str] = [], shared: bool = False):
+        self.stages = list(stages)
+        self._stage_idx = {name: idx for idx, name in enumerate(self.stages)}
+        self._busy_mask = np.array([name not in idle_stages for name in self.stages])
+        num_values = len(self.stages)*(NUM_BUCKETS + 2) + 5
+        if shared:
+            self._shm = mmap.mmap(-1, num_values*8)
+            values = np.ndarray(num_values, dtype=np.float64, buffer=self._shm)
+        else:
+            values = np.zeros(num_values, dtype=np.float64)
+        self.stage_stats = values[:-5].reshape(len(self.stages), NUM_BUCKETS + 2)
+        self.cycle_stats = values[-5:]
+        self._cycle_times = np.zeros(len(self.stages))
+        self._last_ts = time.perf_counter()
+        self.last_rtf = 0.0
+
+    def start(self):
+        """Start a new cycle"""
+        self._cycle_times[:] = 0.0
+        self._last_ts = time.perf_counter()
+
+    def mark(self, stage: str):
+        """Account the time since the last mark (or start) to the given stage"""
+        now = time.perf_counter()
+        duration = now - self._last_ts
+        self._last_ts = now
+        idx = self._stage_idx[stage]
+        stats = self.stage_stats[idx]
+        stats[bisect_right(BUCKET_EDGES, duration)] += 1
+        stats[SUM_IDX] += duration
+        if duration > stats[MAX_IDX]:
+            stats[MAX_IDX] = duration
+        self._cycle_times[idx] += duration
+
+    def skip(self):
+        """Discard the time since the last mark"""
+        self._last_ts = time.perf_counter()
+
+    def finish_cycle(self, data_seconds: float, packet_age: float = 0.0):
+        """Finish the cycle
+
+        Parameters:
+            data_seconds: duration of the data processed in this cycle
+            packet_age: delay between data timestamp and processing (e.g. time.time() - packet timestamp)
+        """
+        if data_seconds <= 0:
+            return
+        busy_seconds = self._cycle_times[self._busy_mask].sum()
+        stats = self.cycle_stats
+        stats[CYCLE_COUNT] += 1
+        stats[CYCLE_DATA_SECONDS] += data_seconds
+        stats[CYCLE_BUSY_SECONDS] += busy_seconds
+        self.last_rtf = busy_seconds/data_seconds
+        if self.last_rtf > stats[CYCLE_MAX_RTF]:
+            stats[CYCLE_MAX_RTF] = self.last_rtf
+        if packet_age > stats[CYCLE_MAX_AGE]:
+            stats[CYCLE_MAX_AGE] = packet_age
+
+
+def _histogram_quantile(counts: np.ndarray, quantile: float, max_value: float) -> float:
+    cum_counts = counts.cumsum()
+    bucket_idx = int(np.searchsorted(cum_counts, quantile*cum_counts[-1]))
+    if bucket_idx >= len(BUCKET_EDGES):
+        return max_value
+    return min(BUCKET_EDGES[bucket_idx], max_value)
+
+class MetricsReporter(object):
+    """Periodically reports the statistics of StageTimers
+
+    Statistics are reported as difference to the last report, the maximum values are
+    reset after each report. The metrics are appended as json line to a text file and/or
+    written to a storage endpoint providing write_metrics (MQTT topic .../metrics/json or
+    archive table metrics), separate from the measurement data.
+
+    Parameters:
+        timers: StageTimers by name (used as key prefix of the rtf values)
+        interval_sec: report interval in seconds (> 0)
+        file_path: optional path of the metrics text file
+        endpoint: optional storage endpoint with write_metrics
+        endpoint_kwargs: additional parameters for write_metrics (e.g. mqtt_topic_prefix)
+    """
+    def __init__(self, timers: Dict[str, StageTimer], interval_sec: float = 60, file_path: str | Path = None, endpoint = None, endpoint_kwargs: dict = {}):
+        if not interval_sec > 0:
+            raise ValueError(f"Metrics: interval_sec must be > 0, got {interval_sec}")
+        if endpoint is not None and not hasattr(endpoint, "write_metrics"):
+            raise ValueError(f"Metrics: endpoint {type(endpoint).__name__:s} does not support metrics")
+        self._timers = timers
+        self._interval_sec = float(interval_sec)
+        self._file_path = Path(file_path) if file_path else None
+        self._endpoint = endpoint
+        self._endpoint_kwargs = endpoint_kwargs
+        self._last_stage_stats = {name: timer.stage_stats.copy() for name, timer in timers.items()}
+        self._last_cycle_stats = {name: timer.cycle_stats.copy() for name, timer in timers.items()}
+        self._next_report_ts = time.time() + interval_sec
+
+    def get_metrics(self) -> dict:
+        """Return the metrics since the last call and reset maximum values"""
+        metrics = {}
+        for name, timer in self._timers.items():
+            stage_stats = timer.stage_stats.copy()
+            cycle_stats = timer.cycle_stats.copy()
+            stage_diff = stage_stats - self._last_stage_stats[name]
+            cycle_diff = cycle_stats - self._last_cycle_stats[name]
+            for stage_idx, stage in enumerate(timer.stages):
+                counts = stage_diff[stage_idx, :NUM_BUCKETS]
+                num_samples = counts.sum()
+                if num_samples == 0:
+                    continue
+                max_value = stage_stats[stage_idx, MAX_IDX]
+                metrics[f"{stage}_count"] = int(num_samples)
+                metrics[f"{stage}_mean_ms"] = stage_diff[stage_idx, SUM_IDX]/num_samples*1e3
+                metrics[f"{stage}_p50_ms"] = _histogram_quantile(counts, 0.5, max_value)*1e3
+                metrics[f"{stage}_p99_ms"] = _histogram_quantile(counts, 0.99, max_value)*1e3
+                metrics[f"{stage}_max_ms"] = max_value*1e3
+            if cycle_diff[CYCLE_DATA_SECONDS] > 0:
+                metrics[f"{name}_rtf"] = cycle_diff[CYCLE_BUSY_SECONDS]/cycle_diff[CYCLE_DATA_SECONDS]
+                metrics[f"{name}_rtf_max"] = cycle_stats[CYCLE_MAX_RTF]
+                metrics[f"{name}_packet_age_max_s"] = cycle_stats[CYCLE_MAX_AGE]
+            # Reset maximum values
+            timer.stage_stats[:, MAX_IDX] = 0.0
+            timer.cycle_stats[CYCLE_MAX_RTF] = 0.0
+            timer.cycle_stats[CYCLE_MAX_AGE] = 0.0
+            stage_stats[:, MAX_IDX] = 0.0
+            cycle_stats[CYCLE_MAX_RTF] = 0.0
+            cycle_stats[CYCLE_MAX_AGE] = 0.0
+            self._last_stage_stats[name] = stage_stats
+            self._last_cycle_stats[name] = cycle_stats
+        return metrics
+
+    def process(self):
+        """Report the metrics if the interval has elapsed"""
+        now = time.time()
+        if now < self._next_report_ts:
+            return
+        self._next_report_ts += self._interval_sec
+        if self._next_report_ts < now:
+            self._next_report_ts = now + self._interval_sec
+        metrics = self.get_metrics()
+        if not metrics:
+            return
+        if self._file_path:
+            with open(self._file_path, "a") as f:
+                f.write(json.dumps({"timestamp": round(now, 3), **metrics}) + "\n")
+        if self._endpoint:
+            self._endpoint.write_metrics(metrics, round(now, 3), **self._endpoint_kwargs)
+        logger.debug(f"Metrics: {metrics}")
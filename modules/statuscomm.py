@@ -1,13 +1,94 @@
-import socket
-import time
+"""
+Status bus of the pqopen-device services
+
+The services send their status and a few metrics (loop lag, packets/s, cache depth, CPU time
+and RSS) as compact binary UDP message to the StatusReceiver of the status-monitor. The
+receiver waits with a selector for messages, inactivity timeouts and other timers (e.g. LED
+blinking) run on a TimerWheel. The aggregated registry can be read from a local Unix socket
+as JSON (read_registry).
+"""
+
+import os
 import json
+import math
+import time
+import socket
+import struct
 import logging
+import selectors
+import functools
+from pathlib import Path
+from typing import Callable, List
 
 logger = logging.getLogger(__name__)
 
-BUF_SIZE = 200
+# Message: magic, version, service name and status (length prefixed utf-8), metrics
+MSG_MAGIC = b"PS"
+MSG_VERSION = 1
+MSG_HEADER = struct.Struct("<2sB")
+MAX_NAME_SIZE = 255
+METRICS = struct.Struct("<ffIdI") # loop lag (ms), packets/s, cache depth, cpu time (s), rss (kB)
+NO_VALUE = 0xFFFFFFFF
+# Largest message of encode_status_message
+BUF_SIZE = MSG_HEADER.size + 2*(1 + MAX_NAME_SIZE) + METRICS.size
+
+def encode_status_message(service: str, status: str | None, metrics: dict = {}) -> bytes:
+    """Encode status and metrics (missing metrics are None) of a service"""
+    def nan_if_none(value):
+        return math.nan if value is None else value
+    def no_value_if_none(value):
+        return NO_VALUE if value is None else min(int(value), NO_VALUE - 1)
+    service_bytes = service.encode()[:MAX_NAME_SIZE]
+    status_bytes = (status or "").encode()[:MAX_NAME_SIZE]
+    return b"".join([MSG_HEADER.pack(MSG_MAGIC, MSG_VERSION),
+                     bytes([len(service_bytes)]), service_bytes,
+                     bytes([len(status_bytes)]), status_bytes,
+                     METRICS.pack(nan_if_none(metrics.get("loop_lag_ms")),
+                                  nan_if_none(metrics.get("packets_per_sec")),
+                                  no_value_if_none(metrics.get("cache_depth")),
+                                  nan_if_none(metrics.get("cpu_time_s")),
+                                  no_value_if_none(metrics.get("rss_kb")))])
+
+def decode_status_message(data: bytes) -> dict:
+    """Decode a message of encode_status_message, raises ValueError if invalid"""
+    try:
+        magic, version = MSG_HEADER.unpack_from(data, 0)
+        if magic != MSG_MAGIC or version != MSG_VERSION:
+            raise ValueError("Unknown message format")
+        pos = MSG_HEADER.size
+        service = data[pos + 1:pos + 1 + data[pos]].decode()
+        pos += 1 + data[pos]
+        status = data[pos + 1:pos + 1 + data[pos]].decode() or None
+        pos += 1 + data[pos]
+        values = METRICS.unpack_from(data, pos)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid status message: {e}")
+    metrics = dict(zip(["loop_lag_ms", "packets_per_sec", "cache_depth", "cpu_time_s", "rss_kb"], values))
+    for name, value in metrics.items():
+        if (isinstance(value, float) and math.isnan(value)) or value == NO_VALUE:
+            metrics[name] = None
+    return {"service": service, "status": status, "metrics": metrics}
+
+def _process_rss_kb() -> int | None:
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")//1024
+    except (OSError, ValueError, IndexError):
+        return None
+
 
 class StatusSender(object):
+    """Sends the status and metrics of a service every send_interval seconds
+
+    update() is cheap and can be called in every loop cycle. Packets are summed and the
+    loop lag is the maximum since the last message. CPU time and RSS are those of the
+    calling process.
+
+    Parameters:
+        service_name: name of the service
+        port: UDP port of the StatusReceiver
+        send_interval: min. interval between messages in seconds
+    """
     def __init__(self, service_name: str, port: int = 50002, send_interval: float = 1.0):
         self.service_name = service_name
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -15,44 +96,233 @@ class StatusSender(object):
         self._send_interval = send_interval
         self._last_time_sent = time.time()
         self._status_reg = {"service": service_name, "status": None}
+        self._packets = 0
+        self._loop_lag = None
+        self._cache_depth = None
+
+    def _send_status_message(self, elapsed: float):
+        metrics = {"loop_lag_ms": self._loop_lag*1e3 if self._loop_lag is not None else None,
+                   "packets_per_sec": self._packets/elapsed if elapsed > 0 else None,
+                   "cache_depth": self._cache_depth,
+                   "cpu_time_s": time.process_time(),
+                   "rss_kb": _process_rss_kb()}
+        self._sock.sendto(encode_status_message(self.service_name, self._status_reg["status"], metrics), ("localhost", self._port))
 
-    def _send_status_message(self):
-        self._sock.sendto(json.dumps(self._status_reg).encode(), ("localhost", self._port))
+    def update(self, status: str, packets: int = 0, loop_lag: float | None = None, cache_depth: int | None = None):
+        """Update the status, send it if the interval is over
 
-    def update(self, status: str):
+        Parameters:
+            status: status of the service (e.g. RUNNING)
+            packets: number of packets processed since the last call
+            loop_lag: delay of the main loop in seconds (e.g. packet age)
+            cache_depth: number of cached messages
+        """
         self._status_reg["status"] = status
-        if self._last_time_sent + self._send_interval < time.time():
-            self._send_status_message()
-            self._last_time_sent = time.time()
+        self._packets += packets
+        if loop_lag is not None and (self._loop_lag is None or loop_lag > self._loop_lag):
+            self._loop_lag = loop_lag
+        if cache_depth is not None:
+            self._cache_depth = cache_depth
+        now = time.time()
+        if self._last_time_sent + self._send_interval < now:
+            self._send_status_message(now - self._last_time_sent)
+            self._last_time_sent = now
+            self._packets = 0
+            self._loop_lag = None
 
     def __del__(self):
         self._sock.close()
 
+
+class _Timer(object):
+    __slots__ = ("expire_tick", "callback", "cancelled")
+
+    def __init__(self, expire_tick: int, callback: Callable[[], None]):
+        self.expire_tick = expire_tick
+        self.callback = callback
+        self.cancelled = False
+
+class TimerWheel(object):
+    """Hashed timer wheel with a resolution of tick_sec
+
+    Timers are kept in the slot of their expiry tick, so scheduling and cancelling are O(1).
+    Timers more than num_slots ticks ahead stay in their slot for further rounds.
+
+    Parameters:
+        tick_sec: resolution of the timers
+        num_slots: number of slots of the wheel
+    """
+    def __init__(self, tick_sec: float = 0.05, num_slots: int = 256):
+        self._tick_sec = tick_sec
+        self._slots: List[List[_Timer]] = [[] for _ in range(num_slots)]
+        self._current_tick = int(time.monotonic()/tick_sec)
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> _Timer:
+        """Call callback after delay seconds (rounded up to the next tick), returns the timer for cancel()"""
+        expire_tick = max(math.ceil((time.monotonic() + delay)/self._tick_sec), self._current_tick + 1)
+        timer = _Timer(expire_tick, callback)
+        self._slots[expire_tick % len(self._slots)].append(timer)
+        return timer
+
+    def cancel(self, timer: _Timer | None):
+        if timer is not None:
+            timer.cancelled = True
+
+    def timeout(self) -> float | None:
+        """Time until the next occupied slot is due (None: no timers)"""
+        for offset in range(1, len(self._slots) + 1):
+            if self._slots[(self._current_tick + offset) % len(self._slots)]:
+                return max((self._current_tick + offset)*self._tick_sec - time.monotonic(), 0.0)
+        return None
+
+    def advance(self):
+        """Call the callbacks of all expired timers"""
+        now_tick = int(time.monotonic()/self._tick_sec)
+        if now_tick <= self._current_tick:
+            return
+        num_ticks = min(now_tick - self._current_tick, len(self._slots))
+        self._current_tick = now_tick
+        for tick in range(now_tick - num_ticks + 1, now_tick + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            expired = [timer for timer in slot if timer.expire_tick <= now_tick]
+            if not expired:
+                continue
+            slot[:] = [timer for timer in slot if timer.expire_tick > now_tick and not timer.cancelled]
+            for timer in expired:
+                if not timer.cancelled:
+                    timer.callback()
+
+
 class StatusReceiver(object):
-    def __init__(self, services: list, port: int = 50002, inactive_timeout: float = 5):
+    """Receives the messages of the StatusSenders into status_reg
+
+    poll() waits with a selector for messages, registry requests and timers of timer_wheel.
+    A service without message for inactive_timeout seconds gets the status None.
+
+    Parameters:
+        services: names of the expected services
+        port: UDP port to listen on
+        inactive_timeout: time without message until a service is inactive
+        registry_path: optional path of a Unix socket, every connection receives the registry as JSON
+            (disabled with a warning if the socket can not be created)
+        on_change: optional function called with (service, status) when the status of a service changes
+    """
+    def __init__(self, services: list, port: int = 50002, inactive_timeout: float = 5, registry_path: str | Path | None = None,
+                 on_change: Callable[[str, str | None], None] | None = None):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._sock.bind(("localhost", port))
-        self._sock.settimeout(1)
+        self._sock.setblocking(False)
         self._port = port
         self._inactive_timeout = inactive_timeout
+        self._on_change = on_change
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ, self._read_messages)
+        self.timer_wheel = TimerWheel()
         self.status_reg = {}
+        self._inactive_timers = {}
         for service in services:
-            self.status_reg[service] = {"status": None, "last_timestamp": time.time()}
-    
-    def recv_message(self):
+            self.status_reg[service] = {"status": None, "last_timestamp": time.time(), "metrics": {}}
+            self._inactive_timers[service] = self.timer_wheel.schedule(inactive_timeout, functools.partial(self._set_inactive, service))
+        self._registry_path = None
+        self._registry_sock = None
+        if registry_path:
+            self._open_registry(Path(registry_path))
+
+    def _open_registry(self, registry_path: Path):
+        """Listen on the registry socket; the registry is disabled with a warning if it can not be created"""
+        registry_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            registry_path.parent.mkdir(parents=True, exist_ok=True)
+            registry_path.unlink(missing_ok=True)
+            registry_sock.bind(str(registry_path))
+            registry_sock.listen()
+        except OSError as e:
+            registry_sock.close()
+            logger.warning(f"StatusReceiver: registry socket {registry_path} not available - registry disabled: {e}")
+            return
+        registry_sock.setblocking(False)
+        self._selector.register(registry_sock, selectors.EVENT_READ, self._send_registry)
+        self._registry_path = registry_path
+        self._registry_sock = registry_sock
+
+    def _set_status(self, service: str, status: str | None):
+        changed = self.status_reg[service]["status"] != status
+        self.status_reg[service]["status"] = status
+        if changed and self._on_change:
+            self._on_change(service, status)
+
+    def _set_inactive(self, service: str):
+        self._inactive_timers[service] = None
+        self.status_reg[service]["metrics"] = {}
+        self._set_status(service, None)
+
+    def _read_messages(self, sock: socket.socket):
+        while True:
+            try:
+                raw_data = sock.recv(BUF_SIZE)
+            except BlockingIOError:
+                return
+            try:
+                data = decode_status_message(raw_data)
+            except ValueError as e:
+                logger.error(str(e))
+                continue
+            service = data["service"]
+            if service not in self.status_reg:
+                logger.error(f"service name {service} not configured!")
+                continue
+            self.status_reg[service]["last_timestamp"] = time.time()
+            self.status_reg[service]["metrics"] = data["metrics"]
+            self.timer_wheel.cancel(self._inactive_timers[service])
+            self._inactive_timers[service] = self.timer_wheel.schedule(self._inactive_timeout, functools.partial(self._set_inactive, service))
+            self._set_status(service, data["status"])
+
+    def _send_registry(self, server_sock: socket.socket):
         try:
-            raw_data = self._sock.recv(BUF_SIZE)
-            data = json.loads(raw_data.decode())
-            if data["service"] not in self.status_reg:
-                logger.error(f"service name {data['service']} not configured!")
-            self.status_reg[data["service"]]["status"] = data["status"]
-            self.status_reg[data["service"]]["last_timestamp"] = time.time()
-        except TimeoutError:
-            pass
-        # Check inactive
-        for service in self.status_reg:
-            if self.status_reg[service]["last_timestamp"] + self._inactive_timeout < time.time():
-                self.status_reg[service]["status"] = None
+            conn, _ = server_sock.accept()
+        except BlockingIOError:
+            return
+        with conn:
+            conn.settimeout(1.0)
+            try:
+                conn.sendall(json.dumps(self.status_reg).encode())
+            except OSError as e:
+                logger.debug(f"Sending registry failed: {e}")
+
+    def poll(self, timeout: float | None = None):
+        """Wait max. timeout seconds (None: until an event) for messages and timers and process them"""
+        wheel_timeout = self.timer_wheel.timeout()
+        if wheel_timeout is not None and (timeout is None or wheel_timeout < timeout):
+            timeout = wheel_timeout
+        for key, _ in self._selector.select(timeout):
+            key.data(key.fileobj)
+        self.timer_wheel.advance()
+
+    def recv_message(self, timeout: float = 1.0):
+        """Process the messages received within timeout seconds (see poll)"""
+        self.poll(timeout)
+
+    def close(self):
+        if self._selector is None:
+            return
+        self._selector.close()
+        self._selector = None
+        self._sock.close()
+        if self._registry_sock is not None:
+            self._registry_sock.close()
+            self._registry_path.unlink(missing_ok=True)
 
     def __del__(self):
-        self._sock.close()
\ No newline at end of file
+        self.close()
+
+def read_registry(registry_path: str | Path, timeout: float = 1.0) -> dict:
+    """Read the registry of a StatusReceiver from its Unix socket"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(registry_path))
+        data = bytearray()
+        while chunk := sock.recv(4096):
+            data += chunk
+    return json.loads(data)
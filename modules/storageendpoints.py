@@ -0,0 +1,187 @@
+import json
+import logging
+from pathlib import Path
+
+from daqopen.channelbuffer import AcqBuffer
+from daqopen.daqinfo import DaqInfo
+from pqopen.storagecontroller import StorageController, StoragePlan, MqttStorageEndpoint
+
+from modules.archive import ArchiveStorageEndpoint
+from modules.binarypayload import encode_data_series, encode_aggregated_data, encode_payload, PayloadCompressor
+
+logger = logging.getLogger(__name__)
+
+class MqttBinaryStorageEndpoint(MqttStorageEndpoint):
+    """MQTT endpoint with optional compact binary encoding (see modules/binarypayload.py)
+
+    Storage plans with encoding = "cbor" send data series and aggregated data as CBOR
+    (topics .../cbor, or .../zcbor if compression is enabled; zlib with the optional
+    preset dictionary). The float64_channels of the plan are not rounded to float32,
+    decimal_places does not apply. Events and the measurement config stay JSON.
+
+    Parameters:
+        dictionary_path: path of a preset dictionary for the compression (optional)
+        compression_level: zlib compression level of binary payloads
+        further parameters: see MqttStorageEndpoint
+    """
+    def __init__(self, name: str, measurement_id: str, device_id: str, mqtt_host: str, client_id: str,
+                 topic_prefix: str = "dt/pqopen", compression: bool = True, limit_precision: int = None,
+                 dictionary_path: str | Path = "", compression_level: int = 6):
+        super().__init__(name, measurement_id, device_id, mqtt_host, client_id,
+                         topic_prefix=topic_prefix, compression=compression, limit_precision=limit_precision)
+        self._payload_compressor = None
+        if compression:
+            dictionary = Path(dictionary_path).read_bytes() if dictionary_path else None
+            self._payload_compressor = PayloadCompressor(dictionary, level=compression_level)
+
+    def _publish_binary(self, message_type: str, message: dict, **kwargs):
+        topic_prefix = kwargs.get("mqtt_topic_prefix", self._topic_prefix)
+        topic_suffix = "zcbor" if self._payload_compressor else "cbor"
+        self._client.publish(topic_prefix + f"/{self._device_id:s}/{message_type:s}/{topic_suffix:s}",
+                             encode_payload(message, self._payload_compressor), qos=2)
+
+    def write_waveform(self, payload: bytes, **kwargs):
+        """Send a compressed waveform payload (see modules/waveformcapture.py)"""
+        topic_prefix = kwargs.get("mqtt_topic_prefix", self._topic_prefix)
+        self._client.publish(topic_prefix + f"/{self._device_id:s}/waveform/zcbor", payload, qos=2)
+
+    def write_metrics(self, metrics: dict, timestamp: float, **kwargs):
+        """Send processing metrics (see modules/stagetimer.py) to the own topic .../metrics/json"""
+        topic_prefix = kwargs.get("mqtt_topic_prefix", self._topic_prefix)
+        message = {"type": "metrics", "measurement_uuid": self.measurement_id, "timestamp": timestamp, "data": metrics}
+        self._client.publish(topic_prefix + f"/{self._device_id:s}/metrics/json", json.dumps(message), qos=2)
+
+    def write_aggregated_data(self, data: dict, timestamp_us: int, interval_seconds: int, **kwargs):
+        if kwargs.get("encoding", "json") != "cbor":
+            return super().write_aggregated_data(data, timestamp_us, interval_seconds, **kwargs)
+        message = encode_aggregated_data(data, timestamp_us, interval_seconds, self.measurement_id,
+                                         float64_channels=kwargs.get("float64_channels", []))
+        self._publish_binary("agg_data", message, **kwargs)
+
+    def write_data_series(self, data: dict, **kwargs):
+        if kwargs.get("encoding", "json") != "cbor":
+            return super().write_data_series(data, **kwargs)
+        message = encode_data_series(data, self.measurement_id, float64_channels=kwargs.get("float64_channels", []))
+        self._publish_binary("dataseries", message, **kwargs)
+
+
+class DeviceStorageController(StorageController):
+    """StorageController with the additional endpoints of pqopen-device
+
+    The endpoints of DEVICE_ENDPOINTS are created here, all others by the StorageController.
+
+    With multiple feeders (see modules/feederpipeline.py), every feeder has its own controller.
+    The device endpoints are shared by the controllers (shared_endpoints) and the data is tagged
+    with the feeder name: MQTT topic prefix <prefix>/<feeder>, archive tables <feeder>/<table>.
+    All other endpoints are created per feeder with data_dir, client_id and topic_prefix tagged.
+
+    Parameters:
+        time_channel: the channel providing the timestamps
+        sample_rate: samplerate of the acquisition
+        feeder: name of the feeder ("": single source)
+        shared_endpoints: device endpoints by type, shared with the controllers of other feeders
+    """
+    DEVICE_ENDPOINTS = ["mqtt", "archive"]
+
+    def __init__(self, time_channel: AcqBuffer, sample_rate: float, feeder: str = "", shared_endpoints: dict | None = None):
+        super().__init__(time_channel=time_channel, sample_rate=sample_rate)
+        self.feeder = feeder
+        self._shared_endpoints = shared_endpoints
+        # Configured endpoints of DEVICE_ENDPOINTS by type
+        self.device_endpoints = {}
+
+    @property
+    def processed_sidx(self) -> int:
+        """Acq sample index up to which the storage plans have processed the data (excluded)"""
+        return self._last_processed_sidx
+
+    def endpoint_kwargs(self, ep_type: str, sp_config: dict = {}) -> dict:
+        """Feeder tags passed with every write to a device endpoint"""
+        if not self.feeder:
+            return {}
+        if ep_type == "mqtt":
+            topic_prefix = sp_config.get("mqtt_topic_prefix", self.device_endpoints["mqtt"]._topic_prefix)
+            return {"mqtt_topic_prefix": f"{topic_prefix:s}/{self.feeder:s}"}
+        return {"feeder": self.feeder}
+
+    def _feeder_endpoint_config(self, ep_config: dict) -> dict:
+        if not self.feeder:
+            return ep_config
+        ep_config = dict(ep_config)
+        if "data_dir" in ep_config:
+            ep_config["data_dir"] = str(Path(ep_config["data_dir"])/self.feeder)
+        if "client_id" in ep_config:
+            ep_config["client_id"] = f"{ep_config['client_id']:s}-{self.feeder:s}"
+        if "topic_prefix" in ep_config:
+            ep_config["topic_prefix"] = f"{ep_config['topic_prefix']:s}/{self.feeder:s}"
+        return ep_config
+
+    def _create_device_endpoint(self, ep_type: str, ep_config: dict, measurement_id: str, device_id: str):
+        if ep_type == "mqtt":
+            return MqttBinaryStorageEndpoint(name="mqtt",
+                                             measurement_id=measurement_id,
+                                             device_id=device_id,
+                                             mqtt_host=ep_config.get("hostname", "localhost"),
+                                             client_id=ep_config.get("client_id", "pqopen-mqtt"),
+                                             topic_prefix=ep_config.get("topic_prefix", "dt/pqopen"),
+                                             compression=ep_config.get("compression", False),
+                                             limit_precision=ep_config.get("decimal_places", None),
+                                             dictionary_path=ep_config.get("cbor_dictionary", ""),
+                                             compression_level=ep_config.get("cbor_compression_level", 6))
+        if ep_type == "archive":
+            return ArchiveStorageEndpoint(name="archive",
+                                          measurement_id=measurement_id,
+                                          data_dir=ep_config.get("data_dir", "/var/lib/pqopen/archive"),
+                                          max_size_bytes=int(ep_config.get("max_size_mb", 1024)*1024*1024),
+                                          segment_max_bytes=int(ep_config.get("segment_max_mb", 16)*1024*1024),
+                                          segment_duration_sec=ep_config.get("segment_duration_sec", 86400.0),
+                                          flush_interval_sec=ep_config.get("flush_interval_sec", 10.0))
+        raise NotImplementedError(f"{ep_type:s} not implemented")
+
+    def setup_endpoints_and_storageplans(self, endpoints: dict, storage_plans: dict, available_channels: dict,
+                                         measurement_id: str, device_id: str, start_timestamp_us: int,
+                                         m_config: dict | None = None, daq_info: DaqInfo | None = None,
+                                         channel_info: dict | None = None):
+        """Setup endpoints and storage plans from config (see StorageController)"""
+        device_endpoints = {ep_type: ep_config for ep_type, ep_config in endpoints.items() if ep_type in self.DEVICE_ENDPOINTS}
+        super().setup_endpoints_and_storageplans(endpoints={ep_type: self._feeder_endpoint_config(ep_config)
+                                                            for ep_type, ep_config in endpoints.items() if ep_type not in device_endpoints},
+                                                 storage_plans={sp_name: sp_config for sp_name, sp_config in storage_plans.items() if sp_config.get("endpoint") not in device_endpoints},
+                                                 available_channels=available_channels,
+                                                 measurement_id=measurement_id,
+                                                 device_id=device_id,
+                                                 start_timestamp_us=start_timestamp_us,
+                                                 m_config=m_config,
+                                                 daq_info=daq_info,
+                                                 channel_info=channel_info)
+        for ep_type, ep_config in device_endpoints.items():
+            if self._shared_endpoints is not None and ep_type in self._shared_endpoints:
+                self.device_endpoints[ep_type] = self._shared_endpoints[ep_type]
+            else:
+                self.device_endpoints[ep_type] = self._create_device_endpoint(ep_type, ep_config, measurement_id, device_id)
+                if self._shared_endpoints is not None:
+                    self._shared_endpoints[ep_type] = self.device_endpoints[ep_type]
+            self._configured_eps[ep_type] = self.device_endpoints[ep_type]
+        for sp_name, sp_config in storage_plans.items():
+            if sp_config.get("endpoint") not in device_endpoints:
+                continue
+            storage_plan = StoragePlan(storage_endpoint=self.device_endpoints[sp_config["endpoint"]],
+                                       start_timestamp_us=start_timestamp_us,
+                                       interval_seconds=sp_config.get("interval_sec", 600),
+                                       storage_name=sp_name,
+                                       store_events=sp_config.get("store_events", False),
+                                       additional_config={**sp_config, **self.endpoint_kwargs(sp_config["endpoint"], sp_config)})
+            for channel in sp_config.get("channels", []) or available_channels:
+                if channel in available_channels:
+                    storage_plan.add_channel(available_channels[channel])
+                else:
+                    logger.warning(f"Channel {channel} not available for storing")
+            self.add_storage_plan(storage_plan)
+            if sp_config.get("store_config", False) and m_config and daq_info and channel_info:
+                storage_plan.store_measurement_config(m_config=m_config, daq_info=daq_info, channel_info=channel_info)
+
+    def close(self):
+        """Write the data buffered by the endpoints"""
+        for endpoint in self._configured_eps.values():
+            if hasattr(endpoint, "close"):
+                endpoint.close()
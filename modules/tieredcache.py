@@ -0,0 +1,369 @@
+import os
+import zlib
+import time
+import logging
+import threading
+import collections
+import cbor2
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+FIRST_SEGMENT_NUM = 10**9
+MAX_MQTT_MID = 65535 # Message ids of the MQTT client wrap from 65535 to 1
+
+class TieredCache(object):
+    """Message cache with a bounded RAM tier and compressed append-only disk segments
+
+    Records are kept in RAM until ram_max_bytes are reached. Further records are
+    collected in a segment buffer and written as one compressed segment file
+    (atomically: temporary file, fsync, rename) when segment_max_bytes are collected
+    or the oldest record waits for flush_interval_sec. As long as the disk tier is in
+    use, new records are appended to it, so the order of the records is kept.
+
+    A segment file is removed only after all its records were committed, segments
+    left after a crash or restart are replayed (records may be sent twice, but are
+    not lost). On close, the records in RAM are written to disk too.
+
+    Parameters:
+        path: directory of the segment files
+        ram_max_bytes: max. payload bytes in the RAM tier
+        segment_max_bytes: payload bytes at which a segment is written
+        flush_interval_sec: max. time a record waits in the segment buffer
+        compression_level: zlib compression level of the segments
+    """
+    def __init__(self, path: str | Path, ram_max_bytes: int = 4*1024*1024, segment_max_bytes: int = 1024*1024,
+                 flush_interval_sec: float = 1.0, compression_level: int = 6):
+        self._path = Path(path)
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._ram_max_bytes = ram_max_bytes
+        self._segment_max_bytes = segment_max_bytes
+        self._flush_interval_sec = flush_interval_sec
+        self._compression_level = compression_level
+        self._lock = threading.RLock()
+        self._ram = collections.deque()
+        self._ram_bytes = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_start_ts = 0.0
+        self._read_segment = None
+        self._read_records = collections.deque()
+        self._pending_commit = []
+        for tmp_file in self._path.glob("*.tmp"):
+            tmp_file.unlink()
+        # Segment files: <segment number>_<number of records>.seg
+        self._segments = sorted(tuple(int(part) for part in segment_file.stem.split("_")) for segment_file in self._path.glob("*.seg"))
+        if self._segments:
+            logger.info(f"TieredCache: replaying {len(self._segments):d} segments from {self._path}")
+
+    def _segment_path(self, segment: Tuple[int, int]) -> Path:
+        return self._path/f"{segment[0]:012d}_{segment[1]:d}.seg"
+
+    def _write_segment(self, segment_num: int, records: List[Tuple[str, bytes]]) -> Tuple[int, int]:
+        segment = (segment_num, len(records))
+        segment_path = self._segment_path(segment)
+        tmp_path = segment_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(cbor2.dumps(records), self._compression_level))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, segment_path)
+        return segment
+
+    def _flush_buffer(self):
+        if not self._buffer:
+            return
+        known_segments = self._segments + self._pending_commit + ([self._read_segment] if self._read_segment else [])
+        segment_num = max([num for num, _ in known_segments] + [FIRST_SEGMENT_NUM - 1]) + 1
+        self._segments.append(self._write_segment(segment_num, self._buffer))
+        logger.debug(f"TieredCache: wrote segment {segment_num:d} with {len(self._buffer):d} records")
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def _load_segment(self) -> bool:
+        while self._segments:
+            segment = self._segments.pop(0)
+            try:
+                records = cbor2.loads(zlib.decompress(self._segment_path(segment).read_bytes()))
+            except (OSError, zlib.error, ValueError) as e:
+                logger.error(f"TieredCache: segment {segment[0]:d} not readable, skipped: {e}")
+                self._segment_path(segment).unlink(missing_ok=True)
+                continue
+            self._read_segment = segment
+            self._read_records = collections.deque((topic, payload) for topic, payload in records)
+            return True
+        return False
+
+    @property
+    def disk_in_use(self) -> bool:
+        return bool(self._segments or self._buffer or self._read_segment is not None)
+
+    @property
+    def tier(self) -> str | None:
+        """Tier in use: "disk", "ram" or None if empty"""
+        with self._lock:
+            if self.disk_in_use:
+                return "disk"
+            return "ram" if self._ram else None
+
+    @property
+    def num_records(self) -> int:
+        """Number of records in all tiers"""
+        with self._lock:
+            return len(self._ram) + len(self._read_records) + sum(count for _, count in self._segments) + len(self._buffer)
+
+    def is_empty(self) -> bool:
+        return self.tier is None
+
+    def append(self, topic: str, payload: bytes):
+        """Append one record"""
+        with self._lock:
+            if not self.disk_in_use and self._ram_bytes + len(payload) <= self._ram_max_bytes:
+                self._ram.append((topic, payload))
+                self._ram_bytes += len(payload)
+                return
+            if not self._buffer:
+                self._buffer_start_ts = time.monotonic()
+            self._buffer.append((topic, payload))
+            self._buffer_bytes += len(payload)
+            if self._buffer_bytes >= self._segment_max_bytes:
+                self._flush_buffer()
+
+    def process(self):
+        """Write the segment buffer if its oldest record waits for flush_interval_sec"""
+        with self._lock:
+            if self._buffer and time.monotonic() > self._buffer_start_ts + self._flush_interval_sec:
+                self._flush_buffer()
+
+    def pop(self, max_count: int) -> List[Tuple[str, bytes]]:
+        """Take up to max_count of the oldest records; call commit() once they are handed over"""
+        with self._lock:
+            records = []
+            while len(records) < max_count:
+                if self._ram:
+                    topic, payload = self._ram.popleft()
+                    self._ram_bytes -= len(payload)
+                    records.append((topic, payload))
+                elif self._read_records:
+                    records.append(self._read_records.popleft())
+                elif self._read_segment is not None:
+                    # Segment completely read, removed on commit
+                    self._pending_commit.append(self._read_segment)
+                    self._read_segment = None
+                elif self._load_segment():
+                    continue
+                elif self._buffer:
+                    num_records = max_count - len(records)
+                    records += self._buffer[:num_records]
+                    self._buffer = self._buffer[num_records:]
+                    self._buffer_bytes = sum(len(payload) for _, payload in self._buffer)
+                else:
+                    break
+            if self._read_segment is not None and not self._read_records:
+                self._pending_commit.append(self._read_segment)
+                self._read_segment = None
+            return records
+
+    def commit(self):
+        """Remove the segments of which all records are handed over"""
+        with self._lock:
+            for segment in self._pending_commit:
+                self._segment_path(segment).unlink(missing_ok=True)
+            self._pending_commit = []
+
+    def close(self):
+        """Write all records kept in RAM to disk"""
+        with self._lock:
+            if self._read_segment is not None:
+                # Replace the partially read segment by the remaining records
+                self._segments.insert(0, self._write_segment(self._read_segment[0], list(self._read_records)))
+                if self._segment_path(self._segments[0]) != self._segment_path(self._read_segment):
+                    self._segment_path(self._read_segment).unlink(missing_ok=True)
+                self._read_segment = None
+                self._read_records.clear()
+            elif self._ram:
+                segment_num = min([num for num, _ in self._segments] + [FIRST_SEGMENT_NUM]) - 1
+                self._segments.insert(0, self._write_segment(segment_num, list(self._ram)))
+            self._ram.clear()
+            self._ram_bytes = 0
+            self._flush_buffer()
+            self.commit()
+
+
+class PriorityTieredCache(object):
+    """TieredCache per priority, the records of priority 0 are taken first
+
+    Every priority has its own TieredCache in the subdirectory priority-<n> of path, so
+    the order of the records is kept within a priority. After an outage, events and
+    aggregates are therefore sent before the backlog of the lower priorities.
+
+    Parameters:
+        path: directory of the caches
+        **cache_kwargs: parameters of each TieredCache (ram_max_bytes applies per priority)
+    """
+    def __init__(self, path: str | Path, **cache_kwargs):
+        self._path = Path(path)
+        self._cache_kwargs = cache_kwargs
+        self._lock = threading.Lock()
+        self._caches = {}
+        # Replay the caches of all priorities left after a restart
+        for cache_path in self._path.glob("priority-*"):
+            self._get_cache(int(cache_path.name.split("-", 1)[1]))
+
+    def _get_cache(self, priority: int) -> TieredCache:
+        with self._lock:
+            if priority not in self._caches:
+                self._caches[priority] = TieredCache(self._path/f"priority-{priority:d}", **self._cache_kwargs)
+                self._caches = dict(sorted(self._caches.items()))
+            return self._caches[priority]
+
+    @property
+    def caches(self) -> List[TieredCache]:
+        """The caches in order of priority"""
+        with self._lock:
+            return list(self._caches.values())
+
+    @property
+    def tier(self) -> str | None:
+        """Tier in use: "disk" if any priority uses it, "ram" or None if empty"""
+        tiers = {cache.tier for cache in self.caches}
+        if "disk" in tiers:
+            return "disk"
+        return "ram" if "ram" in tiers else None
+
+    @property
+    def num_records(self) -> int:
+        """Number of records of all priorities"""
+        return sum(cache.num_records for cache in self.caches)
+
+    def is_empty(self) -> bool:
+        return all(cache.is_empty() for cache in self.caches)
+
+    def append(self, topic: str, payload: bytes, priority: int = 1):
+        """Append one record to the cache of its priority"""
+        self._get_cache(priority).append(topic, payload)
+
+    def process(self):
+        for cache in self.caches:
+            cache.process()
+
+    def pop(self, max_count: int) -> List[Tuple[str, bytes]]:
+        """Take up to max_count of the oldest records, highest priority (0) first; call commit() once they are handed over"""
+        records = []
+        for cache in self.caches:
+            if len(records) >= max_count:
+                break
+            records += cache.pop(max_count - len(records))
+        return records
+
+    def commit(self):
+        for cache in self.caches:
+            cache.commit()
+
+    def close(self):
+        for cache in self.caches:
+            cache.close()
+
+
+class TieredSender(object):
+    """Sends directly while the uplink is available, otherwise via the TieredCache
+
+    The persistent sender is fed only while it is connected and has no backlog of its
+    own, so outages are absorbed by the RAM tier and the disk segments of the cache.
+    Cached records are handed over by priority (see PriorityTieredCache).
+    The cached_items of the sender count only the records it has written to its own
+    database, which it does for its whole queue once more than 100 records are queued.
+    So at most max_in_flight records are handed over and not yet acknowledged, counted
+    by the message ids (last_mid) the sender has acknowledged since. On update, the
+    cache is drained in steps of up to drain_count records until it is empty or the
+    backlog of the sender exceeds max_sender_backlog, waiting for acknowledgements of
+    the sender for up to timeout seconds.
+
+    Parameters:
+        publish: publish function of the persistent sender (topic, payload)
+        cache: the PriorityTieredCache
+        get_sender_status: returns the status of the persistent sender (connected, last_mid, cached_items)
+        drain_count: max. number of cached records handed over per step
+        max_sender_backlog: max. number of cached items of the sender to hand over records
+        max_in_flight: max. number of handed over records not yet acknowledged by the sender
+    """
+    def __init__(self, publish: Callable[[str, bytes], None], cache: PriorityTieredCache, get_sender_status: Callable[[], dict],
+                 drain_count: int = 100, max_sender_backlog: int = 0, max_in_flight: int = 50):
+        self._publish = publish
+        self.cache = cache
+        self._get_sender_status = get_sender_status
+        self._drain_count = drain_count
+        self._max_sender_backlog = max_sender_backlog
+        self._max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._direct = False
+        self._last_mid = 0
+        self.in_flight = 0
+
+    def publish(self, topic: str, payload: bytes, priority: int = 1):
+        with self._lock:
+            if self._direct and self.in_flight < self._max_in_flight and self.cache.is_empty():
+                self._publish(topic, payload)
+                self.in_flight += 1
+            else:
+                self.cache.append(topic, payload, priority)
+
+    def _update_sender_status(self):
+        sender_status = self._get_sender_status()
+        last_mid = sender_status.get("last_mid")
+        if last_mid is not None and last_mid != self._last_mid:
+            self.in_flight = max(self.in_flight - (last_mid - self._last_mid) % MAX_MQTT_MID, 0)
+            self._last_mid = last_mid
+        if sender_status["cached_items"] > 0:
+            # The queue of the sender was moved to its database
+            self.in_flight = 0
+        self._direct = bool(sender_status["connected"]) and sender_status["cached_items"] <= self._max_sender_backlog
+
+    def _drain_step(self) -> int:
+        """Hand over up to drain_count records if the sender accepts them; returns the number of records"""
+        with self._lock:
+            self._update_sender_status()
+            if not self._direct:
+                return 0
+            records = self.cache.pop(min(self._drain_count, self._max_in_flight - self.in_flight))
+            for topic, payload in records:
+                self._publish(topic, payload)
+            self.in_flight += len(records)
+            self.cache.commit()
+            return len(records)
+
+    def update(self, timeout: float = 0.0):
+        """Hand over cached records while the sender accepts them
+
+        Parameters:
+            timeout: max. time to wait for acknowledgements of the sender to hand over further records
+        """
+        stop_ts = time.monotonic() + timeout
+        # The lock is released between the steps, so publish is not blocked while draining
+        while True:
+            if self._drain_step():
+                continue
+            if not self._direct or self.cache.is_empty() or time.monotonic() >= stop_ts:
+                break
+            time.sleep(0.01)
+        self.cache.process()
+
+    def close(self):
+        self.cache.close()
+
+    @classmethod
+    def from_config(cls, config: dict, publish: Callable[[str, bytes], None], get_sender_status: Callable[[], dict]):
+        """Create the sender from the [tiered_cache] section; None if not enabled"""
+        tiered_config = config.get("tiered_cache", {})
+        if not tiered_config.get("enabled", False):
+            return None
+        cache = PriorityTieredCache(tiered_config.get("segment_path", Path(config["cache"].get("path", "/tmp/"), "segments")),
+                                    ram_max_bytes=tiered_config.get("ram_max_bytes", 4*1024*1024),
+                                    segment_max_bytes=tiered_config.get("segment_max_bytes", 1024*1024),
+                                    flush_interval_sec=tiered_config.get("flush_interval_sec", 1.0),
+                                    compression_level=tiered_config.get("compression_level", 6))
+        return cls(publish, cache, get_sender_status,
+                   drain_count=tiered_config.get("drain_count", 100),
+                   max_sender_backlog=tiered_config.get("max_sender_backlog", 0),
+                   max_in_flight=tiered_config.get("max_in_flight", 50))
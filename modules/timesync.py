@@ -1,14 +1,153 @@
-import subprocess
+"""
+Time quality of the system clock
 
-def is_time_synchronized():
+The state of the clock discipline (chronyd, ntpd, systemd-timesyncd) is read from the kernel
+with adjtimex(2) in read-only mode: no process is spawned and no privileges are needed.
+TimeQualityMonitor reads it periodically in a background thread and detects steps of the
+system clock by comparing it with the monotonic clock.
+"""
+
+import time
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Kernel clock state (return value of adjtimex) and status bits
+TIME_ERROR = 5
+STA_UNSYNC = 0x0040
+STA_NANO = 0x2000
+
+class _Timex(ctypes.Structure):
+    _fields_ = [("modes", ctypes.c_uint),
+                ("offset", ctypes.c_long),
+                ("freq", ctypes.c_long),
+                ("maxerror", ctypes.c_long),
+                ("esterror", ctypes.c_long),
+                ("status", ctypes.c_int),
+                ("constant", ctypes.c_long),
+                ("precision", ctypes.c_long),
+                ("tolerance", ctypes.c_long),
+                ("time_sec", ctypes.c_long),
+                ("time_usec", ctypes.c_long),
+                ("tick", ctypes.c_long),
+                ("ppsfreq", ctypes.c_long),
+                ("jitter", ctypes.c_long),
+                ("shift", ctypes.c_int),
+                ("stabil", ctypes.c_long),
+                ("jitcnt", ctypes.c_long),
+                ("calcnt", ctypes.c_long),
+                ("errcnt", ctypes.c_long),
+                ("stbcnt", ctypes.c_long),
+                ("tai", ctypes.c_int),
+                ("_reserved", ctypes.c_int*11)]
+
+_libc = None
+
+def _adjtimex():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc.adjtimex
+
+
+class ClockStatus(object):
+    """State of the system clock discipline
+
+    Attributes:
+        synchronized: the clock is synchronized (kernel clock state not TIME_ERROR, STA_UNSYNC not set)
+        offset: offset of the kernel PLL in seconds (0 with chronyd, which adjusts the frequency)
+        est_error: estimated error in seconds
+        max_error: maximum error in seconds
+        freq_ppm: frequency correction in ppm
+        state: kernel clock state (0: TIME_OK ... 5: TIME_ERROR)
+    """
+    def __init__(self, synchronized: bool, offset: float, est_error: float, max_error: float, freq_ppm: float, state: int):
+        self.synchronized = synchronized
+        self.offset = offset
+        self.est_error = est_error
+        self.max_error = max_error
+        self.freq_ppm = freq_ppm
+        self.state = state
+
+    def to_dict(self) -> dict:
+        return {"synchronized": self.synchronized, "offset": self.offset, "est_error": self.est_error,
+                "max_error": self.max_error, "freq_ppm": self.freq_ppm, "state": self.state}
+
+def read_clock_status() -> ClockStatus | None:
+    """Read the state of the system clock discipline from the kernel (None if not available)"""
+    timex = _Timex()
     try:
-        output = subprocess.check_output(['chronyc', 'tracking'], encoding='utf-8')
-        for line in output.splitlines():
-            if line.startswith('Leap status'):
-                status = line.split(':')[1].strip()
-                return status.lower() == 'normal'
-    except subprocess.CalledProcessError as e:
-        print("Error running chronyc:", e)
-    except FileNotFoundError:
-        print("chronyc not installed")
-    return False
\ No newline at end of file
+        state = _adjtimex()(ctypes.byref(timex))
+    except (OSError, AttributeError) as e:
+        logger.error(f"adjtimex not available: {e}")
+        return None
+    if state < 0:
+        logger.error(f"adjtimex failed: errno {ctypes.get_errno():d}")
+        return None
+    offset_scale = 1e-9 if timex.status & STA_NANO else 1e-6
+    return ClockStatus(synchronized=state != TIME_ERROR and not timex.status & STA_UNSYNC,
+                       offset=timex.offset*offset_scale,
+                       est_error=timex.esterror*1e-6,
+                       max_error=timex.maxerror*1e-6,
+                       freq_ppm=timex.freq/65536,
+                       state=state)
+
+def is_time_synchronized() -> bool:
+    """Check if the system clock is synchronized"""
+    clock_status = read_clock_status()
+    return clock_status is not None and clock_status.synchronized
+
+
+class TimeQualityMonitor(threading.Thread):
+    """Monitors the quality of the system clock in the background
+
+    The clock status is read every poll_interval seconds. Changes of the offset between
+    system clock and monotonic clock larger than step_threshold_sec within one interval are
+    counted as steps. time_quality_ok is the time quality flag of the published data.
+
+    Parameters:
+        poll_interval: interval of the readings in seconds
+        max_est_error: max. estimated error in seconds for a good time quality
+        step_threshold_sec: min. change of the clock offset between two readings counted as step
+    """
+    def __init__(self, poll_interval: float = 1.0, max_est_error: float = 0.1, step_threshold_sec: float = 0.01):
+        super().__init__(name="TimeQualityMonitor", daemon=True)
+        self._poll_interval = poll_interval
+        self._max_est_error = max_est_error
+        self._step_threshold_sec = step_threshold_sec
+        self._stop_event = threading.Event()
+        self._last_clock_offset = time.time() - time.monotonic()
+        self.clock_status: ClockStatus | None = read_clock_status()
+        self.step_count = 0
+        self.last_step = 0.0
+        self.time_quality_ok = self._quality_ok(self.clock_status)
+
+    def _quality_ok(self, clock_status: ClockStatus | None) -> bool:
+        return clock_status is not None and clock_status.synchronized and clock_status.est_error <= self._max_est_error
+
+    def poll(self):
+        """Read the clock status once (called by the thread)"""
+        clock_offset = time.time() - time.monotonic()
+        if abs(clock_offset - self._last_clock_offset) > self._step_threshold_sec:
+            self.last_step = clock_offset - self._last_clock_offset
+            self.step_count += 1
+            logger.warning(f"System clock stepped by {self.last_step:+.6f} s")
+        self._last_clock_offset = clock_offset
+        clock_status = read_clock_status()
+        time_quality_ok = self._quality_ok(clock_status)
+        if time_quality_ok != self.time_quality_ok:
+            logger.log(logging.INFO if time_quality_ok else logging.WARNING,
+                       f"Time quality {'good' if time_quality_ok else 'bad'}: {clock_status.to_dict() if clock_status else None}")
+        self.clock_status = clock_status
+        self.time_quality_ok = time_quality_ok
+
+    def run(self):
+        while not self._stop_event.wait(self._poll_interval):
+            self.poll()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
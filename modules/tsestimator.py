@@ -0,0 +1,170 @@
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PacketTimestampEstimator(object):
+    """Estimates the acquisition timestamp of the newest DAQ packet from noisy arrival times.
+
+    All state lives in preallocated ring buffers with running sums, so one update costs
+    the same regardless of the window sizes and does not allocate new arrays.
+
+    Methods:
+        "window_mean": mean arrival time of the last ts_window packets, projected to the
+            newest packet with the mean packet period of the last diff_window packets
+            (same result as the former np.roll based implementation)
+        "linear_fit": least squares fit of arrival time vs. packet number over the last
+            ts_window packets, evaluated at the newest packet
+    """
+    METHODS = ("window_mean", "linear_fit")
+
+    def __init__(self, ts_window: int = 51, diff_window: int = 1000, method: str = "window_mean", median_rate: float = 0.01):
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown timestamp estimation method: {method:s}")
+        self.method = method
+        self._ts_window = ts_window
+        self._diff_window = diff_window
+        self._median_rate = median_rate
+        self._ts_ring = np.zeros(ts_window)
+        self._diff_ring = np.zeros(diff_window)
+        self._ts_x = np.arange(ts_window, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        """Forget all timestamps, e.g. after a restart of the acquisition"""
+        self._ts_ring[:] = 0.0
+        self._diff_ring[:] = 0.0
+        self._ts_idx = 0
+        self._diff_idx = 0
+        self._ts_sum = 0.0
+        self._ts_xsum = 0.0
+        self._diff_sum = 0.0
+        self._ts_ref = None
+        self._last_rel_ts = None
+        self.count = 0
+        self.last_diff = 0.0
+        self.diff_median = 0.0
+        self.timestamp = 0.0
+
+    def prime(self, timestamp: float):
+        """Remember the timestamp of a packet which should not be part of the estimation
+        (e.g. during startup) but serves as predecessor for the first packet period
+        """
+        if self._ts_ref is None:
+            self._ts_ref = timestamp
+        self._last_rel_ts = timestamp - self._ts_ref
+
+    def update(self, timestamp: float) -> float:
+        """Add the arrival time of the newest packet and return its estimated timestamp
+
+        Parameters:
+            timestamp: arrival time (e.g. time.time()) of the newest packet
+
+        Returns:
+            Estimated timestamp of the newest packet
+        """
+        if self._ts_ref is None:
+            self._ts_ref = timestamp
+        rel_ts = timestamp - self._ts_ref
+        diff = rel_ts - self._last_rel_ts if self._last_rel_ts is not None else 0.0
+        self._last_rel_ts = rel_ts
+        self.count += 1
+        self._add_diff(diff)
+        self._add_ts(rel_ts)
+        self._update_median(diff)
+        self.last_diff = diff
+
+        n_ts = min(self.count, self._ts_window)
+        if self.method == "linear_fit" and n_ts > 2:
+            # Least squares fit with x = 0..n_ts-1 (oldest to newest) in the actual window
+            x_sum = 0.5*n_ts*(n_ts - 1)
+            xx_sum = (n_ts - 1)*n_ts*(2*n_ts - 1)/6
+            slope = (n_ts*self._ts_xsum - x_sum*self._ts_sum)/(n_ts*xx_sum - x_sum*x_sum)
+            rel_estimate = (self._ts_sum - slope*x_sum)/n_ts + slope*(n_ts - 1)
+        else:
+            rel_estimate = self._ts_sum/n_ts + self.diff_mean*(0.5*n_ts - 0.5)
+        self.timestamp = self._ts_ref + rel_estimate
+        return self.timestamp
+
+    @property
+    def diff_mean(self) -> float:
+        """Mean packet period of the diff window"""
+        return self._diff_sum/min(self.count, self._diff_window) if self.count else 0.0
+
+    @property
+    def jitter_exceeded(self) -> bool:
+        """True if the newest packet period is off by more than factor 2 of the median period"""
+        return (self.last_diff < self.diff_median/2) or (self.last_diff > self.diff_median*2)
+
+    def _add_diff(self, diff: float):
+        if self.count > self._diff_window:
+            self._diff_sum -= self._diff_ring[self._diff_idx]
+        self._diff_ring[self._diff_idx] = diff
+        self._diff_sum += diff
+        self._diff_idx += 1
+        if self._diff_idx == self._diff_window:
+            self._diff_idx = 0
+            # Renew running sum to stop accumulation of rounding errors
+            self._diff_sum = self._diff_ring.sum()
+
+    def _add_ts(self, rel_ts: float):
+        n_ts = self._ts_window
+        if self.count > n_ts:
+            # Slide window: all x shift by one, oldest value drops out
+            oldest = self._ts_ring[self._ts_idx]
+            self._ts_xsum -= self._ts_sum - oldest
+            self._ts_sum -= oldest
+            self._ts_xsum += (n_ts - 1)*rel_ts
+        else:
+            self._ts_xsum += (self.count - 1)*rel_ts
+        self._ts_ring[self._ts_idx] = rel_ts
+        self._ts_sum += rel_ts
+        self._ts_idx += 1
+        if self._ts_idx == n_ts:
+            self._ts_idx = 0
+            # Ring is in chronological order now, renew running sums
+            self._ts_sum = self._ts_ring.sum()
+            self._ts_xsum = self._ts_ring.dot(self._ts_x)
+
+    def _update_median(self, diff: float):
+        # Streaming median estimate with step size relative to the actual median
+        if self.count <= 1 or self.diff_median <= 0:
+            self.diff_median = diff
+        elif diff > self.diff_median:
+            self.diff_median += self._median_rate*self.diff_median
+        elif diff < self.diff_median:
+            self.diff_median -= self._median_rate*self.diff_median
+
+
+class ClockOffsetSmoother(object):
+    """Follows the offset between system clock and monotonic clock with a limited slew rate
+
+    With packet timestamps estimated on the monotonic clock, steps of the system clock do
+    not disturb the estimation windows. The offset to the system clock is added afterwards:
+    immediately (max_slew_rate 0) or changed by at most max_slew_rate seconds per second, so
+    the published timestamps stay continuous while a step is slewed in.
+
+    Parameters:
+        max_slew_rate: max. change of the offset per second (e.g. 500e-6; 0: follow immediately)
+    """
+    def __init__(self, max_slew_rate: float = 0.0):
+        self._max_slew_rate = max_slew_rate
+        self._last_mono_ts = None
+        self.clock_offset = None
+        self.offset = None
+
+    def update(self, clock_offset: float, mono_ts: float) -> float:
+        """Update with the actual offset (system clock - monotonic clock) at mono_ts, return the offset to apply"""
+        self.clock_offset = clock_offset
+        if self.offset is None or not self._max_slew_rate:
+            self.offset = clock_offset
+        else:
+            max_change = self._max_slew_rate*(mono_ts - self._last_mono_ts)
+            self.offset += min(max(clock_offset - self.offset, -max_change), max_change)
+        self._last_mono_ts = mono_ts
+        return self.offset
+
+    @property
+    def pending(self) -> float:
+        """Part of the offset change not yet applied"""
+        return self.clock_offset - self.offset if self.offset is not None else 0.0
@@ -0,0 +1,175 @@
+import queue
+import logging
+import threading
+import numpy as np
+from pathlib import Path
+from datetime import datetime, timezone
+from typing import Callable, List
+
+from daqopen.channelbuffer import AcqBufferPool
+from pqopen.eventdetector import Event
+
+from modules.binarypayload import encode_timestamps, encode_typed_array, encode_payload, PayloadCompressor
+
+logger = logging.getLogger(__name__)
+
+class WaveformWriter(threading.Thread):
+    """Encodes and writes the captured waveforms in the background
+
+    Each capture is encoded as compressed binary payload (type "waveform", see
+    modules/binarypayload.py) and written to capture_dir and/or passed to publish.
+
+    Parameters:
+        capture_dir: directory of the waveform files (None: no files)
+        publish: function called with the payload (e.g. MQTT endpoint), optional
+        max_queued: max. number of queued captures (further captures are dropped)
+    """
+    def __init__(self, capture_dir: str | Path | None = None, publish: Callable[[bytes], None] | None = None, max_queued: int = 8):
+        super().__init__(name="WaveformWriter", daemon=True)
+        self._capture_dir = Path(capture_dir) if capture_dir else None
+        if self._capture_dir:
+            self._capture_dir.mkdir(parents=True, exist_ok=True)
+        self._publish = publish
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._compressor = PayloadCompressor()
+        self.written_captures = 0
+        self.dropped_captures = 0
+
+    def put(self, capture: dict) -> bool:
+        try:
+            self._queue.put_nowait(capture)
+        except queue.Full:
+            self.dropped_captures += 1
+            logger.warning("WaveformWriter: queue full - capture dropped")
+            return False
+        return True
+
+    def _write(self, capture: dict):
+        message = {"type": "waveform",
+                   "measurement_uuid": capture["measurement_uuid"],
+                   "samplerate": capture["samplerate"],
+                   "events": capture["events"],
+                   "ts": encode_timestamps(capture["timestamps"]),
+                   "data": {channel: encode_typed_array(values) for channel, values in capture["data"].items()}}
+        payload = encode_payload(message, self._compressor)
+        if self._capture_dir:
+            first_event = capture["events"][0]
+            start_time = datetime.fromtimestamp(first_event["timestamp"], tz=timezone.utc)
+            file_path = self._capture_dir/f"{start_time:%Y%m%dT%H%M%S}_{first_event['event_type']:s}_{first_event['id'][:8]:s}.zcbor"
+            tmp_path = file_path.with_suffix(".tmp")
+            tmp_path.write_bytes(payload)
+            tmp_path.replace(file_path)
+        if self._publish:
+            self._publish(payload)
+        self.written_captures += 1
+
+    def run(self):
+        while (capture := self._queue.get()) is not None:
+            try:
+                self._write(capture)
+            except Exception as e:
+                logger.error(f"WaveformWriter: writing capture failed: {e}")
+
+    def stop(self):
+        """Write the queued captures and stop the thread"""
+        self._queue.put(None)
+        self.join()
+
+
+class WaveformCapture(object):
+    """Captures the raw waveforms around events from the AcqBufferPool
+
+    The AcqBufferPool serves as pre-trigger ring buffer. For every new event, the samples
+    from pre_sec before to post_sec after its start are copied as soon as they are
+    available and handed to the WaveformWriter. Events starting within a pending capture
+    (e.g. the same dip on several phases) are added to it. The number of captures per
+    day (UTC) is limited by max_captures_per_day.
+
+    Parameters:
+        daq_buffer: the AcqBufferPool
+        buffer_size: size of the AcqBufferPool in samples
+        channels: names of the captured channels
+        samplerate: samplerate of the acquisition
+        writer: the (started) WaveformWriter
+        measurement_id: id of the measurement
+        pre_sec: time before the event start
+        post_sec: time after the event start
+        max_captures_per_day: capture budget per day
+    """
+    def __init__(self, daq_buffer: AcqBufferPool, buffer_size: int, channels: List[str], samplerate: float, writer: WaveformWriter,
+                 measurement_id: str, pre_sec: float = 0.2, post_sec: float = 0.8, max_captures_per_day: int = 50):
+        self._daq_buffer = daq_buffer
+        self._buffer_size = buffer_size
+        self._channels = {name: daq_buffer.channel[name] for name in channels}
+        self._samplerate = samplerate
+        self._writer = writer
+        self._measurement_id = measurement_id
+        self._pre_samples = int(pre_sec*samplerate)
+        self._post_samples = int(post_sec*samplerate)
+        self._max_captures_per_day = max_captures_per_day
+        self._pending = []
+        self._triggered_ids = set()
+        self._budget_day = None
+        self.captures_today = 0
+        self.skipped_events = 0
+
+    def _use_budget(self, timestamp: float) -> bool:
+        day = int(timestamp//86400)
+        if day != self._budget_day:
+            self._budget_day = day
+            self.captures_today = 0
+        if self.captures_today >= self._max_captures_per_day:
+            return False
+        self.captures_today += 1
+        return True
+
+    def _trigger(self, event: Event):
+        event_info = {"id": str(event.id), "event_type": event.type, "channel": event.channel,
+                      "timestamp": event.start_ts, "extrem_value": event.extrem_value}
+        for capture in self._pending:
+            if capture["start_sidx"] <= event.start_sidx < capture["stop_sidx"]:
+                capture["events"].append(event_info)
+                return
+        if not self._use_budget(event.start_ts):
+            self.skipped_events += 1
+            if self.skipped_events % 100 == 1:
+                logger.warning(f"WaveformCapture: capture budget of {self._max_captures_per_day:d} per day used - event not captured")
+            return
+        self._pending.append({"start_sidx": event.start_sidx - self._pre_samples,
+                              "stop_sidx": event.start_sidx + self._post_samples,
+                              "events": [event_info]})
+
+    def _copy(self, capture: dict):
+        # Samples older than the buffer size are already overwritten
+        start_sidx = max(capture["start_sidx"], self._daq_buffer.time.sample_count - self._buffer_size + 1, 0)
+        if start_sidx > capture["start_sidx"]:
+            logger.warning(f"WaveformCapture: {start_sidx - capture['start_sidx']:d} pre-trigger samples not available anymore")
+        stop_sidx = capture["stop_sidx"]
+        self._writer.put({"measurement_uuid": self._measurement_id,
+                          "samplerate": self._samplerate,
+                          "events": capture["events"],
+                          "timestamps": self._daq_buffer.time.read_data_by_index(start_sidx, stop_sidx).astype(np.int64),
+                          "data": {name: channel.read_data_by_index(start_sidx, stop_sidx).astype(np.float32)
+                                   for name, channel in self._channels.items()}})
+
+    def process(self, events: List[Event]):
+        """Trigger captures for new events and hand over the complete captures; call after the event detection"""
+        for event in events:
+            if event.id not in self._triggered_ids:
+                self._triggered_ids.add(event.id)
+                self._trigger(event)
+            if event.stop_sidx is not None:
+                self._triggered_ids.discard(event.id)
+        sample_count = self._daq_buffer.time.sample_count
+        while self._pending and self._pending[0]["stop_sidx"] <= sample_count:
+            self._copy(self._pending.pop(0))
+
+    def close(self):
+        """Hand over the pending captures (as far as available) and stop the writer"""
+        sample_count = self._daq_buffer.time.sample_count
+        for capture in self._pending:
+            capture["stop_sidx"] = min(capture["stop_sidx"], sample_count)
+            if capture["stop_sidx"] > capture["start_sidx"]:
+                self._copy(capture)
+        self._pending = []
+        self._writer.stop()
@@ -0,0 +1,118 @@
+import unittest
+import sys
+import os
+import tempfile
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.channelbuffer import DataChannelBuffer
+from modules.archive import ArchiveStorageEndpoint, ArchiveReader
+from modules.storageendpoints import DeviceStorageController
+
+START_TIMESTAMP_US = 1_700_000_000_000_000
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = Path(self.tmp_dir.name, "archive")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_agg_rows(self, endpoint: ArchiveStorageEndpoint, num_rows: int, start_row: int = 0):
+        for row in range(start_row, start_row + num_rows):
+            data = {"U1_rms": 230.0 + row, "U1_H_rms": [230.0, row, None], "W_pos": 1e7 + row*0.1,
+                    "missing": None, "name": "text", "empty": []}
+            if row >= 5:
+                data["late"] = float(row)
+            endpoint.write_aggregated_data(data, START_TIMESTAMP_US + row*10_000_000, 10, float64_channels=["W_pos"])
+
+    def test_aggregated_data(self):
+        endpoint = ArchiveStorageEndpoint("archive", "uuid", self.data_dir)
+        self.write_agg_rows(endpoint, 20)
+        endpoint.close()
+        reader = ArchiveReader(self.data_dir)
+        self.assertEqual(reader.tables(), ["agg_10s"])
+        self.assertEqual(reader.channels("agg_10s"), ["U1_H_rms", "U1_rms", "W_pos", "late", "missing"])
+        timestamps, values = reader.read("agg_10s", "U1_rms")
+        self.assertEqual(timestamps.tolist(), [START_TIMESTAMP_US + row*10_000_000 for row in range(20)])
+        self.assertEqual(values.tolist(), [230.0 + row for row in range(20)])
+        self.assertEqual(values.dtype, np.float32)
+        _, values = reader.read("agg_10s", "W_pos")
+        self.assertEqual(values[3], 1e7 + 0.3)
+        timestamps, values = reader.read("agg_10s", "U1_H_rms", START_TIMESTAMP_US + 20_000_000, START_TIMESTAMP_US + 50_000_000)
+        self.assertEqual(values.shape, (3, 3))
+        self.assertEqual(values[:, 1].tolist(), [2.0, 3.0, 4.0])
+        self.assertTrue(np.isnan(values[:, 2]).all())
+        timestamps, values = reader.read("agg_10s", "late", stop_us=START_TIMESTAMP_US + 80_000_000)
+        self.assertEqual(values.tolist(), [5.0, 6.0, 7.0])
+        self.assertTrue(np.isnan(reader.read("agg_10s", "missing")[1]).all())
+
+    def test_data_series(self):
+        endpoint = ArchiveStorageEndpoint("archive", "uuid", self.data_dir, flush_interval_sec=0.0)
+        for block in range(3):
+            timestamps = (START_TIMESTAMP_US + np.arange(block*50, (block+1)*50)*20_000).tolist()
+            endpoint.write_data_series({"Freq": {"data": [50.0]*50, "timestamps": timestamps},
+                                        "U1_pmu_rms": {"data": [230.0]*25, "timestamps": timestamps[::2]}})
+        reader = ArchiveReader(self.data_dir)
+        self.assertEqual(reader.tables(), ["dataseries/Freq", "dataseries/U1_pmu_rms"])
+        timestamps, values = reader.read("dataseries/Freq", "Freq", START_TIMESTAMP_US + 1_000_000, START_TIMESTAMP_US + 2_000_000)
+        self.assertEqual(timestamps.size, 50)
+        self.assertEqual(timestamps[0], START_TIMESTAMP_US + 1_000_000)
+        self.assertEqual(reader.read("dataseries/U1_pmu_rms", "U1_pmu_rms")[1].size, 75)
+
+    def test_segments_and_retention(self):
+        endpoint = ArchiveStorageEndpoint("archive", "uuid", self.data_dir, max_size_bytes=3000,
+                                          segment_duration_sec=100.0, flush_interval_sec=0.0)
+        self.write_agg_rows(endpoint, 50)
+        segments = sorted(Path(self.data_dir, "agg_10s").iterdir())
+        # Segments of 100 s, the oldest are deleted
+        self.assertLess(len(segments), 5)
+        self.assertEqual(segments[-1].name, f"{START_TIMESTAMP_US + 400_000_000:020d}")
+        self.assertLessEqual(sum(file.stat().st_size for file in self.data_dir.rglob("*") if file.is_file()), 3000)
+        timestamps, values = ArchiveReader(self.data_dir).read("agg_10s", "U1_rms", START_TIMESTAMP_US + 450_000_000)
+        self.assertEqual(values.tolist(), [275.0, 276.0, 277.0, 278.0, 279.0])
+
+    def test_incomplete_files(self):
+        endpoint = ArchiveStorageEndpoint("archive", "uuid", self.data_dir)
+        self.write_agg_rows(endpoint, 10)
+        endpoint.close()
+        # Power loss during writing: column written, time column incomplete
+        time_file = next(self.data_dir.rglob("time.i8"))
+        time_file.write_bytes(time_file.read_bytes()[:-12])
+        timestamps, values = ArchiveReader(self.data_dir).read("agg_10s", "U1_rms")
+        self.assertEqual(timestamps.size, 8)
+        self.assertEqual(values.size, 8)
+        # Restart appends to a new segment
+        endpoint = ArchiveStorageEndpoint("archive", "uuid", self.data_dir)
+        self.write_agg_rows(endpoint, 10, start_row=10)
+        endpoint.close()
+        self.assertEqual(ArchiveReader(self.data_dir).read("agg_10s", "U1_rms")[0].size, 18)
+        # Restart with the same timestamps (e.g. replay) does not append to the existing segment
+        endpoint = ArchiveStorageEndpoint("archive", "uuid", self.data_dir)
+        self.write_agg_rows(endpoint, 10, start_row=10)
+        endpoint.close()
+        self.assertEqual(len(list(Path(self.data_dir, "agg_10s").iterdir())), 3)
+        self.assertEqual(ArchiveReader(self.data_dir).read("agg_10s", "U1_rms")[0].size, 28)
+
+    def test_storage_controller(self):
+        channels = {name: DataChannelBuffer(name) for name in ["U1_rms", "Freq"]}
+        storage_controller = DeviceStorageController(time_channel=DataChannelBuffer("time"), sample_rate=10_000.0)
+        storage_controller.setup_endpoints_and_storageplans(endpoints={"archive": {"data_dir": str(self.data_dir), "max_size_mb": 1}},
+                                                            storage_plans={"archive_10s": {"endpoint": "archive", "interval_sec": 10}},
+                                                            available_channels=channels,
+                                                            measurement_id="uuid",
+                                                            device_id="device",
+                                                            start_timestamp_us=START_TIMESTAMP_US)
+        self.assertIsInstance(storage_controller.device_endpoints["archive"], ArchiveStorageEndpoint)
+        self.assertEqual(len(storage_controller.storage_plans[0].channels), 2)
+        storage_controller.storage_plans[0].storage_endpoint.write_aggregated_data({"U1_rms": 230.0}, START_TIMESTAMP_US, 10)
+        storage_controller.close()
+        self.assertEqual(ArchiveReader(self.data_dir).read("agg_10s", "U1_rms")[1].tolist(), [230.0])
+
+if __name__ == "__main__":
+    unittest.main()
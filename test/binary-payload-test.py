@@ -0,0 +1,116 @@
+import unittest
+import sys
+import os
+import json
+import gzip
+import tempfile
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.channelbuffer import DataChannelBuffer
+from modules.binarypayload import (encode_data_series, encode_aggregated_data, encode_payload, decode_payload,
+                                   train_dictionary, PayloadCompressor)
+from modules.storageendpoints import DeviceStorageController, MqttBinaryStorageEndpoint
+
+START_TIMESTAMP_US = 1_700_000_000_000_000
+
+def create_data_series(num_periods: int = 50) -> dict:
+    rng = np.random.default_rng(0)
+    timestamps = (START_TIMESTAMP_US + np.arange(num_periods)*20_000 + rng.integers(-50, 50, num_periods)).tolist()
+    return {"Freq": {"data": (50.0 + 0.01*rng.standard_normal(num_periods)).tolist(), "timestamps": timestamps},
+            "U1_1p_H1_rms": {"data": (230.0 + rng.standard_normal(num_periods)).tolist(), "timestamps": timestamps},
+            "W_pos": {"data": (12345678.9 + np.arange(num_periods)*0.1).tolist(), "timestamps": timestamps[::2]}}
+
+class PublishRecorder(object):
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, qos=0):
+        self.messages.append((topic, payload))
+
+    def loop_stop(self):
+        pass
+
+class TestBinaryPayload(unittest.TestCase):
+
+    def test_timestamps(self):
+        for timestamps in [[], [START_TIMESTAMP_US], [5, 3, 2**40, 7]]:
+            data = {"A": {"data": [1.0]*len(timestamps), "timestamps": timestamps}}
+            self.assertEqual(decode_payload(encode_payload(encode_data_series(data, "uuid")))["data"]["A"]["timestamps"], timestamps)
+
+    def test_data_series(self):
+        data = create_data_series()
+        payload = encode_payload(encode_data_series(data, "uuid", float64_channels=["W_pos"]))
+        message = decode_payload(payload)
+        self.assertEqual(message["type"], "timeseries_data")
+        self.assertEqual(message["measurement_uuid"], "uuid")
+        for channel, series in data.items():
+            self.assertEqual(message["data"][channel]["timestamps"], series["timestamps"])
+        np.testing.assert_allclose(message["data"]["Freq"]["data"], data["Freq"]["data"], rtol=1e-7)
+        np.testing.assert_allclose(message["data"]["U1_1p_H1_rms"]["data"], data["U1_1p_H1_rms"]["data"], rtol=1e-7)
+        self.assertEqual(message["data"]["W_pos"]["data"], data["W_pos"]["data"])
+        # Much smaller than gzip compressed JSON
+        json_payload = gzip.compress(json.dumps({"type": "timeseries_data", "measurement_uuid": "uuid", "data": data}).encode())
+        self.assertLess(len(payload), len(json_payload))
+        self.assertLess(len(encode_payload(encode_data_series(data, "uuid"), PayloadCompressor())), 0.6*len(json_payload))
+
+    def test_aggregated_data(self):
+        data = {"U1_rms": 230.1234567, "W_pos": 12345678.9, "U1_H_rms": [230.0, None, 1.5], "count": 3, "missing": None}
+        message = decode_payload(encode_payload(encode_aggregated_data(data, START_TIMESTAMP_US, 10, "uuid", float64_channels=["W_pos"])))
+        self.assertEqual(message["timestamp"], START_TIMESTAMP_US/1e6)
+        self.assertEqual(message["interval_sec"], 10)
+        self.assertAlmostEqual(message["data"]["U1_rms"], 230.1234567, places=4)
+        self.assertEqual(message["data"]["W_pos"], 12345678.9)
+        self.assertEqual(message["data"]["U1_H_rms"], [230.0, None, 1.5])
+        self.assertEqual(message["data"]["count"], 3)
+        self.assertIsNone(message["data"]["missing"])
+
+    def test_compression_with_dictionary(self):
+        samples = [encode_payload(encode_data_series(create_data_series(10), "uuid")) for _ in range(3)]
+        dictionary = train_dictionary(samples)
+        message = encode_data_series(create_data_series(), "uuid")
+        payload = encode_payload(message, PayloadCompressor(dictionary))
+        self.assertLess(len(payload), len(encode_payload(message, PayloadCompressor())))
+        self.assertEqual(decode_payload(payload, [b"other", dictionary])["data"]["Freq"]["timestamps"],
+                         create_data_series()["Freq"]["timestamps"])
+        with self.assertRaises(ValueError):
+            decode_payload(payload)
+
+class TestDeviceStorageController(unittest.TestCase):
+
+    def test_binary_endpoint(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            Path(tmp_dir, "dict.bin").write_bytes(b"U1_1p_H1_rms")
+            channels = {name: DataChannelBuffer(name) for name in ["Freq", "U1_1p_H1_rms"]}
+            storage_plans = {"csv_1s": {"endpoint": "csv", "interval_sec": 1},
+                             "mqtt_10s": {"endpoint": "mqtt", "interval_sec": 10, "channels": ["Freq", "X"]},
+                             "mqtt_dataseries": {"endpoint": "mqtt", "interval_sec": 0, "encoding": "cbor"}}
+            storage_controller = DeviceStorageController(time_channel=DataChannelBuffer("time"), sample_rate=10_000.0)
+            storage_controller.setup_endpoints_and_storageplans(endpoints={"csv": {"data_dir": tmp_dir},
+                                                                           "mqtt": {"compression": True, "cbor_dictionary": str(Path(tmp_dir, "dict.bin"))}},
+                                                                storage_plans=storage_plans,
+                                                                available_channels=channels,
+                                                                measurement_id="uuid",
+                                                                device_id="device",
+                                                                start_timestamp_us=START_TIMESTAMP_US)
+            endpoint = storage_controller.device_endpoints["mqtt"]
+            self.assertIsInstance(endpoint, MqttBinaryStorageEndpoint)
+            plans = {plan.storage_name: plan for plan in storage_controller.storage_plans}
+            self.assertEqual(set(plans), set(storage_plans))
+            self.assertEqual([channel["channel"].name for channel in plans["mqtt_10s"].channels], ["Freq"])
+            self.assertEqual(len(plans["mqtt_dataseries"].channels), 2)
+            endpoint._client.loop_stop()
+            endpoint._client = PublishRecorder()
+            data = create_data_series()
+            endpoint.write_data_series(data, **storage_plans["mqtt_dataseries"])
+            endpoint.write_aggregated_data({"Freq": 50.0}, START_TIMESTAMP_US, 10, **storage_plans["mqtt_10s"])
+            (cbor_topic, cbor_payload), (json_topic, _) = endpoint._client.messages
+            self.assertEqual(cbor_topic, "dt/pqopen/device/dataseries/zcbor")
+            self.assertEqual(json_topic, "dt/pqopen/device/agg_data/gjson")
+            self.assertEqual(decode_payload(cbor_payload, [b"U1_1p_H1_rms"])["data"]["Freq"]["timestamps"], data["Freq"]["timestamps"])
+
+if __name__ == "__main__":
+    unittest.main()
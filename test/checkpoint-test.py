@@ -0,0 +1,153 @@
+import unittest
+import sys
+import os
+import csv
+import json
+import tempfile
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.channelbuffer import AcqBufferPool
+from daqopen.daqinfo import DaqInfo
+from modules.pqprocessing import create_power_system, create_storage_controller
+from modules.checkpoint import StateCheckpoint, StorageCheckpoint, config_hash, get_power_system_state, set_power_system_state, get_storage_state, set_storage_state
+
+SAMPLERATE = 50000
+PACKET_SIZE = 2500
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": SAMPLERATE},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"},
+                               "I1": {"ai_pin": "A1", "gain": 0.01, "unit": "A"}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1}
+START_TIMESTAMP_US = 1_750_000_000_000_000
+
+class TestStateCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = Path(self.tmp_dir.name, "state.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_save_load(self):
+        checkpoint = StateCheckpoint(self.file_path, "abc", max_age_sec=60)
+        self.assertIsNone(checkpoint.load(START_TIMESTAMP_US))
+        checkpoint.save({"values": np.arange(3, dtype=np.float32), "flag": np.bool_(True)}, START_TIMESTAMP_US)
+        self.assertFalse(Path(self.tmp_dir.name, "state.json.tmp").exists())
+        self.assertEqual(checkpoint.load(START_TIMESTAMP_US + 10_000_000), {"values": [0.0, 1.0, 2.0], "flag": True})
+        # Too old or from the future
+        self.assertIsNone(checkpoint.load(START_TIMESTAMP_US + 61_000_000))
+        self.assertIsNone(checkpoint.load(START_TIMESTAMP_US - 1_000_000))
+        # Changed config
+        self.assertIsNone(StateCheckpoint(self.file_path, "def").load(START_TIMESTAMP_US))
+        # Corrupt file
+        self.file_path.write_text("{")
+        self.assertIsNone(checkpoint.load(START_TIMESTAMP_US))
+
+    def test_config_hash(self):
+        config = {"powersystem": {"nominal_voltage": 230.0}, "checkpoint": {"interval_sec": 60}}
+        self.assertEqual(config_hash(config, SAMPLERATE), config_hash({**config, "checkpoint": {"interval_sec": 10}}, SAMPLERATE))
+        self.assertNotEqual(config_hash(config, SAMPLERATE), config_hash({"powersystem": {"nominal_voltage": 120.0}}, SAMPLERATE))
+        self.assertNotEqual(config_hash(config, SAMPLERATE), config_hash(config, 2*SAMPLERATE))
+
+class TestStateRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = {"powersystem": {"zcd_channel": "U1",
+                                       "enable_mains_signaling_tracer": True,
+                                       "energy_file_path": os.path.join(self.tmp_dir.name, "energy.json"),
+                                       "phase": {"1": {"u_channel": "U1", "i_channel": "I1"}}},
+                       "storageplan": {"csv_10s": {"endpoint": "csv", "channels": ["U1_rms", "P"], "interval_sec": 10}},
+                       "endpoint": {"csv": {"data_dir": self.tmp_dir.name}}}
+        self.daq_info = DaqInfo.from_dict(DAQ_INFO_CONFIG)
+        self.file_path = Path(self.tmp_dir.name, "storage.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_measurement(self, measurement_id: str, start_sec: float, stop_sec: float, amplitude: float, state: dict = None) -> dict:
+        start_timestamp_us = START_TIMESTAMP_US + int(start_sec*1e6)
+        daq_buffer = AcqBufferPool(self.daq_info, DATA_COLUMNS, size=200_000, start_timestamp_us=start_timestamp_us)
+        power_system = create_power_system(self.config, daq_buffer, SAMPLERATE)
+        storage_controller = create_storage_controller(self.config, daq_buffer, power_system, self.daq_info,
+                                                       measurement_id, "test", start_timestamp_us)
+        if state:
+            set_power_system_state(power_system, state["powersystem"])
+            set_storage_state(storage_controller, state["storage"], start_timestamp_us)
+        num_packets = int((stop_sec - start_sec)*SAMPLERATE/PACKET_SIZE)
+        t = start_sec + np.arange(num_packets*PACKET_SIZE)/SAMPLERATE
+        data = np.zeros((t.size, 2), dtype=np.float32)
+        data[:, 0] = amplitude*np.sin(2*np.pi*50.0*t)
+        data[:, 1] = 1000*np.sin(2*np.pi*50.0*t)
+        for packet_idx in range(num_packets):
+            timestamp_us = start_timestamp_us + (packet_idx+1)*PACKET_SIZE*1_000_000//SAMPLERATE
+            daq_buffer.put_data_with_timestamp(data[packet_idx*PACKET_SIZE:(packet_idx+1)*PACKET_SIZE], timestamp_us)
+            power_system.process()
+            storage_controller.process()
+        state = {"powersystem": get_power_system_state(power_system),
+                 "storage": get_storage_state(storage_controller, storage_controller.processed_sidx)}
+        del power_system
+        # State has to survive the json round trip
+        return json.loads(json.dumps(state, default=lambda value: value.tolist()))
+
+    def read_csv(self, measurement_id: str) -> list:
+        with open(Path(self.tmp_dir.name, f"{measurement_id}_10s.csv")) as f:
+            return list(csv.DictReader(f))
+
+    def test_power_system_state(self):
+        state = self.run_measurement("first", 0.0, 22.0, 325.0)
+        self.assertTrue(state["powersystem"]["phases"][0]["fluctuation"]["steady_state"])
+        restored_state = self.run_measurement("second", 23.0, 24.0, 325.0, state)
+        self.assertTrue(restored_state["powersystem"]["phases"][0]["fluctuation"]["steady_state"])
+        self.assertGreater(restored_state["powersystem"]["phases"][0]["fluctuation"]["processed_samples"],
+                           state["powersystem"]["phases"][0]["fluctuation"]["processed_samples"])
+
+    def test_storage_checkpoint_processed_sidx(self):
+        daq_buffer = AcqBufferPool(self.daq_info, DATA_COLUMNS, size=200_000, start_timestamp_us=START_TIMESTAMP_US)
+        power_system = create_power_system(self.config, daq_buffer, SAMPLERATE)
+        storage_controller = create_storage_controller(self.config, daq_buffer, power_system, self.daq_info,
+                                                       "first", "test", START_TIMESTAMP_US)
+        checkpoint = StateCheckpoint(self.file_path, "abc", interval_sec=0.0)
+        storage_checkpoint = StorageCheckpoint(checkpoint, storage_controller, daq_buffer.time)
+        t = np.arange(4*SAMPLERATE)/SAMPLERATE
+        data = np.zeros((t.size, 2), dtype=np.float32)
+        data[:, 0] = 325*np.sin(2*np.pi*50.0*t)
+        for packet_idx in range(t.size//PACKET_SIZE):
+            daq_buffer.put_data_with_timestamp(data[packet_idx*PACKET_SIZE:(packet_idx+1)*PACKET_SIZE],
+                                               START_TIMESTAMP_US + (packet_idx+1)*PACKET_SIZE*1_000_000//SAMPLERATE)
+            power_system.process()
+            storage_controller.process()
+        storage_checkpoint.process()
+        del power_system
+        # Only the data processed by the storage plans is checkpointed
+        stop_sidx = storage_controller.processed_sidx
+        self.assertLess(stop_sidx, daq_buffer.time.sample_count)
+        saved = json.loads(self.file_path.read_text())
+        self.assertEqual(saved["timestamp_us"], int(daq_buffer.time.read_data_by_index(stop_sidx-1, stop_sidx)[0]))
+        # 10-period values: 5 per second
+        self.assertLessEqual(saved["state"]["csv_10s"]["channels"]["U1_rms"]["count"], stop_sidx/SAMPLERATE*5 + 1)
+
+    def test_resume_aggregation(self):
+        state = self.run_measurement("first", 0.0, 6.0, 325.0)
+        partial = state["storage"]["csv_10s"]
+        self.assertEqual(partial["next_storage_timestamp"], START_TIMESTAMP_US + 10_000_000)
+        partial_count = partial["channels"]["U1_rms"]["count"]
+        self.run_measurement("second", 8.0, 12.0, 300.0, state)
+        rows = self.read_csv("second")
+        self.assertEqual(float(rows[0]["timestamp"]), START_TIMESTAMP_US/1e6 + 10)
+        # About 2 seconds of the second run in the first interval
+        expected_rms = np.sqrt((partial_count*325**2 + 10*300**2)/(partial_count + 10)/2)
+        self.assertAlmostEqual(float(rows[0]["U1_rms"]), expected_rms, delta=1.0)
+        # Without state the first interval only contains the second run
+        self.run_measurement("third", 8.0, 12.0, 300.0)
+        self.assertAlmostEqual(float(self.read_csv("third")[0]["U1_rms"]), 300/np.sqrt(2), delta=0.5)
+        # Not restored into a different interval
+        self.run_measurement("fourth", 10.5, 22.0, 300.0, state)
+        self.assertAlmostEqual(float(self.read_csv("fourth")[0]["U1_rms"]), 300/np.sqrt(2), delta=0.5)
+
+if __name__ == "__main__":
+    unittest.main()
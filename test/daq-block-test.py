@@ -0,0 +1,43 @@
+import unittest
+import sys
+import os
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from modules.daqblock import BlockCoalescer
+
+def frame(frame_idx: int, num_rows: int = 100) -> np.ndarray:
+    return np.full((num_rows, 3), frame_idx, dtype=np.int16)
+
+class TestBlockCoalescer(unittest.TestCase):
+
+    def test_pass_through(self):
+        coalescer = BlockCoalescer(0)
+        data = frame(1)
+        self.assertIs(coalescer.add(data), data)
+        self.assertEqual(coalescer.frames_per_block, 1)
+
+    def test_coalesce(self):
+        # 240 samples are rounded to 2 frames
+        coalescer = BlockCoalescer(240)
+        self.assertIsNone(coalescer.add(frame(0)))
+        block = coalescer.add(frame(1))
+        self.assertEqual(coalescer.frames_per_block, 2)
+        np.testing.assert_array_equal(block, np.concatenate([frame(0), frame(1)]))
+        # Preallocated block is reused
+        self.assertIsNone(coalescer.add(frame(2)))
+        self.assertIs(coalescer.add(frame(3)), block)
+        np.testing.assert_array_equal(block, np.concatenate([frame(2), frame(3)]))
+
+    def test_changed_frame_shape(self):
+        coalescer = BlockCoalescer(400)
+        self.assertIsNone(coalescer.add(frame(0)))
+        # Partial block is dropped
+        for frame_idx in range(1, 4):
+            self.assertIsNone(coalescer.add(frame(frame_idx, num_rows=50)))
+        self.assertEqual(coalescer.frames_per_block, 8)
+
+if __name__ == "__main__":
+    unittest.main()
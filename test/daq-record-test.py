@@ -0,0 +1,75 @@
+import unittest
+import sys
+import os
+import tempfile
+import mmap
+import threading
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.daqinfo import DaqInfo
+from daqopen.daqzmq import DaqSubscriber
+from modules.daqrecord import DaqRecorder, DaqRecordReader, DaqReplayPublisher
+
+def write_test_file(file_path: str, num_packets: int, chunk_size: int):
+    daq_info = DaqInfo.get_default().to_dict()
+    data_columns = {"A0": 0, "A1": 1}
+    recorder = DaqRecorder(file_path, chunk_size=chunk_size)
+    packets = []
+    for packet_num in range(num_packets):
+        data = (np.arange(200, dtype=np.int16) + packet_num).reshape(100, 2)
+        recorder.write_packet(data, packet_num, 1000.0 + packet_num*0.002, daq_info, data_columns, True)
+        packets.append(data)
+    recorder.close()
+    return packets
+
+class TestDaqRecord(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "test.daqrec")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_read_chunked(self):
+        # Small chunks to force several chunk changes
+        packets = write_test_file(self.file_path, 100, mmap.ALLOCATIONGRANULARITY)
+        reader = DaqRecordReader(self.file_path)
+        num_read = 0
+        for meta, data in reader.read_packets():
+            self.assertEqual(meta["packet_num"], num_read)
+            self.assertAlmostEqual(meta["timestamp"], 1000.0 + num_read*0.002)
+            self.assertTrue(meta["sync_status"])
+            self.assertEqual(meta["data_columns"], {"A0": 0, "A1": 1})
+            np.testing.assert_array_equal(data, packets[num_read])
+            num_read += 1
+        self.assertEqual(num_read, 100)
+        daq_info, data_columns = reader.get_daq_info()
+        self.assertEqual(daq_info.board.samplerate, DaqInfo.get_default().board.samplerate)
+        del data
+        reader.close()
+
+    def test_replay_fast(self):
+        packets = write_test_file(self.file_path, 500, 1024*1024)
+        reader = DaqRecordReader(self.file_path)
+        replay_pub = DaqReplayPublisher(port=50101, sndhwm=10)
+        replay_thread = threading.Thread(target=lambda: replay_pub.wait_for_subscriber(2.0) and replay_pub.replay(reader, speed=0))
+        replay_thread.start()
+        daq_sub = DaqSubscriber(port=50101, init_daqinfo=False)
+        for packet_num in range(500):
+            data = daq_sub.recv_data(update_daqinfo=True)
+            self.assertEqual(daq_sub.packet_num, packet_num)
+            np.testing.assert_array_equal(data, packets[packet_num])
+        replay_thread.join()
+        self.assertEqual(daq_sub.data_columns, {"A0": 0, "A1": 1})
+        self.assertEqual(replay_pub.packet_count, 500)
+        self.assertAlmostEqual(replay_pub.data_seconds, 1.0)
+        daq_sub.terminate()
+        replay_pub.terminate()
+        reader.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import sys
+import os
+import time
+import tempfile
+import zmq
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.daqinfo import DaqInfo
+from modules.daqshm import ShmDaqPublisher, ShmDaqSubscriber
+
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": 50000},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"},
+                               "I1": {"ai_pin": "A1", "gain": 0.01, "unit": "A"}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1}
+
+def packet(packet_num: int, num_rows: int = 100) -> np.ndarray:
+    return (np.arange(num_rows*2, dtype=np.int16).reshape(num_rows, 2) + packet_num).astype(np.int16)
+
+class TestShmTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.shm_path = Path(self.tmp_dir.name, "daqopen")
+        self.publisher = ShmDaqPublisher(DaqInfo.from_dict(DAQ_INFO_CONFIG), DATA_COLUMNS, self.shm_path, num_slots=4)
+
+    def tearDown(self):
+        self.publisher.terminate()
+        self.tmp_dir.cleanup()
+
+    def create_subscriber(self) -> ShmDaqSubscriber:
+        subscriber = ShmDaqSubscriber(self.shm_path, init_daqinfo=False)
+        subscriber.sock.setsockopt(zmq.RCVTIMEO, 1000)
+        time.sleep(0.2) # Connection of the notification socket
+        return subscriber
+
+    def test_multiple_subscribers(self):
+        subscribers = [self.create_subscriber() for _ in range(2)]
+        for packet_num in range(3):
+            self.publisher.send_data(packet(packet_num), packet_num, 1000.0 + packet_num, True)
+        for subscriber in subscribers:
+            for packet_num in range(3):
+                data = subscriber.recv_data(update_daqinfo=True)
+                np.testing.assert_array_equal(data, packet(packet_num))
+                # Copy in the buffer of the subscriber, not a view into the shared ring
+                self.assertIs(data.base, subscriber._read_buffer)
+                self.assertEqual(subscriber.packet_num, packet_num)
+                self.assertEqual(subscriber.timestamp, 1000.0 + packet_num)
+                self.assertTrue(subscriber.sync_status)
+            self.assertEqual(subscriber.data_columns, DATA_COLUMNS)
+            self.assertEqual(subscriber.daq_info.board.samplerate, 50000)
+            with self.assertRaises(zmq.Again):
+                subscriber.recv_data()
+            subscriber.terminate()
+
+    def test_overrun_and_new_ring(self):
+        subscriber = self.create_subscriber()
+        # Slow subscriber: the first packets are overwritten
+        for packet_num in range(6):
+            self.publisher.send_data(packet(packet_num), packet_num, 1000.0 + packet_num)
+        np.testing.assert_array_equal(subscriber.recv_data(), packet(2))
+        self.assertEqual(subscriber.packet_num, 2)
+        for _ in range(3):
+            subscriber.recv_data()
+        # Changed packet layout creates a new ring
+        self.publisher.send_data(packet(6, num_rows=200), 6, 1006.0)
+        np.testing.assert_array_equal(subscriber.recv_data(), packet(6, num_rows=200))
+        # Shorter packets fit into the slots
+        self.publisher.send_data(packet(7, num_rows=50), 7, 1007.0)
+        np.testing.assert_array_equal(subscriber.recv_data(), packet(7, num_rows=50))
+        subscriber.terminate()
+
+    def test_torn_read(self):
+        subscriber = self.create_subscriber()
+        self.publisher.send_data(packet(0), 0, 1000.0)
+        copy_slot = subscriber._copy_slot
+        def copy_slot_while_publishing(slot: int, num_rows: int):
+            copy_slot(slot, num_rows)
+            # The publisher reuses the slot of packet 0 during the copy
+            subscriber._copy_slot = copy_slot
+            for packet_num in range(1, 5):
+                self.publisher.send_data(packet(packet_num), packet_num, 1000.0 + packet_num)
+        subscriber._copy_slot = copy_slot_while_publishing
+        with self.assertLogs("modules.daqshm", level="WARNING"):
+            data = subscriber.recv_data()
+        np.testing.assert_array_equal(data, packet(1))
+        self.assertEqual(subscriber.packet_num, 1)
+        subscriber.terminate()
+
+    def test_init_daqinfo(self):
+        with self.assertRaises(ConnectionError):
+            ShmDaqSubscriber(self.shm_path, connect_timeout=0.1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import sys
+import os
+import time
+import zmq
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.daqinfo import DaqInfo
+from daqopen.daqzmq import DaqSubscriber
+from modules.decimation import PolyphaseDecimator, DecimatedStream, DecimatedStreamWorker
+
+SAMPLERATE = 50000
+DAQ_CONFIG = {"board": {"type": "duedaq", "samplerate": SAMPLERATE},
+              "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"},
+                          "I1": {"ai_pin": "A1", "gain": 0.01, "unit": "A"}},
+              "app": {"zmq_server": {"bind_addr": "127.0.0.1"},
+                      "decimated_stream": {"5k": {"factor": 10, "tcp_port": 50912}}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1}
+
+class TestPolyphaseDecimator(unittest.TestCase):
+
+    def test_packets_equal_continuous(self):
+        data = np.random.default_rng(0).normal(size=(10_000, 2)).astype(np.float32)
+        continuous, _ = PolyphaseDecimator(10, 2).process(data)
+        decimator = PolyphaseDecimator(10, 2)
+        # Packet sizes not a multiple of the factor
+        packets = [decimator.process(data[start:start+777])[0] for start in range(0, data.shape[0], 777)]
+        self.assertEqual(continuous.shape, (1000, 2))
+        np.testing.assert_allclose(np.concatenate(packets), continuous, rtol=1e-5, atol=1e-5)
+
+    def test_anti_alias(self):
+        t = np.arange(20_000)/SAMPLERATE
+        decimator = PolyphaseDecimator(10, 2)
+        # 50 Hz in passband, 4.7 kHz would alias to 300 Hz
+        data = np.stack([np.sin(2*np.pi*50*t), np.sin(2*np.pi*4700*t)], axis=1)
+        output, last_idx = decimator.process(data)
+        self.assertEqual(last_idx, 19_990)
+        settled = output[16:] # Filter history (160 taps) filled
+        self.assertAlmostEqual(np.sqrt(np.mean(settled[:, 0]**2)), 1/np.sqrt(2), delta=0.01)
+        self.assertLess(np.abs(settled[:, 1]).max(), 0.01)
+
+class TestDecimatedStream(unittest.TestCase):
+
+    def test_publish(self):
+        daq_info = DaqInfo.from_dict(DAQ_CONFIG)
+        worker = DecimatedStreamWorker.from_config(DAQ_CONFIG, daq_info, DATA_COLUMNS)
+        self.assertIsNone(DecimatedStreamWorker.from_config({"app": {}}, daq_info, DATA_COLUMNS))
+        subscriber = DaqSubscriber("127.0.0.1", 50912, init_daqinfo=False)
+        subscriber.sock.setsockopt(zmq.RCVTIMEO, 1000)
+        time.sleep(0.2)
+        worker.start()
+        packet = np.zeros((2000, 2), dtype=np.int16)
+        for packet_num in range(3):
+            worker.put(packet + packet_num, 100.0 + (packet_num+1)*0.04, True)
+        worker.stop()
+        for packet_num in range(3):
+            data = subscriber.recv_data(update_daqinfo=True)
+            self.assertEqual(data.shape, (200, 2))
+            self.assertEqual(subscriber.packet_num, packet_num)
+            # Last output sample 9 input samples before packet end, delayed by the filter
+            self.assertAlmostEqual(subscriber.timestamp, 100.0 + (packet_num+1)*0.04 - (9 + 79.5)/SAMPLERATE)
+        self.assertEqual(subscriber.daq_info.board.samplerate, SAMPLERATE/10)
+        subscriber.terminate()
+
+    def test_dropped_packets(self):
+        daq_info = DaqInfo.from_dict(DAQ_CONFIG)
+        stream = DecimatedStream(daq_info, DATA_COLUMNS, factor=10, host="127.0.0.1", port=50913)
+        worker = DecimatedStreamWorker([stream], max_queued_packets=1)
+        subscriber = DaqSubscriber("127.0.0.1", 50913, init_daqinfo=False)
+        subscriber.sock.setsockopt(zmq.RCVTIMEO, 1000)
+        time.sleep(0.2)
+        packet = np.zeros((2000, 2), dtype=np.int16)
+        # Worker not running: the queue is full after the first packet
+        for packet_num in range(3):
+            worker.put(packet, 100.0 + (packet_num+1)*0.04, True)
+        self.assertEqual(worker.dropped_packets, 2)
+        worker.start()
+        while not worker._queue.empty():
+            time.sleep(0.01)
+        worker.put(packet, 100.16, True)
+        worker.stop()
+        # The packet numbers continue after the gap
+        for packet_num in [0, 3]:
+            subscriber.recv_data()
+            self.assertEqual(subscriber.packet_num, packet_num)
+        subscriber.terminate()
+
+if __name__ == "__main__":
+    unittest.main()
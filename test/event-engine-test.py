@@ -0,0 +1,113 @@
+import unittest
+import sys
+import os
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.channelbuffer import AcqBufferPool, DataChannelBuffer
+from daqopen.daqinfo import DaqInfo
+from modules.eventengine import PolyphaseEventController, ThresholdRule, hysteresis_state
+
+SAMPLERATE = 10000
+HALF_PERIOD = 100
+PACKET_SIZE = 1000
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": SAMPLERATE},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"}}}
+DATA_COLUMNS = {"A0": 0}
+START_TIMESTAMP_US = 1_750_000_000_000_000
+NOMINAL_VOLTAGE = 230.0
+
+class TestEventEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.daq_buffer = AcqBufferPool(DaqInfo.from_dict(DAQ_INFO_CONFIG), DATA_COLUMNS, size=100_000, start_timestamp_us=START_TIMESTAMP_US)
+        self.channels = [DataChannelBuffer(f"U{idx+1:d}_1p_hp_rms", size=2000) for idx in range(3)]
+        rules = [ThresholdRule("LEVEL_LOW", 208.0, 2.0, below=True),
+                 ThresholdRule("DIP", 0.9*NOMINAL_VOLTAGE, 0.02*NOMINAL_VOLTAGE, below=True, aggregation="any"),
+                 ThresholdRule("SWELL", 1.1*NOMINAL_VOLTAGE, 0.02*NOMINAL_VOLTAGE, below=False, aggregation="any"),
+                 ThresholdRule("INTERRUPTION", 0.05*NOMINAL_VOLTAGE, 0.02*NOMINAL_VOLTAGE, below=True, aggregation="all")]
+        self.controller = PolyphaseEventController(self.daq_buffer.time, SAMPLERATE, self.channels, rules,
+                                                   rvc_threshold=0.05*NOMINAL_VOLTAGE, rvc_hysteresis=0.025*NOMINAL_VOLTAGE, rvc_window=100)
+
+    def run_profile(self, profile: np.ndarray) -> list:
+        """Feed half-period values (rows: half periods, columns: phases), return all events"""
+        profile = np.vstack([profile, np.full((2*PACKET_SIZE//HALF_PERIOD, 3), NOMINAL_VOLTAGE)])
+        half_periods_per_packet = PACKET_SIZE//HALF_PERIOD
+        events = []
+        for packet_idx in range(profile.shape[0]//half_periods_per_packet):
+            sidx = self.daq_buffer.time.sample_count
+            self.daq_buffer.put_data_with_timestamp(np.zeros((PACKET_SIZE, 1)), START_TIMESTAMP_US + (sidx + PACKET_SIZE)*1_000_000//SAMPLERATE)
+            for hp_idx in range(half_periods_per_packet):
+                values = profile[packet_idx*half_periods_per_packet + hp_idx]
+                for channel, value in zip(self.channels, values):
+                    channel.put_data_single(sidx + hp_idx*HALF_PERIOD, value)
+            events += self.controller.process()
+        return events
+
+    def finished(self, events: list, event_type: str) -> list:
+        return [event for event in events if event.type == event_type and event.stop_sidx is not None]
+
+    def test_hysteresis_state(self):
+        mark = np.array([[0, 1, 0, -1, 0], [0, 0, 0, 0, 0]], dtype=np.int8)
+        state = hysteresis_state(mark, np.array([False, True]))
+        np.testing.assert_array_equal(state, [[False, True, True, False, False], [True]*5])
+
+    def test_polyphase_dip(self):
+        profile = np.full((200, 3), NOMINAL_VOLTAGE)
+        profile[50:60, 1] = 150.0
+        profile[55:70, 0] = 190.0
+        events = self.run_profile(profile)
+        dips = self.finished(events, "DIP")
+        self.assertEqual(len(dips), 1)
+        self.assertEqual(dips[0].start_sidx, 50*HALF_PERIOD)
+        self.assertEqual(dips[0].stop_sidx, 70*HALF_PERIOD)
+        self.assertAlmostEqual(dips[0].extrem_value, 150.0)
+        self.assertEqual(dips[0].channel, "U2_1p_hp_rms")
+        self.assertAlmostEqual(dips[0].start_ts, START_TIMESTAMP_US/1e6 + 50*HALF_PERIOD/SAMPLERATE, places=3)
+        # The ongoing dip is reported once with the same id
+        ongoing = [event for event in events if event.type == "DIP" and event.stop_sidx is None]
+        self.assertEqual([event.id for event in ongoing], [dips[0].id])
+        # Level events per phase
+        level_low = self.finished(events, "LEVEL_LOW")
+        self.assertEqual(sorted(event.channel for event in level_low), ["U1_1p_hp_rms", "U2_1p_hp_rms"])
+        # No RVC during a dip
+        self.assertFalse([event for event in events if event.type == "RVC"])
+        self.assertFalse([event for event in events if event.type in ("SWELL", "INTERRUPTION")])
+
+    def test_interruption_and_swell(self):
+        profile = np.full((300, 3), NOMINAL_VOLTAGE)
+        profile[50:80, :] = 0.5
+        profile[60:70, 2] = 20.0
+        profile[200:210, 2] = 260.0
+        events = self.run_profile(profile)
+        interruptions = self.finished(events, "INTERRUPTION")
+        self.assertEqual([(event.start_sidx, event.stop_sidx) for event in interruptions],
+                         [(50*HALF_PERIOD, 60*HALF_PERIOD), (70*HALF_PERIOD, 80*HALF_PERIOD)])
+        self.assertEqual(len(self.finished(events, "DIP")), 1)
+        swells = self.finished(events, "SWELL")
+        self.assertEqual(len(swells), 1)
+        self.assertAlmostEqual(swells[0].extrem_value, 260.0)
+        self.assertEqual(swells[0].channel, "U3_1p_hp_rms")
+
+    def test_rapid_voltage_change(self):
+        profile = np.full((400, 3), NOMINAL_VOLTAGE)
+        profile[150:, :] = 218.0
+        profile[150:153, 0] = 210.0
+        events = self.run_profile(profile)
+        rvcs = [event for event in events if event.type == "RVC"]
+        self.assertEqual(len(rvcs), 1)
+        self.assertEqual(rvcs[0].start_sidx, 150*HALF_PERIOD)
+        self.assertEqual(rvcs[0].stop_sidx, 153*HALF_PERIOD)
+        self.assertAlmostEqual(rvcs[0].extrem_value, 20.0)
+        self.assertEqual(rvcs[0].channel, "U1_1p_hp_rms")
+        self.assertFalse(self.finished(events, "DIP"))
+
+    def test_small_changes(self):
+        profile = np.full((400, 3), NOMINAL_VOLTAGE) + np.sin(np.arange(400)/10)[:, None]*3.0
+        events = self.run_profile(profile)
+        self.assertEqual(events, [])
+
+if __name__ == "__main__":
+    unittest.main()
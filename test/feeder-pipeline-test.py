@@ -0,0 +1,132 @@
+import unittest
+import sys
+import os
+import time
+import socket
+import tempfile
+import threading
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.daqinfo import DaqInfo
+from daqopen.daqzmq import DaqPublisher
+from modules.feederpipeline import FeederPipeline, feeder_config
+from modules.archive import ArchiveReader
+
+SAMPLERATE = 50000
+PACKET_SIZE = 2500
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": SAMPLERATE},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"},
+                               "U2": {"ai_pin": "A1", "gain": 1.0, "unit": "V"},
+                               "U3": {"ai_pin": "A2", "gain": 1.0, "unit": "V"},
+                               "I1": {"ai_pin": "A3", "gain": 0.01, "unit": "A"},
+                               "I2": {"ai_pin": "A4", "gain": 0.01, "unit": "A"},
+                               "I3": {"ai_pin": "A5", "gain": 0.01, "unit": "A"}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1, "A2": 2, "A3": 3, "A4": 4, "A5": 5}
+START_TIMESTAMP = 1_750_000_000.0
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def create_config(data_dir: str, ports: list) -> dict:
+    return {"powersystem": {"zcd_channel": "U1",
+                            "energy_file_path": os.path.join(data_dir, "energy.json"),
+                            "phase": {"1": {"u_channel": "U1", "i_channel": "I1"},
+                                      "2": {"u_channel": "U2", "i_channel": "I2"},
+                                      "3": {"u_channel": "U3", "i_channel": "I3"}}},
+            "eventdetector": {},
+            "storageplan": {"csv_1s": {"endpoint": "csv", "channels": [], "interval_sec": 1},
+                            "archive_1s": {"endpoint": "archive", "channels": [], "interval_sec": 1}},
+            "endpoint": {"csv": {"data_dir": data_dir},
+                         "archive": {"data_dir": os.path.join(data_dir, "archive")}},
+            "checkpoint": {"path": os.path.join(data_dir, "checkpoint"), "interval_sec": 0.5},
+            "zmq_server": {"host": "127.0.0.1", "port": ports[0]},
+            "feeder": {"main": {},
+                       "pv": {"zmq_server": {"port": ports[1]},
+                              "powersystem": {"phase": {"1": {"u_channel": "U2", "i_channel": "I2"}}}}}}
+
+class PacketPublisher(threading.Thread):
+    """Publishes a 3-phase signal, five times faster than real time"""
+    def __init__(self, port: int):
+        super().__init__(daemon=True)
+        self._publisher = DaqPublisher(DaqInfo.from_dict(DAQ_INFO_CONFIG), DATA_COLUMNS, host="127.0.0.1", port=port)
+        self._stopped = False
+
+    def run(self):
+        t = np.arange(PACKET_SIZE)/SAMPLERATE
+        packet_num = 0
+        while not self._stopped:
+            data = np.zeros((PACKET_SIZE, 6), dtype=np.int16)
+            for idx in range(3):
+                phi = 2*np.pi*50.0*(t + packet_num*PACKET_SIZE/SAMPLERATE) - idx*2*np.pi/3
+                data[:, idx] = 325*np.sin(phi)
+                data[:, idx+3] = 1000*np.sin(phi - 0.3)
+            packet_num += 1
+            self._publisher.send_data(data, packet_num, START_TIMESTAMP + packet_num*PACKET_SIZE/SAMPLERATE, sync_status=True)
+            time.sleep(0.2*PACKET_SIZE/SAMPLERATE)
+        self._publisher.terminate()
+
+    def stop(self):
+        self._stopped = True
+        self.join()
+
+class TestFeederConfig(unittest.TestCase):
+
+    def test_merge(self):
+        config = create_config("/tmp/data", [50001, 50011])
+        main_config = feeder_config(config, "main")
+        pv_config = feeder_config(config, "pv")
+        self.assertNotIn("feeder", pv_config)
+        self.assertEqual(main_config["zmq_server"], {"host": "127.0.0.1", "port": 50001})
+        self.assertEqual(pv_config["zmq_server"], {"host": "127.0.0.1", "port": 50011})
+        self.assertEqual(list(pv_config["powersystem"]["phase"].keys()), ["1"])
+        self.assertEqual(pv_config["powersystem"]["zcd_channel"], "U1")
+        self.assertEqual(pv_config["powersystem"]["energy_file_path"], "/tmp/data/energy-pv.json")
+        # The global config is not changed
+        self.assertEqual(len(config["powersystem"]["phase"]), 3)
+
+class TestFeederPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_two_feeders(self):
+        ports = [free_port(), free_port()]
+        publishers = [PacketPublisher(port) for port in ports]
+        for publisher in publishers:
+            publisher.start()
+        pipeline = FeederPipeline(create_config(self.tmp_dir.name, ports), "test", "test")
+        self.assertEqual([feeder.name for feeder in pipeline.feeders], ["main", "pv"])
+        pipeline.start()
+        csv_paths = [Path(self.tmp_dir.name, name, "test_1s.csv") for name in ("main", "pv")]
+        checkpoint_paths = [Path(self.tmp_dir.name, "checkpoint", f"{kind}-{name}.json") for kind in ("powersystem", "storage") for name in ("main", "pv")]
+        stop_time = time.time() + 30
+        while time.time() < stop_time and not (all(path.exists() and len(path.read_text().splitlines()) > 3 for path in csv_paths) and
+                                               all(path.exists() for path in checkpoint_paths)):
+            self.assertTrue(pipeline.is_alive())
+            time.sleep(0.1)
+        pipeline.stop()
+        for publisher in publishers:
+            publisher.stop()
+        for path in csv_paths:
+            self.assertGreater(len(path.read_text().splitlines()), 3)
+        reader = ArchiveReader(Path(self.tmp_dir.name, "archive"))
+        self.assertEqual(reader.tables(), ["main/agg_1s", "pv/agg_1s"])
+        self.assertIn("U3_rms", reader.channels("main/agg_1s"))
+        self.assertNotIn("U3_rms", reader.channels("pv/agg_1s"))
+        _, values = reader.read("pv/agg_1s", "U1_rms")
+        self.assertGreater(values.size, 2)
+        np.testing.assert_allclose(values[1:], 325/np.sqrt(2), rtol=0.01)
+        for path in checkpoint_paths:
+            self.assertTrue(path.exists())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import sys
+import os
+import csv
+import tempfile
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.channelbuffer import AcqBufferPool
+from daqopen.daqinfo import DaqInfo
+from modules.pqpipeline import PqPipeline
+from modules.gaprecovery import GapLog, PacketGapFiller, GAP_CHANNEL
+
+SAMPLERATE = 50000
+PACKET_SIZE = 2500
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": SAMPLERATE},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"},
+                               "I1": {"ai_pin": "A1", "gain": 0.01, "unit": "A"}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1}
+START_TIMESTAMP_US = 1_750_000_000_000_000
+
+def generate_packets(num_packets: int):
+    t = np.arange(num_packets*PACKET_SIZE)/SAMPLERATE
+    data = np.zeros((t.size, 2), dtype=np.float32)
+    data[:, 0] = 325*np.sin(2*np.pi*50.1*t)
+    data[:, 1] = 1000*np.sin(2*np.pi*50.1*t - 0.3)
+    for packet_idx in range(num_packets):
+        timestamp_us = START_TIMESTAMP_US + (packet_idx+1)*PACKET_SIZE*1_000_000//SAMPLERATE
+        yield packet_idx, data[packet_idx*PACKET_SIZE:(packet_idx+1)*PACKET_SIZE], timestamp_us
+
+class TestGapLog(unittest.TestCase):
+
+    def test_read_new(self):
+        gap_log = GapLog(capacity=4, shared=True)
+        self.assertEqual(gap_log.read_new(), [])
+        gap_log.add(10, 20)
+        gap_log.add(30, 40)
+        self.assertEqual(gap_log.read_new(), [(10, 20), (30, 40)])
+        for idx in range(6):
+            gap_log.add(idx*100, idx*100+10)
+        # Only the last gaps within the capacity are kept
+        self.assertEqual(gap_log.read_new(), [(200, 210), (300, 310), (400, 410), (500, 510)])
+
+class TestPacketGapFiller(unittest.TestCase):
+
+    def test_check_packet(self):
+        gap_filler = PacketGapFiller(SAMPLERATE, max_gap_sec=1.0)
+        self.assertEqual(gap_filler.check_packet(5), 0)
+        self.assertEqual(gap_filler.check_packet(6), 0)
+        self.assertEqual(gap_filler.check_packet(9), 2)
+        self.assertEqual(gap_filler.check_packet(3), -7)
+        self.assertFalse(gap_filler.can_fill(PACKET_SIZE))
+        gap_filler.update(np.zeros((PACKET_SIZE, 2)), START_TIMESTAMP_US)
+        self.assertTrue(gap_filler.can_fill(SAMPLERATE))
+        self.assertFalse(gap_filler.can_fill(SAMPLERATE+1))
+
+    def test_fill_continues_signal(self):
+        gap_filler = PacketGapFiller(SAMPLERATE, nominal_frequency=50.0)
+        t = np.arange(3*PACKET_SIZE)/SAMPLERATE
+        signal = np.sin(2*np.pi*50.0*t)[:, None]
+        gap_filler.update(signal[:PACKET_SIZE], START_TIMESTAMP_US)
+        chunks = list(gap_filler.create_fill(2*PACKET_SIZE, PACKET_SIZE, START_TIMESTAMP_US + 100_000))
+        self.assertEqual(len(chunks), 2)
+        np.testing.assert_allclose(np.concatenate([data for data, _ in chunks]), signal[PACKET_SIZE:], atol=1e-9)
+        self.assertEqual([timestamp_us for _, timestamp_us in chunks], [START_TIMESTAMP_US + 50_000, START_TIMESTAMP_US + 100_000])
+
+class TestGapRecovery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_recover_gap(self):
+        config = {"powersystem": {"zcd_channel": "U1",
+                                  "energy_file_path": os.path.join(self.tmp_dir.name, "energy.json"),
+                                  "phase": {"1": {"u_channel": "U1", "i_channel": "I1"}}},
+                  "gap_recovery": {"max_gap_sec": 1.0},
+                  "storageplan": {"csv_1s": {"endpoint": "csv", "channels": ["Freq", "U1_rms", GAP_CHANNEL], "interval_sec": 1}},
+                  "endpoint": {"csv": {"data_dir": self.tmp_dir.name}}}
+        daq_info = DaqInfo.from_dict(DAQ_INFO_CONFIG)
+        max_lead_samples = 4*PACKET_SIZE
+        daq_buffer = AcqBufferPool(daq_info, DATA_COLUMNS, size=200_000 + max_lead_samples, start_timestamp_us=START_TIMESTAMP_US)
+        # Multiprocess pipeline: the PowerSystem stage processes the fill data in parallel to the acquisition
+        pipeline = PqPipeline(config, daq_buffer, daq_info, "test", "test", START_TIMESTAMP_US, max_lead_samples)
+        pipeline.start()
+        gap_filler = PacketGapFiller(SAMPLERATE, max_gap_sec=1.0)
+        for packet_idx, data, timestamp_us in generate_packets(200):
+            # Packets 105 to 108 are lost
+            if 105 <= packet_idx <= 108:
+                continue
+            missing_packets = gap_filler.check_packet(packet_idx)
+            if missing_packets:
+                self.assertTrue(gap_filler.can_fill(missing_packets*PACKET_SIZE))
+                self.assertTrue(gap_filler.fill_gap(pipeline.gap_log, daq_buffer.time.sample_count, missing_packets*PACKET_SIZE,
+                                                    PACKET_SIZE, timestamp_us - 50_000, pipeline.put_data_with_timestamp))
+            self.assertTrue(pipeline.put_data_with_timestamp(data, timestamp_us))
+            gap_filler.update(data, timestamp_us)
+        pipeline.stop()
+        # Sample indices and timestamps are continued over the gap
+        self.assertEqual(daq_buffer.time.sample_count, 200*PACKET_SIZE)
+        self.assertEqual(pipeline.lead_samples, 0)
+        with open(Path(self.tmp_dir.name, "test_1s.csv")) as f:
+            rows = list(csv.DictReader(f))
+        self.assertGreater(len(rows), 6)
+        # Only the interval containing the gap (5.25 s - 5.45 s + settling) is flagged
+        self.assertEqual([float(row[GAP_CHANNEL]) for row in rows[:7]], [0, 0, 0, 0, 0, 1, 0])
+        for row in rows[1:]:
+            self.assertAlmostEqual(float(row["Freq"]), 50.1, delta=0.05)
+            self.assertAlmostEqual(float(row["U1_rms"]), 325/np.sqrt(2), delta=1.0)
+
+    def test_gap_logged_before_fill(self):
+        gap_filler = PacketGapFiller(SAMPLERATE, max_gap_sec=1.0)
+        gap_filler.update(np.zeros((PACKET_SIZE, 2)), START_TIMESTAMP_US)
+        gap_log = GapLog()
+        logged_gaps = []
+        def put_data(data, timestamp_us):
+            logged_gaps.extend(gap_log.read_new())
+            return True
+        self.assertTrue(gap_filler.fill_gap(gap_log, 1000, 2*PACKET_SIZE, PACKET_SIZE, START_TIMESTAMP_US + 100_000, put_data))
+        self.assertEqual(logged_gaps, [(1000, 1000 + 2*PACKET_SIZE)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import sys
+import os
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.daqinfo import DaqInfo
+from modules.inputtransform import InputTransform
+
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": 50000},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 0.2, "offset": 0.0},
+                               "U2": {"ai_pin": "A1", "gain": 0.2, "offset": 0.0},
+                               "U3": {"ai_pin": "A2", "gain": 0.2, "offset": 0.0},
+                               "I1": {"ai_pin": "A3", "gain": 0.01, "offset": 0.5},
+                               "I2": {"ai_pin": "A4", "gain": 0.02, "offset": 0.0},
+                               "I3": {"ai_pin": "A5", "gain": 0.01, "offset": -0.5}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1, "A2": 2, "A3": 3, "A4": 4, "A5": 5}
+
+def to_physical(data: np.ndarray, daq_info: DaqInfo, channel_name: str) -> np.ndarray:
+    info = daq_info.channel[channel_name]
+    return data[:, DATA_COLUMNS[info.ai_pin]]*info.gain - info.offset
+
+class TestInputTransform(unittest.TestCase):
+
+    def setUp(self):
+        self.daq_info = DaqInfo.from_dict(DAQ_INFO_CONFIG)
+        rng = np.random.default_rng(0)
+        self.data = rng.integers(-2000, 2000, size=(2500, 6), dtype=np.int16)
+
+    def test_identity(self):
+        transform = InputTransform(self.daq_info, DATA_COLUMNS)
+        self.assertIs(transform.apply(self.data), self.data)
+
+    def test_3p3w(self):
+        transform = InputTransform.from_config({"input_wiring": "3P3W"}, self.daq_info, DATA_COLUMNS)
+        result = transform.apply(self.data)
+        u2 = self.data[:, 1].astype(np.float64)
+        u3 = self.data[:, 2].astype(np.float64)
+        np.testing.assert_allclose(result[:, 0], 1/3*(u2 - u3), atol=1e-3)
+        np.testing.assert_allclose(result[:, 1], 1/3*(-2*u2 - u3), atol=1e-3)
+        np.testing.assert_allclose(result[:, 2], 1/3*(2*u3 + u2), atol=1e-3)
+        np.testing.assert_array_equal(result[:, 3:], self.data[:, 3:])
+
+    def test_aron_and_polarity_physical(self):
+        config = {"input_transform": {"preset": "ARON", "matrix": {"I1": {"I1": -1.0}}}}
+        transform = InputTransform.from_config(config, self.daq_info, DATA_COLUMNS)
+        result = transform.apply(self.data)
+        i1 = to_physical(self.data, self.daq_info, "I1")
+        i3 = to_physical(self.data, self.daq_info, "I3")
+        np.testing.assert_allclose(to_physical(result, self.daq_info, "I1"), -i1, atol=1e-4)
+        np.testing.assert_allclose(to_physical(result, self.daq_info, "I2"), -i1 - i3, atol=1e-4)
+        np.testing.assert_allclose(to_physical(result, self.daq_info, "I3"), i3, atol=1e-4)
+
+    def test_no_allocation(self):
+        transform = InputTransform.from_config({"input_wiring": "3P3W"}, self.daq_info, DATA_COLUMNS)
+        result_1 = transform.apply(self.data)
+        result_2 = transform.apply(self.data)
+        self.assertIs(result_1, result_2)
+
+    def test_unknown_channel(self):
+        with self.assertRaises(ValueError):
+            InputTransform(self.daq_info, DATA_COLUMNS, matrix={"I4": {"I1": 1.0}})
+
+if __name__ == '__main__':
+    unittest.main()
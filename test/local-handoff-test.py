@@ -0,0 +1,115 @@
+import unittest
+import sys
+import os
+import time
+import queue
+import tempfile
+import threading
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from modules.localhandoff import HandoffClient, HandoffServer, attach_handoff_client
+
+def wait_for(condition, timeout: float = 2.0) -> bool:
+    stop_ts = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > stop_ts:
+            return False
+        time.sleep(0.01)
+    return True
+
+class TestLocalHandoff(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = Path(self.tmp_dir.name, "run", "handoff.sock")
+        self.received = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_handoff(self):
+        server = HandoffServer(self.socket_path, lambda topic, payload: self.received.append((topic, payload)))
+        server.start()
+        client = HandoffClient(self.socket_path)
+        client.publish("dt/pqopen/dev/agg_data/gjson", b"\x1f\x8b\x00data", qos=2)
+        client.publish("dt/pqopen/dev/event/json", '{"type": "event"}')
+        client.publish("dt/pqopen/dev/dataseries/json", b"")
+        self.assertTrue(wait_for(lambda: len(self.received) == 3))
+        self.assertEqual(self.received, [("dt/pqopen/dev/agg_data/gjson", b"\x1f\x8b\x00data"),
+                                         ("dt/pqopen/dev/event/json", b'{"type": "event"}'),
+                                         ("dt/pqopen/dev/dataseries/json", b"")])
+        client.loop_stop()
+        server.stop()
+        self.assertFalse(self.socket_path.exists())
+
+    def test_pending_until_bridge_available(self):
+        client = HandoffClient(self.socket_path, max_pending=3, reconnect_interval_sec=0.0)
+        for idx in range(5):
+            client.publish("topic", f"{idx:d}".encode())
+        self.assertFalse(client.connected)
+        self.assertEqual(client.num_pending, 3)
+        self.assertEqual(client.dropped_messages, 2)
+        server = HandoffServer(self.socket_path, lambda topic, payload: self.received.append((topic, payload)))
+        server.start()
+        client.publish("topic", b"5")
+        self.assertTrue(wait_for(lambda: len(self.received) == 3))
+        self.assertEqual([payload for _, payload in self.received], [b"3", b"4", b"5"])
+        self.assertEqual(client.dropped_messages, 3)
+        self.assertEqual(client.num_pending, 0)
+        client.loop_stop()
+        server.stop()
+
+    def test_backpressure(self):
+        # Slow sender: one message of its backlog is sent every 0.5 s
+        backlog = queue.Queue()
+        sender_stopped = threading.Event()
+        def send():
+            while not sender_stopped.wait(0.5):
+                if not backlog.empty():
+                    self.received.append(backlog.get())
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        server = HandoffServer(self.socket_path, lambda topic, payload: backlog.put((topic, payload)), max_queued=2,
+                               get_backlog=backlog.qsize, max_backlog=2)
+        server.start()
+        client = HandoffClient(self.socket_path, send_timeout_sec=0.2, max_pending=1000)
+        payload = bytes(64*1024)
+        start_ts = time.monotonic()
+        for _ in range(100):
+            client.publish("topic", payload)
+            if not client.connected:
+                break
+        # The sender backlog stalls the publish until send_timeout_sec
+        self.assertFalse(client.connected)
+        self.assertGreater(client.num_pending, 0)
+        self.assertGreaterEqual(time.monotonic() - start_ts, 0.2)
+        self.assertLessEqual(backlog.qsize(), 3)
+        client.loop_stop()
+        sender_stopped.set()
+        sender.join()
+        server.stop()
+
+    def test_attach_handoff_client(self):
+        class PahoClientStandIn(object):
+            calls = []
+            def disconnect(self):
+                self.calls.append("disconnect")
+            def loop_stop(self):
+                self.calls.append("loop_stop")
+
+        class EndpointStandIn(object):
+            name = "mqtt"
+            _client = PahoClientStandIn()
+
+        endpoint = EndpointStandIn()
+        self.assertIsNone(attach_handoff_client(endpoint, {"hostname": "localhost"}))
+        paho_client = endpoint._client
+        handoff_client = attach_handoff_client(endpoint, {"handoff_socket": str(self.socket_path)})
+        self.assertIs(endpoint._client, handoff_client)
+        self.assertEqual(paho_client.calls, ["disconnect", "loop_stop"])
+
+if __name__ == "__main__":
+    unittest.main()
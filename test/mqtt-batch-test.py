@@ -0,0 +1,88 @@
+import unittest
+import sys
+import os
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from modules.mqttbatch import MessageBatcher, split_bulk_topic, encode_bulk, decode_bulk
+
+class TestBulkFormat(unittest.TestCase):
+
+    def test_encode_decode(self):
+        self.assertEqual(split_bulk_topic("dt/pqopen/dev1/dataseries/json", "mixed/cbor"), ("dt/pqopen/dev1", "dataseries/json"))
+        topic, payload = encode_bulk("dt/pqopen/dev1", [("dataseries/json", b"1"), ("agg/json", b"2")], "mixed/cbor")
+        self.assertEqual(topic, "dt/pqopen/dev1/mixed/cbor")
+        self.assertEqual(decode_bulk(topic, payload, "mixed/cbor"),
+                         [("dt/pqopen/dev1/dataseries/json", b"1"), ("dt/pqopen/dev1/agg/json", b"2")])
+        # Bulk of bulk messages (cached by persistmq)
+        nested_topic, nested_payload = encode_bulk("dt/pqopen/dev1", [("mixed/cbor", payload), ("event/json", b"3")], "mixed/cbor")
+        self.assertEqual(len(decode_bulk(nested_topic, nested_payload, "mixed/cbor")), 3)
+        self.assertEqual(decode_bulk("dt/pqopen/dev1/event/json", b"3", "mixed/cbor"), [("dt/pqopen/dev1/event/json", b"3")])
+
+    def test_short_topics(self):
+        self.assertEqual(split_bulk_topic("status/json", "mixed/cbor"), ("", "status/json"))
+        self.assertEqual(split_bulk_topic("status", "mixed/cbor"), ("", "status"))
+        self.assertEqual(decode_bulk("status", b"1", "mixed/cbor"), [("status", b"1")])
+        topic, payload = encode_bulk("", [("a/json", b"1"), ("b/json", b"2")], "mixed/cbor")
+        self.assertEqual(topic, "mixed/cbor")
+        self.assertEqual(decode_bulk(topic, payload, "mixed/cbor"), [("a/json", b"1"), ("b/json", b"2")])
+
+class TestMessageBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.published = []
+
+    def publish(self, topic, payload, priority):
+        self.published.append((topic, payload, time.monotonic()))
+
+    def received(self):
+        return [message for topic, payload, _ in self.published for message in decode_bulk(topic, payload, "mixed/cbor")]
+
+    def test_flush_by_count_and_bytes(self):
+        batcher = MessageBatcher(self.publish, max_count=10, max_bytes=100, max_delay_sec=10.0)
+        batcher.start()
+        for idx in range(25):
+            batcher.put(f"dt/dev/a/{idx:d}", b"x")
+        # Last batch is flushed by size
+        batcher.put("dt/dev/b/big", b"y"*100)
+        time.sleep(0.1)
+        self.assertEqual(len(self.published), 3)
+        batcher.stop()
+        self.assertEqual([topic for topic, _, _ in self.published], ["dt/dev/mixed/cbor"]*3)
+        self.assertEqual(self.received(), [(f"dt/dev/a/{idx:d}", b"x") for idx in range(25)] + [("dt/dev/b/big", b"y"*100)])
+        self.assertEqual((batcher.received_messages, batcher.sent_batches), (26, 3))
+
+    def test_short_topics_unbatched(self):
+        batcher = MessageBatcher(self.publish, max_delay_sec=10.0)
+        batcher.start()
+        for topic in ["status", "a/json", "b/json"]:
+            batcher.put(topic, b"1")
+        time.sleep(0.1)
+        # Sent right away with the original topic
+        self.assertEqual([(topic, payload) for topic, payload, _ in self.published], [("status", b"1"), ("a/json", b"1"), ("b/json", b"1")])
+        batcher.stop()
+        self.assertEqual(len(self.published), 3)
+
+    def test_flush_by_time(self):
+        batcher = MessageBatcher(self.publish, max_delay_sec=0.1)
+        batcher.start()
+        start = time.monotonic()
+        batcher.put("dt/dev1/event/json", b"1")
+        batcher.put("dt/dev2/event/json", b"2")
+        time.sleep(0.3)
+        # Single messages are sent unchanged
+        self.assertEqual([(topic, payload) for topic, payload, _ in self.published], [("dt/dev1/event/json", b"1"), ("dt/dev2/event/json", b"2")])
+        self.assertTrue(all(0.1 <= publish_ts - start < 0.2 for _, _, publish_ts in self.published))
+        batcher.stop()
+
+    def test_bounded_queue(self):
+        batcher = MessageBatcher(self.publish, max_queued=5)
+        self.assertTrue(all(batcher.put("dt/dev/a/b", b"x") for _ in range(5)))
+        self.assertFalse(batcher.put("dt/dev/a/b", b"x"))
+        self.assertEqual(batcher.dropped_messages, 1)
+        self.assertIsNone(MessageBatcher.from_config({}, self.publish))
+
+if __name__ == "__main__":
+    unittest.main()
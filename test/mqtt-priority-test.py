@@ -0,0 +1,60 @@
+import unittest
+import sys
+import os
+import tomllib
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from modules.mqttbatch import topic_matches, MessageBatcher
+from modules.mqttpriority import PriorityGate
+
+class TestPriorityGate(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(SCRIPT_DIR), "config", "persistmq-conf.toml"), "rb") as f:
+            self.gate = PriorityGate.from_config(tomllib.load(f))
+
+    def admitted(self, topic: str, timestamps: list) -> int:
+        return sum(self.gate.admit(topic, now=now) is not None for now in timestamps)
+
+    def test_lanes(self):
+        self.assertTrue(topic_matches("+/+/+/event/#", "dt/pqopen/dev1/event/gjson"))
+        self.assertFalse(topic_matches("+/+/+/event/#", "dt/pqopen/dev1/agg_data/gjson"))
+        self.assertFalse(topic_matches("dt/+", "dt/pqopen/dev1"))
+        self.assertEqual(self.gate.get_lane("dt/pqopen/dev1/event/gjson").name, "events")
+        self.assertEqual(self.gate.get_lane("dt/pqopen/dev1/agg_data/json").name, "aggregates")
+        self.assertEqual(self.gate.get_lane("test/dev1/dataseries/gjson").name, "dataseries")
+        self.assertEqual(self.gate.get_lane("other/topic").name, "default")
+        self.assertIsNone(PriorityGate.from_config({}))
+
+    def test_backlog_limits(self):
+        timestamps = [idx*0.5 for idx in range(100)] # 50 s, 2 messages/s
+        # No backlog
+        self.assertEqual(self.admitted("test/dev1/dataseries/gjson", timestamps), 100)
+        # Above low watermark: dataseries downsampled to 10 s per topic, others unchanged
+        self.gate.update_backlog(5000)
+        self.assertEqual(self.admitted("test/dev1/dataseries/gjson", [100 + ts for ts in timestamps]), 5)
+        self.assertEqual(self.admitted("test/dev2/dataseries/gjson", [100 + ts for ts in timestamps]), 5)
+        self.assertEqual(self.admitted("dt/pqopen/dev1/agg_data/gjson", timestamps), 100)
+        # Above drop watermark: dataseries dropped, events always sent
+        self.gate.update_backlog(20000)
+        self.assertEqual(self.admitted("test/dev1/dataseries/gjson", [200 + ts for ts in timestamps]), 0)
+        self.assertEqual(self.admitted("dt/pqopen/dev1/event/gjson", timestamps), 100)
+        lane = self.gate.get_lane("test/dev1/dataseries/gjson")
+        self.assertEqual((lane.passed_messages, lane.dropped_messages), (110, 290))
+
+class TestPriorityBatches(unittest.TestCase):
+
+    def test_priority_order(self):
+        published = []
+        batcher = MessageBatcher(lambda topic, payload, priority: published.append((topic, priority)), max_delay_sec=10.0)
+        batcher.put("test/dev1/dataseries/gjson", b"1", priority=2)
+        batcher.put("dt/pqopen/dev1/agg_data/gjson", b"2", priority=1)
+        batcher.put("dt/pqopen/dev1/event/gjson", b"3", priority=0)
+        batcher.start()
+        batcher.stop()
+        self.assertEqual(published, [("dt/pqopen/dev1/event/gjson", 0), ("dt/pqopen/dev1/agg_data/gjson", 1), ("test/dev1/dataseries/gjson", 2)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import sys
+import os
+import tempfile
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.channelbuffer import AcqBufferPool
+from daqopen.daqinfo import DaqInfo
+from modules.pqprocessing import create_power_system
+from modules.pqpipeline import ShmMessageRing, ChannelForwarder, ChannelReceiver
+from modules.overloadguard import OverloadGuard, PowerSystemHooks, PacketAgeBacklog, EVENT_TYPE
+
+SAMPLERATE = 50000
+PACKET_SIZE = 2500
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": SAMPLERATE},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"},
+                               "I1": {"ai_pin": "A1", "gain": 0.01, "unit": "A"}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1}
+START_TIMESTAMP_US = 1_750_000_000_000_000
+
+class TestOverloadGuard(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        config = {"powersystem": {"zcd_channel": "U1",
+                                  "enable_mains_signaling_tracer": True,
+                                  "energy_file_path": os.path.join(self.tmp_dir.name, "energy.json"),
+                                  "phase": {"1": {"u_channel": "U1", "i_channel": "I1"}}}}
+        self.daq_buffer = AcqBufferPool(daq_info=DaqInfo.from_dict(DAQ_INFO_CONFIG), data_columns=DATA_COLUMNS,
+                                        start_timestamp_us=START_TIMESTAMP_US, size=200_000)
+        self.power_system = create_power_system(config, self.daq_buffer, SAMPLERATE)
+        self.guard = OverloadGuard(self.power_system, self.daq_buffer.time, harmonics_max_order=25,
+                                   shed_rtf=0.9, restore_rtf=0.6, hold_sec=5.0, rtf_time_constant_sec=1.0)
+        self.packet_idx = 0
+
+    def tearDown(self):
+        # PowerSystem persists the energy file when deleted
+        del self.guard
+        del self.power_system
+        self.tmp_dir.cleanup()
+
+    def process_packets(self, num_packets: int):
+        for _ in range(num_packets):
+            t = np.arange(self.packet_idx*PACKET_SIZE, (self.packet_idx+1)*PACKET_SIZE)/SAMPLERATE
+            data = np.zeros((PACKET_SIZE, 2), dtype=np.int16)
+            data[:, 0] = 325*np.sin(2*np.pi*50.0*t) + 10*np.sin(2*np.pi*50.0*37*t)
+            data[:, 1] = 1000*np.sin(2*np.pi*50.0*t - 0.3)
+            self.packet_idx += 1
+            self.daq_buffer.put_data_with_timestamp(data, START_TIMESTAMP_US + self.packet_idx*PACKET_SIZE*1_000_000//SAMPLERATE)
+            self.power_system.process()
+            self.guard.post_process()
+
+    def test_shed_and_restore(self):
+        self.process_packets(10)
+        # Overloaded: one feature per rtf time constant
+        for _ in range(50):
+            self.guard.update(1.5, 0.1)
+        self.assertEqual(self.guard.shed_features, ["mains_signaling_tracer", "fluctuation", "harmonics"])
+        shed_events = self.guard.get_events()
+        self.assertEqual([event.channel for event in shed_events], self.guard.shed_features)
+        self.assertTrue(all(event.type == EVENT_TYPE and event.stop_ts is None for event in shed_events))
+        self.assertFalse(self.power_system._features["fluctuation"])
+        self.assertEqual(self.power_system._harm_fft_resample_size, 1024)
+        # Processing continues with the shed features
+        self.process_packets(20)
+        harm_rms = self.power_system.output_channels["U1_H_rms"].last_sample_value
+        self.assertTrue(np.isnan(harm_rms[26:]).all())
+        self.assertAlmostEqual(harm_rms[1], 325/np.sqrt(2), delta=0.5)
+        self.assertTrue(np.isnan(self.power_system.output_channels["U1_THD"].last_sample_value))
+        # Headroom: restore in reverse order, not before hold time
+        for _ in range(40):
+            self.guard.update(0.2, 0.1)
+        self.assertEqual(self.guard.shed_features, ["mains_signaling_tracer", "fluctuation"])
+        for _ in range(100):
+            self.guard.update(0.2, 0.1)
+        self.assertEqual(self.guard.shed_features, [])
+        restore_events = self.guard.get_events()
+        self.assertEqual([event.channel for event in restore_events], ["harmonics", "fluctuation", "mains_signaling_tracer"])
+        self.assertEqual([event.id for event in restore_events], [event.id for event in reversed(shed_events)])
+        self.assertTrue(all(event.stop_ts >= event.start_ts for event in restore_events))
+        self.assertTrue(self.power_system._features["fluctuation"])
+        self.assertEqual(self.power_system._harm_fft_resample_size, 8192)
+        self.process_packets(20)
+        harm_rms = self.power_system.output_channels["U1_H_rms"].last_sample_value
+        self.assertAlmostEqual(harm_rms[37], 10/np.sqrt(2), delta=0.1)
+        self.assertAlmostEqual(self.power_system.output_channels["U1_THD"].last_sample_value, 10/325*100, delta=0.1)
+
+    def test_unsupported_power_system(self):
+        del self.power_system._harm_fft_resample_size
+        with self.assertRaisesRegex(RuntimeError, "_harm_fft_resample_size"):
+            PowerSystemHooks(self.power_system)
+
+    def test_backlog(self):
+        self.guard.update(0.1, 0.1, backlog_sec=2.0)
+        self.assertEqual(self.guard.shed_features, ["mains_signaling_tracer"])
+        backlog = PacketAgeBacklog()
+        self.assertEqual(backlog.update(0.3, 0.05), 0.0)
+        self.assertEqual(backlog.update(0.2, 0.05), 0.0)
+        self.assertAlmostEqual(backlog.update(1.2, 0.05), 1.0, places=3)
+
+    def test_event_forwarding(self):
+        self.guard.update(1.5, 1.0)
+        events = self.guard.get_events()
+        ring = ShmMessageRing(capacity=64*1024)
+        forwarder = ChannelForwarder(self.power_system.output_channels, ring)
+        receiver = ChannelReceiver(self.power_system.output_channels, ring)
+        forwarder.send_channel_names()
+        receiver.recv_channel_names()
+        forwarder.send(0, events=events)
+        self.assertEqual(receiver.recv(), 0)
+        self.assertEqual(receiver.get_events(), events)
+        self.assertEqual(receiver.get_events(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+import sys
+import os
+import tempfile
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.channelbuffer import AcqBufferPool, DataChannelBuffer
+from daqopen.daqinfo import DaqInfo
+from modules.pqprocessing import create_power_system, create_storage_controller, create_event_controller
+from modules.pqpipeline import PqPipeline, ShmMessageRing, ChannelForwarder, ChannelReceiver
+
+SAMPLERATE = 50000
+PACKET_SIZE = 2500
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": SAMPLERATE},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"},
+                               "U2": {"ai_pin": "A1", "gain": 1.0, "unit": "V"},
+                               "U3": {"ai_pin": "A2", "gain": 1.0, "unit": "V"},
+                               "I1": {"ai_pin": "A3", "gain": 0.01, "unit": "A"},
+                               "I2": {"ai_pin": "A4", "gain": 0.01, "unit": "A"},
+                               "I3": {"ai_pin": "A5", "gain": 0.01, "unit": "A"}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1, "A2": 2, "A3": 3, "A4": 4, "A5": 5}
+START_TIMESTAMP_US = 1_750_000_000_000_000
+
+def create_config(data_dir: str) -> dict:
+    return {"powersystem": {"zcd_channel": "U1",
+                            "energy_file_path": os.path.join(data_dir, "energy.json"),
+                            "phase": {"1": {"u_channel": "U1", "i_channel": "I1"},
+                                      "2": {"u_channel": "U2", "i_channel": "I2"},
+                                      "3": {"u_channel": "U3", "i_channel": "I3"}}},
+            "eventdetector": {},
+            "metrics": {"interval_sec": 0.1, "file_path": os.path.join(data_dir, "metrics.log")},
+            "storageplan": {"csv_1s": {"endpoint": "csv", "channels": [], "interval_sec": 1}},
+            "endpoint": {"csv": {"data_dir": data_dir}}}
+
+def generate_packets(num_packets: int):
+    t = np.arange(num_packets*PACKET_SIZE)/SAMPLERATE
+    data = np.zeros((t.size, 6), dtype=np.int16)
+    for idx in range(3):
+        phi = -idx*2*np.pi/3
+        data[:, idx] = 325*np.sin(2*np.pi*50.1*t + phi)
+        data[:, idx+3] = 1000*np.sin(2*np.pi*50.1*t + phi - 0.3)
+    for packet_idx in range(num_packets):
+        timestamp_us = START_TIMESTAMP_US + (packet_idx+1)*PACKET_SIZE*1_000_000//SAMPLERATE
+        yield data[packet_idx*PACKET_SIZE:(packet_idx+1)*PACKET_SIZE], timestamp_us
+
+class TestShmMessageRing(unittest.TestCase):
+
+    def test_wrap_around(self):
+        ring = ShmMessageRing(capacity=1024)
+        for msg_idx in range(100):
+            payload = bytes([msg_idx % 256])*(msg_idx % 37 + 1)
+            self.assertTrue(ring.write([payload[:3], payload[3:]]))
+            msg = ring.read()
+            self.assertEqual(bytes(msg), payload)
+            msg.release()
+            ring.release()
+        self.assertIsNone(ring.read())
+
+    def test_full_ring(self):
+        ring = ShmMessageRing(capacity=64)
+        self.assertTrue(ring.write([bytes(24)]))
+        self.assertTrue(ring.write([bytes(24)]))
+        self.assertFalse(ring.write([bytes(24)], stop_callback=lambda: True))
+
+    def test_channel_forwarding(self):
+        ring = ShmMessageRing(capacity=1024*1024)
+        src_channels = {"A": DataChannelBuffer("A", size=10), "B": DataChannelBuffer("B", size=10, sample_dimension=3)}
+        dst_channels = {"A": DataChannelBuffer("A", size=10), "B": DataChannelBuffer("B", size=10, sample_dimension=3)}
+        forwarder = ChannelForwarder(src_channels, ring)
+        receiver = ChannelReceiver(dst_channels, ring)
+        forwarder.send_channel_names()
+        receiver.recv_channel_names()
+        for step in range(5):
+            for sidx in range(step*7, step*7+7):
+                src_channels["A"].put_data_single(sidx, float(sidx))
+                if sidx % 2:
+                    src_channels["B"].put_data_single(sidx, np.array([sidx, sidx+1, sidx+2]))
+            forwarder.send(step)
+            self.assertEqual(receiver.recv(), step)
+        for name in src_channels:
+            np.testing.assert_array_equal(src_channels[name]._data, dst_channels[name]._data)
+            np.testing.assert_array_equal(src_channels[name]._acq_sidx, dst_channels[name]._acq_sidx)
+            self.assertEqual(src_channels[name].last_write_idx, dst_channels[name].last_write_idx)
+
+class TestPqPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.daq_info = DaqInfo.from_dict(DAQ_INFO_CONFIG)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_single(self, num_packets: int) -> str:
+        data_dir = os.path.join(self.tmp_dir.name, "single")
+        config = create_config(data_dir)
+        daq_buffer = AcqBufferPool(self.daq_info, DATA_COLUMNS, size=200_000, start_timestamp_us=START_TIMESTAMP_US)
+        power_system = create_power_system(config, daq_buffer, SAMPLERATE)
+        storage_controller = create_storage_controller(config, daq_buffer, power_system, self.daq_info, "test", "test", START_TIMESTAMP_US)
+        event_controller = create_event_controller(config, daq_buffer, power_system, SAMPLERATE)
+        for data, timestamp_us in generate_packets(num_packets):
+            daq_buffer.put_data_with_timestamp(data, timestamp_us)
+            power_system.process()
+            events = event_controller.process()
+            storage_controller.process()
+            storage_controller.process_events(events)
+        del power_system
+        return Path(data_dir, "test_1s.csv").read_text()
+
+    def run_pipeline(self, num_packets: int) -> str:
+        data_dir = os.path.join(self.tmp_dir.name, "pipeline")
+        config = create_config(data_dir)
+        max_lead_samples = 4*PACKET_SIZE
+        daq_buffer = AcqBufferPool(self.daq_info, DATA_COLUMNS, size=200_000 + max_lead_samples, start_timestamp_us=START_TIMESTAMP_US)
+        pipeline = PqPipeline(config, daq_buffer, self.daq_info, "test", "test", START_TIMESTAMP_US, max_lead_samples)
+        pipeline.start()
+        for data, timestamp_us in generate_packets(num_packets):
+            self.assertTrue(pipeline.put_data_with_timestamp(data, timestamp_us))
+        pipeline.stop()
+        self.assertEqual(pipeline.lead_samples, 0)
+        self.assertTrue(Path(data_dir, "metrics.log").exists())
+        return Path(data_dir, "test_1s.csv").read_text()
+
+    def test_same_result(self):
+        single_result = self.run_single(200)
+        pipeline_result = self.run_pipeline(200)
+        self.assertGreater(len(single_result.splitlines()), 5)
+        self.assertEqual(single_result, pipeline_result)
+
+    def test_mirror_without_energy_file(self):
+        config = create_config(self.tmp_dir.name)
+        daq_buffer = AcqBufferPool(self.daq_info, DATA_COLUMNS, size=200_000, start_timestamp_us=START_TIMESTAMP_US)
+        power_system = create_power_system(config, daq_buffer, SAMPLERATE, persist_energy=False)
+        self.assertIn("W_pos", power_system.output_channels)
+        self.assertIn("W_neg", power_system.output_channels)
+        del power_system
+        self.assertFalse(Path(self.tmp_dir.name, "energy.json").exists())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import sys
+import os
+import time
+import json
+import tempfile
+import multiprocessing
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from modules.stagetimer import StageTimer, MetricsReporter
+from modules.archive import ArchiveStorageEndpoint, ArchiveReader
+
+def record_in_child(timer: StageTimer):
+    for _ in range(5):
+        timer.start()
+        time.sleep(0.002)
+        timer.mark("work")
+        timer.finish_cycle(0.01)
+
+class TestStageTimer(unittest.TestCase):
+
+    def test_histogram_and_rtf(self):
+        timer = StageTimer(["recv", "work"], idle_stages=["recv"])
+        reporter = MetricsReporter({"app": timer})
+        for _ in range(10):
+            timer.start()
+            time.sleep(0.005)
+            timer.mark("recv")
+            time.sleep(0.001)
+            timer.mark("work")
+            timer.finish_cycle(0.01, packet_age=0.5)
+        metrics = reporter.get_metrics()
+        self.assertEqual(metrics["work_count"], 10)
+        self.assertGreaterEqual(metrics["work_mean_ms"], 1.0)
+        self.assertGreaterEqual(metrics["recv_p50_ms"], metrics["work_p50_ms"])
+        self.assertLessEqual(metrics["work_p99_ms"], metrics["work_max_ms"])
+        # Only work is busy: about 1 ms per 10 ms of data
+        self.assertGreater(metrics["app_rtf"], 0.09)
+        self.assertLess(metrics["app_rtf"], 0.5)
+        self.assertAlmostEqual(metrics["app_packet_age_max_s"], 0.5)
+        # Next report contains only new data
+        self.assertEqual(reporter.get_metrics(), {})
+
+    def test_shared_timer(self):
+        timer = StageTimer(["work"], shared=True)
+        reporter = MetricsReporter({"child": timer})
+        process = multiprocessing.get_context("fork").Process(target=record_in_child, args=(timer,))
+        process.start()
+        process.join()
+        metrics = reporter.get_metrics()
+        self.assertEqual(metrics["work_count"], 5)
+        self.assertGreater(metrics["child_rtf"], 0.1)
+
+    def test_report_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "metrics.log")
+            timer = StageTimer(["work"])
+            reporter = MetricsReporter({"app": timer}, interval_sec=0.01, file_path=file_path)
+            timer.start()
+            timer.mark("work")
+            timer.finish_cycle(0.05)
+            time.sleep(0.02)
+            reporter.process()
+            metrics = json.loads(open(file_path).readline())
+            self.assertEqual(metrics["work_count"], 1)
+            self.assertIn("timestamp", metrics)
+
+    def test_report_archive(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            endpoint = ArchiveStorageEndpoint("archive", "uuid", tmp_dir, flush_interval_sec=0.0)
+            timer = StageTimer(["work"])
+            reporter = MetricsReporter({"app": timer}, interval_sec=0.01, endpoint=endpoint)
+            timer.start()
+            timer.mark("work")
+            timer.finish_cycle(0.05)
+            time.sleep(0.02)
+            reporter.process()
+            reader = ArchiveReader(tmp_dir)
+            self.assertEqual(reader.tables(), ["metrics"])
+            _, values = reader.read("metrics", "work_count")
+            self.assertEqual(values.tolist(), [1.0])
+
+    def test_invalid_config(self):
+        timer = StageTimer(["work"])
+        self.assertEqual(MetricsReporter({"app": timer}, interval_sec=0.5)._interval_sec, 0.5)
+        with self.assertRaises(ValueError):
+            MetricsReporter({"app": timer}, interval_sec=0)
+        with self.assertRaises(ValueError):
+            MetricsReporter({"app": timer}, endpoint=object())
+
+if __name__ == '__main__':
+    unittest.main()
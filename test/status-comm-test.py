@@ -2,11 +2,14 @@ import unittest
 import sys
 import os
 import time
+import threading
+import tempfile
+from pathlib import Path
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
-from modules.statuscomm import StatusSender, StatusReceiver
+from modules.statuscomm import StatusSender, StatusReceiver, TimerWheel, encode_status_message, decode_status_message, read_registry
 
 class TestSingleSender(unittest.TestCase):
 
@@ -20,5 +23,104 @@ class TestSingleSender(unittest.TestCase):
             receiver.recv_message()
             self.assertEqual(receiver.status_reg["test-service"]["status"], "OK" if i % 2 else "NOK")
 
+class TestStatusMessage(unittest.TestCase):
+
+    def test_encode_decode(self):
+        metrics = {"loop_lag_ms": 12.5, "packets_per_sec": 10.0, "cache_depth": 1234, "cpu_time_s": 86400.25, "rss_kb": 51200}
+        data = encode_status_message("persistmq-bridge", "CACHING", metrics)
+        self.assertLess(len(data), 64)
+        self.assertEqual(decode_status_message(data), {"service": "persistmq-bridge", "status": "CACHING", "metrics": metrics})
+        decoded = decode_status_message(encode_status_message("pqopen-app", None))
+        self.assertIsNone(decoded["status"])
+        self.assertEqual(set(decoded["metrics"].values()), {None})
+        with self.assertRaises(ValueError):
+            decode_status_message(b'{"service": "pqopen-app"}')
+        with self.assertRaises(ValueError):
+            decode_status_message(data[:-3])
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_timers(self):
+        wheel = TimerWheel(tick_sec=0.01, num_slots=8)
+        fired = []
+        wheel.schedule(0.02, lambda: fired.append("short"))
+        wheel.schedule(0.15, lambda: fired.append("long")) # more than one round
+        cancelled = wheel.schedule(0.03, lambda: fired.append("cancelled"))
+        wheel.cancel(cancelled)
+        self.assertLessEqual(wheel.timeout(), 0.03)
+        time.sleep(0.05)
+        wheel.advance()
+        self.assertEqual(fired, ["short"])
+        time.sleep(0.12)
+        wheel.advance()
+        self.assertEqual(fired, ["short", "long"])
+        self.assertIsNone(wheel.timeout())
+
+class TestStatusBus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_metrics_and_registry(self):
+        changes = []
+        registry_path = Path(self.tmp_dir.name, "run", "status.sock")
+        receiver = StatusReceiver(["test-service", "other-service"], port=50003, inactive_timeout=0.5, registry_path=registry_path,
+                                  on_change=lambda service, status: changes.append((service, status)))
+        sender = StatusSender("test-service", port=50003, send_interval=0.1)
+        for _ in range(3):
+            sender.update("RUNNING", packets=5, loop_lag=0.02, cache_depth=7)
+            time.sleep(0.05)
+        sender.update("RUNNING", packets=5, loop_lag=0.01)
+        receiver.poll(1.0)
+        metrics = receiver.status_reg["test-service"]["metrics"]
+        self.assertEqual(receiver.status_reg["test-service"]["status"], "RUNNING")
+        self.assertAlmostEqual(metrics["loop_lag_ms"], 20.0, places=3)
+        self.assertGreater(metrics["packets_per_sec"], 0)
+        self.assertEqual(metrics["cache_depth"], 7)
+        self.assertGreater(metrics["cpu_time_s"], 0)
+        self.assertGreater(metrics["rss_kb"], 0)
+        # Registry via Unix socket, served by poll()
+        result = {}
+        reader = threading.Thread(target=lambda: result.update(read_registry(registry_path)))
+        reader.start()
+        while reader.is_alive():
+            receiver.poll(0.1)
+        self.assertEqual(result["test-service"]["status"], "RUNNING")
+        self.assertEqual(result["test-service"]["metrics"]["cache_depth"], 7)
+        self.assertIsNone(result["other-service"]["status"])
+        # Inactivity timeout without messages
+        stop_time = time.time() + 2
+        while receiver.status_reg["test-service"]["status"] is not None and time.time() < stop_time:
+            receiver.poll(1.0)
+        self.assertIsNone(receiver.status_reg["test-service"]["status"])
+        self.assertEqual(changes, [("test-service", "RUNNING"), ("test-service", None)])
+        receiver.close()
+        self.assertFalse(registry_path.exists())
+
+    def test_max_message_size(self):
+        service = "s"*300
+        receiver = StatusReceiver([service[:255]], port=50005, registry_path=Path(self.tmp_dir.name, "status.sock"))
+        sender = StatusSender(service, port=50005, send_interval=0.0)
+        sender.update("x"*300, packets=5, cache_depth=7)
+        receiver.poll(1.0)
+        self.assertEqual(receiver.status_reg[service[:255]]["status"], "x"*255)
+        self.assertEqual(receiver.status_reg[service[:255]]["metrics"]["cache_depth"], 7)
+        receiver.close()
+
+    def test_registry_path_not_writable(self):
+        # Parent of the socket is a file: the directory can not be created
+        blocking_file = Path(self.tmp_dir.name, "run")
+        blocking_file.write_text("")
+        with self.assertLogs("modules.statuscomm", level="WARNING"):
+            receiver = StatusReceiver(["test-service"], port=50004, registry_path=blocking_file/"status.sock")
+        sender = StatusSender("test-service", port=50004, send_interval=0.0)
+        sender.update("RUNNING")
+        receiver.poll(1.0)
+        self.assertEqual(receiver.status_reg["test-service"]["status"], "RUNNING")
+        receiver.close()
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,235 @@
+import unittest
+import sys
+import os
+import time
+import sqlite3
+import tempfile
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), "benchmark"))
+
+from persistmq.client import PersistClient
+from modules.tieredcache import TieredCache, PriorityTieredCache, TieredSender
+from mqttbroker import MqttBrokerStandIn
+
+def records(start: int, stop: int) -> list:
+    return [(f"dt/dev/{idx % 3:d}/json", f"payload {idx:d}".ljust(100).encode()) for idx in range(start, stop)]
+
+class TestTieredCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name, "segments")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_cache(self) -> TieredCache:
+        # RAM for 10 records, segments with 20 records
+        return TieredCache(self.path, ram_max_bytes=1000, segment_max_bytes=2000, flush_interval_sec=0.1)
+
+    def append(self, cache: TieredCache, new_records: list):
+        for topic, payload in new_records:
+            cache.append(topic, payload)
+
+    def pop_all(self, cache: TieredCache, count: int = 7) -> list:
+        popped = []
+        while new_records := cache.pop(count):
+            popped += new_records
+            cache.commit()
+        return popped
+
+    def test_ram_tier(self):
+        cache = self.create_cache()
+        self.assertIsNone(cache.tier)
+        self.append(cache, records(0, 10))
+        self.assertEqual(cache.tier, "ram")
+        self.assertEqual(self.pop_all(cache), records(0, 10))
+        self.assertTrue(cache.is_empty())
+        self.assertEqual(list(self.path.iterdir()), [])
+
+    def test_disk_tier_keeps_order(self):
+        cache = self.create_cache()
+        self.append(cache, records(0, 55))
+        self.assertEqual(cache.tier, "disk")
+        self.assertEqual(cache.num_records, 55)
+        # Two segments written, 5 records in the segment buffer
+        self.assertEqual(len(list(self.path.glob("*.seg"))), 2)
+        self.assertEqual(cache.pop(15), records(0, 15))
+        cache.commit()
+        # Appended to the disk tier while in use
+        self.append(cache, records(55, 60))
+        self.assertEqual(self.pop_all(cache), records(15, 60))
+        self.assertIsNone(cache.tier)
+        self.assertEqual(list(self.path.iterdir()), [])
+        # Back to the RAM tier
+        self.append(cache, records(60, 61))
+        self.assertEqual(cache.tier, "ram")
+
+    def test_flush_interval(self):
+        cache = self.create_cache()
+        self.append(cache, records(0, 15))
+        cache.process()
+        self.assertEqual(len(list(self.path.glob("*.seg"))), 0)
+        time.sleep(0.2)
+        cache.process()
+        self.assertEqual(len(list(self.path.glob("*.seg"))), 1)
+
+    def test_replay_after_crash(self):
+        cache = self.create_cache()
+        self.append(cache, records(0, 60))
+        cache.pop(25)
+        cache.commit()
+        # Crash: RAM, segment buffer and the partially read segment are not persisted
+        (self.path/"000000000099_1.tmp").write_bytes(b"partial")
+        replayed = self.pop_all(self.create_cache())
+        self.assertEqual(replayed, records(10, 50))
+        self.assertEqual(list(self.path.iterdir()), [])
+
+    def test_close(self):
+        cache = self.create_cache()
+        self.append(cache, records(0, 25))
+        cache.close()
+        cache = self.create_cache()
+        self.assertEqual(cache.num_records, 25)
+        self.assertEqual(cache.pop(12), records(0, 12))
+        cache.commit()
+        self.append(cache, records(25, 30))
+        cache.close()
+        self.assertEqual(self.pop_all(self.create_cache()), records(12, 30))
+
+class TestPriorityTieredCache(unittest.TestCase):
+
+    def test_priority_order(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = PriorityTieredCache(tmp_dir, ram_max_bytes=1000, segment_max_bytes=2000)
+            for idx, record in enumerate(records(0, 60)):
+                cache.append(*record, priority=2 - idx % 3)
+            self.assertEqual(cache.tier, "disk")
+            self.assertEqual(cache.num_records, 60)
+            cache.close()
+            # Replayed after a restart, priority 0 first, the order is kept within a priority
+            cache = PriorityTieredCache(tmp_dir, ram_max_bytes=1000, segment_max_bytes=2000)
+            popped = cache.pop(25)
+            cache.commit()
+            popped += cache.pop(100)
+            cache.commit()
+            self.assertEqual(popped, records(0, 60)[2::3] + records(0, 60)[1::3] + records(0, 60)[0::3])
+            self.assertTrue(cache.is_empty())
+
+class AckingSender(object):
+    """Sender stand-in, acknowledges the records on ack() like the MQTT client of persistmq"""
+    def __init__(self):
+        self.status = {"connected": False, "last_mid": None, "cached_items": 0}
+        self.queued = []
+        self.sent = []
+
+    def publish(self, topic: str, payload: bytes):
+        self.queued.append((topic, payload))
+
+    def ack(self, count: int):
+        self.sent += self.queued[:count]
+        self.queued = self.queued[count:]
+        self.status["last_mid"] = len(self.sent) % 65535 or 65535
+
+    def get_status(self) -> dict:
+        return dict(self.status)
+
+class TestTieredSender(unittest.TestCase):
+
+    def test_direct_and_cached(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sender = AckingSender()
+            tiered_sender = TieredSender(sender.publish, PriorityTieredCache(tmp_dir, ram_max_bytes=1000, segment_max_bytes=2000),
+                                         sender.get_status, drain_count=5)
+            # Not connected: cached
+            tiered_sender.publish(*records(0, 1)[0])
+            self.assertEqual(sender.queued, [])
+            sender.status.update(connected=True)
+            tiered_sender.update()
+            tiered_sender.publish(*records(1, 2)[0])
+            self.assertEqual(sender.queued, records(0, 2))
+            sender.ack(2)
+            # Sender has a backlog of its own: cached
+            sender.status.update(cached_items=5)
+            tiered_sender.update()
+            for record in records(2, 40):
+                tiered_sender.publish(*record)
+            self.assertEqual(sender.queued, [])
+            self.assertEqual(tiered_sender.cache.tier, "disk")
+            # Drained completely within one update, in steps of drain_count
+            sender.status.update(cached_items=0)
+            tiered_sender.update()
+            self.assertTrue(tiered_sender.cache.is_empty())
+            tiered_sender.publish(*records(40, 41)[0])
+            sender.ack(39)
+            self.assertEqual(sender.sent, records(0, 41))
+
+    def test_drain_stops_at_sender_backlog(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sender = AckingSender()
+            sender.status.update(connected=True)
+            get_status = lambda: dict(sender.get_status(), cached_items=len(sender.queued))
+            tiered_sender = TieredSender(sender.publish, PriorityTieredCache(tmp_dir, ram_max_bytes=1000, segment_max_bytes=2000),
+                                         get_status, drain_count=5, max_sender_backlog=10)
+            for record in records(0, 30):
+                tiered_sender.cache.append(*record)
+            tiered_sender.update()
+            # Steps until the backlog of the sender exceeds max_sender_backlog
+            self.assertEqual(sender.queued, records(0, 15))
+            self.assertEqual(tiered_sender.cache.num_records, 15)
+
+    def test_max_in_flight(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sender = AckingSender()
+            sender.status.update(connected=True, last_mid=65530)
+            tiered_sender = TieredSender(sender.publish, PriorityTieredCache(tmp_dir, ram_max_bytes=1000, segment_max_bytes=2000),
+                                         sender.get_status, drain_count=5, max_in_flight=12)
+            sender.sent = [None]*65530
+            tiered_sender.update()
+            for record in records(0, 30):
+                tiered_sender.publish(*record)
+            tiered_sender.update()
+            # Not acknowledged: no further records handed over, also not directly
+            self.assertEqual(sender.queued, records(0, 12))
+            self.assertEqual(tiered_sender.cache.num_records, 18)
+            # Acknowledged across the wrap of the message ids
+            sender.ack(10)
+            tiered_sender.update()
+            self.assertEqual(sender.queued, records(10, 22))
+            sender.ack(12)
+            tiered_sender.update()
+            sender.ack(8)
+            tiered_sender.update()
+            self.assertEqual(sender.sent[65530:], records(0, 30))
+            self.assertTrue(tiered_sender.cache.is_empty())
+            self.assertEqual(tiered_sender.in_flight, 0)
+
+class TestTieredSenderPersistClient(unittest.TestCase):
+
+    def test_nothing_written_to_sender_database(self):
+        received = []
+        broker = MqttBrokerStandIn(on_publish=lambda topic, payload: received.append((topic, payload)))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_client = PersistClient(client_id="tiered-cache-test", cache_path=Path(tmp_dir, "persistmq"))
+            write_client.connect_async(mqtt_host="127.0.0.1", mqtt_port=broker.port)
+            tiered_sender = TieredSender(write_client.publish, PriorityTieredCache(Path(tmp_dir, "segments"), ram_max_bytes=100_000),
+                                         write_client.get_status)
+            # Outage backlog of 3000 records, partly on disk
+            for record in records(0, 3000):
+                tiered_sender.cache.append(*record)
+            self.assertEqual(tiered_sender.cache.tier, "disk")
+            stop_ts = time.monotonic() + 60
+            while len(received) < 3000 and time.monotonic() < stop_ts:
+                tiered_sender.update(timeout=0.5)
+                self.assertEqual(write_client.get_status()["cached_items"], 0)
+            write_client.stop()
+            broker.stop()
+            self.assertEqual(received, records(0, 3000))
+            with sqlite3.connect(Path(tmp_dir, "persistmq", "database.sq3")) as db:
+                self.assertEqual(db.execute("SELECT count(*) FROM messages").fetchone()[0], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from modules.timesync import ClockStatus, TimeQualityMonitor, read_clock_status
+
+class TestTimeSync(unittest.TestCase):
+
+    def test_read_clock_status(self):
+        clock_status = read_clock_status()
+        self.assertIsInstance(clock_status, ClockStatus)
+        self.assertGreaterEqual(clock_status.est_error, 0.0)
+        self.assertGreaterEqual(clock_status.max_error, clock_status.est_error)
+        self.assertIn(clock_status.state, range(6))
+        if not clock_status.synchronized:
+            self.assertFalse(TimeQualityMonitor().time_quality_ok)
+
+    def test_quality_and_steps(self):
+        monitor = TimeQualityMonitor(max_est_error=0.01)
+        self.assertTrue(monitor._quality_ok(ClockStatus(True, 0.0, 0.005, 0.1, 1.5, 0)))
+        self.assertFalse(monitor._quality_ok(ClockStatus(True, 0.0, 0.05, 0.1, 1.5, 0)))
+        self.assertFalse(monitor._quality_ok(ClockStatus(False, 0.0, 0.005, 0.1, 1.5, 5)))
+        self.assertFalse(monitor._quality_ok(None))
+        monitor.poll()
+        self.assertEqual(monitor.step_count, 0)
+        # Offset between system clock and monotonic clock changed by 1 s
+        monitor._last_clock_offset += 1.0
+        monitor.poll()
+        self.assertEqual(monitor.step_count, 1)
+        self.assertAlmostEqual(monitor.last_step, -1.0, places=3)
+
+    def test_background_thread(self):
+        monitor = TimeQualityMonitor(poll_interval=0.01)
+        monitor.start()
+        monitor.stop()
+        self.assertFalse(monitor.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
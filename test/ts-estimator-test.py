@@ -0,0 +1,95 @@
+import unittest
+import sys
+import os
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from modules.tsestimator import PacketTimestampEstimator, ClockOffsetSmoother
+
+def reference_timestamps(arrival_ts: np.ndarray, warmup: int = 10):
+    # Former implementation of daqopen-zmq-server.py
+    ts_agg_window = 51
+    ts_array = np.zeros(ts_agg_window)
+    diff_agg_window = 1000
+    diff_array = np.zeros(diff_agg_window)
+    sent_packet_num = 0
+    result = []
+    for idx, actual_timestamp in enumerate(arrival_ts):
+        ts_array = np.roll(ts_array, -1)
+        ts_array[-1] = actual_timestamp
+        diff_array = np.roll(diff_array, -1)
+        diff_array[-1] = ts_array[-1] - ts_array[-2]
+        if idx >= warmup:
+            packet_ts_diff_mean = diff_array[-sent_packet_num-1:].mean()
+            ts_mean = ts_array[-sent_packet_num-1:].mean()
+            result.append(ts_mean + packet_ts_diff_mean*(0.5*min(sent_packet_num+1, ts_agg_window) - 0.5))
+            sent_packet_num += 1
+    return np.array(result)
+
+def estimator_timestamps(arrival_ts: np.ndarray, warmup: int = 10, method: str = "window_mean"):
+    estimator = PacketTimestampEstimator(ts_window=51, diff_window=1000, method=method)
+    result = []
+    for idx, actual_timestamp in enumerate(arrival_ts):
+        if idx >= warmup:
+            result.append(estimator.update(actual_timestamp))
+        else:
+            estimator.prime(actual_timestamp)
+    return np.array(result)
+
+def generate_arrival_ts(num_packets: int, period: float = 0.05, jitter: float = 0.002):
+    rng = np.random.default_rng(1)
+    ideal_ts = 1_750_000_000.0 + np.arange(num_packets)*period
+    return ideal_ts, ideal_ts + rng.uniform(0, jitter, num_packets)
+
+class TestPacketTimestampEstimator(unittest.TestCase):
+
+    def test_matches_former_implementation(self):
+        _, arrival_ts = generate_arrival_ts(5000)
+        ref_ts = reference_timestamps(arrival_ts)
+        new_ts = estimator_timestamps(arrival_ts)
+        self.assertEqual(ref_ts.shape, new_ts.shape)
+        self.assertLess(np.abs(ref_ts - new_ts).max(), 1e-6)
+
+    def test_linear_fit(self):
+        ideal_ts, arrival_ts = generate_arrival_ts(5000)
+        new_ts = estimator_timestamps(arrival_ts, method="linear_fit")
+        # Arrival jitter is uniform [0, 2 ms], fit must be close to ideal + mean jitter
+        self.assertLess(np.abs(new_ts[100:] - ideal_ts[110:] - 0.001).max(), 0.001)
+
+    def test_jitter_detection(self):
+        estimator = PacketTimestampEstimator()
+        ts = 1000.0
+        estimator.prime(ts)
+        for i in range(200):
+            ts += 0.05
+            estimator.update(ts)
+            self.assertFalse(estimator.jitter_exceeded)
+        ts += 0.15
+        estimator.update(ts)
+        self.assertTrue(estimator.jitter_exceeded)
+
+    def test_clock_step(self):
+        ideal_ts, arrival_ts = generate_arrival_ts(2000)
+        mono_ts = arrival_ts - 1_749_000_000.0
+        clock_offset = np.full(arrival_ts.size, 1_749_000_000.0)
+        clock_offset[1000:] += 0.5 # system clock stepped by 500 ms
+        for max_slew_rate in [0.0, 0.05]:
+            estimator = PacketTimestampEstimator(method="linear_fit")
+            smoother = ClockOffsetSmoother(max_slew_rate=max_slew_rate)
+            result = np.array([estimator.update(mono) + smoother.update(offset, mono) for mono, offset in zip(mono_ts, clock_offset)])
+            error = result - ideal_ts - 0.001
+            self.assertLess(np.abs(error[100:1000]).max(), 0.001)
+            self.assertLess(np.abs(error[-100:] - 0.5).max(), 0.001)
+            # The packet periods are not disturbed by the step
+            self.assertLess(estimator.diff_mean, 0.0501)
+            periods = np.diff(result[900:1100])
+            if max_slew_rate:
+                self.assertLess(periods.max(), 0.05*(1 + max_slew_rate) + 0.001)
+                self.assertAlmostEqual(smoother.pending, 0.0)
+            else:
+                self.assertGreater(periods.max(), 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
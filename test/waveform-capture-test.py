@@ -0,0 +1,102 @@
+import unittest
+import sys
+import os
+import uuid
+import tempfile
+import numpy as np
+from pathlib import Path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from daqopen.channelbuffer import AcqBufferPool
+from daqopen.daqinfo import DaqInfo
+from pqopen.eventdetector import Event
+from modules.binarypayload import decode_payload
+from modules.waveformcapture import WaveformCapture, WaveformWriter
+
+SAMPLERATE = 10000
+PACKET_SIZE = 1000
+DAQ_INFO_CONFIG = {"board": {"type": "duedaq", "samplerate": SAMPLERATE},
+                   "channel": {"U1": {"ai_pin": "A0", "gain": 1.0, "unit": "V"},
+                               "I1": {"ai_pin": "A1", "gain": 1.0, "unit": "A"}}}
+DATA_COLUMNS = {"A0": 0, "A1": 1}
+START_TIMESTAMP_US = 1_750_000_000_000_000
+
+def create_event(start_sidx: int, stop_sidx: int | None = None, event_id: uuid.UUID | None = None, channel: str = "U1_1p_hp_rms") -> Event:
+    return Event(start_ts=START_TIMESTAMP_US/1e6 + start_sidx/SAMPLERATE, stop_ts=None, start_sidx=start_sidx, stop_sidx=stop_sidx,
+                 extrem_value=180.0, channel=channel, type="LEVEL_LOW", id=event_id or uuid.uuid4())
+
+class TestWaveformCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.capture_dir = Path(self.tmp_dir.name, "waveforms")
+        self.published = []
+        self.daq_buffer = AcqBufferPool(DaqInfo.from_dict(DAQ_INFO_CONFIG), DATA_COLUMNS, size=20_000, start_timestamp_us=START_TIMESTAMP_US)
+        self.writer = WaveformWriter(self.capture_dir, publish=self.published.append)
+        self.writer.start()
+        self.capture = WaveformCapture(self.daq_buffer, 20_000, ["U1", "I1"], SAMPLERATE, self.writer, "uuid",
+                                       pre_sec=0.1, post_sec=0.3, max_captures_per_day=2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def put_packets(self, num_packets: int):
+        for _ in range(num_packets):
+            sidx = self.daq_buffer.time.sample_count
+            data = np.zeros((PACKET_SIZE, 2))
+            data[:, 0] = np.arange(sidx, sidx + PACKET_SIZE)
+            data[:, 1] = -data[:, 0]
+            self.daq_buffer.put_data_with_timestamp(data, START_TIMESTAMP_US + (sidx + PACKET_SIZE)*1_000_000//SAMPLERATE)
+
+    def test_capture(self):
+        self.put_packets(5)
+        event_id = uuid.uuid4()
+        self.capture.process([create_event(4500, event_id=event_id)])
+        # Post-trigger samples not available yet
+        self.capture.process([])
+        self.put_packets(3)
+        # Same dip on another phase and the stop of the first event
+        self.capture.process([create_event(4600, channel="U2_1p_hp_rms"), create_event(4500, 7000, event_id=event_id)])
+        self.writer.stop()
+        self.assertEqual(len(self.published), 1)
+        files = list(self.capture_dir.iterdir())
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].name.endswith(f"_LEVEL_LOW_{str(event_id)[:8]}.zcbor"))
+        message = decode_payload(files[0].read_bytes())
+        self.assertEqual(message["type"], "waveform")
+        self.assertEqual(message["samplerate"], SAMPLERATE)
+        self.assertEqual([event["channel"] for event in message["events"]], ["U1_1p_hp_rms", "U2_1p_hp_rms"])
+        self.assertEqual(message["data"]["U1"].tolist(), list(range(3500, 7500)))
+        self.assertEqual(message["data"]["I1"][0], -3500)
+        self.assertEqual(message["timestamps"].size, 4000)
+        self.assertEqual(np.diff(message["timestamps"]).max(), 100)
+
+    def test_budget(self):
+        self.put_packets(20)
+        for start_sidx in [2000, 6000, 10000]:
+            self.capture.process([create_event(start_sidx)])
+        self.assertEqual(self.capture.skipped_events, 1)
+        self.capture.close()
+        self.assertEqual(self.writer.written_captures, 2)
+
+    def test_pre_trigger_overwritten(self):
+        self.put_packets(5)
+        self.capture.process([create_event(4500)])
+        # Buffer of 2 s overwritten meanwhile
+        self.put_packets(20)
+        self.capture.process([])
+        self.writer.stop()
+        message = decode_payload(self.published[0])
+        self.assertEqual(message["data"]["U1"][0], 25000 - 20000 + 1)
+
+    def test_close_with_pending_capture(self):
+        self.put_packets(5)
+        self.capture.process([create_event(4800)])
+        self.capture.close()
+        message = decode_payload(self.published[0])
+        self.assertEqual(message["data"]["U1"].tolist(), list(range(3800, 5000)))
+
+if __name__ == "__main__":
+    unittest.main()